@@ -81,6 +81,13 @@ struct _GabblePluginInterface {
     /**
      * A %NULL-terminated array of strings listing the sidecar D-Bus interfaces
      * implemented by this plugin.
+     *
+     * If the plugin's module has a manifest (libfoo.plugin next to
+     * libfoo.so), Gabble doesn't load the module until something the
+     * manifest lists is needed, so these must also be in its Sidecars key;
+     * likewise, presence statuses, privacy lists and whether it has any
+     * channel managers must be in its PresenceStatuses, PrivacyLists and
+     * ChannelManagers keys.
      */
     const gchar * const *sidecar_interfaces;
 
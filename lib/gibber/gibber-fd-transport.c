@@ -29,6 +29,10 @@
 # include <unistd.h>
 #endif
 
+#ifdef HAVE_SYS_UIO_H
+# include <sys/uio.h>
+#endif
+
 #include "gibber-sockets.h"
 #include "gibber-fd-transport.h"
 
@@ -56,6 +60,11 @@ static void _do_disconnect (GibberFdTransport *self);
 static gboolean gibber_fd_transport_buffer_is_empty (
     GibberTransport *transport);
 
+#ifdef HAVE_SPLICE
+static GibberFdIOResult _forward_in (GibberFdTransport *self, GError **error);
+static void _forward_unlink (GibberFdTransport *self);
+#endif
+
 static void gibber_fd_transport_block_receiving (GibberTransport *transport,
     gboolean block);
 
@@ -72,6 +81,34 @@ gibber_fd_transport_error_quark (void)
   return quark;
 }
 
+/* Read size used unless high-throughput mode is enabled */
+#define BUFSIZE 1024
+
+/* Most chunks we hand to a single writev() */
+#define MAX_IOVECS 64
+
+/* A block of data we couldn't write straight away. The data itself follows
+ * the structure in the same allocation. */
+typedef struct {
+  gsize len;
+  /* how much of it has already been written */
+  gsize offset;
+} OutputChunk;
+
+#define OUTPUT_CHUNK_DATA(chunk) ((guint8 *) ((chunk) + 1))
+
+static OutputChunk *
+output_chunk_new (const guint8 *data,
+    gsize len)
+{
+  OutputChunk *chunk = g_malloc (sizeof (OutputChunk) + len);
+
+  chunk->len = len;
+  chunk->offset = 0;
+  memcpy (OUTPUT_CHUNK_DATA (chunk), data, len);
+  return chunk;
+}
+
 /* private structure */
 typedef struct _GibberFdTransportPrivate GibberFdTransportPrivate;
 
@@ -82,8 +119,27 @@ struct _GibberFdTransportPrivate
   guint watch_in;
   guint watch_out;
   guint watch_err;
-  GString *output_buffer;
+  /* OutputChunk, oldest first */
+  GQueue output_queue;
+  /* unwritten bytes in output_queue */
+  gsize output_len;
   gboolean receiving_blocked;
+
+  gboolean high_throughput;
+  gsize read_size;
+  /* read_buffer_size + 1 bytes, allocated on the first read */
+  guint8 *read_buffer;
+  gsize read_buffer_size;
+
+  /* When set, everything we receive is moved to this transport by the kernel
+   * through forward_pipe, bypassing our handler. We don't hold a ref: the
+   * two transports are unlinked as soon as either is disconnected. */
+  GibberFdTransport *forward_peer;
+  int forward_pipe[2];
+  /* bytes in forward_pipe waiting for forward_peer to be writable */
+  gsize forward_pending;
+  guint forward_watch;
+  guint64 forwarded;
 };
 
 #define GIBBER_FD_TRANSPORT_GET_PRIVATE(o)  \
@@ -97,7 +153,11 @@ gibber_fd_transport_init (GibberFdTransport *self)
   GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
   self->fd = -1;
   priv->channel = NULL;
-  priv->output_buffer = NULL;
+  g_queue_init (&priv->output_queue);
+  priv->output_len = 0;
+  priv->read_size = BUFSIZE;
+  priv->forward_pipe[0] = -1;
+  priv->forward_pipe[1] = -1;
   priv->watch_in = 0;
   priv->watch_out = 0;
   priv->watch_err = 0;
@@ -154,6 +214,11 @@ gibber_fd_transport_dispose (GObject *object)
 void
 gibber_fd_transport_finalize (GObject *object)
 {
+  GibberFdTransport *self = GIBBER_FD_TRANSPORT (object);
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  g_free (priv->read_buffer);
+
   G_OBJECT_CLASS (gibber_fd_transport_parent_class)->finalize (object);
 }
 
@@ -162,6 +227,10 @@ _do_disconnect (GibberFdTransport *self)
 {
   GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
 
+#ifdef HAVE_SPLICE
+  _forward_unlink (self);
+#endif
+
   if (GIBBER_TRANSPORT(self)->state == GIBBER_TRANSPORT_DISCONNECTED)
     {
       return;
@@ -190,11 +259,9 @@ _do_disconnect (GibberFdTransport *self)
     }
   self->fd = -1;
 
-  if (priv->output_buffer)
-    {
-      g_string_free (priv->output_buffer, TRUE);
-      priv->output_buffer = NULL;
-    }
+  g_queue_foreach (&priv->output_queue, (GFunc) g_free, NULL);
+  g_queue_clear (&priv->output_queue);
+  priv->output_len = 0;
 
   if (!priv->dispose_has_run)
     /* If we are disposing we don't care about the state anymore */
@@ -240,8 +307,10 @@ _writeout (GibberFdTransport *self, const guint8 *data, gsize len,
   GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
   gsize written = 0;
 
-  DEBUG ("Writing out %" G_GSIZE_FORMAT " bytes", len);
-  if (priv->output_buffer == NULL || priv->output_buffer->len == 0)
+  if (!priv->high_throughput)
+    DEBUG ("Writing out %" G_GSIZE_FORMAT " bytes", len);
+
+  if (priv->output_len == 0)
     {
       /* We've got nothing buffer yet so try to write out directly */
       if (!_try_write (self, data, len, &written, error))
@@ -256,16 +325,12 @@ _writeout (GibberFdTransport *self, const guint8 *data, gsize len,
       return TRUE;
     }
 
-  if (priv->output_buffer)
-    {
-      g_string_append_len (priv->output_buffer, (gchar *) data + written,
-        len - written);
-    }
-  else
-    {
-      priv->output_buffer = g_string_new_len ((gchar *) data + written,
-          len - written);
-    }
+  /* Queue the rest rather than appending it to one big buffer, so that
+   * writing out the head of a long backlog doesn't mean moving the rest of
+   * it around. */
+  g_queue_push_tail (&priv->output_queue,
+      output_chunk_new (data + written, len - written));
+  priv->output_len += len - written;
 
   if (!priv->watch_out)
     {
@@ -286,7 +351,12 @@ _channel_io_in (GIOChannel *source, GIOCondition condition, gpointer data)
   GError *error = NULL;
   GibberFdTransportClass *cls = GIBBER_FD_TRANSPORT_GET_CLASS(self);
 
-  result = cls->read (self, priv->channel, &error);
+#ifdef HAVE_SPLICE
+  if (priv->forward_peer != NULL)
+    result = _forward_in (self, &error);
+  else
+#endif
+    result = cls->read (self, priv->channel, &error);
 
   switch (result)
     {
@@ -305,27 +375,139 @@ _channel_io_in (GIOChannel *source, GIOCondition condition, gpointer data)
   return TRUE;
 }
 
+/* Drops the first @written bytes of the output queue */
+static void
+_consume_output (GibberFdTransport *self,
+    gsize written)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  g_assert (written <= priv->output_len);
+  priv->output_len -= written;
+
+  while (written > 0)
+    {
+      OutputChunk *chunk = g_queue_peek_head (&priv->output_queue);
+      gsize left = chunk->len - chunk->offset;
+
+      if (written < left)
+        {
+          chunk->offset += written;
+          return;
+        }
+
+      written -= left;
+      g_free (g_queue_pop_head (&priv->output_queue));
+    }
+}
+
+#ifdef HAVE_SYS_UIO_H
+/* Writes out as much of the output queue as the fd will take, handing
+ * several chunks to the kernel at once. Returns FALSE if the transport was
+ * disconnected. */
+static gboolean
+_flush_output_vectored (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  while (priv->output_len > 0)
+    {
+      struct iovec iov[MAX_IOVECS];
+      GList *l;
+      gint n = 0;
+      gsize batch = 0;
+      gssize ret;
+
+      for (l = priv->output_queue.head; l != NULL && n < MAX_IOVECS;
+          l = l->next, n++)
+        {
+          OutputChunk *chunk = l->data;
+
+          iov[n].iov_base = OUTPUT_CHUNK_DATA (chunk) + chunk->offset;
+          iov[n].iov_len = chunk->len - chunk->offset;
+          batch += iov[n].iov_len;
+        }
+
+      ret = writev (self->fd, iov, n);
+
+      if (ret < 0)
+        {
+          GError *error;
+
+          if (errno == EINTR)
+            continue;
+
+          if (errno == EAGAIN || errno == EWOULDBLOCK)
+            return TRUE;
+
+          error = g_error_new_literal (GIBBER_FD_TRANSPORT_ERROR,
+              errno == EPIPE ? GIBBER_FD_TRANSPORT_ERROR_PIPE
+                  : GIBBER_FD_TRANSPORT_ERROR_FAILED,
+              g_strerror (errno));
+          gibber_transport_emit_error (GIBBER_TRANSPORT (self), error);
+          g_error_free (error);
+
+          DEBUG ("Writing data failed, closing the transport");
+          _do_disconnect (self);
+          return FALSE;
+        }
+
+      _consume_output (self, ret);
+
+      /* The fd is full; wait until it isn't. */
+      if ((gsize) ret < batch)
+        return TRUE;
+    }
+
+  return TRUE;
+}
+#endif
+
+/* Returns FALSE if the transport was disconnected. */
+static gboolean
+_flush_output (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+#ifdef HAVE_SYS_UIO_H
+  /* Subclasses which write in their own way get one chunk at a time */
+  if (GIBBER_FD_TRANSPORT_GET_CLASS (self)->write == gibber_fd_transport_write)
+    return _flush_output_vectored (self);
+#endif
+
+  while (priv->output_len > 0)
+    {
+      OutputChunk *chunk = g_queue_peek_head (&priv->output_queue);
+      gsize left = chunk->len - chunk->offset;
+      gsize written = 0;
+
+      if (!_try_write (self, OUTPUT_CHUNK_DATA (chunk) + chunk->offset, left,
+            &written, NULL))
+        return FALSE;
+
+      _consume_output (self, written);
+
+      if (written < left)
+        break;
+    }
+
+  return TRUE;
+}
+
 static gboolean
 _channel_io_out (GIOChannel *source, GIOCondition condition, gpointer data)
 {
   GibberFdTransport *self = GIBBER_FD_TRANSPORT (data);
   GibberFdTransportPrivate *priv =
      GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
-  gsize written;
 
-  g_assert (priv->output_buffer);
-  if (!_try_write (self, (guint8 *) priv->output_buffer->str,
-                   priv->output_buffer->len, &written, NULL))
+  g_assert (priv->output_len > 0);
+  if (!_flush_output (self))
     {
       return FALSE;
     }
 
-  if (written > 0 )
-    {
-      priv->output_buffer = g_string_erase (priv->output_buffer, 0, written);
-    }
-
-  if (priv->output_buffer->len == 0)
+  if (priv->output_len == 0)
     {
       priv->watch_out = 0;
       gibber_transport_emit_buffer_empty (GIBBER_TRANSPORT (self));
@@ -411,24 +593,38 @@ gibber_fd_transport_write (GibberFdTransport *fd_transport,
     g_assert_not_reached ();
 }
 
-#define BUFSIZE 1024
-
 GibberFdIOResult
 gibber_fd_transport_read (GibberFdTransport *transport,
     GIOChannel *channel, GError **error)
 {
-  guint8  buf[BUFSIZE + 1];
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (transport);
+  guint8 *buf;
   GIOStatus status;
   gsize bytes_read;
 
-  status = g_io_channel_read_chars (channel, (gchar *) buf, BUFSIZE,
-    &bytes_read, error);
+  /* The read size may have changed since the last read. Handlers are only
+   * given a pointer into the buffer while it's in use, so it's safe to
+   * replace it here. */
+  if (priv->read_buffer_size != priv->read_size)
+    {
+      g_free (priv->read_buffer);
+      priv->read_buffer = g_malloc (priv->read_size + 1);
+      priv->read_buffer_size = priv->read_size;
+    }
+
+  buf = priv->read_buffer;
+
+  status = g_io_channel_read_chars (channel, (gchar *) buf,
+    priv->read_buffer_size, &bytes_read, error);
 
   switch (status)
     {
       case G_IO_STATUS_NORMAL:
         buf[bytes_read] = '\0';
-        DEBUG ("Received %" G_GSIZE_FORMAT " bytes", bytes_read);
+
+        if (!priv->high_throughput)
+          DEBUG ("Received %" G_GSIZE_FORMAT " bytes", bytes_read);
+
         gibber_transport_received_data (GIBBER_TRANSPORT (transport),
             buf, bytes_read);
         return GIBBER_FD_IO_RESULT_SUCCESS;
@@ -444,6 +640,297 @@ gibber_fd_transport_read (GibberFdTransport *transport,
 }
 
 
+#ifdef HAVE_SPLICE
+
+/* How much we ask the kernel to let each forwarding pipe hold */
+#define FORWARD_PIPE_SIZE (1024 * 1024)
+
+static void
+_pause_receiving (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  if (priv->watch_in != 0)
+    {
+      g_source_remove (priv->watch_in);
+      priv->watch_in = 0;
+    }
+}
+
+static void
+_resume_receiving (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  if (priv->receiving_blocked || priv->watch_in != 0 || priv->channel == NULL)
+    return;
+
+  priv->watch_in =
+    g_io_add_watch (priv->channel, G_IO_IN, _channel_io_in, self);
+}
+
+/* Stops @self forwarding what it receives; it goes to its handler again */
+static void
+_forward_stop (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  if (priv->forward_peer == NULL)
+    return;
+
+  DEBUG ("forwarded %" G_GUINT64_FORMAT " bytes from fd %d; dropping %"
+      G_GSIZE_FORMAT " left in the pipe", priv->forwarded, self->fd,
+      priv->forward_pending);
+
+  if (priv->forward_watch != 0)
+    {
+      g_source_remove (priv->forward_watch);
+      priv->forward_watch = 0;
+    }
+
+  close (priv->forward_pipe[0]);
+  close (priv->forward_pipe[1]);
+  priv->forward_pipe[0] = -1;
+  priv->forward_pipe[1] = -1;
+
+  priv->forward_peer = NULL;
+  priv->forward_pending = 0;
+  priv->forwarded = 0;
+
+  _resume_receiving (self);
+}
+
+static void
+_forward_unlink (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+  GibberFdTransport *peer = priv->forward_peer;
+
+  if (peer == NULL)
+    return;
+
+  _forward_stop (peer);
+  _forward_stop (self);
+}
+
+static gboolean
+_forward_setup (GibberFdTransport *self,
+    GibberFdTransport *peer)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  if (pipe (priv->forward_pipe) != 0)
+    {
+      DEBUG ("couldn't create a pipe: %s", g_strerror (errno));
+      priv->forward_pipe[0] = -1;
+      priv->forward_pipe[1] = -1;
+      return FALSE;
+    }
+
+#ifdef F_SETPIPE_SZ
+  /* If this fails, we just move less at a time */
+  fcntl (priv->forward_pipe[1], F_SETPIPE_SZ, FORWARD_PIPE_SIZE);
+#endif
+
+  priv->forward_peer = peer;
+  priv->forward_pending = 0;
+  priv->forwarded = 0;
+  return TRUE;
+}
+
+static gboolean _forward_out_cb (GIOChannel *source, GIOCondition condition,
+    gpointer data);
+
+/* Moves whatever is in our pipe to our peer, and decides whether we should
+ * read more or wait until the peer can take more */
+static void
+_forward_flush (GibberFdTransport *self)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+  GibberFdTransport *peer = priv->forward_peer;
+
+  while (priv->forward_pending > 0)
+    {
+      gssize n = splice (priv->forward_pipe[0], NULL, peer->fd, NULL,
+          priv->forward_pending, SPLICE_F_MOVE | SPLICE_F_NONBLOCK);
+
+      if (n < 0)
+        {
+          GError *error;
+
+          if (errno == EINTR)
+            continue;
+
+          if (errno == EAGAIN || errno == EWOULDBLOCK)
+            break;
+
+          error = g_error_new_literal (GIBBER_FD_TRANSPORT_ERROR,
+              errno == EPIPE ? GIBBER_FD_TRANSPORT_ERROR_PIPE
+                  : GIBBER_FD_TRANSPORT_ERROR_FAILED,
+              g_strerror (errno));
+          gibber_transport_emit_error (GIBBER_TRANSPORT (peer), error);
+          g_error_free (error);
+
+          DEBUG ("Forwarding data failed, closing the destination");
+          /* this unlinks us from it too */
+          _do_disconnect (peer);
+          return;
+        }
+
+      priv->forward_pending -= n;
+      priv->forwarded += n;
+    }
+
+  if (priv->forward_pending > 0)
+    {
+      GibberFdTransportPrivate *peer_priv =
+          GIBBER_FD_TRANSPORT_GET_PRIVATE (peer);
+
+      _pause_receiving (self);
+
+      if (priv->forward_watch == 0)
+        priv->forward_watch = g_io_add_watch (peer_priv->channel, G_IO_OUT,
+            _forward_out_cb, self);
+    }
+  else
+    {
+      _resume_receiving (self);
+    }
+}
+
+static gboolean
+_forward_out_cb (GIOChannel *source,
+    GIOCondition condition,
+    gpointer data)
+{
+  GibberFdTransport *self = GIBBER_FD_TRANSPORT (data);
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  priv->forward_watch = 0;
+  _forward_flush (self);
+  return FALSE;
+}
+
+static GibberFdIOResult
+_forward_in (GibberFdTransport *self,
+    GError **error)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+  gssize n;
+
+  if (priv->forward_pending > 0)
+    {
+      /* Someone unblocked us while we were waiting for our peer to take
+       * what we read last time */
+      _pause_receiving (self);
+      return GIBBER_FD_IO_RESULT_AGAIN;
+    }
+
+  n = splice (self->fd, NULL, priv->forward_pipe[1], NULL, FORWARD_PIPE_SIZE,
+      SPLICE_F_MOVE | SPLICE_F_NONBLOCK);
+
+  if (n < 0)
+    {
+      if (errno == EINTR || errno == EAGAIN || errno == EWOULDBLOCK)
+        return GIBBER_FD_IO_RESULT_AGAIN;
+
+      g_set_error_literal (error, GIBBER_FD_TRANSPORT_ERROR,
+          GIBBER_FD_TRANSPORT_ERROR_FAILED, g_strerror (errno));
+      return GIBBER_FD_IO_RESULT_ERROR;
+    }
+
+  if (n == 0)
+    return GIBBER_FD_IO_RESULT_EOF;
+
+  priv->forward_pending = n;
+  _forward_flush (self);
+  return GIBBER_FD_IO_RESULT_SUCCESS;
+}
+
+#endif /* HAVE_SPLICE */
+
+/*
+ * gibber_fd_transport_forward:
+ *
+ * Joins @a and @b, two connected transports, so that whatever either of
+ * them receives is written straight to the other by the kernel with
+ * splice(), without being copied to userspace or passed to their handlers.
+ * Data the caller has already read from either of them must have been
+ * passed on first. The transports are unlinked again when either is
+ * disconnected.
+ *
+ * Returns: %TRUE if the transports are now joined; %FALSE if that isn't
+ *  possible (on platforms without splice(), or if either transport still
+ *  has data waiting to be written, for instance), in which case nothing has
+ *  changed.
+ */
+gboolean
+gibber_fd_transport_forward (GibberFdTransport *a,
+    GibberFdTransport *b)
+{
+#ifdef HAVE_SPLICE
+  GibberFdTransportPrivate *a_priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (a);
+  GibberFdTransportPrivate *b_priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (b);
+
+  g_return_val_if_fail (a != b, FALSE);
+
+  if (GIBBER_TRANSPORT (a)->state != GIBBER_TRANSPORT_CONNECTED ||
+      GIBBER_TRANSPORT (b)->state != GIBBER_TRANSPORT_CONNECTED)
+    return FALSE;
+
+  if (a_priv->forward_peer != NULL || b_priv->forward_peer != NULL)
+    return FALSE;
+
+  /* Forwarded data would overtake anything still queued */
+  if (a_priv->output_len > 0 || b_priv->output_len > 0)
+    return FALSE;
+
+  /* Subclasses which write in their own way can't be bypassed */
+  if (GIBBER_FD_TRANSPORT_GET_CLASS (a)->write != gibber_fd_transport_write ||
+      GIBBER_FD_TRANSPORT_GET_CLASS (b)->write != gibber_fd_transport_write)
+    return FALSE;
+
+  if (!_forward_setup (a, b))
+    return FALSE;
+
+  if (!_forward_setup (b, a))
+    {
+      _forward_stop (a);
+      return FALSE;
+    }
+
+  DEBUG ("forwarding between fds %d and %d", a->fd, b->fd);
+  return TRUE;
+#else
+  return FALSE;
+#endif
+}
+
+/*
+ * gibber_fd_transport_set_high_throughput:
+ * @read_size: how much to try to read at once, or 0 for
+ *  GIBBER_FD_TRANSPORT_HIGH_THROUGHPUT_READ_SIZE
+ *
+ * Switches @self to a mode suited to bulk data such as tubes and file
+ * transfers: data is read in large blocks and individual reads and writes
+ * are not logged. May be called at any time, including from the
+ * transport's handler.
+ */
+void
+gibber_fd_transport_set_high_throughput (GibberFdTransport *self,
+    gsize read_size)
+{
+  GibberFdTransportPrivate *priv = GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
+
+  if (read_size == 0)
+    read_size = GIBBER_FD_TRANSPORT_HIGH_THROUGHPUT_READ_SIZE;
+
+  DEBUG ("reading %" G_GSIZE_FORMAT " bytes at a time", read_size);
+
+  priv->high_throughput = TRUE;
+  priv->read_size = read_size;
+}
+
 void
 gibber_fd_transport_set_fd (GibberFdTransport *self, int fd,
     gboolean is_socket)
@@ -554,7 +1041,7 @@ gibber_fd_transport_buffer_is_empty (GibberTransport *transport)
   GibberFdTransportPrivate *priv =
      GIBBER_FD_TRANSPORT_GET_PRIVATE (self);
 
-  return (priv->output_buffer == NULL || priv->output_buffer->len == 0);
+  return priv->output_len == 0;
 }
 
 static void
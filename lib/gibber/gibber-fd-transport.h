@@ -91,6 +91,15 @@ GibberFdIOResult gibber_fd_transport_read (GibberFdTransport *transport,
     GIOChannel *channel,
     GError **error);
 
+/* Default read size for gibber_fd_transport_set_high_throughput() */
+#define GIBBER_FD_TRANSPORT_HIGH_THROUGHPUT_READ_SIZE (64 * 1024)
+
+void gibber_fd_transport_set_high_throughput (GibberFdTransport *self,
+    gsize read_size);
+
+gboolean gibber_fd_transport_forward (GibberFdTransport *a,
+    GibberFdTransport *b);
+
 G_END_DECLS
 
 #endif /* #ifndef __GIBBER_FD_TRANSPORT_H__*/
@@ -29,12 +29,17 @@ static void plugin_iface_init (
 #define IFACE_TEST_PROPS IFACE_TEST ".Props"
 #define IFACE_TEST_BUGGY IFACE_TEST ".Buggy"
 #define IFACE_TEST_IQ IFACE_TEST ".IQ"
+#define IFACE_TEST_SLOW IFACE_TEST ".Slow"
+
+/* How long the .Slow sidecar blocks the main loop for */
+#define SLOW_SIDECAR_DELAY_MS 1000
 
 static const gchar * const sidecar_interfaces[] = {
     IFACE_TEST,
     IFACE_TEST_PROPS,
     IFACE_TEST_BUGGY,
     IFACE_TEST_IQ,
+    IFACE_TEST_SLOW,
     NULL
 };
 
@@ -80,6 +85,21 @@ sidecar_iq_created_cb (
   g_object_unref (result);
 }
 
+static gboolean
+slow_sidecar_cb (gpointer user_data)
+{
+  GSimpleAsyncResult *result = user_data;
+
+  /* Hog the main loop, so the tests can see Gabble's watchdog notice. */
+  g_usleep (SLOW_SIDECAR_DELAY_MS * 1000);
+
+  g_simple_async_result_set_error (result, TP_ERROR,
+      TP_ERROR_NOT_IMPLEMENTED, "'%s' took too long", IFACE_TEST_SLOW);
+  g_simple_async_result_complete (result);
+  g_object_unref (result);
+  return FALSE;
+}
+
 static void
 test_plugin_create_sidecar_async (
     GabblePlugin *plugin,
@@ -110,6 +130,16 @@ test_plugin_create_sidecar_async (
           "plugin-connection", plugin_connection, NULL);
       return;
     }
+  else if (!tp_strdiff (sidecar_interface, IFACE_TEST_SLOW))
+    {
+      GSource *source = g_idle_source_new ();
+
+      g_source_set_name (source, "test-plugin-slow-sidecar");
+      g_source_set_callback (source, slow_sidecar_cb, result, NULL);
+      g_source_attach (source, NULL);
+      g_source_unref (source);
+      return;
+    }
   else
     {
       /* This deliberately doesn't check for IFACE_TEST_BUGGY, to test Gabble's
@@ -356,12 +356,18 @@ gabble_ensure_handle_from_vcard_address (TpHandleRepoIface *repo,
 gchar **
 gabble_uris_for_handle (TpHandleRepoIface *contact_repo,
     TpHandle contact)
+{
+  return gabble_uris_for_jid (tp_handle_inspect (contact_repo, contact));
+}
+
+gchar **
+gabble_uris_for_jid (const gchar *jid)
 {
   GPtrArray *uris = g_ptr_array_new ();
 
   for (const gchar * const *scheme = addressable_uri_schemes; *scheme != NULL; scheme++)
     {
-      gchar *uri = gabble_uri_for_handle (contact_repo, *scheme, contact);
+      gchar *uri = gabble_jid_to_uri (*scheme, jid, NULL);
 
       if (uri != NULL)
         {
@@ -376,13 +382,20 @@ gabble_uris_for_handle (TpHandleRepoIface *contact_repo,
 GHashTable *
 gabble_vcard_addresses_for_handle (TpHandleRepoIface *contact_repo,
     TpHandle contact)
+{
+  return gabble_vcard_addresses_for_jid (
+      tp_handle_inspect (contact_repo, contact));
+}
+
+GHashTable *
+gabble_vcard_addresses_for_jid (const gchar *jid)
 {
   GHashTable *addresses = g_hash_table_new_full (g_str_hash, g_str_equal,
       NULL, (GDestroyNotify) g_free);
 
   for (const gchar * const *field = addressable_vcard_fields; *field != NULL; field++)
     {
-      gchar *vcard_address = gabble_vcard_address_for_handle (contact_repo, *field, contact);
+      gchar *vcard_address = gabble_jid_to_vcard_address (*field, jid, NULL);
 
       if (vcard_address != NULL)
         {
@@ -59,6 +59,10 @@ gchar **gabble_uris_for_handle (TpHandleRepoIface *contact_repo,
 GHashTable *gabble_vcard_addresses_for_handle (TpHandleRepoIface *contact_repo,
     TpHandle contact);
 
+gchar **gabble_uris_for_jid (const gchar *jid);
+
+GHashTable *gabble_vcard_addresses_for_jid (const gchar *jid);
+
 gchar *gabble_uri_for_handle (TpHandleRepoIface *contact_repo,
     const gchar *uri_scheme,
     TpHandle contact);
@@ -315,6 +315,9 @@ gabble_auth_manager_start_auth_async (WockyAuthRegistry *registry,
    * auth request outstanding */
   g_assert (self->priv->channel == NULL);
 
+  /* Everything up to here was TCP, TLS and stream negotiation */
+  gabble_connection_mark_phase (self->priv->conn, "sasl-started");
+
   if (password == NULL || username == NULL)
     {
       GPtrArray *mech_array = g_ptr_array_new ();
@@ -553,6 +556,8 @@ gabble_auth_manager_success_async (WockyAuthRegistry *registry,
   GSimpleAsyncResult *result = g_simple_async_result_new (G_OBJECT (self),
       callback, user_data, gabble_auth_manager_success_async);
 
+  gabble_connection_mark_phase (self->priv->conn, "sasl-succeeded");
+
   /* Annoyingly, in the X-TELEPATHY-PASSWORD case we actually want to both
    * chain up to the parent class, *and* pass the success notification out to
    * the client for consistency with other mechanisms.
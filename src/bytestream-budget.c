@@ -0,0 +1,438 @@
+/*
+ * bytestream-budget.c - Source for the connection-wide bytestream budget
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+
+#include "config.h"
+#include "bytestream-budget.h"
+
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_BYTESTREAM
+
+#include "debug.h"
+
+/* Streams waiting for room are woken once the connection's buffers have
+ * drained down to this */
+#define LOW_WATER (GABBLE_BYTESTREAM_BUDGET_MAX_BUFFERED / 2)
+
+typedef struct {
+  gpointer stream;
+  gchar *name;
+  GabbleBytestreamBudgetWakeFunc wake;
+
+  gsize buffered;
+  guint in_flight;
+  /* credits handed to this stream while it was waiting, which it hasn't
+   * used yet; they're already counted in the budget's in_flight */
+  guint granted;
+
+  gboolean waiting_credit;
+  gboolean waiting_room;
+  gboolean to_wake;
+} Account;
+
+struct _GabbleBytestreamBudget
+{
+  guint ref_count;
+
+  /* stream (borrowed) → owned Account */
+  GHashTable *accounts;
+
+  gsize buffered;
+  guint in_flight;
+
+  /* Accounts (borrowed), in the order they will get a credit */
+  GQueue credit_waiters;
+  /* Accounts (borrowed) which will be woken once there's room again */
+  GQueue room_waiters;
+  /* Accounts (borrowed) which will be woken next time we're idle */
+  GQueue to_wake;
+  guint wake_id;
+};
+
+static void
+account_free (gpointer data)
+{
+  Account *account = data;
+
+  g_free (account->name);
+  g_slice_free (Account, account);
+}
+
+GabbleBytestreamBudget *
+gabble_bytestream_budget_new (void)
+{
+  GabbleBytestreamBudget *self = g_slice_new0 (GabbleBytestreamBudget);
+
+  self->ref_count = 1;
+  self->accounts = g_hash_table_new_full (NULL, NULL, NULL, account_free);
+  g_queue_init (&self->credit_waiters);
+  g_queue_init (&self->room_waiters);
+  g_queue_init (&self->to_wake);
+
+  return self;
+}
+
+GabbleBytestreamBudget *
+gabble_bytestream_budget_ref (GabbleBytestreamBudget *self)
+{
+  self->ref_count++;
+  return self;
+}
+
+void
+gabble_bytestream_budget_unref (GabbleBytestreamBudget *self)
+{
+  if (--self->ref_count > 0)
+    return;
+
+  if (self->wake_id != 0)
+    g_source_remove (self->wake_id);
+
+  g_queue_clear (&self->credit_waiters);
+  g_queue_clear (&self->room_waiters);
+  g_queue_clear (&self->to_wake);
+  g_hash_table_unref (self->accounts);
+  g_slice_free (GabbleBytestreamBudget, self);
+}
+
+static Account *
+lookup_account (GabbleBytestreamBudget *self,
+    gpointer stream)
+{
+  Account *account = g_hash_table_lookup (self->accounts, stream);
+
+  g_return_val_if_fail (account != NULL, NULL);
+  return account;
+}
+
+static void schedule_wake (GabbleBytestreamBudget *self, Account *account);
+
+/* Hands out returned credits to the streams which have been waiting longest,
+ * one each, so that a busy stream can't starve the others. */
+static void
+dispatch_credits (GabbleBytestreamBudget *self)
+{
+  while (self->in_flight < GABBLE_BYTESTREAM_BUDGET_MAX_IN_FLIGHT &&
+      !g_queue_is_empty (&self->credit_waiters))
+    {
+      Account *account = g_queue_pop_head (&self->credit_waiters);
+
+      account->waiting_credit = FALSE;
+      account->granted++;
+      self->in_flight++;
+      schedule_wake (self, account);
+    }
+}
+
+static gboolean
+wake_cb (gpointer user_data)
+{
+  GabbleBytestreamBudget *self = user_data;
+  Account *account;
+
+  self->wake_id = 0;
+
+  while ((account = g_queue_pop_head (&self->to_wake)) != NULL)
+    {
+      gpointer stream = account->stream;
+
+      account->to_wake = FALSE;
+
+      if (account->wake != NULL)
+        account->wake (stream);
+
+      /* The stream may have gone away while it was being woken */
+      account = g_hash_table_lookup (self->accounts, stream);
+
+      if (account != NULL && account->granted > 0)
+        {
+          /* it had nothing to send after all */
+          self->in_flight -= account->granted;
+          account->granted = 0;
+          dispatch_credits (self);
+        }
+    }
+
+  return FALSE;
+}
+
+static void
+schedule_wake (GabbleBytestreamBudget *self,
+    Account *account)
+{
+  if (!account->to_wake)
+    {
+      account->to_wake = TRUE;
+      g_queue_push_tail (&self->to_wake, account);
+    }
+
+  /* Streams are woken from an idle so they can't be re-entered from the
+   * middle of another stream's code. */
+  if (self->wake_id == 0)
+    self->wake_id = g_idle_add (wake_cb, self);
+}
+
+/*
+ * gabble_bytestream_budget_add_stream:
+ * @stream: a bytestream
+ * @name: how to refer to @stream in debug messages
+ * @wake: (allow-none): called on @stream when it may try to take a credit
+ *  or buffer data again, having been refused
+ *
+ * Starts accounting for @stream, which must be removed with
+ * gabble_bytestream_budget_remove_stream() before it is disposed.
+ */
+void
+gabble_bytestream_budget_add_stream (GabbleBytestreamBudget *self,
+    gpointer stream,
+    const gchar *name,
+    GabbleBytestreamBudgetWakeFunc wake)
+{
+  Account *account;
+
+  g_return_if_fail (g_hash_table_lookup (self->accounts, stream) == NULL);
+
+  account = g_slice_new0 (Account);
+  account->stream = stream;
+  account->name = g_strdup (name);
+  account->wake = wake;
+  g_hash_table_insert (self->accounts, stream, account);
+}
+
+/*
+ * gabble_bytestream_budget_remove_stream:
+ *
+ * Forgets about @stream, giving back any credits it held and releasing
+ * whatever it had buffered.
+ */
+void
+gabble_bytestream_budget_remove_stream (GabbleBytestreamBudget *self,
+    gpointer stream)
+{
+  Account *account = g_hash_table_lookup (self->accounts, stream);
+
+  if (account == NULL)
+    return;
+
+  g_queue_remove (&self->credit_waiters, account);
+  g_queue_remove (&self->room_waiters, account);
+  g_queue_remove (&self->to_wake, account);
+
+  self->in_flight -= account->in_flight + account->granted;
+  self->buffered -= account->buffered;
+
+  if (account->buffered > 0)
+    DEBUG ("%s: gone; %" G_GSIZE_FORMAT " bytes buffered by the connection",
+        account->name, self->buffered);
+
+  g_hash_table_remove (self->accounts, stream);
+
+  dispatch_credits (self);
+}
+
+/*
+ * gabble_bytestream_budget_take_credit:
+ *
+ * Returns: %TRUE if @stream may send one more stanza which the peer has to
+ *  acknowledge, in which case it must call
+ *  gabble_bytestream_budget_return_credit() once it has been; or %FALSE if it
+ *  must wait until it is woken up.
+ */
+gboolean
+gabble_bytestream_budget_take_credit (GabbleBytestreamBudget *self,
+    gpointer stream)
+{
+  Account *account = lookup_account (self, stream);
+
+  g_return_val_if_fail (account != NULL, FALSE);
+
+  if (account->granted > 0)
+    {
+      account->granted--;
+      account->in_flight++;
+      return TRUE;
+    }
+
+  /* If anyone else is already waiting, they go first. */
+  if (self->in_flight < GABBLE_BYTESTREAM_BUDGET_MAX_IN_FLIGHT &&
+      g_queue_is_empty (&self->credit_waiters))
+    {
+      account->in_flight++;
+      self->in_flight++;
+      return TRUE;
+    }
+
+  if (!account->waiting_credit)
+    {
+      account->waiting_credit = TRUE;
+      g_queue_push_tail (&self->credit_waiters, account);
+    }
+
+  return FALSE;
+}
+
+void
+gabble_bytestream_budget_return_credit (GabbleBytestreamBudget *self,
+    gpointer stream)
+{
+  Account *account = lookup_account (self, stream);
+
+  g_return_if_fail (account != NULL);
+  g_return_if_fail (account->in_flight > 0);
+
+  account->in_flight--;
+  self->in_flight--;
+  dispatch_credits (self);
+}
+
+/*
+ * gabble_bytestream_budget_may_buffer:
+ *
+ * Returns: %TRUE if @stream may buffer another @len bytes without taking
+ *  the connection over its budget. Once the connection is more than half
+ *  full, streams already holding more than their fair share of the budget
+ *  are refused, so that the rest is kept for the others.
+ */
+gboolean
+gabble_bytestream_budget_may_buffer (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len)
+{
+  Account *account = lookup_account (self, stream);
+  gsize share;
+
+  g_return_val_if_fail (account != NULL, FALSE);
+
+  if (self->buffered + len > GABBLE_BYTESTREAM_BUDGET_MAX_BUFFERED)
+    return FALSE;
+
+  if (self->buffered + len <= LOW_WATER)
+    return TRUE;
+
+  share = GABBLE_BYTESTREAM_BUDGET_MAX_BUFFERED /
+      g_hash_table_size (self->accounts);
+  return account->buffered + len <= share;
+}
+
+void
+gabble_bytestream_budget_add_buffered (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len)
+{
+  Account *account = lookup_account (self, stream);
+
+  g_return_if_fail (account != NULL);
+
+  if (len == 0)
+    return;
+
+  account->buffered += len;
+  self->buffered += len;
+
+  DEBUG ("%s: %" G_GSIZE_FORMAT " bytes buffered; %" G_GSIZE_FORMAT
+      " bytes buffered by the connection", account->name, account->buffered,
+      self->buffered);
+}
+
+void
+gabble_bytestream_budget_remove_buffered (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len)
+{
+  Account *account = lookup_account (self, stream);
+
+  g_return_if_fail (account != NULL);
+  g_return_if_fail (account->buffered >= len);
+
+  if (len == 0)
+    return;
+
+  account->buffered -= len;
+  self->buffered -= len;
+
+  DEBUG ("%s: %" G_GSIZE_FORMAT " bytes buffered; %" G_GSIZE_FORMAT
+      " bytes buffered by the connection", account->name, account->buffered,
+      self->buffered);
+
+  if (self->buffered <= LOW_WATER)
+    {
+      while ((account = g_queue_pop_head (&self->room_waiters)) != NULL)
+        {
+          account->waiting_room = FALSE;
+          schedule_wake (self, account);
+        }
+    }
+}
+
+/*
+ * gabble_bytestream_budget_wait_for_room:
+ *
+ * Returns: %TRUE if the connection is over its budget, in which case @stream
+ *  should stop producing data until it is woken up; %FALSE if it may carry
+ *  on.
+ */
+gboolean
+gabble_bytestream_budget_wait_for_room (GabbleBytestreamBudget *self,
+    gpointer stream)
+{
+  Account *account = lookup_account (self, stream);
+
+  g_return_val_if_fail (account != NULL, FALSE);
+
+  if (self->buffered <= GABBLE_BYTESTREAM_BUDGET_MAX_BUFFERED)
+    return FALSE;
+
+  if (!account->waiting_room)
+    {
+      account->waiting_room = TRUE;
+      g_queue_push_tail (&self->room_waiters, account);
+    }
+
+  return TRUE;
+}
+
+/*
+ * gabble_bytestream_budget_dup_usage:
+ *
+ * Returns: how much of the budget each stream is using, as a
+ *  GABBLE_ARRAY_TYPE_BYTESTREAM_USAGE_LIST
+ */
+GPtrArray *
+gabble_bytestream_budget_dup_usage (GabbleBytestreamBudget *self)
+{
+  GPtrArray *ret = g_ptr_array_new ();
+  GHashTableIter iter;
+  gpointer value;
+
+  g_hash_table_iter_init (&iter, self->accounts);
+
+  while (g_hash_table_iter_next (&iter, NULL, &value))
+    {
+      Account *account = value;
+
+      g_ptr_array_add (ret, tp_value_array_build (3,
+          G_TYPE_STRING, account->name,
+          G_TYPE_UINT64, (guint64) account->buffered,
+          G_TYPE_UINT, account->in_flight,
+          G_TYPE_INVALID));
+    }
+
+  return ret;
+}
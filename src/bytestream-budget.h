@@ -0,0 +1,75 @@
+/*
+ * bytestream-budget.h - Header for the connection-wide bytestream budget
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+
+#ifndef GABBLE_BYTESTREAM_BUDGET_H
+#define GABBLE_BYTESTREAM_BUDGET_H
+
+#include <glib.h>
+
+G_BEGIN_DECLS
+
+/* How many in-band stanzas all the connection's bytestreams together may
+ * have awaiting acknowledgement */
+#define GABBLE_BYTESTREAM_BUDGET_MAX_IN_FLIGHT 32
+
+/* How many bytes all the connection's bytestreams together may hold in
+ * their buffers */
+#define GABBLE_BYTESTREAM_BUDGET_MAX_BUFFERED (4 * 1024 * 1024)
+
+typedef struct _GabbleBytestreamBudget GabbleBytestreamBudget;
+
+/* Called when a stream which had to wait for a credit, or for room in the
+ * budget, may try again */
+typedef void (* GabbleBytestreamBudgetWakeFunc) (gpointer stream);
+
+GabbleBytestreamBudget *gabble_bytestream_budget_new (void);
+GabbleBytestreamBudget *gabble_bytestream_budget_ref (
+    GabbleBytestreamBudget *self);
+void gabble_bytestream_budget_unref (GabbleBytestreamBudget *self);
+
+void gabble_bytestream_budget_add_stream (GabbleBytestreamBudget *self,
+    gpointer stream,
+    const gchar *name,
+    GabbleBytestreamBudgetWakeFunc wake);
+void gabble_bytestream_budget_remove_stream (GabbleBytestreamBudget *self,
+    gpointer stream);
+
+gboolean gabble_bytestream_budget_take_credit (GabbleBytestreamBudget *self,
+    gpointer stream);
+void gabble_bytestream_budget_return_credit (GabbleBytestreamBudget *self,
+    gpointer stream);
+
+gboolean gabble_bytestream_budget_may_buffer (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len);
+void gabble_bytestream_budget_add_buffered (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len);
+void gabble_bytestream_budget_remove_buffered (GabbleBytestreamBudget *self,
+    gpointer stream,
+    gsize len);
+gboolean gabble_bytestream_budget_wait_for_room (GabbleBytestreamBudget *self,
+    gpointer stream);
+
+GPtrArray *gabble_bytestream_budget_dup_usage (GabbleBytestreamBudget *self);
+
+G_END_DECLS
+
+#endif /* GABBLE_BYTESTREAM_BUDGET_H */
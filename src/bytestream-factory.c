@@ -43,6 +43,7 @@
 #include "namespaces.h"
 #include "presence-cache.h"
 #include "private-tubes-factory.h"
+#include "proxy-store.h"
 #include "util.h"
 
 G_DEFINE_TYPE (GabbleBytestreamFactory, gabble_bytestream_factory,
@@ -181,6 +182,13 @@ struct _GabbleBytestreamFactoryPrivate
   /* Time stamp of the proxies list received from TELEPATHY_PROXIES_SERVICE */
   GTimeVal proxies_list_stamp;
 
+  /* What we learnt about proxies on previous connections, and what we're
+   * learning now; only exists while we're connected */
+  GabbleProxyStore *proxy_store;
+
+  /* Shared by the in-band bytestreams (and D-Bus tubes) on the connection */
+  GabbleBytestreamBudget *budget;
+
   gboolean dispose_has_run;
 };
 
@@ -232,6 +240,8 @@ gabble_bytestream_factory_init (GabbleBytestreamFactory *self)
       bytestream_id_equal, bytestream_id_free, g_object_unref);
 
   memset (&priv->proxies_list_stamp, 0, sizeof (GTimeVal));
+
+  priv->budget = gabble_bytestream_budget_new ();
 }
 
 static gint
@@ -272,6 +282,7 @@ add_proxy_to_list (GabbleBytestreamFactory *self,
           fallback ? "Fallback": "Discovered",
           proxy->jid, proxy->host, proxy->port);
 
+      gabble_socks5_proxy_free (found->data);
       *list = g_slist_delete_link (*list, found);
     }
   else
@@ -415,13 +426,12 @@ query_proxies (GabbleBytestreamFactory *self,
 {
   GabbleBytestreamFactoryPrivate *priv = GABBLE_BYTESTREAM_FACTORY_GET_PRIVATE (
       self);
-  guint i;
+  guint i, len;
 
-  /* We don't want to query more than once the same proxy */
-  nb_proxies_needed = MIN (nb_proxies_needed,
-      g_slist_length (priv->socks5_potential_proxies));
+  len = g_slist_length (priv->socks5_potential_proxies);
 
-  for (i = 0; i < nb_proxies_needed; i++)
+  /* We don't want to query more than once the same proxy */
+  for (i = 0; i < len && nb_proxies_needed > 0; i++)
     {
       gchar *jid;
 
@@ -429,9 +439,19 @@ query_proxies (GabbleBytestreamFactory *self,
         priv->next_query = priv->socks5_potential_proxies;
 
       jid = priv->next_query->data;
-      send_proxy_query (self, jid, TRUE);
-
       priv->next_query = g_slist_next (priv->next_query);
+
+      /* We used this one recently, so we already know where it is */
+      if (priv->proxy_store != NULL &&
+          gabble_proxy_store_is_fresh (priv->proxy_store, jid,
+            PROXIES_LIST_LIFE_TIME))
+        {
+          DEBUG ("%s is in our cache; not querying it", jid);
+          continue;
+        }
+
+      send_proxy_query (self, jid, TRUE);
+      nb_proxies_needed--;
     }
 }
 
@@ -482,6 +502,11 @@ proxies_disco_cb (GabbleDisco *disco,
   priv->socks5_potential_proxies = randomize_g_slist (new_list);
   priv->next_query = priv->socks5_potential_proxies;
 
+  /* so we don't have to ask again next time we connect */
+  if (priv->proxy_store != NULL)
+    gabble_proxy_store_set_list (priv->proxy_store,
+        priv->socks5_potential_proxies, priv->proxies_list_stamp.tv_sec);
+
   gabble_bytestream_factory_query_socks5_proxies (self);
 }
 
@@ -607,6 +632,49 @@ porter_available_cb (
       NULL);
 }
 
+static void
+add_stored_proxy (const gchar *jid,
+    const gchar *host,
+    guint16 port,
+    gboolean fallback,
+    gpointer user_data)
+{
+  GabbleBytestreamFactory *self = user_data;
+
+  add_proxy_to_list (self, gabble_socks5_proxy_new (jid, host, port),
+      fallback);
+}
+
+static void
+load_stored_proxies (GabbleBytestreamFactory *self)
+{
+  GabbleBytestreamFactoryPrivate *priv = GABBLE_BYTESTREAM_FACTORY_GET_PRIVATE (
+      self);
+
+  priv->proxy_store = gabble_proxy_store_new (
+      conn_util_get_bare_self_jid (priv->conn));
+
+  /* Proxies we have used recently can be offered straight away, without
+   * waiting to discover and query them again */
+  gabble_proxy_store_foreach (priv->proxy_store, PROXIES_LIST_LIFE_TIME,
+      add_stored_proxy, self);
+
+  if (priv->socks5_potential_proxies == NULL)
+    {
+      gint64 stamp;
+
+      priv->socks5_potential_proxies = gabble_proxy_store_dup_list (
+          priv->proxy_store, PROXIES_LIST_LIFE_TIME, &stamp);
+
+      if (priv->socks5_potential_proxies != NULL)
+        {
+          DEBUG ("Using the proxies list we got from %s last time",
+              TELEPATHY_PROXIES_SERVICE);
+          priv->proxies_list_stamp.tv_sec = stamp;
+        }
+    }
+}
+
 static void
 conn_status_changed_cb (GabbleConnection *conn,
                         TpConnectionStatus status,
@@ -632,6 +700,8 @@ conn_status_changed_cb (GabbleConnection *conn,
               priv->socks5_potential_proxies, g_strdup (jids[i]));
         }
 
+      load_stored_proxies (self);
+
       /* randomize the list to not always use the same proxies */
       priv->socks5_potential_proxies = randomize_g_slist (
               priv->socks5_potential_proxies);
@@ -640,6 +710,10 @@ conn_status_changed_cb (GabbleConnection *conn,
 
       g_strfreev (jids);
     }
+  else if (status == TP_CONNECTION_STATUS_DISCONNECTED)
+    {
+      tp_clear_pointer (&priv->proxy_store, gabble_proxy_store_free);
+    }
 }
 
 static GObject *
@@ -723,6 +797,9 @@ gabble_bytestream_factory_dispose (GObject *object)
   g_slist_free (priv->socks5_potential_proxies);
   priv->socks5_potential_proxies = NULL;
 
+  tp_clear_pointer (&priv->budget, gabble_bytestream_budget_unref);
+  tp_clear_pointer (&priv->proxy_store, gabble_proxy_store_free);
+
   if (G_OBJECT_CLASS (gabble_bytestream_factory_parent_class)->dispose)
     G_OBJECT_CLASS (gabble_bytestream_factory_parent_class)->dispose (object);
 }
@@ -2255,12 +2332,128 @@ gabble_bytestream_factory_make_multi_accept_iq (const gchar *full_jid,
   return msg;
 }
 
+static gint
+cmp_proxy_cost (gconstpointer a,
+    gconstpointer b,
+    gpointer user_data)
+{
+  GabbleProxyStore *store = user_data;
+  gdouble cost_a = gabble_proxy_store_get_cost (store,
+      ((GabbleSocks5Proxy *) a)->jid);
+  gdouble cost_b = gabble_proxy_store_get_cost (store,
+      ((GabbleSocks5Proxy *) b)->jid);
+
+  if (cost_a < cost_b)
+    return -1;
+  else if (cost_a > cost_b)
+    return 1;
+  else
+    return 0;
+}
+
+/*
+ * gabble_bytestream_factory_get_socks5_proxies:
+ *
+ * Returns: (transfer container): the proxies we know about, those we expect
+ *  to get through to soonest first
+ */
 GSList *
 gabble_bytestream_factory_get_socks5_proxies (GabbleBytestreamFactory *self)
 {
   GabbleBytestreamFactoryPrivate *priv = GABBLE_BYTESTREAM_FACTORY_GET_PRIVATE (
       self);
+  GSList *proxies;
 
-  return g_slist_concat (g_slist_copy (priv->socks5_proxies),
+  proxies = g_slist_concat (g_slist_copy (priv->socks5_proxies),
       g_slist_copy (priv->socks5_fallback_proxies));
+
+  /* The sort is stable, so proxies we know nothing about stay in the order
+   * we found them */
+  if (priv->proxy_store != NULL)
+    proxies = g_slist_sort_with_data (proxies, cmp_proxy_cost,
+        priv->proxy_store);
+
+  return proxies;
+}
+
+static void
+record_proxy (GabbleBytestreamFactory *self,
+    const gchar *jid,
+    gboolean connected,
+    gint64 latency)
+{
+  GabbleBytestreamFactoryPrivate *priv = GABBLE_BYTESTREAM_FACTORY_GET_PRIVATE (
+      self);
+  GabbleSocks5Proxy key = { NULL, NULL, 0 };
+  GabbleSocks5Proxy *proxy;
+  GSList *found;
+  gboolean fallback = FALSE;
+
+  if (priv->proxy_store == NULL)
+    return;
+
+  key.jid = (gchar *) jid;
+
+  found = g_slist_find_custom (priv->socks5_proxies, &key, cmp_proxy);
+
+  if (found == NULL)
+    {
+      found = g_slist_find_custom (priv->socks5_fallback_proxies, &key,
+          cmp_proxy);
+      fallback = TRUE;
+    }
+
+  /* Streamhosts offered to us by other people aren't our business */
+  if (found == NULL)
+    return;
+
+  proxy = found->data;
+  gabble_proxy_store_record (priv->proxy_store, proxy->jid, proxy->host,
+      proxy->port, fallback, connected, latency);
+}
+
+/*
+ * gabble_bytestream_factory_socks5_proxy_connected:
+ * @jid: the JID of a streamhost
+ * @latency: how long (in microseconds) it took to get through the SOCKS5
+ *  handshake with it
+ *
+ * If @jid is one of our proxies, records that it worked, so it will be
+ * preferred in future (including on future connections).
+ */
+void
+gabble_bytestream_factory_socks5_proxy_connected (
+    GabbleBytestreamFactory *self,
+    const gchar *jid,
+    gint64 latency)
+{
+  record_proxy (self, jid, TRUE, latency);
+}
+
+/*
+ * gabble_bytestream_factory_socks5_proxy_failed:
+ * @jid: the JID of a streamhost
+ *
+ * If @jid is one of our proxies, records that we couldn't use it.
+ */
+void
+gabble_bytestream_factory_socks5_proxy_failed (GabbleBytestreamFactory *self,
+    const gchar *jid)
+{
+  record_proxy (self, jid, FALSE, 0);
+}
+
+/*
+ * gabble_bytestream_factory_get_budget:
+ *
+ * Returns: (transfer none): the budget shared by the connection's in-band
+ *  bytestreams
+ */
+GabbleBytestreamBudget *
+gabble_bytestream_factory_get_budget (GabbleBytestreamFactory *self)
+{
+  GabbleBytestreamFactoryPrivate *priv = GABBLE_BYTESTREAM_FACTORY_GET_PRIVATE (
+      self);
+
+  return priv->budget;
 }
@@ -23,6 +23,7 @@
 #include <glib-object.h>
 #include <telepathy-glib/telepathy-glib.h>
 #include "types.h"
+#include "bytestream-budget.h"
 #include "bytestream-iface.h"
 #include "bytestream-ibb.h"
 #include "bytestream-muc.h"
@@ -110,6 +111,14 @@ GSList *gabble_bytestream_factory_get_socks5_proxies (
 void gabble_bytestream_factory_query_socks5_proxies (
     GabbleBytestreamFactory *self);
 
+void gabble_bytestream_factory_socks5_proxy_connected (
+    GabbleBytestreamFactory *self, const gchar *jid, gint64 latency);
+void gabble_bytestream_factory_socks5_proxy_failed (
+    GabbleBytestreamFactory *self, const gchar *jid);
+
+GabbleBytestreamBudget *gabble_bytestream_factory_get_budget (
+    GabbleBytestreamFactory *self);
+
 G_END_DECLS
 
 #endif /* #ifndef __BYTESTREAM_FACTORY_H__ */
@@ -97,6 +97,10 @@ struct _GabbleBytestreamIBBPrivate
   GString *write_buffer;
   gboolean write_blocked;
 
+  /* shared with the connection's other bytestreams; limits how many stanzas
+   * we may have in flight and how much we may buffer */
+  GabbleBytestreamBudget *budget;
+
   gboolean dispose_has_run;
 };
 
@@ -142,6 +146,9 @@ gabble_bytestream_ibb_dispose (GObject *object)
       priv->close_iq_to_ack = NULL;
     }
 
+  gabble_bytestream_budget_remove_stream (priv->budget, self);
+  tp_clear_pointer (&priv->budget, gabble_bytestream_budget_unref);
+
   G_OBJECT_CLASS (gabble_bytestream_ibb_parent_class)->dispose (object);
 }
 
@@ -259,6 +266,17 @@ gabble_bytestream_ibb_set_property (GObject *object,
     }
 }
 
+static void flush_write_buffer (GabbleBytestreamIBB *self);
+
+static void
+budget_wake_cb (gpointer stream)
+{
+  GabbleBytestreamIBB *self = stream;
+
+  if (self->priv->write_buffer != NULL)
+    flush_write_buffer (self);
+}
+
 static GObject *
 gabble_bytestream_ibb_constructor (GType type,
                                    guint n_props,
@@ -268,6 +286,7 @@ gabble_bytestream_ibb_constructor (GType type,
   GabbleBytestreamIBBPrivate *priv;
   TpHandleRepoIface *contact_repo;
   const gchar *jid;
+  gchar *name;
 
   obj = G_OBJECT_CLASS (gabble_bytestream_ibb_parent_class)->
            constructor (type, n_props, props);
@@ -288,6 +307,13 @@ gabble_bytestream_ibb_constructor (GType type,
   else
     priv->peer_jid = g_strdup (jid);
 
+  priv->budget = gabble_bytestream_budget_ref (
+      gabble_bytestream_factory_get_budget (priv->conn->bytestream_factory));
+  name = g_strdup_printf ("IBB %s", priv->stream_id);
+  gabble_bytestream_budget_add_stream (priv->budget, obj, name,
+      budget_wake_cb);
+  g_free (name);
+
   return obj;
 }
 
@@ -421,6 +447,7 @@ iq_reply_cb (
 
   priv = GABBLE_BYTESTREAM_IBB_GET_PRIVATE (self);
   g_hash_table_remove (priv->sent_stanzas_not_acked, sent_msg);
+  gabble_bytestream_budget_return_credit (priv->budget, self);
 
   if (!conn_util_send_iq_finish (GABBLE_CONNECTION (source), result, NULL, &error))
     {
@@ -432,38 +459,46 @@ iq_reply_cb (
     }
   else if (priv->write_buffer != NULL)
     {
-      guint sent;
-
       DEBUG ("A stanza has been acked. Try to flush the buffer");
+      flush_write_buffer (self);
+    }
 
-      sent = send_data (self, priv->write_buffer->str, priv->write_buffer->len);
-      if (sent == priv->write_buffer->len)
-        {
-          DEBUG ("buffer has been flushed; unblock write the bytestream");
-          g_string_free (priv->write_buffer, TRUE);
-          priv->write_buffer = NULL;
+  g_object_unref (self);
+}
 
-          change_write_blocked_state (self, FALSE);
+static void
+flush_write_buffer (GabbleBytestreamIBB *self)
+{
+  GabbleBytestreamIBBPrivate *priv = GABBLE_BYTESTREAM_IBB_GET_PRIVATE (self);
+  guint sent;
 
-          if (priv->state == GABBLE_BYTESTREAM_STATE_CLOSING)
-            {
-              DEBUG ("Can close the bystream now the buffer is flushed");
-              send_close_stanza (self);
-              g_object_set (self, "state", GABBLE_BYTESTREAM_STATE_CLOSED,
-                  NULL);
-            }
-        }
-      else
-        {
-          g_string_erase (priv->write_buffer, 0, sent);
+  sent = send_data (self, priv->write_buffer->str, priv->write_buffer->len);
+  gabble_bytestream_budget_remove_buffered (priv->budget, self, sent);
+
+  if (sent == priv->write_buffer->len)
+    {
+      DEBUG ("buffer has been flushed; unblock write the bytestream");
+      g_string_free (priv->write_buffer, TRUE);
+      priv->write_buffer = NULL;
 
-          DEBUG ("buffer has not been completely flushed; %" G_GSIZE_FORMAT
-              " bytes left",
-              priv->write_buffer->len);
+      change_write_blocked_state (self, FALSE);
+
+      if (priv->state == GABBLE_BYTESTREAM_STATE_CLOSING)
+        {
+          DEBUG ("Can close the bystream now the buffer is flushed");
+          send_close_stanza (self);
+          g_object_set (self, "state", GABBLE_BYTESTREAM_STATE_CLOSED,
+              NULL);
         }
     }
+  else
+    {
+      g_string_erase (priv->write_buffer, 0, sent);
 
-  g_object_unref (self);
+      DEBUG ("buffer has not been completely flushed; %" G_GSIZE_FORMAT
+          " bytes left",
+          priv->write_buffer->len);
+    }
 }
 
 static guint
@@ -493,6 +528,14 @@ send_data (GabbleBytestreamIBB *self,
           break;
         }
 
+      /* Other bytestreams on the connection get their turn too */
+      if (!gabble_bytestream_budget_take_credit (priv->budget, self))
+        {
+          DEBUG ("Connection has too many stanzas in flight. Stop sending "
+              "stanzas");
+          break;
+        }
+
       /* We can send stanzas */
       if (remaining > priv->block_size)
         {
@@ -570,6 +613,7 @@ gabble_bytestream_ibb_send (GabbleBytestreamIface *iface,
       DEBUG ("Write buffer is not empty. Buffering data");
 
       g_string_append_len (priv->write_buffer, str, len);
+      gabble_bytestream_budget_add_buffered (priv->budget, self, len);
       return TRUE;
     }
 
@@ -592,6 +636,8 @@ gabble_bytestream_ibb_send (GabbleBytestreamIface *iface,
           g_string_append_len (priv->write_buffer, str + sent, remaining);
         }
 
+      gabble_bytestream_budget_add_buffered (priv->budget, self, remaining);
+
       DEBUG ("write buffer size: %" G_GSIZE_FORMAT, priv->write_buffer->len);
       change_write_blocked_state (self, TRUE);
     }
@@ -655,7 +701,25 @@ gabble_bytestream_ibb_receive (GabbleBytestreamIBB *self,
       if (priv->read_buffer != NULL)
         current_buffer_len = priv->read_buffer->len;
 
-      if (current_buffer_len + str->len > READ_BUFFER_MAX_SIZE)
+      /* If the connection has no room for it, we ask the peer to send it
+       * again later; the acknowledgements we're holding back for what we
+       * have buffered should stop a well-behaved peer getting that far. */
+      if (is_iq &&
+          !gabble_bytestream_budget_may_buffer (priv->budget, self, str->len))
+        {
+          DEBUG ("Connection's buffers are full. Refusing the data");
+
+          wocky_porter_send_iq_error (
+              wocky_session_get_porter (priv->conn->session), msg,
+              WOCKY_XMPP_ERROR_RESOURCE_CONSTRAINT, "buffers are full");
+          g_string_free (str, TRUE);
+          return;
+        }
+
+      /* Data sent in messages can't be refused without losing it, so a
+       * stream which sends more than we can keep has to be closed. */
+      if (current_buffer_len + str->len > READ_BUFFER_MAX_SIZE ||
+          !gabble_bytestream_budget_may_buffer (priv->budget, self, str->len))
         {
           DEBUG ("Buffer is full. Closing the bytestream");
 
@@ -679,6 +743,9 @@ gabble_bytestream_ibb_receive (GabbleBytestreamIBB *self,
           g_string_free (str, TRUE);
         }
 
+      gabble_bytestream_budget_add_buffered (priv->budget, self,
+          priv->read_buffer->len - current_buffer_len);
+
       if (is_iq)
         {
           priv->received_stanzas_not_acked = g_slist_prepend (
@@ -913,6 +980,8 @@ gabble_bytestream_ibb_block_reading (GabbleBytestreamIface *iface,
       g_signal_emit_by_name (G_OBJECT (self), "data-received",
           priv->peer_handle, priv->read_buffer);
 
+      gabble_bytestream_budget_remove_buffered (priv->budget, self,
+          priv->read_buffer->len);
       g_string_free (priv->read_buffer, TRUE);
       priv->read_buffer = NULL;
 
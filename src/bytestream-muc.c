@@ -73,6 +73,11 @@ struct _GabbleBytestreamMucPrivate
   /* (gchar *): sender's muc-JID -> (GString *): accumulated message data */
   GHashTable *buffers;
 
+  /* shared with the connection's other bytestreams; we stop the application
+   * writing while the connection has too much waiting to go out */
+  GabbleBytestreamBudget *budget;
+  gboolean write_blocked;
+
   gboolean dispose_has_run;
 };
 
@@ -111,6 +116,9 @@ gabble_bytestream_muc_dispose (GObject *object)
       gabble_bytestream_iface_close (GABBLE_BYTESTREAM_IFACE (self), NULL);
     }
 
+  gabble_bytestream_budget_remove_stream (priv->budget, self);
+  tp_clear_pointer (&priv->budget, gabble_bytestream_budget_unref);
+
   G_OBJECT_CLASS (gabble_bytestream_muc_parent_class)->dispose (object);
 }
 
@@ -203,6 +211,26 @@ gabble_bytestream_muc_set_property (GObject *object,
     }
 }
 
+static void
+change_write_blocked_state (GabbleBytestreamMuc *self,
+                            gboolean blocked)
+{
+  GabbleBytestreamMucPrivate *priv = GABBLE_BYTESTREAM_MUC_GET_PRIVATE (self);
+
+  if (priv->write_blocked == blocked)
+    return;
+
+  priv->write_blocked = blocked;
+  g_signal_emit_by_name (self, "write-blocked", blocked);
+}
+
+static void
+budget_wake_cb (gpointer stream)
+{
+  DEBUG ("connection has room again; unblock write the bytestream");
+  change_write_blocked_state (stream, FALSE);
+}
+
 static GObject *
 gabble_bytestream_muc_constructor (GType type,
                                    guint n_props,
@@ -211,6 +239,7 @@ gabble_bytestream_muc_constructor (GType type,
   GObject *obj;
   GabbleBytestreamMucPrivate *priv;
   TpHandleRepoIface *room_repo;
+  gchar *name;
 
   obj = G_OBJECT_CLASS (gabble_bytestream_muc_parent_class)->
            constructor (type, n_props, props);
@@ -227,6 +256,13 @@ gabble_bytestream_muc_constructor (GType type,
   priv->peer_jid = tp_handle_inspect (room_repo,
         priv->peer_handle);
 
+  priv->budget = gabble_bytestream_budget_ref (
+      gabble_bytestream_factory_get_budget (priv->conn->bytestream_factory));
+  name = g_strdup_printf ("MUC %s", priv->stream_id);
+  gabble_bytestream_budget_add_stream (priv->budget, obj, name,
+      budget_wake_cb);
+  g_free (name);
+
   return obj;
 }
 
@@ -270,6 +306,32 @@ enum
   FRAG_LAST
 };
 
+static void
+stanza_sent_cb (GObject *source,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  TpWeakRef *weak_ref = user_data;
+  GabbleBytestreamMuc *self = tp_weak_ref_dup_object (weak_ref);
+  gsize size = GPOINTER_TO_SIZE (tp_weak_ref_get_user_data (weak_ref));
+  GError *error = NULL;
+
+  tp_weak_ref_destroy (weak_ref);
+
+  if (!wocky_porter_send_finish (WOCKY_PORTER (source), result, &error))
+    {
+      DEBUG ("error sending pseudo IBB Muc stanza: %s", error->message);
+      g_clear_error (&error);
+    }
+
+  /* If the bytestream has gone, the budget has already forgotten it */
+  if (self == NULL)
+    return;
+
+  gabble_bytestream_budget_remove_buffered (self->priv->budget, self, size);
+  g_object_unref (self);
+}
+
 static gboolean
 send_data_to (GabbleBytestreamMuc *self,
               const gchar *to,
@@ -278,6 +340,7 @@ send_data_to (GabbleBytestreamMuc *self,
               const gchar *str)
 {
   GabbleBytestreamMucPrivate *priv = GABBLE_BYTESTREAM_MUC_GET_PRIVATE (self);
+  WockyPorter *porter;
   guint sent, stanza_count;
   guint frag;
 
@@ -288,15 +351,23 @@ send_data_to (GabbleBytestreamMuc *self,
       return FALSE;
     }
 
+  porter = gabble_connection_dup_porter (priv->conn);
+
+  if (porter == NULL)
+    {
+      DEBUG ("error sending pseudo IBB Muc stanza: connection is "
+          "disconnected");
+      return FALSE;
+    }
+
   sent = 0;
   stanza_count = 0;
 
   while (sent < len)
     {
-      gboolean ret;
       gchar *encoded;
+      gsize encoded_len;
       guint send_now;
-      GError *error = NULL;
       WockyStanza *msg;
       WockyNode *data = NULL;
 
@@ -355,19 +426,17 @@ send_data_to (GabbleBytestreamMuc *self,
             break;
         }
 
+      /* The stanza sits in the porter's queue until it has been written, so
+       * it counts against the connection's budget until then. */
+      encoded_len = strlen (encoded);
+      gabble_bytestream_budget_add_buffered (priv->budget, self, encoded_len);
+
       DEBUG ("send %d bytes", send_now);
-      ret = _gabble_connection_send (priv->conn, msg, &error);
+      wocky_porter_send_async (porter, msg, NULL, stanza_sent_cb,
+          tp_weak_ref_new (self, GSIZE_TO_POINTER (encoded_len), NULL));
 
       g_free (encoded);
 
-      if (!ret)
-        {
-          DEBUG ("error sending pseusdo IBB Muc stanza: %s", error->message);
-          g_error_free (error);
-          g_object_unref (msg);
-          return FALSE;
-        }
-
       sent += send_now;
       stanza_count++;
 
@@ -376,6 +445,17 @@ send_data_to (GabbleBytestreamMuc *self,
 
   DEBUG ("finished to send %d bytes (%d stanzas needed)", len, stanza_count);
 
+  g_object_unref (porter);
+
+  /* We can't refuse data we've been given, but we can ask for no more until
+   * the connection has caught up. */
+  if (gabble_bytestream_budget_wait_for_room (priv->budget, self))
+    {
+      DEBUG ("connection has too much data waiting to go out; write block "
+          "the bytestream");
+      change_write_blocked_state (self, TRUE);
+    }
+
   return TRUE;
 }
 
@@ -48,6 +48,7 @@
 #include <telepathy-glib/telepathy-glib.h>
 #include <telepathy-glib/telepathy-glib-dbus.h>
 
+#include <gibber/gibber-fd-transport.h>
 #include <gibber/gibber-transport.h>
 #include <gibber/gibber-tcp-transport.h>
 #include <gibber/gibber-listener.h>
@@ -123,6 +124,10 @@ typedef enum _Socks5State Socks5State;
 #define CONNECT_REPLY_TIMEOUT 30
 #define CONNECT_TIMEOUT 10
 
+/* How long we give a streamhost to answer before also trying the next one,
+ * in milliseconds */
+#define STREAMHOST_STAGGER 300
+
 struct _Streamhost
 {
   gchar *jid;
@@ -161,6 +166,45 @@ streamhost_free (Streamhost *streamhost)
   g_slice_free (Streamhost, streamhost);
 }
 
+/* A connection to one of the streamhosts we have been offered. When we are
+ * the target, several of them race each other and the first one to complete
+ * the SOCKS5 handshake is used. */
+struct _StreamhostAttempt
+{
+  /* borrowed: attempts are cancelled before the bytestream goes away */
+  GabbleBytestreamSocks5 *self;
+  Streamhost *streamhost;
+  GibberTransport *transport;
+  GString *read_buffer;
+  Socks5State state;
+  guint timer_id;
+  gint64 started;
+};
+typedef struct _StreamhostAttempt StreamhostAttempt;
+
+static void
+streamhost_attempt_free (StreamhostAttempt *attempt)
+{
+  if (attempt->timer_id != 0)
+    g_source_remove (attempt->timer_id);
+
+  if (attempt->transport != NULL)
+    {
+      g_signal_handlers_disconnect_matched (attempt->transport,
+          G_SIGNAL_MATCH_DATA, 0, 0, NULL, NULL, attempt);
+      gibber_transport_set_handler (attempt->transport, NULL, NULL);
+
+      if (attempt->transport->state == GIBBER_TRANSPORT_CONNECTED)
+        gibber_transport_disconnect (attempt->transport);
+
+      g_object_unref (attempt->transport);
+    }
+
+  g_string_free (attempt->read_buffer, TRUE);
+  streamhost_free (attempt->streamhost);
+  g_slice_free (StreamhostAttempt, attempt);
+}
+
 struct _GabbleBytestreamSocks5Private
 {
   GabbleConnection *conn;
@@ -172,11 +216,18 @@ struct _GabbleBytestreamSocks5Private
   gchar *peer_jid;
   gchar *self_full_jid;
   gchar *proxy_jid;
+  /* When we started connecting to proxy_jid */
+  gint64 proxy_started;
   /* TRUE if the peer of this bytestream is a muc contact */
   gboolean muc_contact;
 
-  /* List of Streamhost */
+  /* List of Streamhost we haven't tried yet */
   GSList *streamhosts;
+  /* List of StreamhostAttempt currently racing each other */
+  GSList *attempts;
+  /* Starts the next attempt if none of the current ones has succeeded
+   * in time */
+  guint stagger_id;
 
   /* Connections to streamhosts are async, so we keep the IQ set message
    * around */
@@ -196,7 +247,7 @@ struct _GabbleBytestreamSocks5Private
 
 #define GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE(obj) ((obj)->priv)
 
-static void socks5_connect (GabbleBytestreamSocks5 *self);
+static void try_next_streamhost (GabbleBytestreamSocks5 *self);
 
 static void gabble_bytestream_socks5_close (GabbleBytestreamIface *iface,
     GError *error);
@@ -228,6 +279,27 @@ stop_timer (GabbleBytestreamSocks5 *self)
   priv->timer_id = 0;
 }
 
+static void
+cancel_streamhost_attempts (GabbleBytestreamSocks5 *self)
+{
+  GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
+      self);
+
+  if (priv->stagger_id != 0)
+    {
+      g_source_remove (priv->stagger_id);
+      priv->stagger_id = 0;
+    }
+
+  g_slist_foreach (priv->attempts, (GFunc) streamhost_attempt_free, NULL);
+  g_slist_free (priv->attempts);
+  priv->attempts = NULL;
+
+  g_slist_foreach (priv->streamhosts, (GFunc) streamhost_free, NULL);
+  g_slist_free (priv->streamhosts);
+  priv->streamhosts = NULL;
+}
+
 static void
 gabble_bytestream_socks5_dispose (GObject *object)
 {
@@ -241,6 +313,7 @@ gabble_bytestream_socks5_dispose (GObject *object)
   priv->dispose_has_run = TRUE;
 
   stop_timer (self);
+  cancel_streamhost_attempts (self);
 
   if (priv->bytestream_state != GABBLE_BYTESTREAM_STATE_CLOSED)
     {
@@ -490,6 +563,20 @@ write_to_transport (GabbleBytestreamSocks5 *self,
   return TRUE;
 }
 
+static void
+send_auth_request (GibberTransport *transport)
+{
+  gchar msg[3];
+
+  msg[0] = SOCKS5_VERSION;
+  /* Number of auth methods we are offering, we support just
+   * SOCKS5_AUTH_NONE */
+  msg[1] = 1;
+  msg[2] = SOCKS5_AUTH_NONE;
+
+  gibber_transport_send (transport, (const guint8 *) msg, 3, NULL);
+}
+
 static void
 transport_connected_cb (GibberTransport *transport,
                         GabbleBytestreamSocks5 *self)
@@ -499,25 +586,12 @@ transport_connected_cb (GibberTransport *transport,
 
   stop_timer (self);
 
-  if (priv->socks5_state == SOCKS5_STATE_TARGET_TRYING_CONNECT ||
-      priv->socks5_state == SOCKS5_STATE_INITIATOR_TRYING_CONNECT)
+  if (priv->socks5_state == SOCKS5_STATE_INITIATOR_TRYING_CONNECT)
     {
-      gchar msg[3];
-
       DEBUG ("transport is connected. Sending auth request");
 
-      msg[0] = SOCKS5_VERSION;
-      /* Number of auth methods we are offering, we support just
-       * SOCKS5_AUTH_NONE */
-      msg[1] = 1;
-      msg[2] = SOCKS5_AUTH_NONE;
-
-      write_to_transport (self, msg, 3, NULL);
-
-      if (priv->socks5_state == SOCKS5_STATE_TARGET_TRYING_CONNECT)
-        priv->socks5_state = SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT;
-      else
-        priv->socks5_state = SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT;
+      send_auth_request (transport);
+      priv->socks5_state = SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT;
     }
 }
 
@@ -550,6 +624,8 @@ socks5_close_transport (GabbleBytestreamSocks5 *self)
   GabbleBytestreamSocks5Private *priv =
     GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
 
+  cancel_streamhost_attempts (self);
+
   if (priv->read_buffer != NULL)
     {
       g_string_free (priv->read_buffer, TRUE);
@@ -598,6 +674,7 @@ set_transport (GabbleBytestreamSocks5 *self,
       GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
 
   priv->transport = g_object_ref (transport);
+  gibber_fd_transport_set_high_throughput (GIBBER_FD_TRANSPORT (transport), 0);
 
   g_assert (priv->read_buffer == NULL);
   priv->read_buffer = g_string_sized_new (4096);
@@ -630,25 +707,9 @@ socks5_error (GabbleBytestreamSocks5 *self)
       case SOCKS5_STATE_TARGET_TRYING_CONNECT:
       case SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT:
       case SOCKS5_STATE_TARGET_CONNECT_REQUESTED:
-        /* The attempt for connect to the streamhost failed */
+        /* None of the streamhosts worked */
         socks5_close_transport (self);
 
-        if (priv->streamhosts != NULL)
-          {
-            /* Remove the failed streamhost */
-            streamhost_free (priv->streamhosts->data);
-            priv->streamhosts = g_slist_delete_link (priv->streamhosts,
-                priv->streamhosts);
-          }
-
-        if (priv->streamhosts != NULL)
-          {
-            DEBUG ("connection to streamhost failed, trying the next one");
-
-            socks5_connect (self);
-            return;
-          }
-
         DEBUG ("no more streamhosts to try");
 
         g_signal_emit_by_name (self, "connection-error");
@@ -669,6 +730,14 @@ socks5_error (GabbleBytestreamSocks5 *self)
             "the bytestream yet as the target can still try other streamhosts");
         break;
 
+      case SOCKS5_STATE_INITIATOR_TRYING_CONNECT:
+      case SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT:
+      case SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED:
+        /* We couldn't use the proxy the target picked */
+        gabble_bytestream_factory_socks5_proxy_failed (
+            priv->conn->bytestream_factory, priv->proxy_jid);
+        /* fall through */
+
       default:
         DEBUG ("error, closing the connection\n");
         gabble_bytestream_socks5_close (GABBLE_BYTESTREAM_IFACE (self), NULL);
@@ -728,12 +797,12 @@ start_timer (GabbleBytestreamSocks5 *self,
 }
 
 static void
-target_got_connect_reply (GabbleBytestreamSocks5 *self)
+target_got_connect_reply (GabbleBytestreamSocks5 *self,
+                          const gchar *streamhost_jid)
 {
   GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
       self);
   WockyPorter *porter = wocky_session_get_porter (priv->conn->session);
-  Streamhost *current_streamhost;
 
   DEBUG ("Received CONNECT reply. Socks5 stream connected. "
       "Bytestream is now open");
@@ -741,7 +810,6 @@ target_got_connect_reply (GabbleBytestreamSocks5 *self)
   g_object_set (self, "state", GABBLE_BYTESTREAM_STATE_OPEN, NULL);
 
   /* Acknowledge the connection */
-  current_streamhost = priv->streamhosts->data;
   wocky_porter_acknowledge_iq (porter, priv->msg_for_acknowledge_connection,
       '(', "query", ':', NS_BYTESTREAMS,
         /* streamhost-used informs the other end of the streamhost we
@@ -749,10 +817,12 @@ target_got_connect_reply (GabbleBytestreamSocks5 *self)
          * but if we are using an external proxy we need to know which
          * one was selected */
         '(', "streamhost-used",
-          '@', "jid", current_streamhost->jid,
+          '@', "jid", streamhost_jid,
         ')',
       ')', NULL);
 
+  tp_clear_object (&priv->msg_for_acknowledge_connection);
+
   if (priv->read_blocked)
     {
       DEBUG ("reading has been blocked. Blocking now as the socks5 "
@@ -817,6 +887,10 @@ initiator_got_connect_reply (GabbleBytestreamSocks5 *self)
   DEBUG ("Got CONNECT reply. SOCKS5 negotiation with proxy is done. "
       "Sending activation IQ");
 
+  gabble_bytestream_factory_socks5_proxy_connected (
+      priv->conn->bytestream_factory, priv->proxy_jid,
+      g_get_monotonic_time () - priv->proxy_started);
+
   iq = wocky_stanza_build (WOCKY_STANZA_TYPE_IQ, WOCKY_STANZA_SUB_TYPE_SET,
       NULL, priv->proxy_jid,
       '(', "query",
@@ -835,6 +909,139 @@ initiator_got_connect_reply (GabbleBytestreamSocks5 *self)
   g_object_unref (iq);
 }
 
+static gchar *
+socks5_domain (GabbleBytestreamSocks5 *self,
+               gboolean initiator)
+{
+  GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
+      self);
+
+  if (initiator)
+    return compute_domain (priv->stream_id, priv->self_full_jid,
+        priv->peer_jid);
+  else
+    return compute_domain (priv->stream_id, priv->peer_jid,
+        priv->self_full_jid);
+}
+
+/* Returns the number of bytes used, 0 if the auth reply hasn't been fully
+ * received yet or -1 if the streamhost refused us */
+static gssize
+parse_auth_reply (const GString *string)
+{
+  /* The response to our authorization request is 2 bytes-long */
+  if (string->len < 2)
+    return 0;
+
+  if (string->str[0] != SOCKS5_VERSION ||
+      string->str[1] != SOCKS5_STATUS_OK)
+    {
+      DEBUG ("Authentication failed");
+      return -1;
+    }
+
+  return 2;
+}
+
+static void
+send_connect_request (GabbleBytestreamSocks5 *self,
+                      GibberTransport *transport,
+                      gboolean initiator)
+{
+  gchar msg[SOCKS5_CONNECT_LENGTH];
+  gchar *domain;
+
+  domain = socks5_domain (self, initiator);
+
+  msg[0] = SOCKS5_VERSION;
+  msg[1] = SOCKS5_CMD_CONNECT;
+  msg[2] = SOCKS5_RESERVED;
+  msg[3] = SOCKS5_ATYP_DOMAIN;
+  /* Length of a hex SHA1 */
+  msg[4] = 40;
+  /* Domain name: SHA-1(sid + initiator + target) */
+  memcpy (&msg[5], domain, 40);
+  /* Port: 0 */
+  msg[45] = 0x00;
+  msg[46] = 0x00;
+
+  g_free (domain);
+
+  gibber_transport_send (transport, (const guint8 *) msg,
+      SOCKS5_CONNECT_LENGTH, NULL);
+}
+
+/* Returns the number of bytes used, 0 if the CONNECT reply hasn't been fully
+ * received yet or -1 if the streamhost refused the connection */
+static gssize
+parse_connect_reply (GabbleBytestreamSocks5 *self,
+                     const GString *string,
+                     gboolean initiator)
+{
+  gchar *domain;
+  /* the length of the BND.ADDR field */
+  guint8 addr_len;
+
+  if (string->len < SOCKS5_MIN_LENGTH)
+    return 0;
+
+  if (string->str[0] != SOCKS5_VERSION ||
+      string->str[1] != SOCKS5_STATUS_OK ||
+      string->str[2] != SOCKS5_RESERVED)
+    {
+      DEBUG ("Connection refused");
+      return -1;
+    }
+
+  if (string->str[3] == SOCKS5_ATYP_DOMAIN)
+    {
+      /* correct domain. The first byte of the domain contains its
+       * length */
+      addr_len = (guint8) string->str[4];
+      addr_len += 1;
+    }
+  else if (string->str[3] == 0x00)
+    {
+      DEBUG ("Got 0x00 as domain. Pretend it's ok to be able to interop "
+          "with ejabberd < 2.0.2");
+      addr_len = 0;
+    }
+  else
+    {
+      DEBUG ("Wrong domain");
+      return -1;
+    }
+
+  if ((guint8) string->len < SOCKS5_MIN_LENGTH + addr_len)
+    /* We didn't receive the full packet yet */
+    return 0;
+
+  if (
+      /* first half of the port number */
+      string->str[4 + addr_len] != 0 ||
+      /* second half of the port number */
+      string->str[5 + addr_len] != 0)
+    {
+      DEBUG ("Connection refused");
+      return -1;
+    }
+
+  domain = socks5_domain (self, initiator);
+
+  if (addr_len > 0)
+    {
+      if (!check_domain (&string->str[5], addr_len - 1, domain))
+        {
+          /* Thanks Pidgin... */
+          DEBUG ("Ignoring to interop with buggy implementations");
+        }
+    }
+
+  g_free (domain);
+
+  return SOCKS5_MIN_LENGTH + addr_len;
+}
+
 /* Process the received data and returns the number of bytes that have been
  * used */
 static gssize
@@ -850,62 +1057,28 @@ socks5_handle_received_data (GabbleBytestreamSocks5 *self,
   /* the length of the BND.ADDR field */
   guint8 addr_len;
   gsize len;
+  gssize used;
 
   switch (priv->socks5_state)
     {
-      case SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT:
       case SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT:
-        /* We sent an authorization request and we are awaiting for a
-         * response, the response is 2 bytes-long */
-        if (string->len < 2)
-          return 0;
+        /* We sent an authorization request to the proxy and we are awaiting
+         * for a response */
+        used = parse_auth_reply (string);
 
-        if (string->str[0] != SOCKS5_VERSION ||
-            string->str[1] != SOCKS5_STATUS_OK)
+        if (used <= 0)
           {
-            DEBUG ("Authentication failed");
+            if (used < 0)
+              socks5_error (self);
 
-            socks5_error (self);
-            return -1;
+            return used;
           }
 
         /* We have been authorized, let's send a CONNECT command */
-
         DEBUG ("Received auth reply. Sending CONNECT command");
 
-        if (priv->socks5_state == SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT)
-          {
-            domain = compute_domain (priv->stream_id, priv->peer_jid,
-                priv->self_full_jid);
-          }
-        else
-          {
-            /* SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT */
-            domain = compute_domain (priv->stream_id, priv->self_full_jid,
-                priv->peer_jid);
-          }
-
-        msg[0] = SOCKS5_VERSION;
-        msg[1] = SOCKS5_CMD_CONNECT;
-        msg[2] = SOCKS5_RESERVED;
-        msg[3] = SOCKS5_ATYP_DOMAIN;
-        /* Length of a hex SHA1 */
-        msg[4] = 40;
-        /* Domain name: SHA-1(sid + initiator + target) */
-        memcpy (&msg[5], domain, 40);
-        /* Port: 0 */
-        msg[45] = 0x00;
-        msg[46] = 0x00;
-
-        g_free (domain);
-
-        write_to_transport (self, msg, SOCKS5_CONNECT_LENGTH, NULL);
-
-        if (priv->socks5_state == SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT)
-          priv->socks5_state = SOCKS5_STATE_TARGET_CONNECT_REQUESTED;
-        else
-          /* SOCKS5_STATE_INITIATOR_AUTH_REQUEST_SENT */
-          priv->socks5_state = SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED;
+        send_connect_request (self, priv->transport, TRUE);
+        priv->socks5_state = SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED;
 
         /* Older version of Gabble (pre 0.7.22) are bugged and just send 2
          * bytes as CONNECT reply. We set a timer to not wait the full reply
@@ -914,93 +1087,25 @@ socks5_handle_received_data (GabbleBytestreamSocks5 *self,
          * will switch to IBB as a fallback. */
         start_timer (self, CONNECT_REPLY_TIMEOUT);
 
-        return 2;
+        return used;
 
-      case SOCKS5_STATE_TARGET_CONNECT_REQUESTED:
       case SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED:
         /* We sent a CONNECT request and are awaiting for the response */
-        if (string->len < SOCKS5_MIN_LENGTH)
-          return 0;
+        used = parse_connect_reply (self, string, TRUE);
 
-        if (string->str[0] != SOCKS5_VERSION ||
-            string->str[1] != SOCKS5_STATUS_OK ||
-            string->str[2] != SOCKS5_RESERVED)
-          {
-            DEBUG ("Connection refused");
-
-            socks5_error (self);
-            return -1;
-          }
-
-        if (string->str[3] == SOCKS5_ATYP_DOMAIN)
-          {
-            /* correct domain. The first byte of the domain contains its
-             * length */
-            addr_len = (guint8) string->str[4];
-            addr_len += 1;
-          }
-        else if (string->str[3] == 0x00)
-          {
-            DEBUG ("Got 0x00 as domain. Pretend it's ok to be able to interop "
-                "with ejabberd < 2.0.2");
-            addr_len = 0;
-          }
-        else
-          {
-            DEBUG ("Wrong domain");
-
-            socks5_error (self);
-            return -1;
-          }
-
-        if ((guint8) string->len < SOCKS5_MIN_LENGTH + addr_len)
-          /* We didn't receive the full packet yet */
+        if (used == 0)
           return 0;
 
         stop_timer (self);
 
-        if (
-            /* first half of the port number */
-            string->str[4 + addr_len] != 0 ||
-            /* second half of the port number */
-            string->str[5 + addr_len] != 0)
+        if (used < 0)
           {
-            DEBUG ("Connection refused");
-
             socks5_error (self);
             return -1;
           }
 
-        if (priv->socks5_state == SOCKS5_STATE_TARGET_CONNECT_REQUESTED)
-          {
-            domain = compute_domain (priv->stream_id, priv->peer_jid,
-                priv->self_full_jid);
-          }
-        else
-          {
-            /* SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED */
-            domain = compute_domain (priv->stream_id, priv->self_full_jid,
-                priv->peer_jid);
-          }
-
-        if (addr_len > 0)
-          {
-            if (!check_domain (&string->str[5], addr_len - 1, domain))
-              {
-                /* Thanks Pidgin... */
-                DEBUG ("Ignoring to interop with buggy implementations");
-              }
-          }
-
-        g_free (domain);
-
-        if (priv->socks5_state == SOCKS5_STATE_TARGET_CONNECT_REQUESTED)
-          target_got_connect_reply (self);
-        else
-          /* SOCKS5_STATE_INITIATOR_CONNECT_REQUESTED */
-          initiator_got_connect_reply (self);
-
-        return SOCKS5_MIN_LENGTH + addr_len;
+        initiator_got_connect_reply (self);
+        return used;
 
       case SOCKS5_STATE_INITIATOR_AWAITING_AUTH_REQUEST:
         /* A client connected to us and we are awaiting for the authorization
@@ -1139,6 +1244,11 @@ socks5_handle_received_data (GabbleBytestreamSocks5 *self,
         return string->len;
 
       case SOCKS5_STATE_TARGET_TRYING_CONNECT:
+      case SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT:
+      case SOCKS5_STATE_TARGET_CONNECT_REQUESTED:
+        DEBUG ("Streamhosts we are trying have their own buffers");
+        break;
+
       case SOCKS5_STATE_INITIATOR_TRYING_CONNECT:
         DEBUG ("Impossible to receive data when not yet connected to the "
             "socket");
@@ -1162,20 +1272,12 @@ socks5_handle_received_data (GabbleBytestreamSocks5 *self,
 }
 
 static void
-transport_handler (GibberTransport *transport,
-                   GibberBuffer *data,
-                   gpointer user_data)
-
+process_read_buffer (GabbleBytestreamSocks5 *self)
 {
-  GabbleBytestreamSocks5 *self = GABBLE_BYTESTREAM_SOCKS5 (user_data);
   GabbleBytestreamSocks5Private *priv =
       GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
   gssize used_bytes;
 
-  g_assert (priv->read_buffer != NULL);
-  g_string_append_len (priv->read_buffer, (const gchar *) data->data,
-      data->length);
-
   /* If something goes wrong in socks5_handle_received_data, the bytestream
    * could be closed and disposed. Ref it to artificially keep this bytestream
    * object alive while we are in this function. */
@@ -1201,39 +1303,256 @@ transport_handler (GibberTransport *transport,
 }
 
 static void
-socks5_connect (GabbleBytestreamSocks5 *self)
+transport_handler (GibberTransport *transport,
+                   GibberBuffer *data,
+                   gpointer user_data)
+
 {
+  GabbleBytestreamSocks5 *self = GABBLE_BYTESTREAM_SOCKS5 (user_data);
   GabbleBytestreamSocks5Private *priv =
       GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
-  Streamhost* streamhost;
-  GibberTCPTransport *transport;
 
-  priv->socks5_state = SOCKS5_STATE_TARGET_TRYING_CONNECT;
+  g_assert (priv->read_buffer != NULL);
+  g_string_append_len (priv->read_buffer, (const gchar *) data->data,
+      data->length);
+
+  process_read_buffer (self);
+}
+
+static void
+streamhost_attempt_failed (StreamhostAttempt *attempt)
+{
+  GabbleBytestreamSocks5 *self = attempt->self;
+  GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
+      self);
+
+  DEBUG ("connection to streamhost %s failed", attempt->streamhost->jid);
+
+  gabble_bytestream_factory_socks5_proxy_failed (
+      priv->conn->bytestream_factory, attempt->streamhost->jid);
+
+  priv->attempts = g_slist_remove (priv->attempts, attempt);
+  streamhost_attempt_free (attempt);
 
   if (priv->streamhosts != NULL)
     {
-      streamhost = priv->streamhosts->data;
+      /* No point waiting for the stagger timeout */
+      try_next_streamhost (self);
     }
-  else
+  else if (priv->attempts == NULL)
     {
-      DEBUG ("No more streamhosts to try, closing");
-
       socks5_error (self);
-      return;
     }
+}
+
+static void
+streamhost_attempt_won (StreamhostAttempt *attempt)
+{
+  GabbleBytestreamSocks5 *self = attempt->self;
+  GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
+      self);
+  gint64 latency = g_get_monotonic_time () - attempt->started;
+
+  DEBUG ("streamhost %s completed the SOCKS5 handshake first, after %"
+      G_GINT64_FORMAT " ms", attempt->streamhost->jid, latency / 1000);
+
+  gabble_bytestream_factory_socks5_proxy_connected (
+      priv->conn->bytestream_factory, attempt->streamhost->jid, latency);
+
+  /* Hang up on everyone else */
+  priv->attempts = g_slist_remove (priv->attempts, attempt);
+  cancel_streamhost_attempts (self);
+
+  /* ...and adopt the winner's connection, with anything the initiator has
+   * already sent us through it */
+  g_signal_handlers_disconnect_matched (attempt->transport,
+      G_SIGNAL_MATCH_DATA, 0, 0, NULL, NULL, attempt);
+  gibber_transport_set_handler (attempt->transport, NULL, NULL);
+  set_transport (self, attempt->transport);
+  tp_clear_object (&attempt->transport);
+  g_string_append_len (priv->read_buffer, attempt->read_buffer->str,
+      attempt->read_buffer->len);
+
+  target_got_connect_reply (self, attempt->streamhost->jid);
+  streamhost_attempt_free (attempt);
+
+  if (priv->read_buffer != NULL && priv->read_buffer->len > 0)
+    process_read_buffer (self);
+}
+
+static gboolean
+streamhost_attempt_timeout_cb (gpointer user_data)
+{
+  StreamhostAttempt *attempt = user_data;
+
+  DEBUG ("Timed out connecting to streamhost %s", attempt->streamhost->jid);
+
+  attempt->timer_id = 0;
+  streamhost_attempt_failed (attempt);
+  return FALSE;
+}
+
+static void
+streamhost_attempt_start_timer (StreamhostAttempt *attempt,
+                                guint seconds)
+{
+  if (attempt->timer_id != 0)
+    g_source_remove (attempt->timer_id);
+
+  attempt->timer_id = g_timeout_add_seconds (seconds,
+      streamhost_attempt_timeout_cb, attempt);
+}
+
+static void
+streamhost_attempt_connected_cb (GibberTransport *transport,
+                                 StreamhostAttempt *attempt)
+{
+  DEBUG ("connected to streamhost %s. Sending auth request",
+      attempt->streamhost->jid);
+
+  send_auth_request (transport);
+  attempt->state = SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT;
+}
+
+static void
+streamhost_attempt_disconnected_cb (GibberTransport *transport,
+                                    StreamhostAttempt *attempt)
+{
+  streamhost_attempt_failed (attempt);
+}
+
+static void
+streamhost_attempt_handler (GibberTransport *transport,
+                            GibberBuffer *data,
+                            gpointer user_data)
+{
+  StreamhostAttempt *attempt = user_data;
+  GabbleBytestreamSocks5 *self = attempt->self;
+  gssize used;
+
+  g_string_append_len (attempt->read_buffer, (const gchar *) data->data,
+      data->length);
+
+  /* Failing or winning can close the bytestream */
+  g_object_ref (self);
+
+  if (attempt->state == SOCKS5_STATE_TARGET_AUTH_REQUEST_SENT)
+    {
+      used = parse_auth_reply (attempt->read_buffer);
+
+      if (used == 0)
+        goto out;
+
+      if (used < 0)
+        {
+          streamhost_attempt_failed (attempt);
+          goto out;
+        }
+
+      g_string_erase (attempt->read_buffer, 0, used);
+
+      DEBUG ("Received auth reply from %s. Sending CONNECT command",
+          attempt->streamhost->jid);
+      send_connect_request (self, transport, FALSE);
+      attempt->state = SOCKS5_STATE_TARGET_CONNECT_REQUESTED;
+
+      /* Older version of Gabble (pre 0.7.22) are bugged and just send 2
+       * bytes as CONNECT reply. We set a timer to not wait the full reply
+       * forever if we are connected to such Gabble. */
+      streamhost_attempt_start_timer (attempt, CONNECT_REPLY_TIMEOUT);
+    }
+
+  if (attempt->state == SOCKS5_STATE_TARGET_CONNECT_REQUESTED)
+    {
+      used = parse_connect_reply (self, attempt->read_buffer, FALSE);
+
+      if (used == 0)
+        goto out;
+
+      if (used < 0)
+        {
+          streamhost_attempt_failed (attempt);
+          goto out;
+        }
+
+      g_string_erase (attempt->read_buffer, 0, used);
+      streamhost_attempt_won (attempt);
+    }
+
+out:
+  g_object_unref (self);
+}
+
+static gboolean
+stagger_timeout_cb (gpointer user_data)
+{
+  GabbleBytestreamSocks5 *self = GABBLE_BYTESTREAM_SOCKS5 (user_data);
+  GabbleBytestreamSocks5Private *priv = GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (
+      self);
+
+  priv->stagger_id = 0;
+
+  DEBUG ("No streamhost has answered yet; trying another one alongside");
+  try_next_streamhost (self);
+  return FALSE;
+}
+
+/* Starts connecting to the first streamhost we haven't tried yet. Unless it
+ * completes the SOCKS5 handshake within STREAMHOST_STAGGER, the next one is
+ * tried too, without giving up on the first. */
+static void
+try_next_streamhost (GabbleBytestreamSocks5 *self)
+{
+  GabbleBytestreamSocks5Private *priv =
+      GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
+  StreamhostAttempt *attempt;
+  GibberTCPTransport *transport;
+
+  g_assert (priv->streamhosts != NULL);
+
+  if (priv->stagger_id != 0)
+    {
+      g_source_remove (priv->stagger_id);
+      priv->stagger_id = 0;
+    }
+
+  attempt = g_slice_new0 (StreamhostAttempt);
+  attempt->self = self;
+  attempt->streamhost = priv->streamhosts->data;
+  attempt->read_buffer = g_string_sized_new (SOCKS5_CONNECT_LENGTH);
+  attempt->state = SOCKS5_STATE_TARGET_TRYING_CONNECT;
+  attempt->started = g_get_monotonic_time ();
+
+  priv->streamhosts = g_slist_delete_link (priv->streamhosts,
+      priv->streamhosts);
+  priv->attempts = g_slist_prepend (priv->attempts, attempt);
 
-  DEBUG ("Trying streamhost %s on port %d", streamhost->host,
-      streamhost->port);
+  DEBUG ("Trying streamhost %s on port %d", attempt->streamhost->host,
+      attempt->streamhost->port);
 
   transport = gibber_tcp_transport_new ();
-  set_transport (self, GIBBER_TRANSPORT (transport));
-  g_object_unref (transport);
+  attempt->transport = g_object_ref (transport);
 
-  /* We don't wait to wait for the TCP timeout is the host is unreachable */
-  start_timer (self, CONNECT_TIMEOUT);
+  gibber_transport_set_handler (attempt->transport,
+      streamhost_attempt_handler, attempt);
+  g_signal_connect (transport, "connected",
+      G_CALLBACK (streamhost_attempt_connected_cb), attempt);
+  g_signal_connect (transport, "disconnected",
+      G_CALLBACK (streamhost_attempt_disconnected_cb), attempt);
 
-  gibber_tcp_transport_connect (transport, streamhost->host,
-      streamhost->port);
+  /* We don't want to wait for the TCP timeout if the host is unreachable,
+   * nor forever if it never answers */
+  streamhost_attempt_start_timer (attempt, CONNECT_TIMEOUT);
+
+  if (priv->streamhosts != NULL)
+    priv->stagger_id = g_timeout_add (STREAMHOST_STAGGER,
+        stagger_timeout_cb, self);
+
+  /* This can fail straight away, in which case the attempt is already gone
+   * when it returns; we keep our own ref to the transport until then. */
+  gibber_tcp_transport_connect (transport, attempt->streamhost->host,
+      attempt->streamhost->port);
+  g_object_unref (transport);
 
   /* We'll send the auth request once the transport is connected */
 }
@@ -1322,8 +1641,16 @@ gabble_bytestream_socks5_connect_to_streamhost (GabbleBytestreamSocks5 *self,
       GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
 
   priv->msg_for_acknowledge_connection = g_object_ref (msg);
+  priv->socks5_state = SOCKS5_STATE_TARGET_TRYING_CONNECT;
+
+  if (priv->streamhosts == NULL)
+    {
+      DEBUG ("No streamhosts to try, closing");
+      socks5_error (self);
+      return;
+    }
 
-  socks5_connect (self);
+  try_next_streamhost (self);
 }
 
 /*
@@ -1531,6 +1858,7 @@ initiator_connected_to_proxy (GabbleBytestreamSocks5 *self)
 
   DEBUG ("connect to proxy: %s (%s:%d)", proxy->jid, proxy->host, proxy->port);
   priv->socks5_state = SOCKS5_STATE_INITIATOR_TRYING_CONNECT;
+  priv->proxy_started = g_get_monotonic_time ();
 
   transport = gibber_tcp_transport_new ();
   set_transport (self, GIBBER_TRANSPORT (transport));
@@ -1999,6 +2327,41 @@ gabble_bytestream_socks5_initiate (GabbleBytestreamIface *iface)
   return TRUE;
 }
 
+/*
+ * gabble_bytestream_socks5_forward:
+ * @transport: a connected local socket
+ *
+ * Joins @transport and our SOCKS5 socket so that the kernel moves data
+ * between them directly. Once this has succeeded, "data-received" is no
+ * longer emitted and gabble_bytestream_iface_send() mustn't be used.
+ *
+ * Returns: %TRUE if the sockets have been joined; if not, nothing changes
+ *  and the bytestream should be used as usual.
+ */
+gboolean
+gabble_bytestream_socks5_forward (GabbleBytestreamSocks5 *self,
+    GibberTransport *transport)
+{
+  GabbleBytestreamSocks5Private *priv =
+      GABBLE_BYTESTREAM_SOCKS5_GET_PRIVATE (self);
+
+  if (priv->bytestream_state != GABBLE_BYTESTREAM_STATE_OPEN ||
+      priv->socks5_state != SOCKS5_STATE_CONNECTED ||
+      priv->transport == NULL)
+    return FALSE;
+
+  /* Data we've read but not emitted yet would be overtaken */
+  if (priv->read_buffer == NULL || priv->read_buffer->len > 0)
+    return FALSE;
+
+  if (!GIBBER_IS_FD_TRANSPORT (priv->transport) ||
+      !GIBBER_IS_FD_TRANSPORT (transport))
+    return FALSE;
+
+  return gibber_fd_transport_forward (GIBBER_FD_TRANSPORT (priv->transport),
+      GIBBER_FD_TRANSPORT (transport));
+}
+
 static void
 gabble_bytestream_socks5_block_reading (GabbleBytestreamIface *iface,
                                         gboolean block)
@@ -26,6 +26,8 @@
 #include <wocky/wocky.h>
 #include <telepathy-glib/telepathy-glib.h>
 
+#include <gibber/gibber-transport.h>
+
 G_BEGIN_DECLS
 
 typedef struct _GabbleBytestreamSocks5 GabbleBytestreamSocks5;
@@ -67,6 +69,9 @@ void gabble_bytestream_socks5_add_streamhost (GabbleBytestreamSocks5 *socks5,
 void gabble_bytestream_socks5_connect_to_streamhost (
     GabbleBytestreamSocks5 *socks5, WockyStanza *msg);
 
+gboolean gabble_bytestream_socks5_forward (GabbleBytestreamSocks5 *socks5,
+    GibberTransport *transport);
+
 G_END_DECLS
 
 #endif /* #ifndef __GABBLE_BYTESTREAM_SOCKS5_H__ */
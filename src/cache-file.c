@@ -0,0 +1,209 @@
+/*
+ * cache-file.c - Source for per-account files in Gabble's cache
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "cache-file.h"
+
+#include <glib/gstdio.h>
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_CONNECTION
+
+#include "debug.h"
+
+/* How long (in seconds) a GabbleCacheSaver waits before saving */
+#define SAVE_DELAY 5
+
+static gboolean
+use_memory_store (GabbleCacheFile *cache)
+{
+  return !tp_strdiff (g_getenv (cache->env_var), GABBLE_CACHE_FILE_MEMORY);
+}
+
+static gchar *
+get_path (GabbleCacheFile *cache,
+    const gchar *account)
+{
+  const gchar *dir = g_getenv (cache->env_var);
+  gchar *escaped = tp_escape_as_identifier (account);
+  gchar *filename = g_strconcat (escaped, cache->suffix, NULL);
+  gchar *path;
+
+  if (dir != NULL)
+    path = g_build_filename (dir, filename, NULL);
+  else
+    path = g_build_filename (g_get_user_cache_dir (), "telepathy", "gabble",
+        cache->dir_name, filename, NULL);
+
+  g_free (filename);
+  g_free (escaped);
+  return path;
+}
+
+/*
+ * gabble_cache_file_read:
+ *
+ * Returns: what was last saved for @account, or %NULL if nothing was
+ */
+GBytes *
+gabble_cache_file_read (GabbleCacheFile *cache,
+    const gchar *account)
+{
+  gchar *path, *contents;
+  gsize length;
+  GError *error = NULL;
+
+  if (use_memory_store (cache))
+    {
+      GBytes *bytes;
+
+      if (cache->memory_store == NULL)
+        return NULL;
+
+      bytes = g_hash_table_lookup (cache->memory_store, account);
+      return bytes == NULL ? NULL : g_bytes_ref (bytes);
+    }
+
+  path = get_path (cache, account);
+
+  if (!g_file_get_contents (path, &contents, &length, &error))
+    {
+      DEBUG ("nothing stored at %s: %s", path, error->message);
+      g_clear_error (&error);
+      g_free (path);
+      return NULL;
+    }
+
+  g_free (path);
+  return g_bytes_new_take (contents, length);
+}
+
+void
+gabble_cache_file_write (GabbleCacheFile *cache,
+    const gchar *account,
+    gconstpointer data,
+    gsize length)
+{
+  gchar *path, *dir;
+  GError *error = NULL;
+
+  if (use_memory_store (cache))
+    {
+      if (cache->memory_store == NULL)
+        cache->memory_store = g_hash_table_new_full (g_str_hash, g_str_equal,
+            g_free, (GDestroyNotify) g_bytes_unref);
+
+      g_hash_table_insert (cache->memory_store, g_strdup (account),
+          g_bytes_new (data, length));
+      return;
+    }
+
+  path = get_path (cache, account);
+  dir = g_path_get_dirname (path);
+
+  if (g_mkdir_with_parents (dir, 0700) != 0)
+    {
+      DEBUG ("couldn't create %s", dir);
+    }
+  else if (!g_file_set_contents (path, data, length, &error))
+    {
+      DEBUG ("couldn't save %s: %s", path, error->message);
+      g_clear_error (&error);
+    }
+
+  g_free (dir);
+  g_free (path);
+}
+
+void
+gabble_cache_file_remove (GabbleCacheFile *cache,
+    const gchar *account)
+{
+  gchar *path;
+
+  if (use_memory_store (cache))
+    {
+      if (cache->memory_store != NULL)
+        g_hash_table_remove (cache->memory_store, account);
+
+      return;
+    }
+
+  path = get_path (cache, account);
+  g_unlink (path);
+  g_free (path);
+}
+
+void
+gabble_cache_saver_init (GabbleCacheSaver *saver,
+    GabbleCacheSaveFunc save,
+    gpointer user_data)
+{
+  saver->save = save;
+  saver->user_data = user_data;
+  saver->dirty = FALSE;
+  saver->save_id = 0;
+}
+
+static gboolean
+save_timeout_cb (gpointer user_data)
+{
+  GabbleCacheSaver *saver = user_data;
+
+  saver->save_id = 0;
+  gabble_cache_saver_flush (saver);
+  return FALSE;
+}
+
+/*
+ * gabble_cache_saver_changed:
+ *
+ * Arranges for the owner's save function to be called shortly.
+ */
+void
+gabble_cache_saver_changed (GabbleCacheSaver *saver)
+{
+  saver->dirty = TRUE;
+
+  if (saver->save_id == 0)
+    saver->save_id = g_timeout_add_seconds (SAVE_DELAY, save_timeout_cb,
+        saver);
+}
+
+/*
+ * gabble_cache_saver_flush:
+ *
+ * Calls the owner's save function immediately if there's anything to save,
+ * and cancels the pending save. Must be called before the owner goes away.
+ */
+void
+gabble_cache_saver_flush (GabbleCacheSaver *saver)
+{
+  if (saver->save_id != 0)
+    {
+      g_source_remove (saver->save_id);
+      saver->save_id = 0;
+    }
+
+  if (!saver->dirty)
+    return;
+
+  saver->dirty = FALSE;
+  saver->save (saver->user_data);
+}
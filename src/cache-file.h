@@ -0,0 +1,81 @@
+/*
+ * cache-file.h - Header for per-account files in Gabble's cache
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_CACHE_FILE_H
+#define GABBLE_CACHE_FILE_H
+
+#include <glib.h>
+
+G_BEGIN_DECLS
+
+/* One kind of file kept per account, such as stored rosters. Declare one
+ * statically with GABBLE_CACHE_FILE_INIT. */
+typedef struct
+{
+  /* environment variable which, if set, is the directory to use instead of
+   * the default; or GABBLE_CACHE_FILE_MEMORY */
+  const gchar *env_var;
+  /* the default directory, under $XDG_CACHE_HOME/telepathy/gabble */
+  const gchar *dir_name;
+  /* appended to the escaped account to make the filename */
+  const gchar *suffix;
+
+  /* account → GBytes, for GABBLE_CACHE_FILE_MEMORY */
+  GHashTable *memory_store;
+} GabbleCacheFile;
+
+#define GABBLE_CACHE_FILE_INIT(env_var, dir_name, suffix) \
+  { env_var, dir_name, suffix, NULL }
+
+/* If the environment variable is set to this, files are only kept in memory
+ * for the lifetime of the process. The test suite uses this. */
+#define GABBLE_CACHE_FILE_MEMORY ":memory:"
+
+GBytes *gabble_cache_file_read (GabbleCacheFile *cache,
+    const gchar *account);
+void gabble_cache_file_write (GabbleCacheFile *cache,
+    const gchar *account,
+    gconstpointer data,
+    gsize length);
+void gabble_cache_file_remove (GabbleCacheFile *cache,
+    const gchar *account);
+
+/* Writes out whatever the owner of a GabbleCacheSaver has in memory */
+typedef void (* GabbleCacheSaveFunc) (gpointer user_data);
+
+/* Saves changes a little while after they're made, rather than after every
+ * one, since they tend to come in bursts. */
+typedef struct
+{
+  GabbleCacheSaveFunc save;
+  gpointer user_data;
+
+  gboolean dirty;
+  guint save_id;
+} GabbleCacheSaver;
+
+void gabble_cache_saver_init (GabbleCacheSaver *saver,
+    GabbleCacheSaveFunc save,
+    gpointer user_data);
+void gabble_cache_saver_changed (GabbleCacheSaver *saver);
+void gabble_cache_saver_flush (GabbleCacheSaver *saver);
+
+G_END_DECLS
+
+#endif /* GABBLE_CACHE_FILE_H */
@@ -19,7 +19,7 @@
  */
 
 #include "config.h"
-#include "gabble/capabilities.h"
+#include "capabilities.h"
 
 #include <stdlib.h>
 #include <string.h>
@@ -96,6 +96,8 @@ static const Feature self_advertised_features[] =
 
 static const Feature quirks[] = {
       { 0, QUIRK_OMITS_CONTENT_CREATORS },
+      { 0, QUIRK_GOOGLE_WEBMAIL_CLIENT },
+      { 0, QUIRK_ANDROID_GTALK_CLIENT },
       { 0, NULL }
 };
 
@@ -243,6 +245,10 @@ static gsize feature_handles_refcount = 0;
  * QUIRK_OMITS_CONTENT_CREATORS). */
 static TpHandleRepoIface *feature_handles = NULL;
 
+/* Sets returned by gabble_capability_set_intern(); each is both a key and its
+ * own value */
+static GHashTable *interned_sets = NULL;
+
 void
 gabble_capabilities_init (gpointer conn)
 {
@@ -268,6 +274,12 @@ gabble_capabilities_init (gpointer conn)
           gabble_capability_set_add (legacy_caps, feat->ns);
         }
 
+      /* The features we advertise have just been given the first few
+       * handles, and so fit in the dense part of a GabbleCapabilitySet.
+       * Make sure the quirks do, too. */
+      for (feat = quirks; feat->ns != NULL; feat++)
+        tp_handle_ensure (feature_handles, feat->ns, NULL, NULL);
+
 #ifdef ENABLE_VOIP
       share_v1_caps = gabble_capability_set_new ();
       gabble_capability_set_add (share_v1_caps, NS_GOOGLE_FEAT_SHARE);
@@ -372,22 +384,162 @@ gabble_capabilities_finalize (gpointer conn)
       geoloc_caps = NULL;
       olpc_caps = NULL;
 
+      tp_clear_pointer (&interned_sets, g_hash_table_unref);
       tp_clear_object (&feature_handles);
     }
 }
 
+/* Features whose handles are below this are kept in a bitmap: the features
+ * we advertise ourselves are interned first, and the ones commonly seen from
+ * other clients soon afterwards, so in practice almost every set only uses
+ * the bitmap. Anything else goes in the overflow set. */
+#define DENSE_FEATURES 256
+#define DENSE_WORDS (DENSE_FEATURES / 32)
+
 struct _GabbleCapabilitySet {
-    TpHandleSet *handles;
+    guint32 dense[DENSE_WORDS];
+    /* handles >= DENSE_FEATURES, or NULL if there are none */
+    TpIntset *overflow;
+
+    /* TRUE if this set came from gabble_capability_set_intern(), in which
+     * case it's shared, immutable and refcounted */
+    gboolean interned;
+    guint ref_count;
 };
 
+static gboolean
+set_contains (const GabbleCapabilitySet *caps,
+    guint handle)
+{
+  if (handle < DENSE_FEATURES)
+    return (caps->dense[handle / 32] & (1U << (handle % 32))) != 0;
+
+  return caps->overflow != NULL && tp_intset_is_member (caps->overflow, handle);
+}
+
+static void
+set_add_handle (GabbleCapabilitySet *caps,
+    guint handle)
+{
+  if (handle < DENSE_FEATURES)
+    {
+      caps->dense[handle / 32] |= 1U << (handle % 32);
+      return;
+    }
+
+  if (caps->overflow == NULL)
+    caps->overflow = tp_intset_new ();
+
+  tp_intset_add (caps->overflow, handle);
+}
+
+static gboolean
+set_remove_handle (GabbleCapabilitySet *caps,
+    guint handle)
+{
+  if (handle < DENSE_FEATURES)
+    {
+      guint32 bit = 1U << (handle % 32);
+      gboolean ret = (caps->dense[handle / 32] & bit) != 0;
+
+      caps->dense[handle / 32] &= ~bit;
+      return ret;
+    }
+
+  return caps->overflow != NULL && tp_intset_remove (caps->overflow, handle);
+}
+
+static gboolean
+overflow_is_empty (const GabbleCapabilitySet *caps)
+{
+  return caps->overflow == NULL || tp_intset_is_empty (caps->overflow);
+}
+
+static guint
+count_bits (guint32 word)
+{
+  guint n = 0;
+
+  while (word != 0)
+    {
+      word &= word - 1;
+      n++;
+    }
+
+  return n;
+}
+
+/* Iterates over the handles in a set, in ascending order */
+typedef struct {
+    const GabbleCapabilitySet *caps;
+    guint word;
+    guint32 bits;
+    gboolean in_overflow;
+    TpIntsetFastIter overflow_iter;
+} CapsIter;
+
+static void
+caps_iter_init (CapsIter *iter,
+    const GabbleCapabilitySet *caps)
+{
+  iter->caps = caps;
+  iter->word = 0;
+  iter->bits = caps->dense[0];
+  iter->in_overflow = FALSE;
+}
+
+static gboolean
+caps_iter_next (CapsIter *iter,
+    guint *handle)
+{
+  while (iter->word < DENSE_WORDS)
+    {
+      if (iter->bits != 0)
+        {
+          gint bit = g_bit_nth_lsf (iter->bits, -1);
+
+          iter->bits &= iter->bits - 1;
+          *handle = iter->word * 32 + bit;
+          return TRUE;
+        }
+
+      if (++iter->word < DENSE_WORDS)
+        iter->bits = iter->caps->dense[iter->word];
+    }
+
+  if (iter->caps->overflow == NULL)
+    return FALSE;
+
+  if (!iter->in_overflow)
+    {
+      tp_intset_fast_iter_init (&iter->overflow_iter, iter->caps->overflow);
+      iter->in_overflow = TRUE;
+    }
+
+  return tp_intset_fast_iter_next (&iter->overflow_iter, handle);
+}
+
+static TpIntset *
+caps_to_intset (const GabbleCapabilitySet *caps)
+{
+  TpIntset *ret = tp_intset_new ();
+  CapsIter iter;
+  guint handle;
+
+  caps_iter_init (&iter, caps);
+
+  while (caps_iter_next (&iter, &handle))
+    tp_intset_add (ret, handle);
+
+  return ret;
+}
+
 GabbleCapabilitySet *
 gabble_capability_set_new (void)
 {
-  GabbleCapabilitySet *ret = g_slice_new0 (GabbleCapabilitySet);
-
   g_assert (feature_handles != NULL);
-  ret->handles = tp_handle_set_new (feature_handles);
-  return ret;
+
+  return g_slice_new0 (GabbleCapabilitySet);
 }
 
 GabbleCapabilitySet *
@@ -448,76 +600,155 @@ gabble_capability_set_copy (const GabbleCapabilitySet *caps)
   return ret;
 }
 
+static guint
+caps_hash (gconstpointer p)
+{
+  const GabbleCapabilitySet *caps = p;
+  guint ret = 0;
+  guint i;
+
+  for (i = 0; i < DENSE_WORDS; i++)
+    ret = (ret * 31) + caps->dense[i];
+
+  /* An empty overflow set is equal to a missing one, so they must hash the
+   * same too */
+  if (!overflow_is_empty (caps))
+    {
+      TpIntsetFastIter iter;
+      guint element;
+
+      tp_intset_fast_iter_init (&iter, caps->overflow);
+
+      while (tp_intset_fast_iter_next (&iter, &element))
+        ret = (ret * 31) + element;
+    }
+
+  return ret;
+}
+
+/*
+ * gabble_capability_set_intern:
+ * @caps: a set of capabilities
+ *
+ * Contacts using the same client (and so advertising the same verification
+ * string) have the same capabilities, and there can be a lot of them, so
+ * rather than each having its own copy they can share one.
+ *
+ * Returns: a shared, read-only set with the same contents as @caps, to be
+ *  released with gabble_capability_set_free()
+ */
+GabbleCapabilitySet *
+gabble_capability_set_intern (const GabbleCapabilitySet *caps)
+{
+  GabbleCapabilitySet *ret;
+
+  g_return_val_if_fail (caps != NULL, NULL);
+  g_assert (feature_handles != NULL);
+
+  if (interned_sets == NULL)
+    interned_sets = g_hash_table_new (caps_hash,
+        (GEqualFunc) gabble_capability_set_equals);
+
+  if (caps->interned)
+    ret = (GabbleCapabilitySet *) caps;
+  else
+    ret = g_hash_table_lookup (interned_sets, caps);
+
+  if (ret == NULL)
+    {
+      ret = gabble_capability_set_copy (caps);
+      ret->interned = TRUE;
+      g_hash_table_insert (interned_sets, ret, ret);
+    }
+
+  ret->ref_count++;
+  return ret;
+}
+
 void
 gabble_capability_set_update (GabbleCapabilitySet *target,
     const GabbleCapabilitySet *source)
 {
-  TpIntset *ret;
+  guint i;
+
   g_return_if_fail (target != NULL);
   g_return_if_fail (source != NULL);
+  g_return_if_fail (!target->interned);
 
-  ret = tp_handle_set_update (target->handles,
-    tp_handle_set_peek (source->handles));
+  for (i = 0; i < DENSE_WORDS; i++)
+    target->dense[i] |= source->dense[i];
 
-  tp_intset_destroy (ret);
-}
+  if (!overflow_is_empty (source))
+    {
+      if (target->overflow == NULL)
+        target->overflow = tp_intset_new ();
 
-typedef struct {
-    GSList *deleted;
-    TpHandleSet *intersect_with;
-} IntersectHelper;
+      tp_intset_union_update (target->overflow, source->overflow);
+    }
+}
 
 static void
-intersect_helper (TpHandleSet *unused G_GNUC_UNUSED,
-    TpHandle handle,
-    gpointer p)
+debug_dropped (guint handle)
 {
-  IntersectHelper *data = p;
-
-  if (!tp_handle_set_is_member (data->intersect_with, handle))
-    data->deleted = g_slist_prepend (data->deleted, GUINT_TO_POINTER (handle));
+  DEBUG ("dropping %s", tp_handle_inspect (feature_handles, handle));
 }
 
 void
 gabble_capability_set_intersect (GabbleCapabilitySet *target,
     const GabbleCapabilitySet *source)
 {
-  IntersectHelper data = { NULL, NULL };
+  guint i;
 
   g_return_if_fail (target != NULL);
   g_return_if_fail (source != NULL);
+  g_return_if_fail (!target->interned);
 
   if (target == source)
     return;
 
-  data.intersect_with = source->handles;
+  for (i = 0; i < DENSE_WORDS; i++)
+    {
+      guint32 dropped = target->dense[i] & ~source->dense[i];
 
-  tp_handle_set_foreach (target->handles, intersect_helper, &data);
+      while (dropped != 0)
+        {
+          debug_dropped (i * 32 + g_bit_nth_lsf (dropped, -1));
+          dropped &= dropped - 1;
+        }
 
-  while (data.deleted != NULL)
-    {
-      DEBUG ("dropping %s", tp_handle_inspect (feature_handles,
-            GPOINTER_TO_UINT (data.deleted->data)));
-      tp_handle_set_remove (target->handles,
-          GPOINTER_TO_UINT (data.deleted->data));
-      data.deleted = g_slist_delete_link (data.deleted, data.deleted);
+      target->dense[i] &= source->dense[i];
     }
-}
 
-static void
-remove_from_set (TpHandleSet *unused G_GNUC_UNUSED,
-    TpHandle handle,
-    gpointer handles)
-{
-  tp_handle_set_remove (handles, handle);
+  if (!overflow_is_empty (target))
+    {
+      TpIntset *dropped;
+      TpIntsetFastIter iter;
+      guint handle;
+
+      if (source->overflow != NULL)
+        dropped = tp_intset_difference (target->overflow, source->overflow);
+      else
+        dropped = tp_intset_copy (target->overflow);
+
+      tp_intset_fast_iter_init (&iter, dropped);
+
+      while (tp_intset_fast_iter_next (&iter, &handle))
+        debug_dropped (handle);
+
+      tp_intset_difference_update (target->overflow, dropped);
+      tp_intset_destroy (dropped);
+    }
 }
 
 void
 gabble_capability_set_exclude (GabbleCapabilitySet *caps,
     const GabbleCapabilitySet *removed)
 {
+  guint i;
+
   g_return_if_fail (caps != NULL);
   g_return_if_fail (removed != NULL);
+  g_return_if_fail (!caps->interned);
 
   if (caps == removed)
     {
@@ -525,7 +756,11 @@ gabble_capability_set_exclude (GabbleCapabilitySet *caps,
       return;
     }
 
-  tp_handle_set_foreach (removed->handles, remove_from_set, caps->handles);
+  for (i = 0; i < DENSE_WORDS; i++)
+    caps->dense[i] &= ~removed->dense[i];
+
+  if (caps->overflow != NULL && removed->overflow != NULL)
+    tp_intset_difference_update (caps->overflow, removed->overflow);
 }
 
 void
@@ -536,9 +771,10 @@ gabble_capability_set_add (GabbleCapabilitySet *caps,
 
   g_return_if_fail (caps != NULL);
   g_return_if_fail (cap != NULL);
+  g_return_if_fail (!caps->interned);
 
   handle = tp_handle_ensure (feature_handles, cap, NULL, NULL);
-  tp_handle_set_add (caps->handles, handle);
+  set_add_handle (caps, handle);
 }
 
 gboolean
@@ -549,23 +785,24 @@ gabble_capability_set_remove (GabbleCapabilitySet *caps,
 
   g_return_val_if_fail (caps != NULL, FALSE);
   g_return_val_if_fail (cap != NULL, FALSE);
+  g_return_val_if_fail (!caps->interned, FALSE);
 
   handle = tp_handle_lookup (feature_handles, cap, NULL, NULL);
 
   if (handle == 0)
     return FALSE;
 
-  return tp_handle_set_remove (caps->handles, handle);
+  return set_remove_handle (caps, handle);
 }
 
 void
 gabble_capability_set_clear (GabbleCapabilitySet *caps)
 {
   g_return_if_fail (caps != NULL);
+  g_return_if_fail (!caps->interned);
 
-  /* There is no tp_handle_set_clear, so do the next best thing */
-  tp_handle_set_destroy (caps->handles);
-  caps->handles = tp_handle_set_new (feature_handles);
+  memset (caps->dense, 0, sizeof (caps->dense));
+  tp_clear_pointer (&caps->overflow, tp_intset_destroy);
 }
 
 void
@@ -573,15 +810,36 @@ gabble_capability_set_free (GabbleCapabilitySet *caps)
 {
   g_return_if_fail (caps != NULL);
 
-  tp_handle_set_destroy (caps->handles);
+  if (caps->interned)
+    {
+      g_return_if_fail (caps->ref_count > 0);
+
+      if (--caps->ref_count > 0)
+        return;
+
+      if (interned_sets != NULL)
+        g_hash_table_remove (interned_sets, caps);
+    }
+
+  tp_clear_pointer (&caps->overflow, tp_intset_destroy);
   g_slice_free (GabbleCapabilitySet, caps);
 }
 
 gint
 gabble_capability_set_size (const GabbleCapabilitySet *caps)
 {
+  guint i;
+  gint ret = 0;
+
   g_return_val_if_fail (caps != NULL, 0);
-  return tp_handle_set_size (caps->handles);
+
+  for (i = 0; i < DENSE_WORDS; i++)
+    ret += count_bits (caps->dense[i]);
+
+  if (caps->overflow != NULL)
+    ret += tp_intset_size (caps->overflow);
+
+  return ret;
 }
 
 /* By design, this function can be used as a GabbleCapabilitySetPredicate */
@@ -602,7 +860,7 @@ gabble_capability_set_has (const GabbleCapabilitySet *caps,
       return FALSE;
     }
 
-  return tp_handle_set_is_member (caps->handles, handle);
+  return set_contains (caps, handle);
 }
 
 /* By design, this function can be used as a GabbleCapabilitySetPredicate */
@@ -612,15 +870,25 @@ gabble_capability_set_has_one (const GabbleCapabilitySet *caps,
 {
   TpIntsetFastIter iter;
   guint element;
+  guint i;
 
   g_return_val_if_fail (caps != NULL, FALSE);
   g_return_val_if_fail (alternatives != NULL, FALSE);
 
-  tp_intset_fast_iter_init (&iter, tp_handle_set_peek (alternatives->handles));
+  for (i = 0; i < DENSE_WORDS; i++)
+    {
+      if ((caps->dense[i] & alternatives->dense[i]) != 0)
+        return TRUE;
+    }
+
+  if (overflow_is_empty (caps) || overflow_is_empty (alternatives))
+    return FALSE;
+
+  tp_intset_fast_iter_init (&iter, alternatives->overflow);
 
   while (tp_intset_fast_iter_next (&iter, &element))
     {
-      if (tp_handle_set_is_member (caps->handles, element))
+      if (tp_intset_is_member (caps->overflow, element))
         {
           return TRUE;
         }
@@ -636,15 +904,25 @@ gabble_capability_set_at_least (const GabbleCapabilitySet *caps,
 {
   TpIntsetFastIter iter;
   guint element;
+  guint i;
 
   g_return_val_if_fail (caps != NULL, FALSE);
   g_return_val_if_fail (query != NULL, FALSE);
 
-  tp_intset_fast_iter_init (&iter, tp_handle_set_peek (query->handles));
+  for (i = 0; i < DENSE_WORDS; i++)
+    {
+      if ((query->dense[i] & ~caps->dense[i]) != 0)
+        return FALSE;
+    }
+
+  if (overflow_is_empty (query))
+    return TRUE;
+
+  tp_intset_fast_iter_init (&iter, query->overflow);
 
   while (tp_intset_fast_iter_next (&iter, &element))
     {
-      if (!tp_handle_set_is_member (caps->handles, element))
+      if (!set_contains (caps, element))
         {
           return FALSE;
         }
@@ -660,8 +938,16 @@ gabble_capability_set_equals (const GabbleCapabilitySet *a,
   g_return_val_if_fail (a != NULL, FALSE);
   g_return_val_if_fail (b != NULL, FALSE);
 
-  return tp_intset_is_equal (tp_handle_set_peek (a->handles),
-      tp_handle_set_peek (b->handles));
+  if (a == b)
+    return TRUE;
+
+  if (memcmp (a->dense, b->dense, sizeof (a->dense)) != 0)
+    return FALSE;
+
+  if (overflow_is_empty (a) || overflow_is_empty (b))
+    return overflow_is_empty (a) && overflow_is_empty (b);
+
+  return tp_intset_is_equal (a->overflow, b->overflow);
 }
 
 /* Does not iterate over quirks, only real features. */
@@ -669,15 +955,15 @@ void
 gabble_capability_set_foreach (const GabbleCapabilitySet *caps,
     GFunc func, gpointer user_data)
 {
-  TpIntsetFastIter iter;
+  CapsIter iter;
   guint element;
 
   g_return_if_fail (caps != NULL);
   g_return_if_fail (func != NULL);
 
-  tp_intset_fast_iter_init (&iter, tp_handle_set_peek (caps->handles));
+  caps_iter_init (&iter, caps);
 
-  while (tp_intset_fast_iter_next (&iter, &element))
+  while (caps_iter_next (&iter, &element))
     {
       const gchar *var = tp_handle_inspect (feature_handles, element);
 
@@ -720,6 +1006,7 @@ gabble_capability_set_dump (const GabbleCapabilitySet *caps,
     const gchar *indent)
 {
   GString *ret;
+  TpIntset *cap_ints;
 
   g_return_val_if_fail (caps != NULL, NULL);
 
@@ -728,7 +1015,9 @@ gabble_capability_set_dump (const GabbleCapabilitySet *caps,
 
   ret = g_string_new (indent);
   g_string_append (ret, "--begin--\n");
-  append_intset (ret, tp_handle_set_peek (caps->handles), indent);
+  cap_ints = caps_to_intset (caps);
+  append_intset (ret, cap_ints, indent);
+  tp_intset_destroy (cap_ints);
   g_string_append (ret, indent);
   g_string_append (ret, "--end--\n");
   return g_string_free (ret, FALSE);
@@ -745,12 +1034,11 @@ gabble_capability_set_dump_diff (const GabbleCapabilitySet *old_caps,
   g_return_val_if_fail (old_caps != NULL, NULL);
   g_return_val_if_fail (new_caps != NULL, NULL);
 
-  old_ints = tp_handle_set_peek (old_caps->handles);
-  new_ints = tp_handle_set_peek (new_caps->handles);
-
-  if (tp_intset_is_equal (old_ints, new_ints))
+  if (gabble_capability_set_equals (old_caps, new_caps))
     return g_strdup_printf ("%s--no change--", indent);
 
+  old_ints = caps_to_intset (old_caps);
+  new_ints = caps_to_intset (new_caps);
   rem = tp_intset_difference (old_ints, new_ints);
   add = tp_intset_difference (new_ints, old_ints);
 
@@ -775,6 +1063,108 @@ gabble_capability_set_dump_diff (const GabbleCapabilitySet *old_caps,
 
   tp_intset_destroy (add);
   tp_intset_destroy (rem);
+  tp_intset_destroy (new_ints);
+  tp_intset_destroy (old_ints);
 
   return g_string_free (ret, FALSE);
 }
+
+struct _GabbleCapabilityUnion {
+    GabbleCapabilitySet *caps;
+    /* feature handle → number of added sets which contain it */
+    GHashTable *counts;
+};
+
+GabbleCapabilityUnion *
+gabble_capability_union_new (void)
+{
+  GabbleCapabilityUnion *self = g_slice_new0 (GabbleCapabilityUnion);
+
+  self->caps = gabble_capability_set_new ();
+  self->counts = g_hash_table_new (NULL, NULL);
+  return self;
+}
+
+void
+gabble_capability_union_free (GabbleCapabilityUnion *self)
+{
+  g_return_if_fail (self != NULL);
+
+  gabble_capability_set_free (self->caps);
+  g_hash_table_unref (self->counts);
+  g_slice_free (GabbleCapabilityUnion, self);
+}
+
+void
+gabble_capability_union_add (GabbleCapabilityUnion *self,
+    const GabbleCapabilitySet *caps)
+{
+  CapsIter iter;
+  guint element;
+
+  g_return_if_fail (self != NULL);
+  g_return_if_fail (caps != NULL);
+
+  caps_iter_init (&iter, caps);
+
+  while (caps_iter_next (&iter, &element))
+    {
+      gpointer key = GUINT_TO_POINTER (element);
+      guint count = GPOINTER_TO_UINT (g_hash_table_lookup (self->counts, key));
+
+      if (count == 0)
+        set_add_handle (self->caps, element);
+
+      g_hash_table_insert (self->counts, key, GUINT_TO_POINTER (count + 1));
+    }
+}
+
+/* @caps must have been passed to gabble_capability_union_add() and not
+ * modified since. */
+void
+gabble_capability_union_remove (GabbleCapabilityUnion *self,
+    const GabbleCapabilitySet *caps)
+{
+  CapsIter iter;
+  guint element;
+
+  g_return_if_fail (self != NULL);
+  g_return_if_fail (caps != NULL);
+
+  caps_iter_init (&iter, caps);
+
+  while (caps_iter_next (&iter, &element))
+    {
+      gpointer key = GUINT_TO_POINTER (element);
+      guint count = GPOINTER_TO_UINT (g_hash_table_lookup (self->counts, key));
+
+      g_return_if_fail (count > 0);
+
+      if (count == 1)
+        {
+          g_hash_table_remove (self->counts, key);
+          set_remove_handle (self->caps, element);
+        }
+      else
+        {
+          g_hash_table_insert (self->counts, key, GUINT_TO_POINTER (count - 1));
+        }
+    }
+}
+
+void
+gabble_capability_union_clear (GabbleCapabilityUnion *self)
+{
+  g_return_if_fail (self != NULL);
+
+  gabble_capability_set_clear (self->caps);
+  g_hash_table_remove_all (self->counts);
+}
+
+const GabbleCapabilitySet *
+gabble_capability_union_peek (GabbleCapabilityUnion *self)
+{
+  g_return_val_if_fail (self != NULL, NULL);
+
+  return self->caps;
+}
@@ -0,0 +1,48 @@
+/*
+ * capabilities.h - internal capability set utilities
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef __CAPABILITIES_H__
+#define __CAPABILITIES_H__
+
+#include "gabble/capabilities.h"
+
+G_BEGIN_DECLS
+
+GabbleCapabilitySet *gabble_capability_set_intern (
+    const GabbleCapabilitySet *caps);
+
+/* The union of several capability sets, which can be maintained as sets are
+ * added and removed without walking all the others. */
+typedef struct _GabbleCapabilityUnion GabbleCapabilityUnion;
+
+GabbleCapabilityUnion *gabble_capability_union_new (void);
+void gabble_capability_union_free (GabbleCapabilityUnion *self);
+
+void gabble_capability_union_add (GabbleCapabilityUnion *self,
+    const GabbleCapabilitySet *caps);
+void gabble_capability_union_remove (GabbleCapabilityUnion *self,
+    const GabbleCapabilitySet *caps);
+void gabble_capability_union_clear (GabbleCapabilityUnion *self);
+
+const GabbleCapabilitySet *gabble_capability_union_peek (
+    GabbleCapabilityUnion *self);
+
+G_END_DECLS
+
+#endif /* __CAPABILITIES_H__ */
@@ -40,19 +40,18 @@ static const char *assumed_interfaces[] = {
 
 
 static void
-_fill_contact_attributes (TpHandleRepoIface *contact_repo,
-    TpHandle contact,
+_fill_contact_attributes (const GabbleContactSnapshotEntry *contact,
     GHashTable *attributes_hash)
 {
-  gchar **uris = gabble_uris_for_handle (contact_repo, contact);
-  GHashTable *addresses = gabble_vcard_addresses_for_handle (contact_repo, contact);
+  gchar **uris = gabble_uris_for_jid (contact->jid);
+  GHashTable *addresses = gabble_vcard_addresses_for_jid (contact->jid);
 
   tp_contacts_mixin_set_contact_attribute (attributes_hash,
-      contact, TP_TOKEN_CONNECTION_INTERFACE_ADDRESSING_URIS,
+      contact->handle, TP_TOKEN_CONNECTION_INTERFACE_ADDRESSING_URIS,
       tp_g_value_slice_new_take_boxed (G_TYPE_STRV, uris));
 
   tp_contacts_mixin_set_contact_attribute (attributes_hash,
-      contact, TP_TOKEN_CONNECTION_INTERFACE_ADDRESSING_ADDRESSES,
+      contact->handle, TP_TOKEN_CONNECTION_INTERFACE_ADDRESSING_ADDRESSES,
       tp_g_value_slice_new_take_boxed (TP_HASH_TYPE_STRING_STRING_MAP, addresses));
 }
 
@@ -62,14 +61,13 @@ conn_addressing_fill_contact_attributes (GObject *obj,
     GHashTable *attributes_hash)
 {
   guint i;
-  TpHandleRepoIface *contact_repo = tp_base_connection_get_handles (
-      (TpBaseConnection *) obj, TP_HANDLE_TYPE_CONTACT);
+  GabbleContactSnapshot *snapshot = gabble_connection_ref_contact_snapshot (
+      GABBLE_CONNECTION (obj), contacts);
 
-  for (i = 0; i < contacts->len; i++)
-    {
-      TpHandle contact = g_array_index (contacts, TpHandle, i);
-      _fill_contact_attributes (contact_repo, contact, attributes_hash);
-    }
+  for (i = 0; i < snapshot->len; i++)
+    _fill_contact_attributes (snapshot->entries + i, attributes_hash);
+
+  gabble_contact_snapshot_unref (snapshot);
 }
 
 static void
@@ -98,8 +96,9 @@ conn_addressing_get_contacts_by_uri (TpSvcConnectionInterfaceAddressing *iface,
       g_array_append_val (handles, h);
     }
 
-  attributes = tp_contacts_mixin_get_contact_attributes (G_OBJECT (iface), handles,
-      interfaces, assumed_interfaces, sender);
+  attributes = gabble_connection_get_contact_attributes (
+      GABBLE_CONNECTION (iface), handles, interfaces, assumed_interfaces,
+      sender);
 
   tp_svc_connection_interface_addressing_return_from_get_contacts_by_uri (
       context, requested, attributes);
@@ -138,8 +137,9 @@ conn_addressing_get_contacts_by_vcard_field (TpSvcConnectionInterfaceAddressing
       g_array_append_val (handles, h);
     }
 
-  attributes = tp_contacts_mixin_get_contact_attributes (G_OBJECT (iface), handles,
-      interfaces, assumed_interfaces, sender);
+  attributes = gabble_connection_get_contact_attributes (
+      GABBLE_CONNECTION (iface), handles, interfaces, assumed_interfaces,
+      sender);
 
   tp_svc_connection_interface_addressing_return_from_get_contacts_by_vcard_field (
       context, requested, attributes);
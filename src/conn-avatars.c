@@ -623,35 +623,321 @@ gabble_connection_request_avatar (TpSvcConnectionInterfaceAvatars *iface,
     }
 }
 
+/* How many of RequestAvatars' vCard fetches we let into the request pipeline
+ * at once. Asking for a whole contact list's avatars would otherwise fill the
+ * pipeline, and everything else we send would have to queue up behind it. */
+#define MAX_AVATAR_FETCHES 4
+
+/* How many bytes of avatars we keep in memory, so that contacts sharing an
+ * avatar (or asked about again) don't need their vCards fetched. */
+#define AVATAR_CACHE_SIZE (2 * 1024 * 1024)
+
+/* How many AvatarRetrieved signals we emit per main loop iteration */
+#define AVATARS_PER_BATCH 16
+
+typedef struct {
+    gchar *sha1;
+    GArray *data;
+    gchar *mime_type;
+    guint refcount;
+    /* our link in avatar_lru, or NULL if we've been evicted */
+    GList *link;
+} Avatar;
+
+typedef struct {
+    TpHandle handle;
+    Avatar *avatar;
+} PendingSignal;
+
+typedef struct {
+    GabbleConnection *conn;
+    TpHandle handle;
+    /* the token we expect handle's avatar to have, if we know it and other
+     * contacts are waiting for it, or NULL */
+    gchar *token;
+} FetchContext;
+
+struct _GabbleConnectionAvatarsPrivate
+{
+  /* SHA-1 (borrowed from the Avatar) → borrowed Avatar in avatar_lru */
+  GHashTable *avatars;
+  /* Avatar, owned; the most recently used is at the head */
+  GQueue avatar_lru;
+  gsize avatar_bytes;
+
+  /* Set of contacts whose vCards are queued or being fetched, or who are
+   * waiting for somebody else's to arrive */
+  GHashTable *wanted;
+  /* owned FetchContext not yet sent to the vCard manager */
+  GQueue fetch_queue;
+  guint fetches;
+  /* token (owned) → GArray of TpHandle, for avatars we're already going to
+   * fetch on behalf of one contact but which others also have */
+  GHashTable *fetching_tokens;
+
+  /* owned PendingSignal */
+  GQueue signals;
+  guint emit_id;
+};
+
+static Avatar *
+avatar_ref (Avatar *avatar)
+{
+  avatar->refcount++;
+  return avatar;
+}
+
 static void
-emit_avatar_retrieved (TpSvcConnectionInterfaceAvatars *iface,
-                       TpHandle contact,
-                       WockyNode *vcard_node)
+avatar_unref (Avatar *avatar)
+{
+  if (--avatar->refcount > 0)
+    return;
+
+  g_free (avatar->sha1);
+  g_array_unref (avatar->data);
+  g_free (avatar->mime_type);
+  g_slice_free (Avatar, avatar);
+}
+
+static Avatar *
+avatar_cache_lookup (GabbleConnection *self,
+    const gchar *sha1)
+{
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+  Avatar *avatar = g_hash_table_lookup (priv->avatars, sha1);
+
+  if (avatar == NULL)
+    return NULL;
+
+  g_queue_unlink (&priv->avatar_lru, avatar->link);
+  g_queue_push_head_link (&priv->avatar_lru, avatar->link);
+  return avatar;
+}
+
+static void
+avatar_cache_add (GabbleConnection *self,
+    Avatar *avatar)
+{
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+
+  g_queue_push_head (&priv->avatar_lru, avatar_ref (avatar));
+  avatar->link = priv->avatar_lru.head;
+  g_hash_table_insert (priv->avatars, avatar->sha1, avatar);
+  priv->avatar_bytes += avatar->data->len;
+
+  /* We always keep the newest one, however big it is. */
+  while (priv->avatar_bytes > AVATAR_CACHE_SIZE &&
+      priv->avatar_lru.length > 1)
+    {
+      Avatar *old = g_queue_pop_tail (&priv->avatar_lru);
+
+      g_hash_table_remove (priv->avatars, old->sha1);
+      priv->avatar_bytes -= old->data->len;
+      old->link = NULL;
+      avatar_unref (old);
+    }
+}
+
+/* Returns: a new reference to the avatar in @vcard_node, or NULL if it
+ * doesn't have one */
+static Avatar *
+avatar_from_vcard (GabbleConnection *self,
+    WockyNode *vcard_node)
 {
   const gchar *mime_type;
   GString *avatar_str;
   gchar *sha1;
-  GArray *arr;
+  Avatar *avatar;
 
   if (!parse_avatar (vcard_node, &mime_type, &avatar_str, NULL))
-    return;
+    return NULL;
 
   sha1 = sha1_hex (avatar_str->str, avatar_str->len);
-  arr = g_array_new (FALSE, FALSE, sizeof (gchar));
-  g_array_append_vals (arr, avatar_str->str, avatar_str->len);
-  tp_svc_connection_interface_avatars_emit_avatar_retrieved (iface, contact,
-      sha1, arr, mime_type);
-  g_array_unref (arr);
-  g_free (sha1);
+  avatar = avatar_cache_lookup (self, sha1);
+
+  if (avatar != NULL)
+    {
+      g_free (sha1);
+      g_string_free (avatar_str, TRUE);
+      return avatar_ref (avatar);
+    }
+
+  avatar = g_slice_new0 (Avatar);
+  avatar->refcount = 1;
+  avatar->sha1 = sha1;
+  avatar->data = g_array_sized_new (FALSE, FALSE, sizeof (gchar),
+      avatar_str->len);
+  g_array_append_vals (avatar->data, avatar_str->str, avatar_str->len);
+  avatar->mime_type = g_strdup (mime_type != NULL ? mime_type : "");
   g_string_free (avatar_str, TRUE);
+
+  avatar_cache_add (self, avatar);
+  return avatar;
 }
 
-/* All references are borrowed */
-typedef struct {
-    TpHandle handle;
-    GabbleConnection *conn;
-    TpSvcConnectionInterfaceAvatars *iface;
-} RequestAvatarsContext;
+static void
+pending_signal_free (gpointer data)
+{
+  PendingSignal *s = data;
+
+  avatar_unref (s->avatar);
+  g_slice_free (PendingSignal, s);
+}
+
+static gboolean
+emit_avatars_retrieved_cb (gpointer user_data)
+{
+  GabbleConnection *self = user_data;
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+  guint i;
+
+  for (i = 0; i < AVATARS_PER_BATCH && !g_queue_is_empty (&priv->signals);
+      i++)
+    {
+      PendingSignal *s = g_queue_pop_head (&priv->signals);
+
+      tp_svc_connection_interface_avatars_emit_avatar_retrieved (self,
+          s->handle, s->avatar->sha1, s->avatar->data, s->avatar->mime_type);
+      pending_signal_free (s);
+    }
+
+  if (!g_queue_is_empty (&priv->signals))
+    return TRUE;
+
+  priv->emit_id = 0;
+  return FALSE;
+}
+
+/* Rather than emitting AvatarRetrieved for each contact as soon as we have
+ * its avatar, we queue them up and emit a batch at a time from the main
+ * loop, so that answering a big RequestAvatars call doesn't stop us from
+ * doing anything else in the meantime. */
+static void
+queue_avatar_retrieved (GabbleConnection *self,
+    TpHandle contact,
+    Avatar *avatar)
+{
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+  PendingSignal *s = g_slice_new (PendingSignal);
+
+  s->handle = contact;
+  s->avatar = avatar_ref (avatar);
+  g_queue_push_tail (&priv->signals, s);
+
+  if (priv->emit_id == 0)
+    priv->emit_id = g_idle_add (emit_avatars_retrieved_cb, self);
+}
+
+static void
+fetch_context_free (FetchContext *ctx)
+{
+  g_free (ctx->token);
+  g_slice_free (FetchContext, ctx);
+}
+
+static void
+queue_fetch (GabbleConnection *self,
+    TpHandle contact,
+    const gchar *token)
+{
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+  FetchContext *ctx = g_slice_new0 (FetchContext);
+
+  ctx->conn = self;
+  ctx->handle = contact;
+  ctx->token = g_strdup (token);
+
+  g_hash_table_add (priv->wanted, GUINT_TO_POINTER (contact));
+
+  if (token != NULL)
+    g_hash_table_insert (priv->fetching_tokens, g_strdup (token),
+        g_array_new (FALSE, FALSE, sizeof (TpHandle)));
+
+  g_queue_push_tail (&priv->fetch_queue, ctx);
+}
+
+static void
+fetch_done (FetchContext *ctx,
+    WockyNode *vcard_node,
+    gboolean retry_waiters)
+{
+  GabbleConnection *self = ctx->conn;
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+  Avatar *avatar = NULL;
+
+  g_hash_table_remove (priv->wanted, GUINT_TO_POINTER (ctx->handle));
+
+  if (vcard_node != NULL)
+    avatar = avatar_from_vcard (self, vcard_node);
+
+  if (avatar != NULL)
+    queue_avatar_retrieved (self, ctx->handle, avatar);
+
+  if (ctx->token != NULL)
+    {
+      GArray *waiters = g_array_ref (g_hash_table_lookup (
+            priv->fetching_tokens, ctx->token));
+      guint i;
+
+      g_hash_table_remove (priv->fetching_tokens, ctx->token);
+
+      for (i = 0; i < waiters->len; i++)
+        {
+          TpHandle contact = g_array_index (waiters, TpHandle, i);
+
+          g_hash_table_remove (priv->wanted, GUINT_TO_POINTER (contact));
+
+          /* If the contact we fetched turned out not to have the avatar
+           * its presence advertised, the others will have to be asked
+           * themselves. */
+          if (avatar != NULL && !tp_strdiff (avatar->sha1, ctx->token))
+            queue_avatar_retrieved (self, contact, avatar);
+          else if (retry_waiters)
+            queue_fetch (self, contact, NULL);
+        }
+
+      g_array_unref (waiters);
+    }
+
+  if (avatar != NULL)
+    avatar_unref (avatar);
+
+  fetch_context_free (ctx);
+}
+
+static void request_avatars_cb (GabbleVCardManager *manager,
+    GabbleVCardManagerRequest *request, TpHandle handle, WockyNode *vcard,
+    GError *vcard_error, gpointer user_data);
+
+static void
+start_fetches (GabbleConnection *self)
+{
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
+
+  if (tp_base_connection_get_status ((TpBaseConnection *) self) !=
+      TP_CONNECTION_STATUS_CONNECTED)
+    return;
+
+  while (priv->fetches < MAX_AVATAR_FETCHES &&
+      !g_queue_is_empty (&priv->fetch_queue))
+    {
+      FetchContext *ctx = g_queue_pop_head (&priv->fetch_queue);
+      WockyNode *vcard_node;
+
+      /* Someone else might have fetched it while this was queued. */
+      if (gabble_vcard_manager_get_cached (self->vcard_manager, ctx->handle,
+            &vcard_node))
+        {
+          fetch_done (ctx, vcard_node, TRUE);
+        }
+      else
+        {
+          priv->fetches++;
+          gabble_vcard_manager_request (self->vcard_manager, ctx->handle, 0,
+              request_avatars_cb, ctx, NULL);
+        }
+    }
+}
 
 static void
 request_avatars_cb (GabbleVCardManager *manager,
@@ -661,18 +947,37 @@ request_avatars_cb (GabbleVCardManager *manager,
                     GError *vcard_error,
                     gpointer user_data)
 {
-  RequestAvatarsContext *ctx = user_data;
+  FetchContext *ctx = user_data;
+  GabbleConnection *self = ctx->conn;
+  gboolean cancelled = g_error_matches (vcard_error,
+      GABBLE_VCARD_MANAGER_ERROR, GABBLE_VCARD_MANAGER_ERROR_CANCELLED);
 
-  g_assert (g_hash_table_lookup (ctx->conn->avatar_requests,
-      GUINT_TO_POINTER (ctx->handle)));
+  g_assert (self->avatars_priv->fetches > 0);
+  self->avatars_priv->fetches--;
+
+  fetch_done (ctx, vcard_error == NULL ? vcard : NULL, !cancelled);
+
+  /* Requests are only cancelled when we're disconnecting or going away */
+  if (!cancelled)
+    start_fetches (self);
+}
+
+static const gchar *
+get_avatar_token (GabbleConnection *self,
+    TpHandle contact)
+{
+  TpBaseConnection *base = (TpBaseConnection *) self;
+  GabblePresence *presence;
 
-  g_hash_table_remove (ctx->conn->avatar_requests,
-      GUINT_TO_POINTER (ctx->handle));
+  if (contact == tp_base_connection_get_self_handle (base))
+    presence = self->self_presence;
+  else
+    presence = gabble_presence_cache_get (self->presence_cache, contact);
 
-  if (vcard_error == NULL)
-    emit_avatar_retrieved (ctx->iface, handle, vcard);
+  if (presence == NULL || tp_str_empty (presence->avatar_sha1))
+    return NULL;
 
-  g_slice_free (RequestAvatarsContext, ctx);
+  return presence->avatar_sha1;
 }
 
 static void
@@ -682,10 +987,11 @@ gabble_connection_request_avatars (TpSvcConnectionInterfaceAvatars *iface,
 {
   GabbleConnection *self = GABBLE_CONNECTION (iface);
   TpBaseConnection *base = (TpBaseConnection *) self;
+  GabbleConnectionAvatarsPrivate *priv = self->avatars_priv;
   TpHandleRepoIface *contacts_repo =
       tp_base_connection_get_handles (base, TP_HANDLE_TYPE_CONTACT);
   GError *error = NULL;
-  guint i;
+  guint i, hits = 0, shared = 0, queued = 0;
 
   TP_BASE_CONNECTION_ERROR_IF_NOT_CONNECTED (base, context);
 
@@ -700,32 +1006,57 @@ gabble_connection_request_avatars (TpSvcConnectionInterfaceAvatars *iface,
     {
       WockyNode *vcard_node;
       TpHandle contact = g_array_index (contacts, TpHandle, i);
+      const gchar *token = get_avatar_token (self, contact);
+      Avatar *avatar = NULL;
+      GArray *waiters = NULL;
 
-      if (gabble_vcard_manager_get_cached (self->vcard_manager,
-            contact, &vcard_node))
+      if (token != NULL)
         {
-          emit_avatar_retrieved (iface, contact, vcard_node);
+          avatar = avatar_cache_lookup (self, token);
+          waiters = g_hash_table_lookup (priv->fetching_tokens, token);
         }
-      else
-        {
-          if (NULL == g_hash_table_lookup (self->avatar_requests,
-                GUINT_TO_POINTER (contact)))
-            {
-              RequestAvatarsContext *ctx = g_slice_new (RequestAvatarsContext);
-
-              ctx->conn = self;
-              ctx->iface = iface;
-              ctx->handle = contact;
 
-              g_hash_table_insert (self->avatar_requests,
-                  GUINT_TO_POINTER (contact), ctx);
+      if (avatar != NULL)
+        {
+          queue_avatar_retrieved (self, contact, avatar);
+          hits++;
+        }
+      else if (gabble_vcard_manager_get_cached (self->vcard_manager,
+            contact, &vcard_node))
+        {
+          avatar = avatar_from_vcard (self, vcard_node);
 
-              gabble_vcard_manager_request (self->vcard_manager,
-                contact, 0, request_avatars_cb, ctx, NULL);
+          if (avatar != NULL)
+            {
+              queue_avatar_retrieved (self, contact, avatar);
+              avatar_unref (avatar);
             }
         }
+      else if (g_hash_table_contains (priv->wanted,
+            GUINT_TO_POINTER (contact)))
+        {
+          /* we're already on it */
+        }
+      else if (waiters != NULL)
+        {
+          g_array_append_val (waiters, contact);
+          g_hash_table_add (priv->wanted, GUINT_TO_POINTER (contact));
+          shared++;
+        }
+      else
+        {
+          queue_fetch (self, contact, token);
+          queued++;
+        }
     }
 
+  DEBUG ("%u contacts: %u avatars already known, %u waiting for another "
+      "contact's vCard, %u vCards queued; %u fetches outstanding",
+      contacts->len, hits, shared, queued,
+      priv->fetches + priv->fetch_queue.length);
+
+  start_fetches (self);
+
   tp_svc_connection_interface_avatars_return_from_request_avatars (context);
 }
 
@@ -896,18 +1227,13 @@ conn_avatars_fill_contact_attributes (GObject *obj,
     const GArray *contacts, GHashTable *attributes_hash)
 {
   guint i;
-  GabbleConnection *self = GABBLE_CONNECTION(obj);
-  TpBaseConnection *base = (TpBaseConnection *) self;
+  GabbleContactSnapshot *snapshot = gabble_connection_ref_contact_snapshot (
+      GABBLE_CONNECTION (obj), contacts);
 
-  for (i = 0; i < contacts->len; i++)
+  for (i = 0; i < snapshot->len; i++)
     {
-      TpHandle handle = g_array_index (contacts, guint, i);
-      GabblePresence *presence = NULL;
-
-      if (tp_base_connection_get_self_handle (base) == handle)
-        presence = self->self_presence;
-      else
-        presence = gabble_presence_cache_get (self->presence_cache, handle);
+      TpHandle handle = snapshot->entries[i].handle;
+      GabblePresence *presence = snapshot->entries[i].presence;
 
       if (NULL != presence)
         {
@@ -922,14 +1248,24 @@ conn_avatars_fill_contact_attributes (GObject *obj,
             TP_IFACE_CONNECTION_INTERFACE_AVATARS"/token", val);
         }
     }
+
+  gabble_contact_snapshot_unref (snapshot);
 }
 
 
 void
 conn_avatars_init (GabbleConnection *conn)
 {
+  GabbleConnectionAvatarsPrivate *priv;
+
   g_assert (conn->vcard_manager != NULL);
 
+  priv = conn->avatars_priv = g_slice_new0 (GabbleConnectionAvatarsPrivate);
+  priv->avatars = g_hash_table_new (g_str_hash, g_str_equal);
+  priv->wanted = g_hash_table_new (NULL, NULL);
+  priv->fetching_tokens = g_hash_table_new_full (g_str_hash, g_str_equal,
+      g_free, (GDestroyNotify) g_array_unref);
+
   g_signal_connect (conn->vcard_manager, "got-self-initial-avatar", G_CALLBACK
       (connection_got_self_initial_avatar_cb), conn);
   g_signal_connect (conn->presence_cache, "avatar-update", G_CALLBACK
@@ -941,6 +1277,35 @@ conn_avatars_init (GabbleConnection *conn)
 }
 
 
+/* Called after the vCard manager has gone away, so there are no fetches
+ * outstanding any more */
+void
+conn_avatars_dispose (GabbleConnection *conn)
+{
+  GabbleConnectionAvatarsPrivate *priv = conn->avatars_priv;
+
+  if (priv == NULL)
+    return;
+
+  if (priv->emit_id != 0)
+    g_source_remove (priv->emit_id);
+
+  g_queue_foreach (&priv->signals, (GFunc) pending_signal_free, NULL);
+  g_queue_clear (&priv->signals);
+  g_queue_foreach (&priv->fetch_queue, (GFunc) fetch_context_free, NULL);
+  g_queue_clear (&priv->fetch_queue);
+  g_queue_foreach (&priv->avatar_lru, (GFunc) avatar_unref, NULL);
+  g_queue_clear (&priv->avatar_lru);
+
+  g_hash_table_unref (priv->avatars);
+  g_hash_table_unref (priv->wanted);
+  g_hash_table_unref (priv->fetching_tokens);
+
+  g_slice_free (GabbleConnectionAvatarsPrivate, priv);
+  conn->avatars_priv = NULL;
+}
+
+
 void
 conn_avatars_iface_init (gpointer g_iface, gpointer iface_data)
 {
@@ -26,6 +26,7 @@
 G_BEGIN_DECLS
 
 void conn_avatars_init (GabbleConnection *conn);
+void conn_avatars_dispose (GabbleConnection *conn);
 void conn_avatars_iface_init (gpointer g_iface, gpointer iface_data);
 
 extern TpDBusPropertiesMixinPropImpl *conn_avatars_properties;
@@ -37,13 +37,11 @@
 #include "debug.h"
 
 static gboolean
-get_client_types_from_handle (GabbleConnection *conn,
+get_client_types_from_presence (GabbleConnection *conn,
     TpHandle handle,
+    GabblePresence *presence,
     gchar ***types_out)
 {
-  GabblePresence *presence = gabble_presence_cache_get (conn->presence_cache,
-      handle);
-
   g_return_val_if_fail (types_out != NULL, FALSE);
 
   if (presence == NULL)
@@ -78,6 +76,15 @@ get_client_types_from_handle (GabbleConnection *conn,
     }
 }
 
+static gboolean
+get_client_types_from_handle (GabbleConnection *conn,
+    TpHandle handle,
+    gchar ***types_out)
+{
+  return get_client_types_from_presence (conn, handle,
+      gabble_presence_cache_get (conn->presence_cache, handle), types_out);
+}
+
 static void
 client_types_get_client_types (TpSvcConnectionInterfaceClientTypes *iface,
     const GArray *contacts,
@@ -189,15 +196,20 @@ conn_client_types_fill_contact_attributes (GObject *obj,
     GHashTable *attributes_hash)
 {
   GabbleConnection *conn = GABBLE_CONNECTION (obj);
+  GabbleContactSnapshot *snapshot = gabble_connection_ref_contact_snapshot (
+      conn, contacts);
   guint i;
 
-  for (i = 0; i < contacts->len; i++)
+  for (i = 0; i < snapshot->len; i++)
     {
-      TpHandle handle = g_array_index (contacts, TpHandle, i);
+      TpHandle handle = snapshot->entries[i].handle;
       GValue *val;
       gchar **types;
 
-      if (!get_client_types_from_handle (conn, handle, &types))
+      /* like get_client_types_from_handle(), this uses the presence cache
+       * even for the self-handle */
+      if (!get_client_types_from_presence (conn, handle,
+            snapshot->entries[i].cached_presence, &types))
         continue;
 
       val = tp_g_value_slice_new_take_boxed (G_TYPE_STRV, types);
@@ -205,6 +217,8 @@ conn_client_types_fill_contact_attributes (GObject *obj,
       tp_contacts_mixin_set_contact_attribute (attributes_hash, handle,
           TP_IFACE_CONNECTION_INTERFACE_CLIENT_TYPES "/client-types", val);
     }
+
+  gabble_contact_snapshot_unref (snapshot);
 }
 
 typedef struct
@@ -25,6 +25,7 @@
 #include "debug.h"
 #include "namespaces.h"
 #include "util.h"
+#include "conn-presence.h"
 #include "conn-util.h"
 
 #include <wocky/wocky.h>
@@ -60,6 +61,21 @@ google_queueing_send_command (
   g_object_unref (stanza);
 }
 
+/* XEP-0352 */
+static void
+send_client_state (GabbleConnection *conn,
+    gboolean active)
+{
+  WockyPorter *porter = gabble_connection_dup_porter (conn);
+  WockyStanza *stanza = wocky_stanza_new (active ? "active" : "inactive",
+      NS_CLIENT_STATE_INDICATION);
+
+  wocky_porter_send (porter, stanza);
+
+  g_object_unref (stanza);
+  g_object_unref (porter);
+}
+
 static void
 maybe_emit_power_saving_changed (GabbleConnection *self,
     gboolean enabling)
@@ -154,15 +170,38 @@ conn_power_saving_set_power_saving (
       google_queueing_send_command (self, enable ? "enable" : "disable",
           toggle_google_queueing_cb, queueing_context);
     }
+  else if (self->features & GABBLE_CONNECTION_FEATURES_CLIENT_STATE_INDICATION)
+    {
+      /* The server decides what it can hold back while we're inactive. It
+       * doesn't reply, so there's nothing to wait for. */
+      send_client_state (self, !enable);
+      DEBUG ("told the server we're %sactive", enable ? "in" : "");
+      maybe_emit_power_saving_changed (self, enable);
+
+      tp_svc_connection_interface_power_saving_return_from_set_power_saving (
+          context);
+    }
   else
     {
       /* If the server doesn't support any method of queueing, we can still
-       * do it locally by enabling power save mode on Wocky. */
+       * do it locally by enabling power save mode on Wocky. On top of that,
+       * we hold presence changes back from D-Bus until power saving ends,
+       * so that a contact who changes presence several times, or a stanza
+       * that flushes Wocky's queue, only wakes clients up once. */
       WockyPorter *porter = gabble_connection_dup_porter (self);
 
+      if (enable)
+        conn_presence_hold_updates (self, TRUE);
+
       wocky_c2s_porter_enable_power_saving_mode (WOCKY_C2S_PORTER (porter), enable);
       DEBUG ("%sabled local stanza queueing", enable ? "En" : "Dis");
       g_object_unref (porter);
+
+      /* Disabling it on Wocky handles everything it had queued, so the
+       * presences in there are held along with the rest. */
+      if (!enable)
+        conn_presence_hold_updates (self, FALSE);
+
       maybe_emit_power_saving_changed (self, enable);
 
       tp_svc_connection_interface_power_saving_return_from_set_power_saving (
@@ -52,6 +52,15 @@ typedef enum {
     INVISIBILITY_METHOD_SHARED_STATUS
 } InvisibilityMethod;
 
+typedef enum {
+    /* We haven't asked for the privacy lists early */
+    PRIVACY_LISTS_PREFETCH_NONE = 0,
+    PRIVACY_LISTS_PREFETCH_PENDING,
+    PRIVACY_LISTS_PREFETCH_DONE,
+    /* We asked for them early, but it turned out we use shared status */
+    PRIVACY_LISTS_PREFETCH_UNWANTED
+} PrivacyListsPrefetch;
+
 struct _GabbleConnectionPresencePrivate {
     InvisibilityMethod invisibility_method;
     guint iq_list_push_id;
@@ -82,6 +91,19 @@ struct _GabbleConnectionPresencePrivate {
 
     /* The previous presence when using shared status */
     GabblePresenceId previous_shared_status;
+
+    /* See conn_presence_prefetch() */
+    PrivacyListsPrefetch privacy_lists_prefetch;
+    gboolean privacy_lists_prefetched;
+    /* Setting the initial presence, if it's waiting for the privacy lists
+     * we asked for early */
+    GSimpleAsyncResult *waiting_for_privacy_lists;
+
+    /* Contacts whose presence has changed since conn_presence_hold_updates()
+     * was told to hold them, or NULL if we're not holding them; and how many
+     * more times it has been told to hold them than to stop */
+    TpHandleSet *held_updates;
+    guint hold_count;
 };
 
 static const TpPresenceStatusOptionalArgumentSpec gabble_status_arguments[] = {
@@ -185,21 +207,19 @@ construct_contact_statuses_cb (GObject *obj,
   const gchar *status_message;
   TpHandleRepoIface *handle_repo = tp_base_connection_get_handles (base,
       TP_HANDLE_TYPE_CONTACT);
+  GabbleContactSnapshot *snapshot;
 
   if (!tp_handles_are_valid (handle_repo, contact_handles, FALSE, error))
     return NULL;
 
   contact_statuses = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
       (GDestroyNotify) tp_presence_status_free);
+  snapshot = gabble_connection_ref_contact_snapshot (self, contact_handles);
 
-  for (i = 0; i < contact_handles->len; i++)
+  for (i = 0; i < snapshot->len; i++)
     {
-      handle = g_array_index (contact_handles, TpHandle, i);
-
-      if (handle == tp_base_connection_get_self_handle (base))
-        presence = self->self_presence;
-      else
-        presence = gabble_presence_cache_get (self->presence_cache, handle);
+      handle = snapshot->entries[i].handle;
+      presence = snapshot->entries[i].presence;
 
       if (presence)
         {
@@ -233,6 +253,7 @@ construct_contact_statuses_cb (GObject *obj,
           contact_status);
     }
 
+  gabble_contact_snapshot_unref (snapshot);
   return contact_statuses;
 }
 
@@ -1377,17 +1398,15 @@ toggle_initial_presence_visibility_cb (GObject *source_object,
 }
 
 static void
-privacy_lists_loaded_cb (GObject *source_object,
-    GAsyncResult *result,
-    gpointer user_data)
+privacy_lists_loaded (GabbleConnection *self,
+    gboolean loaded,
+    GSimpleAsyncResult *external_result)
 {
-  GabbleConnection *self = GABBLE_CONNECTION (source_object);
   GabbleConnectionPresencePrivate *priv = self->presence_priv;
-  GError *error = NULL;
 
-  if (get_existing_privacy_lists_finish (self, result, &error))
+  if (loaded)
     {
-      /* if the above call succeeded, the server supports privacy
+      /* if the lists were loaded, the server supports privacy
        * lists, so this should be initialised. */
       g_assert (priv->privacy_statuses != NULL);
 
@@ -1403,10 +1422,53 @@ privacy_lists_loaded_cb (GObject *source_object,
 
   if (priv->invisibility_method == INVISIBILITY_METHOD_PRIVACY)
     setup_invisible_privacy_list_async (self, initial_presence_setup_cb,
-        user_data);
+        external_result);
   else
     toggle_presence_visibility_async (self,
-        toggle_initial_presence_visibility_cb, user_data);
+        toggle_initial_presence_visibility_cb, external_result);
+}
+
+static void
+privacy_lists_loaded_cb (GObject *source_object,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  GabbleConnection *self = GABBLE_CONNECTION (source_object);
+  gboolean loaded;
+
+  gabble_connection_mark_phase (self, "privacy-lists");
+
+  loaded = get_existing_privacy_lists_finish (self, result, NULL);
+  privacy_lists_loaded (self, loaded, user_data);
+}
+
+static void
+privacy_lists_prefetched_cb (GObject *source_object,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  GabbleConnection *self = GABBLE_CONNECTION (source_object);
+  GabbleConnectionPresencePrivate *priv = self->presence_priv;
+  GSimpleAsyncResult *waiting = priv->waiting_for_privacy_lists;
+  gboolean loaded = get_existing_privacy_lists_finish (self, result, NULL);
+
+  if (priv->privacy_lists_prefetch == PRIVACY_LISTS_PREFETCH_UNWANTED)
+    {
+      /* We'd never have asked for them if we'd known, so forget them */
+      tp_clear_pointer (&priv->privacy_statuses, g_hash_table_unref);
+      return;
+    }
+
+  gabble_connection_mark_phase (self, "privacy-lists");
+
+  priv->privacy_lists_prefetch = PRIVACY_LISTS_PREFETCH_DONE;
+  priv->privacy_lists_prefetched = loaded;
+
+  if (waiting != NULL)
+    {
+      priv->waiting_for_privacy_lists = NULL;
+      privacy_lists_loaded (self, loaded, waiting);
+    }
 }
 
 static void
@@ -1450,6 +1512,8 @@ shared_status_setup_cb (GObject *source_object,
   GabbleConnection *self = GABBLE_CONNECTION (source_object);
   GabbleConnectionPresencePrivate *priv = self->presence_priv;
 
+  gabble_connection_mark_phase (self, "shared-status");
+
   if (get_shared_status_finish (self, result, &error))
     {
       WockyPorter *porter = wocky_session_get_porter (self->session);
@@ -1487,9 +1551,54 @@ conn_presence_set_initial_presence_async (GabbleConnection *self,
     priv->invisibility_method = INVISIBILITY_METHOD_INVISIBLE_COMMAND;
 
   if (self->features & GABBLE_CONNECTION_FEATURES_GOOGLE_SHARED_STATUS)
-    get_shared_status_async (self, shared_status_setup_cb, result);
-  else
-    get_existing_privacy_lists_async (self, privacy_lists_loaded_cb, result);
+    {
+      if (priv->privacy_lists_prefetch == PRIVACY_LISTS_PREFETCH_DONE)
+        tp_clear_pointer (&priv->privacy_statuses, g_hash_table_unref);
+
+      if (priv->privacy_lists_prefetch != PRIVACY_LISTS_PREFETCH_NONE)
+        priv->privacy_lists_prefetch = PRIVACY_LISTS_PREFETCH_UNWANTED;
+
+      get_shared_status_async (self, shared_status_setup_cb, result);
+      return;
+    }
+
+  switch (priv->privacy_lists_prefetch)
+    {
+      case PRIVACY_LISTS_PREFETCH_PENDING:
+        DEBUG ("waiting for the privacy lists we asked for earlier");
+        priv->waiting_for_privacy_lists = result;
+        break;
+
+      case PRIVACY_LISTS_PREFETCH_DONE:
+        privacy_lists_loaded (self, priv->privacy_lists_prefetched, result);
+        break;
+
+      default:
+        get_existing_privacy_lists_async (self, privacy_lists_loaded_cb,
+            result);
+    }
+}
+
+/*
+ * conn_presence_prefetch:
+ *
+ * Asks for the list of privacy lists straight away, rather than waiting to
+ * find out from the server's disco reply whether we'll need it, to save a
+ * round trip while connecting. If we turn out not to need it because the
+ * server supports Google's shared status, the reply is ignored.
+ *
+ * This must be called before conn_presence_set_initial_presence_async().
+ */
+void
+conn_presence_prefetch (GabbleConnection *self)
+{
+  GabbleConnectionPresencePrivate *priv = self->presence_priv;
+
+  g_return_if_fail (priv->privacy_lists_prefetch ==
+      PRIVACY_LISTS_PREFETCH_NONE);
+
+  priv->privacy_lists_prefetch = PRIVACY_LISTS_PREFETCH_PENDING;
+  get_existing_privacy_lists_async (self, privacy_lists_prefetched_cb, NULL);
 }
 
 gboolean
@@ -1845,8 +1954,69 @@ connection_presences_updated_cb (
     gpointer user_data)
 {
   GabbleConnection *conn = GABBLE_CONNECTION (user_data);
+  GabbleConnectionPresencePrivate *priv = conn->presence_priv;
+  guint i;
+
+  if (priv->held_updates == NULL)
+    {
+      conn_presence_emit_presence_update (conn, handles);
+      return;
+    }
+
+  /* However many times they change, we only need to say so once, with
+   * whatever their presence is by then. */
+  for (i = 0; i < handles->len; i++)
+    tp_handle_set_add (priv->held_updates,
+        g_array_index (handles, TpHandle, i));
+}
+
+/*
+ * conn_presence_hold_updates:
+ * @self: A #GabbleConnection
+ * @hold: whether to hold contacts' presence updates back from D-Bus
+ *
+ * While updates are held, we keep track of which contacts' presences have
+ * changed rather than signalling each change. When we stop holding them, we
+ * signal the latest presence of each of those contacts, all at once. Our own
+ * presence is signalled as usual.
+ *
+ * Calls nest: updates are held until every call with @hold %TRUE has been
+ * matched by one with @hold %FALSE.
+ */
+void
+conn_presence_hold_updates (GabbleConnection *self,
+    gboolean hold)
+{
+  GabbleConnectionPresencePrivate *priv = self->presence_priv;
+  TpHandleSet *held = priv->held_updates;
+
+  if (hold)
+    {
+      if (priv->hold_count++ == 0)
+        priv->held_updates = tp_handle_set_new (
+            tp_base_connection_get_handles ((TpBaseConnection *) self,
+                TP_HANDLE_TYPE_CONTACT));
+
+      return;
+    }
+
+  g_return_if_fail (priv->hold_count > 0);
+
+  if (--priv->hold_count > 0)
+    return;
+
+  priv->held_updates = NULL;
+
+  if (!tp_handle_set_is_empty (held))
+    {
+      GArray *handles = tp_handle_set_to_array (held);
+
+      DEBUG ("signalling %u held presence updates", handles->len);
+      conn_presence_emit_presence_update (self, handles);
+      g_array_unref (handles);
+    }
 
-  conn_presence_emit_presence_update (conn, handles);
+  tp_handle_set_destroy (held);
 }
 
 
@@ -1998,6 +2168,7 @@ conn_presence_finalize (GabbleConnection *conn)
   GabbleConnectionPresencePrivate *priv = conn->presence_priv;
 
   g_free (priv->invisible_list_name);
+  tp_clear_pointer (&priv->held_updates, tp_handle_set_destroy);
 
   if (priv->privacy_statuses != NULL)
       g_hash_table_unref (priv->privacy_statuses);
@@ -51,6 +51,8 @@ gboolean conn_presence_signal_own_presence (GabbleConnection *self,
     const gchar *to, GError **error);
 gboolean conn_presence_visible_to (GabbleConnection *self,
     TpHandle recipient);
+void conn_presence_prefetch (GabbleConnection *self);
+void conn_presence_hold_updates (GabbleConnection *self, gboolean hold);
 void conn_presence_set_initial_presence_async (GabbleConnection *self,
     GAsyncReadyCallback callback, gpointer user_data);
 gboolean conn_presence_set_initial_presence_finish (GabbleConnection *self,
@@ -65,12 +65,14 @@
 #include "roomlist-manager.h"
 #include "roster.h"
 #include "search-manager.h"
+#include "stream-management.h"
 #include "server-tls-channel.h"
 #include "server-tls-manager.h"
 #include "plugin-loader.h"
 #include "private-tubes-factory.h"
 #include "util.h"
 #include "vcard-manager.h"
+#include "watchdog.h"
 #include "conn-util.h"
 #include "conn-addressing.h"
 
@@ -83,6 +85,7 @@ static guint disco_reply_timeout = 5;
 #define DISCONNECT_TIMEOUT 5
 
 static void gabble_conn_contact_caps_iface_init (gpointer, gpointer);
+static void conn_contacts_iface_init (gpointer, gpointer);
 static void conn_contact_capabilities_fill_contact_attributes (GObject *obj,
   const GArray *contacts, GHashTable *attributes_hash);
 static void gabble_plugin_connection_iface_init (
@@ -105,7 +108,7 @@ G_DEFINE_TYPE_WITH_CODE(GabbleConnection,
     G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_DBUS_PROPERTIES,
        tp_dbus_properties_mixin_iface_init);
     G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CONNECTION_INTERFACE_CONTACTS,
-      tp_contacts_mixin_iface_init);
+      conn_contacts_iface_init);
     G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CONNECTION_INTERFACE_CONTACT_LIST,
       tp_base_contact_list_mixin_list_iface_init);
     G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CONNECTION_INTERFACE_CONTACT_GROUPS,
@@ -116,6 +119,11 @@ G_DEFINE_TYPE_WITH_CODE(GabbleConnection,
       tp_presence_mixin_simple_presence_iface_init);
     G_IMPLEMENT_INTERFACE (GABBLE_TYPE_SVC_CONNECTION_INTERFACE_GABBLE_DECLOAK,
       conn_decloak_iface_init);
+    G_IMPLEMENT_INTERFACE (GABBLE_TYPE_SVC_CONNECTION_INTERFACE_GABBLE_DEBUG,
+      NULL);
+    G_IMPLEMENT_INTERFACE (
+      GABBLE_TYPE_SVC_CONNECTION_INTERFACE_GABBLE_FILE_TRANSFER_PROGRESS,
+      NULL);
     G_IMPLEMENT_INTERFACE (TP_TYPE_SVC_CONNECTION_INTERFACE_LOCATION,
       location_iface_init);
     G_IMPLEMENT_INTERFACE (GABBLE_TYPE_SVC_OLPC_BUDDY_INFO,
@@ -149,6 +157,7 @@ enum
     PROP_REQUIRE_ENCRYPTION,
     PROP_REGISTER,
     PROP_LOW_BANDWIDTH,
+    PROP_PARALLEL_CONNECT,
     PROP_STREAM_SERVER,
     PROP_USERNAME,
     PROP_PASSWORD,
@@ -165,15 +174,31 @@ enum
     PROP_ALIAS,
     PROP_FALLBACK_SOCKS5_PROXIES,
     PROP_KEEPALIVE_INTERVAL,
+    PROP_SEARCH_PAGE_SIZE,
     PROP_DECLOAK_AUTOMATICALLY,
     PROP_FALLBACK_SERVERS,
     PROP_EXTRA_CERTIFICATE_IDENTITIES,
     PROP_POWER_SAVING,
     PROP_DOWNLOAD_AT_CONNECTION,
+    PROP_ADAPTIVE_PROGRESS,
+    PROP_ACTIVE_TRANSFERS,
+    PROP_TRANSFERRED_BYTES,
+    PROP_TOTAL_BYTES,
+    PROP_CONNECTION_PHASES,
+    PROP_MAIN_LOOP_LATENCY,
+    PROP_SLOW_CALLBACKS,
+    PROP_BYTESTREAM_USAGE,
 
     LAST_PROPERTY
 };
 
+typedef struct {
+    /* a static string */
+    const gchar *name;
+    /* microseconds after Connect() */
+    gint64 time;
+} ConnectionPhase;
+
 /* private structure */
 
 struct _GabbleConnectionPrivate
@@ -181,6 +206,8 @@ struct _GabbleConnectionPrivate
   WockyConnector *connector;
   WockyPorter *porter;
   WockyPing *pinger;
+  /* NULL unless the server supports XEP-0198 */
+  GabbleStreamManagement *stream_management;
 
   GCancellable *cancellable;
 
@@ -198,8 +225,12 @@ struct _GabbleConnectionPrivate
 
   gboolean low_bandwidth;
 
+  gboolean parallel_connect;
+
   guint keepalive_interval;
 
+  guint search_page_size;
+
   gchar *https_proxy_server;
   guint16 https_proxy_port;
 
@@ -215,6 +246,8 @@ struct _GabbleConnectionPrivate
 
   gboolean decloak_automatically;
 
+  gboolean adaptive_progress;
+
   GStrv fallback_servers;
   guint fallback_server_index;
 
@@ -222,6 +255,11 @@ struct _GabbleConnectionPrivate
 
   gboolean power_saving;
 
+  /* When Connect() was called, or 0 if it hasn't been */
+  gint64 connect_time;
+  /* ConnectionPhase, in the order they finished */
+  GArray *phases;
+
   /* authentication properties */
   gchar *stream_server;
   gchar *username;
@@ -273,6 +311,12 @@ struct _GabbleConnectionPrivate
   /* stream id returned by the connector */
   gchar *stream_id;
 
+  /* TRUE while gabble_connection_get_contact_attributes() is running, when
+   * contact_snapshot is the snapshot the attribute fillers share, or NULL if
+   * none of them has asked for one yet */
+  gboolean sharing_contact_snapshot;
+  GabbleContactSnapshot *contact_snapshot;
+
   /* timer used when trying to properly disconnect */
   guint disconnect_timer;
 
@@ -452,7 +496,6 @@ gabble_connection_constructor (GType type,
 
   self->bytestream_factory = gabble_bytestream_factory_new (self);
 
-  self->avatar_requests = g_hash_table_new (NULL, NULL);
   self->vcard_requests = g_hash_table_new (NULL, NULL);
 
   if (priv->fallback_socks5_proxies == NULL)
@@ -554,6 +597,7 @@ gabble_connection_init (GabbleConnection *self)
   priv->caps_serial = 1;
   priv->last_activity_time = time (NULL);
   priv->port = 5222;
+  priv->phases = g_array_new (FALSE, FALSE, sizeof (ConnectionPhase));
 
   gabble_capabilities_init (self);
 }
@@ -592,6 +636,9 @@ gabble_connection_get_property (GObject    *object,
     case PROP_LOW_BANDWIDTH:
       g_value_set_boolean (value, priv->low_bandwidth);
       break;
+    case PROP_PARALLEL_CONNECT:
+      g_value_set_boolean (value, priv->parallel_connect);
+      break;
     case PROP_USERNAME:
       g_value_set_string (value, priv->username);
       break;
@@ -637,11 +684,57 @@ gabble_connection_get_property (GObject    *object,
     case PROP_KEEPALIVE_INTERVAL:
       g_value_set_uint (value, priv->keepalive_interval);
       break;
+    case PROP_SEARCH_PAGE_SIZE:
+      g_value_set_uint (value, priv->search_page_size);
+      break;
 
     case PROP_DECLOAK_AUTOMATICALLY:
       g_value_set_boolean (value, priv->decloak_automatically);
       break;
 
+    case PROP_ADAPTIVE_PROGRESS:
+      g_value_set_boolean (value, priv->adaptive_progress);
+      break;
+
+    case PROP_ACTIVE_TRANSFERS:
+    case PROP_TRANSFERRED_BYTES:
+    case PROP_TOTAL_BYTES:
+      {
+        guint active = 0;
+        guint64 transferred = 0, total = 0;
+
+#ifdef ENABLE_FILE_TRANSFER
+        if (self->ft_manager != NULL)
+          gabble_ft_manager_get_progress (self->ft_manager, &active,
+              &transferred, &total);
+#endif
+
+        if (property_id == PROP_ACTIVE_TRANSFERS)
+          g_value_set_uint (value, active);
+        else if (property_id == PROP_TRANSFERRED_BYTES)
+          g_value_set_uint64 (value, transferred);
+        else
+          g_value_set_uint64 (value, total);
+        break;
+      }
+
+    case PROP_CONNECTION_PHASES:
+      g_value_take_boxed (value, gabble_connection_dup_phases (self));
+      break;
+
+    case PROP_MAIN_LOOP_LATENCY:
+      g_value_take_boxed (value, gabble_watchdog_dup_latency_histogram ());
+      break;
+
+    case PROP_SLOW_CALLBACKS:
+      g_value_take_boxed (value, gabble_watchdog_dup_slow_callbacks ());
+      break;
+
+    case PROP_BYTESTREAM_USAGE:
+      g_value_take_boxed (value, gabble_bytestream_budget_dup_usage (
+          gabble_bytestream_factory_get_budget (self->bytestream_factory)));
+      break;
+
     case PROP_FALLBACK_SERVERS:
       g_value_set_boxed (value, priv->fallback_servers);
       break;
@@ -708,6 +801,9 @@ gabble_connection_set_property (GObject      *object,
     case PROP_LOW_BANDWIDTH:
       priv->low_bandwidth = g_value_get_boolean (value);
       break;
+    case PROP_PARALLEL_CONNECT:
+      priv->parallel_connect = g_value_get_boolean (value);
+      break;
     case PROP_STREAM_SERVER:
       g_free (priv->stream_server);
       priv->stream_server = g_value_dup_string (value);
@@ -786,11 +882,18 @@ gabble_connection_set_property (GObject      *object,
         g_object_set (priv->pinger, "ping-interval",
             priv->keepalive_interval, NULL);
       break;
+    case PROP_SEARCH_PAGE_SIZE:
+      priv->search_page_size = g_value_get_uint (value);
+      break;
 
     case PROP_DECLOAK_AUTOMATICALLY:
       priv->decloak_automatically = g_value_get_boolean (value);
       break;
 
+    case PROP_ADAPTIVE_PROGRESS:
+      priv->adaptive_progress = g_value_get_boolean (value);
+      break;
+
     case PROP_FALLBACK_SERVERS:
       if (priv->fallback_servers != NULL)
         g_strfreev (priv->fallback_servers);
@@ -883,6 +986,8 @@ static const gchar *implemented_interfaces[] = {
     TP_IFACE_CONNECTION_INTERFACE_CONTACT_CAPABILITIES,
     TP_IFACE_CONNECTION_INTERFACE_LOCATION,
     GABBLE_IFACE_CONNECTION_INTERFACE_GABBLE_DECLOAK,
+    GABBLE_IFACE_CONNECTION_INTERFACE_GABBLE_DEBUG,
+    GABBLE_IFACE_CONNECTION_INTERFACE_GABBLE_FILE_TRANSFER_PROGRESS,
     TP_IFACE_CONNECTION_INTERFACE_SIDECARS1,
     TP_IFACE_CONNECTION_INTERFACE_CLIENT_TYPES,
     TP_IFACE_CONNECTION_INTERFACE_ADDRESSING,
@@ -933,6 +1038,20 @@ gabble_connection_class_init (GabbleConnectionClass *gabble_connection_class)
         { "DecloakAutomatically", TWICE ("decloak-automatically") },
         { NULL }
   };
+  static TpDBusPropertiesMixinPropImpl ft_progress_props[] = {
+        { "AdaptiveProgress", TWICE ("adaptive-progress") },
+        { "ActiveTransfers", "active-transfers", NULL },
+        { "TransferredBytes", "transferred-bytes", NULL },
+        { "TotalBytes", "total-bytes", NULL },
+        { NULL }
+  };
+  static TpDBusPropertiesMixinPropImpl debug_props[] = {
+        { "ConnectionPhases", "connection-phases", NULL },
+        { "MainLoopLatency", "main-loop-latency", NULL },
+        { "SlowCallbacks", "slow-callbacks", NULL },
+        { "BytestreamUsage", "bytestream-usage", NULL },
+        { NULL }
+  };
   static TpDBusPropertiesMixinPropImpl mail_notif_props[] = {
         { "MailNotificationFlags", NULL, NULL },
         { "UnreadMailCount", NULL, NULL },
@@ -965,6 +1084,16 @@ gabble_connection_class_init (GabbleConnectionClass *gabble_connection_class)
           tp_dbus_properties_mixin_setter_gobject_properties,
           decloak_props,
         },
+        { GABBLE_IFACE_CONNECTION_INTERFACE_GABBLE_FILE_TRANSFER_PROGRESS,
+          tp_dbus_properties_mixin_getter_gobject_properties,
+          tp_dbus_properties_mixin_setter_gobject_properties,
+          ft_progress_props,
+        },
+        { GABBLE_IFACE_CONNECTION_INTERFACE_GABBLE_DEBUG,
+          tp_dbus_properties_mixin_getter_gobject_properties,
+          NULL,
+          debug_props,
+        },
         { TP_IFACE_CONNECTION_INTERFACE_MAIL_NOTIFICATION,
           conn_mail_notif_properties_getter,
           NULL,
@@ -1065,6 +1194,15 @@ gabble_connection_class_init (GabbleConnectionClass *gabble_connection_class)
           FALSE,
           G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
 
+  g_object_class_install_property (object_class, PROP_PARALLEL_CONNECT,
+      g_param_spec_boolean (
+          "parallel-connect", "Parallel connection setup",
+          "If TRUE, requests made while connecting are sent as soon as "
+          "everything they depend on is known, rather than one after another, "
+          "so that fewer round trips to the server are needed.",
+          FALSE,
+          G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
+
   g_object_class_install_property (object_class, PROP_STREAM_SERVER,
       g_param_spec_string (
           "stream-server", "The server name used to initialise the stream.",
@@ -1181,6 +1319,14 @@ gabble_connection_class_init (GabbleConnectionClass *gabble_connection_class)
           0, G_MAXUINT, 30,
           G_PARAM_CONSTRUCT | G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
 
+  g_object_class_install_property (object_class, PROP_SEARCH_PAGE_SIZE,
+      g_param_spec_uint (
+          "search-page-size", "search page size",
+          "How many contact search results to ask for at once, or 0 for all "
+          "of them",
+          0, G_MAXUINT, GABBLE_PARAMS_DEFAULT_SEARCH_PAGE_SIZE,
+          G_PARAM_CONSTRUCT | G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
+
   g_object_class_install_property (
       object_class, PROP_DECLOAK_AUTOMATICALLY,
       g_param_spec_boolean (
@@ -1189,6 +1335,71 @@ gabble_connection_class_init (GabbleConnectionClass *gabble_connection_class)
           FALSE,
           G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
 
+  g_object_class_install_property (
+      object_class, PROP_ADAPTIVE_PROGRESS,
+      g_param_spec_boolean (
+          "adaptive-progress", "Adaptive file transfer progress?",
+          "Pace file transfers' progress signals by their throughput and "
+          "how many there are, rather than once a second",
+          FALSE,
+          G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_ACTIVE_TRANSFERS,
+      g_param_spec_uint (
+          "active-transfers", "Active file transfers",
+          "Number of accepted file transfers which haven't finished yet",
+          0, G_MAXUINT, 0,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_TRANSFERRED_BYTES,
+      g_param_spec_uint64 (
+          "transferred-bytes", "Transferred bytes",
+          "Bytes of the active file transfers transferred so far",
+          0, G_MAXUINT64, 0,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_TOTAL_BYTES,
+      g_param_spec_uint64 (
+          "total-bytes", "Total bytes",
+          "Combined size of the active file transfers",
+          0, G_MAXUINT64, 0,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_CONNECTION_PHASES,
+      g_param_spec_boxed (
+          "connection-phases", "Connection phases",
+          "The phases of connecting we've been through, and when",
+          GABBLE_ARRAY_TYPE_CONNECTION_PHASE_LIST,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_MAIN_LOOP_LATENCY,
+      g_param_spec_boxed (
+          "main-loop-latency", "Main loop latency",
+          "How late the main loop has been, as a histogram",
+          GABBLE_ARRAY_TYPE_LATENCY_BUCKET_LIST,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_SLOW_CALLBACKS,
+      g_param_spec_boxed (
+          "slow-callbacks", "Slow callbacks",
+          "The callbacks which have blocked the main loop longest",
+          GABBLE_ARRAY_TYPE_SLOW_CALLBACK_LIST,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
+  g_object_class_install_property (
+      object_class, PROP_BYTESTREAM_USAGE,
+      g_param_spec_boxed (
+          "bytestream-usage", "Bytestream usage",
+          "How much each bytestream has buffered and in flight",
+          GABBLE_ARRAY_TYPE_BYTESTREAM_USAGE_LIST,
+          G_PARAM_READABLE | G_PARAM_STATIC_STRINGS));
+
   g_object_class_install_property (
       object_class, PROP_DOWNLOAD_AT_CONNECTION,
       g_param_spec_boolean (
@@ -1276,11 +1487,12 @@ gabble_connection_dispose (GObject *object)
 
   conn_olpc_activity_properties_dispose (self);
 
-  g_hash_table_unref (self->avatar_requests);
   g_hash_table_unref (self->vcard_requests);
 
   conn_presence_dispose (self);
 
+  conn_avatars_dispose (self);
+
   conn_mail_notif_dispose (self);
 
   tp_clear_object (&priv->connector);
@@ -1346,6 +1558,7 @@ gabble_connection_finalize (GObject *object)
 
   g_free (priv->alias);
   g_free (priv->stream_id);
+  g_array_unref (priv->phases);
 
   tp_contacts_mixin_finalize (G_OBJECT(self));
 
@@ -1491,6 +1704,54 @@ gabble_connection_get_last_use (GabbleConnection *conn)
   return difftime (time (NULL), conn->priv->last_activity_time);
 }
 
+/*
+ * gabble_connection_mark_phase:
+ * @phase: a static string naming what has just finished, such as "bound"
+ *
+ * Records that we've got this far in connecting, for ConnectionPhases.
+ */
+void
+gabble_connection_mark_phase (GabbleConnection *self,
+    const gchar *phase)
+{
+  GabbleConnectionPrivate *priv = self->priv;
+  ConnectionPhase p = { phase, 0 };
+
+  if (priv->connect_time == 0)
+    return;
+
+  p.time = g_get_monotonic_time () - priv->connect_time;
+  g_array_append_val (priv->phases, p);
+
+  DEBUG ("%s after %" G_GINT64_FORMAT " ms", phase, p.time / 1000);
+}
+
+/*
+ * gabble_connection_dup_phases:
+ *
+ * Returns: the phases marked with gabble_connection_mark_phase() so far, as a
+ *  GABBLE_ARRAY_TYPE_CONNECTION_PHASE_LIST
+ */
+GPtrArray *
+gabble_connection_dup_phases (GabbleConnection *self)
+{
+  GArray *phases = self->priv->phases;
+  GPtrArray *ret = g_ptr_array_sized_new (phases->len);
+  guint i;
+
+  for (i = 0; i < phases->len; i++)
+    {
+      ConnectionPhase *p = &g_array_index (phases, ConnectionPhase, i);
+
+      g_ptr_array_add (ret, tp_value_array_build (2,
+          G_TYPE_STRING, p->name,
+          G_TYPE_UINT64, (guint64) p->time,
+          G_TYPE_INVALID));
+    }
+
+  return ret;
+}
+
 typedef struct {
     GabbleConnectionMsgReplyFunc reply_func;
 
@@ -1774,6 +2035,8 @@ bare_jid_disco_cb (GabbleDisco *disco,
 {
   GabbleConnection *conn = user_data;
 
+  gabble_connection_mark_phase (conn, "bare-jid-disco");
+
   if (disco_error != NULL)
     {
       DEBUG ("Got disco error on bare jid: %s", disco_error->message);
@@ -1887,6 +2150,7 @@ connector_connected (GabbleConnection *self,
   TpBaseConnection *base = (TpBaseConnection *) self;
   TpHandleRepoIface *contact_handles = tp_base_connection_get_handles (base,
       TP_HANDLE_TYPE_CONTACT);
+  gboolean stream_management = FALSE;
 
   /* cleanup the cancellable */
   tp_clear_object (&priv->cancellable);
@@ -1904,6 +2168,38 @@ connector_connected (GabbleConnection *self,
       return;
     }
 
+  /* Roster versioning, client state indication and stream management are
+   * advertised as stream features rather than via disco, so we have to look
+   * for them before we drop the connector. */
+  if (conn != NULL)
+    {
+      WockyStanza *features = NULL;
+
+      g_object_get (priv->connector, "features", &features, NULL);
+
+      if (features != NULL)
+        {
+          if (wocky_node_get_child_ns (wocky_stanza_get_top_node (features),
+                "ver", NS_ROSTER_VER) != NULL)
+            {
+              DEBUG ("Server supports roster versioning");
+              self->features |= GABBLE_CONNECTION_FEATURES_ROSTER_VERSIONING;
+            }
+
+          if (wocky_node_get_child_ns (wocky_stanza_get_top_node (features),
+                "csi", NS_CLIENT_STATE_INDICATION) != NULL)
+            {
+              DEBUG ("Server supports client state indication");
+              self->features |=
+                  GABBLE_CONNECTION_FEATURES_CLIENT_STATE_INDICATION;
+            }
+
+          stream_management = gabble_stream_management_is_supported (
+              features);
+          g_object_unref (features);
+        }
+    }
+
   /* We don't need the connector any more */
   tp_clear_object (&priv->connector);
 
@@ -1916,6 +2212,7 @@ connector_connected (GabbleConnection *self,
     }
 
   DEBUG ("connected (jid: %s)", jid);
+  gabble_connection_mark_phase (self, "bound");
 
   self->session = wocky_session_new_with_connection (conn, jid);
   priv->porter = wocky_session_get_porter (self->session);
@@ -1929,6 +2226,12 @@ connector_connected (GabbleConnection *self,
   g_signal_connect (priv->porter, "remote-error",
       G_CALLBACK (remote_error_cb), self);
 
+  if (stream_management)
+    {
+      DEBUG ("Server supports stream management");
+      priv->stream_management = gabble_stream_management_new (priv->porter);
+    }
+
   g_signal_emit_by_name (self, "porter-available", priv->porter);
   connect_iq_callbacks (self);
 
@@ -2027,6 +2330,11 @@ connector_connected (GabbleConnection *self,
       g_error_free (error);
     }
 
+  /* We don't know yet whether we'll need the privacy lists, but we ask
+   * anyway rather than wait for the server's disco reply to tell us. */
+  if (priv->parallel_connect)
+    conn_presence_prefetch (self);
+
   self->priv->waiting_connected = 2;
 }
 
@@ -2137,6 +2445,9 @@ connect_iq_callbacks (GabbleConnection *conn)
  * Stage 3 is connection_disco_cb processing the server's features, and setting
  *            initial presence
  * Stage 4 is set_status_to_connected setting the CONNECTED state.
+ *
+ * With parallel-connect, stage 2 also asks for the privacy lists and stage 3
+ * for the roster, rather than leaving them until they're needed.
  */
 static gboolean
 _gabble_connection_connect (TpBaseConnection *base,
@@ -2154,6 +2465,8 @@ _gabble_connection_connect (TpBaseConnection *base,
   g_assert (priv->stream_server != NULL);
   g_assert (priv->resource != NULL);
 
+  priv->connect_time = g_get_monotonic_time ();
+
   jid = gabble_encode_jid (priv->username, priv->stream_server, NULL);
   tls_handler = WOCKY_TLS_HANDLER (priv->server_tls_manager);
   priv->connector = wocky_connector_new (jid, priv->password, priv->resource,
@@ -2322,6 +2635,8 @@ connection_shut_down (TpBaseConnection *base)
   GabbleConnectionPrivate *priv = self->priv;
 
   tp_clear_object (&priv->pinger);
+  tp_clear_pointer (&priv->stream_management,
+      gabble_stream_management_free);
 
   if (priv->closing)
     return;
@@ -2798,6 +3113,8 @@ set_status_to_connected (GabbleConnection *conn)
       tp_base_connection_add_interfaces ((TpBaseConnection *) conn, ifaces);
     }
 
+  gabble_connection_mark_phase (conn, "connected");
+
   /* go go gadget on-line */
   tp_base_connection_change_status (base,
       TP_CONNECTION_STATUS_CONNECTED, TP_CONNECTION_STATUS_REASON_REQUESTED);
@@ -2940,6 +3257,8 @@ connection_disco_cb (GabbleDisco *disco,
       return;
     }
 
+  gabble_connection_mark_phase (conn, "server-disco");
+
   if (disco_error)
     {
       DEBUG ("got disco error, setting no features: %s", disco_error->message);
@@ -3018,6 +3337,12 @@ connection_disco_cb (GabbleDisco *disco,
           conn_wlm_jid_lookup_finish);
     }
 
+  /* We now know everything the roster request depends on, and the roster
+   * doesn't depend on our initial presence, so we needn't wait until we're
+   * connected to ask for it. */
+  if (conn->priv->parallel_connect)
+    gabble_roster_prefetch (conn->roster);
+
   conn_presence_set_initial_presence_async (conn,
       connection_initial_presence_cb, NULL);
 
@@ -3062,6 +3387,7 @@ connection_initial_presence_cb (GObject *source_object,
     }
   else
     {
+      gabble_connection_mark_phase (self, "initial-presence");
       decrement_waiting_connected (self);
     }
 }
@@ -3426,20 +3752,189 @@ conn_contact_capabilities_fill_contact_attributes (GObject *obj,
   const GArray *contacts, GHashTable *attributes_hash)
 {
   GabbleConnection *self = GABBLE_CONNECTION (obj);
+  GabbleContactSnapshot *snapshot = gabble_connection_ref_contact_snapshot (
+      self, contacts);
   guint i;
 
-  for (i = 0; i < contacts->len; i++)
+  for (i = 0; i < snapshot->len; i++)
     {
-      TpHandle handle = g_array_index (contacts, TpHandle, i);
-      GValue *val = tp_g_value_slice_new_take_boxed (
+      GabbleContactSnapshotEntry *contact = snapshot->entries + i;
+      const GabbleCapabilitySet *caps;
+      GValue *val;
+
+      if (contact->presence == NULL)
+        caps = empty_caps_set ();
+      else
+        caps = gabble_presence_peek_caps (contact->presence);
+
+      val = tp_g_value_slice_new_take_boxed (
           TP_ARRAY_TYPE_REQUESTABLE_CHANNEL_CLASS_LIST,
-          gabble_connection_get_handle_contact_capabilities (self, handle));
+          gabble_connection_build_contact_caps (self, contact->handle, caps));
 
       tp_contacts_mixin_set_contact_attribute (attributes_hash,
-          handle,
+          contact->handle,
           TP_IFACE_CONNECTION_INTERFACE_CONTACT_CAPABILITIES"/capabilities",
           val);
     }
+
+  gabble_contact_snapshot_unref (snapshot);
+}
+
+static GabbleContactSnapshot *
+contact_snapshot_new (GabbleConnection *self,
+    const GArray *contacts)
+{
+  TpBaseConnection *base = (TpBaseConnection *) self;
+  TpHandleRepoIface *contact_repo = tp_base_connection_get_handles (base,
+      TP_HANDLE_TYPE_CONTACT);
+  TpHandle self_handle = tp_base_connection_get_self_handle (base);
+  GabbleContactSnapshot *snapshot = g_slice_new0 (GabbleContactSnapshot);
+  guint i;
+
+  snapshot->ref_count = 1;
+  snapshot->contacts = contacts;
+  snapshot->len = contacts->len;
+  snapshot->entries = g_new (GabbleContactSnapshotEntry, contacts->len);
+
+  for (i = 0; i < contacts->len; i++)
+    {
+      GabbleContactSnapshotEntry *contact = snapshot->entries + i;
+
+      contact->handle = g_array_index (contacts, TpHandle, i);
+      contact->jid = tp_handle_inspect (contact_repo, contact->handle);
+      contact->cached_presence = gabble_presence_cache_get (
+          self->presence_cache, contact->handle);
+
+      if (contact->handle == self_handle)
+        contact->presence = self->self_presence;
+      else
+        contact->presence = contact->cached_presence;
+    }
+
+  return snapshot;
+}
+
+/*
+ * gabble_connection_ref_contact_snapshot:
+ * @contacts: valid contact handles
+ *
+ * Looks up what we know about each of @contacts. Within a call to
+ * gabble_connection_get_contact_attributes(), the attribute fillers for the
+ * various interfaces are all passed the same array of handles, and they all
+ * get the same snapshot back rather than doing the lookups again.
+ *
+ * Returns: a snapshot of @contacts, to be released with
+ *  gabble_contact_snapshot_unref()
+ */
+GabbleContactSnapshot *
+gabble_connection_ref_contact_snapshot (GabbleConnection *self,
+    const GArray *contacts)
+{
+  GabbleConnectionPrivate *priv = self->priv;
+  GabbleContactSnapshot *snapshot = priv->contact_snapshot;
+
+  if (snapshot != NULL &&
+      snapshot->contacts == contacts &&
+      snapshot->len == contacts->len)
+    {
+      snapshot->ref_count++;
+      return snapshot;
+    }
+
+  snapshot = contact_snapshot_new (self, contacts);
+
+  if (priv->sharing_contact_snapshot)
+    {
+      tp_clear_pointer (&priv->contact_snapshot,
+          gabble_contact_snapshot_unref);
+      snapshot->ref_count++;
+      priv->contact_snapshot = snapshot;
+    }
+
+  return snapshot;
+}
+
+void
+gabble_contact_snapshot_unref (GabbleContactSnapshot *snapshot)
+{
+  if (--snapshot->ref_count > 0)
+    return;
+
+  g_free (snapshot->entries);
+  g_slice_free (GabbleContactSnapshot, snapshot);
+}
+
+/*
+ * gabble_connection_get_contact_attributes:
+ *
+ * A wrapper around tp_contacts_mixin_get_contact_attributes() which lets the
+ * attribute fillers share a #GabbleContactSnapshot.
+ */
+GHashTable *
+gabble_connection_get_contact_attributes (GabbleConnection *self,
+    const GArray *handles,
+    const gchar **interfaces,
+    const gchar **assumed_interfaces,
+    const gchar *sender)
+{
+  GabbleConnectionPrivate *priv = self->priv;
+  GHashTable *attributes;
+
+  g_return_val_if_fail (!priv->sharing_contact_snapshot, NULL);
+
+  priv->sharing_contact_snapshot = TRUE;
+  attributes = tp_contacts_mixin_get_contact_attributes (G_OBJECT (self),
+      handles, interfaces, assumed_interfaces, sender);
+  priv->sharing_contact_snapshot = FALSE;
+
+  /* The array it was taken of has gone now. */
+  tp_clear_pointer (&priv->contact_snapshot, gabble_contact_snapshot_unref);
+
+  return attributes;
+}
+
+static const gchar *contacts_always_included_interfaces[] = {
+    TP_IFACE_CONNECTION,
+    NULL
+};
+
+static void
+gabble_connection_get_contact_attributes_impl (
+    TpSvcConnectionInterfaceContacts *iface,
+    const GArray *handles,
+    const gchar **interfaces,
+    gboolean hold,
+    DBusGMethodInvocation *context)
+{
+  GabbleConnection *self = GABBLE_CONNECTION (iface);
+  TpBaseConnection *base = (TpBaseConnection *) self;
+  GHashTable *attributes;
+  gchar *sender;
+
+  TP_BASE_CONNECTION_ERROR_IF_NOT_CONNECTED (base, context);
+
+  sender = dbus_g_method_get_sender (context);
+  attributes = gabble_connection_get_contact_attributes (self, handles,
+      interfaces, contacts_always_included_interfaces, sender);
+
+  tp_svc_connection_interface_contacts_return_from_get_contact_attributes (
+      context, attributes);
+
+  g_hash_table_unref (attributes);
+  g_free (sender);
+}
+
+static void
+conn_contacts_iface_init (gpointer g_iface,
+    gpointer iface_data)
+{
+  TpSvcConnectionInterfaceContactsClass *klass = g_iface;
+
+  tp_contacts_mixin_iface_init (g_iface, iface_data);
+
+  /* Everything else is as the mixin has it. */
+  tp_svc_connection_interface_contacts_implement_get_contact_attributes (
+      klass, gabble_connection_get_contact_attributes_impl);
 }
 
 /**
@@ -103,6 +103,7 @@ WockyXep0115Capabilities * gabble_connection_get_caps (
 #define GABBLE_PARAMS_DEFAULT_STUN_PORT                  3478
 #define GABBLE_PARAMS_DEFAULT_FALLBACK_STUN_SERVER       "stun.telepathy.im"
 #define GABBLE_PARAMS_DEFAULT_SOCKS5_PROXIES             { NULL }
+#define GABBLE_PARAMS_DEFAULT_SEARCH_PAGE_SIZE           100
 
 
 /* order must match array of statuses in conn-presence.c */
@@ -138,11 +139,14 @@ typedef enum
   GABBLE_CONNECTION_FEATURES_GOOGLE_QUEUE = 1 << 8,
   GABBLE_CONNECTION_FEATURES_GOOGLE_SETTING = 1 << 9,
   GABBLE_CONNECTION_FEATURES_WLM_JID_LOOKUP = 1 << 10,
+  GABBLE_CONNECTION_FEATURES_ROSTER_VERSIONING = 1 << 11,
+  GABBLE_CONNECTION_FEATURES_CLIENT_STATE_INDICATION = 1 << 12,
 } GabbleConnectionFeatures;
 
 typedef struct _GabbleConnectionPrivate GabbleConnectionPrivate;
 typedef struct _GabbleConnectionMailNotificationPrivate GabbleConnectionMailNotificationPrivate;
 typedef struct _GabbleConnectionPresencePrivate GabbleConnectionPresencePrivate;
+typedef struct _GabbleConnectionAvatarsPrivate GabbleConnectionAvatarsPrivate;
 
 typedef void (*GabbleConnectionMsgReplyFunc) (
     GabbleConnection *conn,
@@ -213,8 +217,8 @@ struct _GabbleConnection {
     /* bytestream factory */
     GabbleBytestreamFactory *bytestream_factory;
 
-    /* outstanding avatar requests */
-    GHashTable *avatar_requests;
+    /* avatar cache and outstanding avatar requests */
+    GabbleConnectionAvatarsPrivate *avatars_priv;
 
     /* outstanding vcard requests */
     GHashTable *vcard_requests;
@@ -281,6 +285,10 @@ void _gabble_connection_acknowledge_set_iq (GabbleConnection *conn,
     WockyStanza *iq);
 void gabble_connection_update_last_use (GabbleConnection *conn);
 
+void gabble_connection_mark_phase (GabbleConnection *self,
+    const gchar *phase);
+GPtrArray *gabble_connection_dup_phases (GabbleConnection *self);
+
 const char *_gabble_connection_find_conference_server (GabbleConnection *);
 gchar *gabble_connection_get_canonical_room_name (GabbleConnection *conn,
     const gchar *jid);
@@ -309,6 +317,37 @@ gboolean _gabble_connection_invisible_privacy_list_set_active (
 const gchar **gabble_connection_get_implemented_interfaces (void);
 const gchar **gabble_connection_get_guaranteed_interfaces (void);
 
+/* What we know about each of a set of contacts, looked up once per
+ * GetContactAttributes call and shared between the interfaces' attribute
+ * fillers. */
+typedef struct {
+    TpHandle handle;
+    /* borrowed from the handle repository */
+    const gchar *jid;
+    /* borrowed from the presence cache, or NULL */
+    GabblePresence *cached_presence;
+    /* our own presence for the self-handle, cached_presence otherwise */
+    GabblePresence *presence;
+} GabbleContactSnapshotEntry;
+
+typedef struct {
+    /* one per contact, in the same order as the array it was taken of */
+    GabbleContactSnapshotEntry *entries;
+    guint len;
+
+    /*< private >*/
+    const GArray *contacts;
+    guint ref_count;
+} GabbleContactSnapshot;
+
+GabbleContactSnapshot *gabble_connection_ref_contact_snapshot (
+    GabbleConnection *self, const GArray *contacts);
+void gabble_contact_snapshot_unref (GabbleContactSnapshot *snapshot);
+
+GHashTable *gabble_connection_get_contact_attributes (GabbleConnection *self,
+    const GArray *handles, const gchar **interfaces,
+    const gchar **assumed_interfaces, const gchar *sender);
+
 /* extern only for the benefit of the unit tests */
 void _gabble_connection_create_handle_repos (TpBaseConnection *conn,
     TpHandleRepoIface *repos[TP_NUM_HANDLE_TYPES]);
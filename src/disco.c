@@ -427,6 +427,11 @@ notify_delete_request (gpointer data, GObject *obj)
   delete_request (request);
 }
 
+static GabbleDiscoRequest *disco_request_full (GabbleDisco *self,
+    GabbleDiscoType type, const gchar *jid, const char *node, guint timeout,
+    guint max, const gchar *after, GabbleDiscoCb callback, gpointer user_data,
+    GObject *object, GError **error);
+
 /**
  * gabble_disco_request:
  * @self: #GabbleDisco object to use for request
@@ -475,6 +480,45 @@ gabble_disco_request_with_timeout (GabbleDisco *self, GabbleDiscoType type,
                                    guint timeout, GabbleDiscoCb callback,
                                    gpointer user_data, GObject *object,
                                    GError **error)
+{
+  return disco_request_full (self, type, jid, node, timeout, 0, NULL,
+      callback, user_data, object, error);
+}
+
+/**
+ * gabble_disco_request_page:
+ * @self: #GabbleDisco object to use for request
+ * @jid: Jabber ID to request on
+ * @node: node to request on @jid, or NULL
+ * @max: the most items the reply should contain
+ * @after: the <last> item ID from the previous page, or NULL for the first
+ * @callback: #GabbleDiscoCb to call on request fullfilment
+ * @object: GObject to bind request to. the callback will not be
+ *          called if this object has been unrefed. NULL if not needed
+ * @error: #GError to return a telepathy error in if unable to make
+ *         request, NULL if unneeded.
+ *
+ * Make an ITEMS request on the given jid for a page of at most @max items,
+ * using XEP-0059 Result Set Management. Servers which don't support it
+ * ignore the <set/> and send all the items at once.
+ */
+GabbleDiscoRequest *
+gabble_disco_request_page (GabbleDisco *self, const gchar *jid,
+                           const char *node, guint max, const gchar *after,
+                           GabbleDiscoCb callback, gpointer user_data,
+                           GObject *object, GError **error)
+{
+  return disco_request_full (self, GABBLE_DISCO_TYPE_ITEMS, jid, node,
+      DEFAULT_REQUEST_TIMEOUT, max, after, callback, user_data, object,
+      error);
+}
+
+static GabbleDiscoRequest *
+disco_request_full (GabbleDisco *self, GabbleDiscoType type,
+                    const gchar *jid, const char *node,
+                    guint timeout, guint max, const gchar *after,
+                    GabbleDiscoCb callback, gpointer user_data,
+                    GObject *object, GError **error)
 {
   GabbleDiscoPrivate *priv = self->priv;
   GabbleDiscoRequest *request;
@@ -509,6 +553,18 @@ gabble_disco_request_with_timeout (GabbleDisco *self, GabbleDiscoType type,
       wocky_node_set_attribute (lm_node, "node", node);
     }
 
+  if (max > 0)
+    {
+      WockyNode *set = wocky_node_add_child_ns (lm_node, "set", NS_RSM);
+      gchar *max_str = g_strdup_printf ("%u", max);
+
+      wocky_node_add_child_with_content (set, "max", max_str);
+      g_free (max_str);
+
+      if (after != NULL)
+        wocky_node_add_child_with_content (set, "after", after);
+    }
+
   if (! _gabble_connection_send_with_reply (priv->connection, msg,
         request_reply_cb, G_OBJECT(self), request, error))
     {
@@ -550,9 +606,21 @@ struct _GabbleDiscoPipeline {
     GabbleDiscoPipelineCb callback;
     GabbleDiscoEndCb end_callback;
     GPtrArray *disco_pipeline;
+    /* JIDs we still have to ask for INFO on, in the order the server listed
+     * them; remaining_items indexes the same strings, which the queue owns */
+    GQueue remaining_queue;
     GHashTable *remaining_items;
     GabbleDiscoRequest *list_request;
     gboolean running;
+
+    gchar *server;
+    /* XEP-0059 paging of the ITEMS request: 0 to ask for everything at once */
+    guint page_size;
+    gchar *after;
+    gboolean more_pages;
+    guint items_seen;
+    /* what the server said the whole result set holds, or G_MAXUINT */
+    guint items_count;
 };
 
 static void
@@ -656,11 +724,19 @@ done:
   return;
 }
 
+static void disco_items_cb (GabbleDisco *disco, GabbleDiscoRequest *request,
+    const gchar *jid, const gchar *node, WockyNode *result, GError *error,
+    gpointer user_data);
 
-static gboolean
-return_true (gpointer key, gpointer value, gpointer data)
+static void
+request_items_page (GabbleDiscoPipeline *pipeline)
 {
-  return TRUE;
+  /* disco_items_cb works out whether there's another page after this one */
+  pipeline->more_pages = FALSE;
+
+  pipeline->list_request = gabble_disco_request_page (pipeline->disco,
+      pipeline->server, NULL, pipeline->page_size, pipeline->after,
+      disco_items_cb, pipeline, G_OBJECT (pipeline->disco), NULL);
 }
 
 static void
@@ -672,29 +748,39 @@ gabble_disco_fill_pipeline (GabbleDisco *disco, GabbleDiscoPipeline *pipeline)
     }
   else
     {
-      /* send disco requests for the JIDs in the remaining_items hash table
+      /* send disco requests for the JIDs in the remaining_items queue
        * until there are DISCO_PIPELINE_SIZE requests in progress */
       while (pipeline->disco_pipeline->len < DISCO_PIPELINE_SIZE)
         {
           gchar *jid;
           GabbleDiscoRequest *request;
 
-          jid = (gchar *) g_hash_table_find (pipeline->remaining_items,
-              return_true, NULL);
+          jid = g_queue_pop_head (&pipeline->remaining_queue);
           if (NULL == jid)
             break;
 
+          g_hash_table_remove (pipeline->remaining_items, jid);
+
           request = gabble_disco_request (disco,
               GABBLE_DISCO_TYPE_INFO, jid, NULL, item_info_cb, pipeline,
               G_OBJECT(disco), NULL);
 
-          g_ptr_array_add (pipeline->disco_pipeline, request);
+          if (request != NULL)
+            g_ptr_array_add (pipeline->disco_pipeline, request);
 
-          /* frees jid */
-          g_hash_table_remove (pipeline->remaining_items, jid);
+          g_free (jid);
         }
 
-      if (0 == pipeline->disco_pipeline->len)
+      /* only ask for the next page of items once we're nearly through this
+       * one, so that we never hold much more than a page of them */
+      if (pipeline->more_pages && pipeline->list_request == NULL &&
+          g_queue_get_length (&pipeline->remaining_queue) <
+              DISCO_PIPELINE_SIZE)
+        request_items_page (pipeline);
+
+      if (0 == pipeline->disco_pipeline->len &&
+          NULL == pipeline->list_request &&
+          g_queue_is_empty (&pipeline->remaining_queue))
         {
           /* signal that the pipeline has finished */
           pipeline->running = FALSE;
@@ -714,10 +800,10 @@ disco_items_cb (GabbleDisco *disco,
           gpointer user_data)
 {
   const char *item_jid;
-  gpointer key, value;
   GabbleDiscoPipeline *pipeline = (GabbleDiscoPipeline *) user_data;
   WockyNodeIter i;
-  WockyNode *item;
+  WockyNode *item, *set;
+  guint n_items = 0;
 
   pipeline->list_request = NULL;
 
@@ -730,18 +816,47 @@ disco_items_cb (GabbleDisco *disco,
   wocky_node_iter_init (&i, result, "item", NULL);
   while (wocky_node_iter_next (&i, &item))
     {
+      n_items++;
       item_jid = wocky_node_get_attribute (item, "jid");
 
       if (NULL != item_jid &&
           !g_hash_table_lookup_extended (pipeline->remaining_items, item_jid,
-            &key, &value))
+            NULL, NULL))
         {
           gchar *tmp = g_strdup (item_jid);
           DEBUG ("discovered service item: %s", tmp);
+          g_queue_push_tail (&pipeline->remaining_queue, tmp);
           g_hash_table_insert (pipeline->remaining_items, tmp, tmp);
         }
     }
 
+  pipeline->items_seen += n_items;
+  set = wocky_node_get_child_ns (result, "set", NS_RSM);
+
+  /* Servers which don't do XEP-0059 just send everything; those which do
+   * tell us where this page ended, and we carry on from there until a page
+   * comes back empty or we've had as many items as they said there were. */
+  if (pipeline->page_size > 0 && set != NULL && n_items > 0)
+    {
+      const gchar *last = wocky_node_get_content_from_child (set, "last");
+      const gchar *count = wocky_node_get_content_from_child (set, "count");
+
+      if (count != NULL)
+        pipeline->items_count = (guint) MIN (G_MAXUINT,
+            g_ascii_strtoull (count, NULL, 10));
+
+      if (last != NULL && tp_strdiff (last, pipeline->after) &&
+          pipeline->items_seen < pipeline->items_count)
+        {
+          g_free (pipeline->after);
+          pipeline->after = g_strdup (last);
+          pipeline->more_pages = TRUE;
+        }
+    }
+
+  DEBUG ("got %u items from %s (%u so far)%s", n_items, jid,
+      pipeline->items_seen, pipeline->more_pages ? ", and there are more" : "");
+
 out:
   gabble_disco_fill_pipeline (disco, pipeline);
 }
@@ -762,19 +877,37 @@ gpointer gabble_disco_pipeline_init (GabbleDisco *disco,
                                      GabbleDiscoEndCb end_callback,
                                      gpointer user_data)
 {
-  GabbleDiscoPipeline *pipeline = g_new (GabbleDiscoPipeline, 1);
+  GabbleDiscoPipeline *pipeline = g_new0 (GabbleDiscoPipeline, 1);
   pipeline->user_data = user_data;
   pipeline->callback = callback;
   pipeline->end_callback = end_callback;
   pipeline->disco_pipeline = g_ptr_array_sized_new (DISCO_PIPELINE_SIZE);
-  pipeline->remaining_items = g_hash_table_new_full (g_str_hash, g_str_equal,
-      g_free, NULL);
+  g_queue_init (&pipeline->remaining_queue);
+  pipeline->remaining_items = g_hash_table_new (g_str_hash, g_str_equal);
   pipeline->running = TRUE;
   pipeline->disco = disco;
 
   return pipeline;
 }
 
+/**
+ * gabble_disco_pipeline_set_page_size:
+ * @self: reference to the pipeline structure
+ * @page_size: how many items to ask for at a time, or 0 for all of them
+ *
+ * Makes the pipeline ask for the server's items a page at a time using
+ * XEP-0059 Result Set Management, and only ask for the next page once it has
+ * nearly finished querying the items on the last one. Takes effect from the
+ * next gabble_disco_pipeline_run().
+ */
+void
+gabble_disco_pipeline_set_page_size (gpointer self, guint page_size)
+{
+  GabbleDiscoPipeline *pipeline = (GabbleDiscoPipeline *) self;
+
+  pipeline->page_size = page_size;
+}
+
 /**
  * gabble_disco_pipeline_run:
  * @self: reference to the pipeline structure
@@ -795,9 +928,13 @@ gabble_disco_pipeline_run (gpointer self, const char *server)
 
   pipeline->running = TRUE;
 
-  pipeline->list_request = gabble_disco_request (pipeline->disco,
-      GABBLE_DISCO_TYPE_ITEMS, server, NULL, disco_items_cb, pipeline,
-      G_OBJECT (pipeline->disco), NULL);
+  g_free (pipeline->server);
+  pipeline->server = g_strdup (server);
+  tp_clear_pointer (&pipeline->after, g_free);
+  pipeline->items_seen = 0;
+  pipeline->items_count = G_MAXUINT;
+
+  request_items_page (pipeline);
 }
 
 
@@ -831,7 +968,11 @@ gabble_disco_pipeline_destroy (gpointer self)
     }
 
   g_hash_table_unref (pipeline->remaining_items);
+  g_queue_foreach (&pipeline->remaining_queue, (GFunc) g_free, NULL);
+  g_queue_clear (&pipeline->remaining_queue);
   g_ptr_array_unref (pipeline->disco_pipeline);
+  g_free (pipeline->server);
+  g_free (pipeline->after);
   g_free (pipeline);
 }
 
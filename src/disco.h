@@ -97,6 +97,11 @@ GabbleDiscoRequest *gabble_disco_request_with_timeout (GabbleDisco *self,
     guint timeout, GabbleDiscoCb callback, gpointer user_data,
     GObject *object, GError **error);
 
+GabbleDiscoRequest *gabble_disco_request_page (GabbleDisco *self,
+    const gchar *jid, const char *node, guint max, const gchar *after,
+    GabbleDiscoCb callback, gpointer user_data, GObject *object,
+    GError **error);
+
 void gabble_disco_cancel_request (GabbleDisco *, GabbleDiscoRequest *);
 
 /* Pipelines */
@@ -123,6 +128,7 @@ gpointer gabble_disco_pipeline_init (GabbleDisco *disco,
                                      GabbleDiscoEndCb end_callback,
                                      gpointer user_data);
 
+void gabble_disco_pipeline_set_page_size (gpointer self, guint page_size);
 void gabble_disco_pipeline_run (gpointer self, const char *server);
 void gabble_disco_pipeline_destroy (gpointer self);
 
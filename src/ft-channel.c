@@ -37,6 +37,7 @@
 #define DEBUG_FLAG GABBLE_DEBUG_FT
 #include "debug.h"
 
+#include <gibber/gibber-fd-transport.h>
 #include <gibber/gibber-listener.h>
 #include <gibber/gibber-transport.h>
 #include <gibber/gibber-unix-transport.h>       /* just for the feature-test */
@@ -109,6 +110,12 @@ struct _GabbleFileTransferChannelPrivate {
   gboolean dispose_has_run;
   GTimeVal last_transferred_bytes_emitted;
   guint progress_timer;
+  /* for adaptive progress reporting: when we last emitted
+   * TransferredBytesChanged, with what, and an estimate of how many bytes a
+   * second we're transferring */
+  gint64 last_progress_time;
+  guint64 last_progress_bytes;
+  gdouble rate;
   TpSocketAddressType socket_type;
   GValue *socket_address;
   gboolean resume_supported;
@@ -138,6 +145,14 @@ struct _GabbleFileTransferChannelPrivate {
   gchar *service_name;
   GHashTable *metadata;
   gboolean channel_opened;
+
+  /* incremental hash of what we've received, to check against content_hash
+   * once the whole file is here; NULL if we're not verifying this transfer */
+  GChecksum *checksum;
+  /* TRUE while we're hashing the part of the file we already had before
+   * resuming; the bytestream stays blocked until we're done */
+  gboolean hashing_prefix;
+  GCancellable *prefix_cancellable;
 };
 
 static void gabble_file_transfer_channel_set_state (
@@ -197,7 +212,8 @@ gabble_file_transfer_channel_get_property (GObject *object,
         g_value_set_uint (value, self->priv->content_hash_type);
         break;
       case PROP_CONTENT_HASH:
-        g_value_set_string (value, self->priv->content_hash);
+        g_value_set_string (value,
+            self->priv->content_hash != NULL ? self->priv->content_hash : "");
         break;
       case PROP_DESCRIPTION:
         g_value_set_string (value, self->priv->description);
@@ -864,6 +880,7 @@ gabble_file_transfer_channel_finalize (GObject *object)
   g_free (self->priv->service_name);
   if (self->priv->metadata != NULL)
     g_hash_table_unref (self->priv->metadata);
+  tp_clear_pointer (&self->priv->checksum, g_checksum_free);
 
   G_OBJECT_CLASS (gabble_file_transfer_channel_parent_class)->finalize (object);
 }
@@ -874,6 +891,11 @@ close_session_and_transport (GabbleFileTransferChannel *self)
 
   DEBUG ("Closing session and transport");
 
+  if (self->priv->prefix_cancellable != NULL)
+    g_cancellable_cancel (self->priv->prefix_cancellable);
+
+  tp_clear_object (&self->priv->prefix_cancellable);
+
 #ifdef ENABLE_JINGLE_FILE_TRANSFER
   if (self->priv->gtalk_file_collection != NULL)
     gtalk_file_collection_terminate (self->priv->gtalk_file_collection, self);
@@ -1475,14 +1497,39 @@ gabble_file_transfer_channel_offer_file (GabbleFileTransferChannel *self,
   return result;
 }
 
+/* In adaptive mode, we aim for about this many TransferredBytesChanged
+ * signals a second for the whole connection */
+#define ADAPTIVE_PROGRESS_PER_SECOND 4
+/* ...but whatever that works out as, a transfer reports its progress at
+ * least this often (in milliseconds) */
+#define ADAPTIVE_PROGRESS_MAX_INTERVAL 5000
+
 static void
 emit_progress_update (GabbleFileTransferChannel *self)
 {
   TpSvcChannelTypeFileTransfer *iface =
       TP_SVC_CHANNEL_TYPE_FILE_TRANSFER (self);
+  gint64 now = g_get_monotonic_time ();
 
   g_get_current_time (&self->priv->last_transferred_bytes_emitted);
 
+  if (self->priv->last_progress_time != 0 &&
+      now > self->priv->last_progress_time)
+    {
+      gdouble rate = (self->priv->transferred_bytes -
+          self->priv->last_progress_bytes) * (gdouble) G_USEC_PER_SEC /
+          (now - self->priv->last_progress_time);
+
+      /* smooth it out a bit */
+      if (self->priv->rate == 0)
+        self->priv->rate = rate;
+      else
+        self->priv->rate = (self->priv->rate + rate) / 2;
+    }
+
+  self->priv->last_progress_time = now;
+  self->priv->last_progress_bytes = self->priv->transferred_bytes;
+
   tp_svc_channel_type_file_transfer_emit_transferred_bytes_changed (
     iface, self->priv->transferred_bytes);
 
@@ -1504,6 +1551,60 @@ emit_progress_update_cb (gpointer user_data)
   return FALSE;
 }
 
+static gboolean
+adaptive_progress (GabbleFileTransferChannel *self)
+{
+  TpBaseChannel *base = TP_BASE_CHANNEL (self);
+  gboolean adaptive;
+
+  g_object_get (tp_base_channel_get_connection (base),
+      "adaptive-progress", &adaptive,
+      NULL);
+  return adaptive;
+}
+
+/*
+ * adaptive_progress_interval:
+ * @self: a file transfer in progress
+ *
+ * Returns: how long to wait between progress reports, in milliseconds. The
+ *  more transfers the connection has going on, the longer this is, so that
+ *  they don't add up to a torrent of signals; it's also longer if reporting
+ *  any sooner would be pointless, because the transfer will finish before
+ *  then or has hardly moved since last time.
+ */
+static guint
+adaptive_progress_interval (GabbleFileTransferChannel *self)
+{
+  GabbleConnection *conn = GABBLE_CONNECTION (
+      tp_base_channel_get_connection (TP_BASE_CHANNEL (self)));
+  guint active = 1;
+  guint interval;
+
+  gabble_ft_manager_get_progress (conn->ft_manager, &active, NULL, NULL);
+  interval = MAX (active, 1) * 1000 / ADAPTIVE_PROGRESS_PER_SECOND;
+
+  if (self->priv->rate > 0 && self->priv->size != GABBLE_UNDEFINED_FILE_SIZE)
+    {
+      guint64 done = self->priv->transferred_bytes +
+        self->priv->initial_offset;
+      gdouble remaining = self->priv->size > done ?
+        self->priv->size - done : 0;
+
+      if (remaining * 1000 / self->priv->rate < interval)
+        /* We'll be done before the next report would have been due, and
+         * finishing is reported right away; so only report before then if
+         * the transfer stalls. */
+        interval = ADAPTIVE_PROGRESS_MAX_INTERVAL;
+      else if (self->priv->size / 100 * 1000 / self->priv->rate > interval)
+        /* Don't bother until we've moved by at least 1% */
+        interval = MIN (self->priv->size / 100 * 1000 / self->priv->rate,
+            ADAPTIVE_PROGRESS_MAX_INTERVAL);
+    }
+
+  return MIN (interval, ADAPTIVE_PROGRESS_MAX_INTERVAL);
+}
+
 static void
 transferred_chunk (GabbleFileTransferChannel *self,
                    guint64 count)
@@ -1527,6 +1628,21 @@ transferred_chunk (GabbleFileTransferChannel *self,
       return;
     }
 
+  if (adaptive_progress (self))
+    {
+      guint wait = adaptive_progress_interval (self);
+      gint64 elapsed = (g_get_monotonic_time () -
+          self->priv->last_progress_time) / 1000;
+
+      if (self->priv->last_progress_time == 0 || elapsed >= wait)
+        emit_progress_update (self);
+      else
+        self->priv->progress_timer = g_timeout_add (wait - elapsed,
+            emit_progress_update_cb, self);
+
+      return;
+    }
+
   /* Only emit the TransferredBytes signal if it has been one second since its
    * last emission.
    */
@@ -1559,6 +1675,235 @@ transferred_chunk (GabbleFileTransferChannel *self,
        emit_progress_update_cb, self);
 }
 
+/* How much of an already-received prefix we hash at a time when resuming */
+#define PREFIX_CHUNK_SIZE (64 * 1024)
+
+static gboolean
+checksum_type_for_hash_type (TpFileHashType hash_type,
+    GChecksumType *checksum_type)
+{
+  switch (hash_type)
+    {
+      case TP_FILE_HASH_TYPE_MD5:
+        *checksum_type = G_CHECKSUM_MD5;
+        return TRUE;
+      case TP_FILE_HASH_TYPE_SHA1:
+        *checksum_type = G_CHECKSUM_SHA1;
+        return TRUE;
+      case TP_FILE_HASH_TYPE_SHA256:
+        *checksum_type = G_CHECKSUM_SHA256;
+        return TRUE;
+      default:
+        return FALSE;
+    }
+}
+
+static void
+unblock_reading (GabbleFileTransferChannel *self)
+{
+  /* We'll unblock it ourselves once the prefix has been hashed */
+  if (self->priv->hashing_prefix)
+    return;
+
+  if (self->priv->bytestream != NULL)
+    gabble_bytestream_iface_block_reading (self->priv->bytestream, FALSE);
+#ifdef ENABLE_JINGLE_FILE_TRANSFER
+  else if (self->priv->gtalk_file_collection != NULL)
+    gtalk_file_collection_block_reading (self->priv->gtalk_file_collection,
+        self, FALSE);
+#endif
+}
+
+typedef struct {
+    GabbleFileTransferChannel *self;
+    GInputStream *input;
+    guint64 remaining;
+    guchar buffer[PREFIX_CHUNK_SIZE];
+} PrefixReader;
+
+static void
+prefix_hashed (PrefixReader *reader,
+    GError *error)
+{
+  GabbleFileTransferChannel *self = reader->self;
+
+  if (error != NULL)
+    {
+      /* If we were cancelled, the transfer has gone away in the meantime */
+      if (!g_error_matches (error, G_IO_ERROR, G_IO_ERROR_CANCELLED))
+        {
+          DEBUG ("can't hash the first %" G_GUINT64_FORMAT " bytes of %s, "
+              "so won't verify the transfer: %s", self->priv->initial_offset,
+              self->priv->uri, error->message);
+          tp_clear_pointer (&self->priv->checksum, g_checksum_free);
+        }
+    }
+  else
+    {
+      DEBUG ("hashed the first %" G_GUINT64_FORMAT " bytes of %s",
+          self->priv->initial_offset, self->priv->uri);
+    }
+
+  self->priv->hashing_prefix = FALSE;
+
+  /* If the client is already connected and keeping up, we can start
+   * receiving the rest of the file */
+  if (self->priv->transport != NULL &&
+      gibber_transport_buffer_is_empty (self->priv->transport))
+    unblock_reading (self);
+
+  if (reader->input != NULL)
+    g_object_unref (reader->input);
+
+  g_object_unref (reader->self);
+  g_slice_free (PrefixReader, reader);
+}
+
+static void
+prefix_read_cb (GObject *source,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  PrefixReader *reader = user_data;
+  GabbleFileTransferChannel *self = reader->self;
+  GError *error = NULL;
+  gssize len;
+
+  len = g_input_stream_read_finish (reader->input, result, &error);
+
+  if (len < 0)
+    {
+      prefix_hashed (reader, error);
+      g_error_free (error);
+      return;
+    }
+
+  if (len == 0)
+    {
+      error = g_error_new (G_IO_ERROR, G_IO_ERROR_PARTIAL_INPUT,
+          "file is %" G_GUINT64_FORMAT " bytes short",
+          reader->remaining);
+      prefix_hashed (reader, error);
+      g_error_free (error);
+      return;
+    }
+
+  if (self->priv->checksum != NULL)
+    g_checksum_update (self->priv->checksum, reader->buffer, len);
+
+  reader->remaining -= len;
+
+  if (reader->remaining == 0)
+    {
+      prefix_hashed (reader, NULL);
+      return;
+    }
+
+  g_input_stream_read_async (reader->input, reader->buffer,
+      MIN (reader->remaining, PREFIX_CHUNK_SIZE), G_PRIORITY_DEFAULT,
+      self->priv->prefix_cancellable, prefix_read_cb, reader);
+}
+
+static void
+prefix_opened_cb (GObject *source,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  PrefixReader *reader = user_data;
+  GabbleFileTransferChannel *self = reader->self;
+  GError *error = NULL;
+  GFileInputStream *input;
+
+  input = g_file_read_finish (G_FILE (source), result, &error);
+
+  if (input == NULL)
+    {
+      prefix_hashed (reader, error);
+      g_error_free (error);
+      return;
+    }
+
+  reader->input = G_INPUT_STREAM (input);
+  g_input_stream_read_async (reader->input, reader->buffer,
+      MIN (reader->remaining, PREFIX_CHUNK_SIZE), G_PRIORITY_DEFAULT,
+      self->priv->prefix_cancellable, prefix_read_cb, reader);
+}
+
+/*
+ * start_verifier:
+ * @self: an incoming transfer which has just been accepted
+ *
+ * If the sender told us the file's hash, and it's one we know how to compute,
+ * start hashing the data as it goes past so we can check it once the whole
+ * file has arrived. If we're resuming, the part of the file we already had
+ * counts too, so it is read back from the URI first; if that can't be done,
+ * the transfer just isn't verified.
+ */
+static void
+start_verifier (GabbleFileTransferChannel *self)
+{
+  GChecksumType checksum_type;
+  PrefixReader *reader;
+  GFile *file;
+
+  if (tp_str_empty (self->priv->content_hash) ||
+      !checksum_type_for_hash_type (self->priv->content_hash_type,
+          &checksum_type))
+    return;
+
+  /* Google's file transfers can be directories, and the sizes and hashes of
+   * those don't describe a single stream of data */
+  if (self->priv->bytestream == NULL)
+    return;
+
+  self->priv->checksum = g_checksum_new (checksum_type);
+
+  if (self->priv->initial_offset == 0)
+    return;
+
+  if (self->priv->uri == NULL)
+    {
+      DEBUG ("resuming without a URI; won't verify the transfer");
+      tp_clear_pointer (&self->priv->checksum, g_checksum_free);
+      return;
+    }
+
+  reader = g_slice_new0 (PrefixReader);
+  reader->self = g_object_ref (self);
+  reader->remaining = self->priv->initial_offset;
+
+  self->priv->hashing_prefix = TRUE;
+  self->priv->prefix_cancellable = g_cancellable_new ();
+
+  file = g_file_new_for_uri (self->priv->uri);
+  g_file_read_async (file, G_PRIORITY_DEFAULT,
+      self->priv->prefix_cancellable, prefix_opened_cb, reader);
+  g_object_unref (file);
+}
+
+/* Returns: %FALSE if we were verifying the data and it turned out not to be
+ *  what the sender said it would be */
+static gboolean
+verify_transfer (GabbleFileTransferChannel *self)
+{
+  const gchar *digest;
+
+  if (self->priv->checksum == NULL)
+    return TRUE;
+
+  digest = g_checksum_get_string (self->priv->checksum);
+
+  if (g_ascii_strcasecmp (digest, self->priv->content_hash) != 0)
+    {
+      DEBUG ("received data hashes to %s, but the sender said %s",
+          digest, self->priv->content_hash);
+      return FALSE;
+    }
+
+  DEBUG ("received data matches the hash, %s", digest);
+  return TRUE;
+}
+
 static void
 data_received_cb (GabbleFileTransferChannel *self, const guint8 *data, guint len)
 {
@@ -1578,12 +1923,28 @@ data_received_cb (GabbleFileTransferChannel *self, const guint8 *data, guint len
       return;
     }
 
+  if (self->priv->checksum != NULL)
+    g_checksum_update (self->priv->checksum, data, len);
+
   transferred_chunk (self, (guint64) len);
 
   if (self->priv->bytestream != NULL &&
       self->priv->transferred_bytes + self->priv->initial_offset >=
       self->priv->size)
     {
+      if (!verify_transfer (self))
+        {
+          gabble_file_transfer_channel_set_state (
+              TP_SVC_CHANNEL_TYPE_FILE_TRANSFER (self),
+              TP_FILE_TRANSFER_STATE_CANCELLED,
+              TP_FILE_TRANSFER_STATE_CHANGE_REASON_REMOTE_ERROR);
+
+          /* We don't know which part was wrong, so there's no point handing
+           * the client whatever is still waiting to be written */
+          gibber_transport_disconnect (self->priv->transport);
+          return;
+        }
+
       DEBUG ("Received all the file. Transfer is complete");
       gabble_file_transfer_channel_set_state (
           TP_SVC_CHANNEL_TYPE_FILE_TRANSFER (self),
@@ -1628,6 +1989,30 @@ bytestream_data_received_cb (GabbleBytestreamIface *stream,
   data_received_cb (self, (const guint8 *) data->str, data->len);
 }
 
+/*
+ * gabble_file_transfer_channel_get_progress:
+ * @self: a file transfer
+ * @transferred: (out): how much of the file has been transferred, counting
+ *  any part which was transferred before it was resumed
+ * @size: (out): the size of the file, or %G_MAXUINT64 if it's not known
+ *
+ * Returns: %TRUE if the transfer has been accepted and has not finished yet,
+ *  in which case @transferred and @size are set
+ */
+gboolean
+gabble_file_transfer_channel_get_progress (GabbleFileTransferChannel *self,
+    guint64 *transferred,
+    guint64 *size)
+{
+  if (self->priv->state != TP_FILE_TRANSFER_STATE_ACCEPTED &&
+      self->priv->state != TP_FILE_TRANSFER_STATE_OPEN)
+    return FALSE;
+
+  *transferred = self->priv->initial_offset + self->priv->transferred_bytes;
+  *size = self->priv->size;
+  return TRUE;
+}
+
 static void
 augment_si_reply (WockyNode *si,
                   gpointer user_data)
@@ -1726,6 +2111,8 @@ gabble_file_transfer_channel_accept_file (TpSvcChannelTypeFileTransfer *iface,
       self->priv->initial_offset = 0;
     }
 
+  start_verifier (self);
+
   if (self->priv->bytestream != NULL)
     {
       gabble_signal_connect_weak (self->priv->bytestream, "data-received",
@@ -1975,13 +2362,7 @@ static void
 file_transfer_receive (GabbleFileTransferChannel *self)
 {
   /* Client is connected, we can now receive data. Unblock the bytestream */
-  if (self->priv->bytestream != NULL)
-    gabble_bytestream_iface_block_reading (self->priv->bytestream, FALSE);
-#ifdef ENABLE_JINGLE_FILE_TRANSFER
-  else if (self->priv->gtalk_file_collection != NULL)
-    gtalk_file_collection_block_reading (self->priv->gtalk_file_collection,
-        self, FALSE);
-#endif
+  unblock_reading (self);
 }
 
 static void
@@ -2019,14 +2400,7 @@ transport_buffer_empty_cb (GibberTransport *transport,
                            GabbleFileTransferChannel *self)
 {
   /* Buffer is empty so we can unblock the buffer if it was blocked */
-  if (self->priv->bytestream != NULL)
-    gabble_bytestream_iface_block_reading (self->priv->bytestream, FALSE);
-
-#ifdef ENABLE_JINGLE_FILE_TRANSFER
-  if (self->priv->gtalk_file_collection != NULL)
-    gtalk_file_collection_block_reading (self->priv->gtalk_file_collection,
-        self, FALSE);
-#endif
+  unblock_reading (self);
 
   if (self->priv->state > TP_FILE_TRANSFER_STATE_OPEN)
     gibber_transport_disconnect (transport);
@@ -2048,6 +2422,7 @@ new_connection_cb (GibberListener *listener,
   DEBUG ("Client connected to local socket");
 
   self->priv->transport = g_object_ref (transport);
+  gibber_fd_transport_set_high_throughput (GIBBER_FD_TRANSPORT (transport), 0);
   gabble_signal_connect_weak (transport, "disconnected",
     G_CALLBACK (transport_disconnected_cb), G_OBJECT (self));
   gabble_signal_connect_weak (transport, "buffer-empty",
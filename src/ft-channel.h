@@ -90,6 +90,9 @@ gabble_file_transfer_channel_new (GabbleConnection *conn,
 gboolean gabble_file_transfer_channel_offer_file (
     GabbleFileTransferChannel *self, GError **error);
 
+gboolean gabble_file_transfer_channel_get_progress (
+    GabbleFileTransferChannel *self, guint64 *transferred, guint64 *size);
+
 #ifdef ENABLE_JINGLE_FILE_TRANSFER
 /* The following methods are a hack, they are 'signal-like' callbacks for the
    GTalkFileCollection. They have to be made this way because the FileCollection
@@ -261,6 +261,55 @@ gabble_ft_manager_foreach_channel (TpChannelManager *iface,
       (GFunc) gabble_ft_manager_iface_foreach_one, &f);
 }
 
+/*
+ * gabble_ft_manager_get_progress:
+ * @self: the file transfer manager
+ * @active: (out) (allow-none): the number of accepted transfers which
+ *  haven't finished yet
+ * @transferred: (out) (allow-none): how much of those transfers' files has
+ *  been transferred, counting from the start of each file
+ * @total: (out) (allow-none): the combined size of those files
+ *
+ * Adds up the progress of every active transfer. Transfers whose size isn't
+ * known don't contribute to @transferred or @total.
+ */
+void
+gabble_ft_manager_get_progress (GabbleFtManager *self,
+    guint *active,
+    guint64 *transferred,
+    guint64 *total)
+{
+  GList *l;
+  guint n = 0;
+  guint64 bytes = 0, size_sum = 0;
+
+  for (l = self->priv->channels; l != NULL; l = l->next)
+    {
+      guint64 chan_bytes, chan_size;
+
+      if (!gabble_file_transfer_channel_get_progress (l->data, &chan_bytes,
+              &chan_size))
+        continue;
+
+      n++;
+
+      if (chan_size != G_MAXUINT64)
+        {
+          bytes += chan_bytes;
+          size_sum += chan_size;
+        }
+    }
+
+  if (active != NULL)
+    *active = n;
+
+  if (transferred != NULL)
+    *transferred = bytes;
+
+  if (total != NULL)
+    *total = size_sum;
+}
+
 static void
 file_channel_closed_cb (GabbleFileTransferChannel *chan,
                         gpointer user_data)
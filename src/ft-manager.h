@@ -66,6 +66,9 @@ void gabble_ft_manager_handle_si_request (GabbleFtManager *self,
     GabbleBytestreamIface *bytestream, TpHandle handle, const gchar *stream_id,
     WockyStanza *msg);
 
+void gabble_ft_manager_get_progress (GabbleFtManager *self,
+    guint *active, guint64 *transferred, guint64 *total);
+
 #ifdef G_OS_UNIX
 /* Slight encapsulation violation: this function isn't portable, but we
  * happen to know that it's only needed if we support Unix sockets, and
@@ -21,6 +21,8 @@
 #include "config.h"
 #include "gabble.h"
 
+#include <stdlib.h>
+
 #ifdef HAVE_UNISTD_H
 # include <unistd.h>
 #endif
@@ -36,6 +38,7 @@
 #include "debug.h"
 #include "connection-manager.h"
 #include "plugin-loader.h"
+#include "watchdog.h"
 
 static TpBaseConnectionManager *
 construct_cm (void)
@@ -134,6 +137,7 @@ gabble_main (int argc,
   GabblePluginLoader *loader;
   int out;
   GLogLevelFlags fatal_mask;
+  const gchar *watchdog;
 
   tp_debug_divert_messages (g_getenv ("GABBLE_LOGFILE"));
 
@@ -168,9 +172,17 @@ gabble_main (int argc,
 
   try_to_delete_old_caps_cache ();
 
+  /* GABBLE_WATCHDOG=<ms> reports callbacks which block the main loop for
+   * that long, as Gabble.Debug.SlowCallbacks */
+  watchdog = g_getenv ("GABBLE_WATCHDOG");
+
+  if (watchdog != NULL)
+    gabble_watchdog_start (atoi (watchdog));
+
   out = tp_run_connection_manager ("telepathy-gabble", VERSION,
       construct_cm, argc, argv);
 
+  gabble_watchdog_stop ();
   g_object_unref (loader);
 
   g_log_set_default_handler (g_log_default_handler, NULL);
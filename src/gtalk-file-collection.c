@@ -29,6 +29,7 @@
 #define DEBUG_FLAG GABBLE_DEBUG_SHARE
 
 #include "debug.h"
+#include "http-parser.h"
 #include "jingle-share.h"
 #include "namespaces.h"
 #include "util.h"
@@ -123,23 +124,20 @@ enum
   LAST_PROPERTY
 };
 
+/* Where we are in the HTTP exchange; parsing the messages themselves is left
+ * to the GabbleHttpParser */
 typedef enum
   {
     HTTP_SERVER_IDLE,
-    HTTP_SERVER_HEADERS,
     HTTP_SERVER_SEND,
     HTTP_CLIENT_IDLE,
     HTTP_CLIENT_RECEIVE,
-    HTTP_CLIENT_HEADERS,
-    HTTP_CLIENT_CHUNK_SIZE,
-    HTTP_CLIENT_CHUNK_END,
-    HTTP_CLIENT_CHUNK_FINAL,
-    HTTP_CLIENT_BODY,
   } HttpStatus;
 
 
 typedef struct
 {
+  GTalkFileCollection *collection;
   NiceAgent *agent;
   guint stream_id;
   guint component_id;
@@ -147,13 +145,15 @@ typedef struct
   GabbleJingleShare *content;
   guint share_channel_id;
   HttpStatus http_status;
-  gchar *status_line;
-  gboolean is_chunked;
-  guint64 content_length;
+  GabbleHttpParser *parser;
+  /* Whether the response we're reading is a 200 */
+  gboolean response_ok;
   gchar *write_buffer;
   guint write_len;
-  gchar *read_buffer;
-  guint read_len;
+  /* Requests our peer pipelined while we were still sending a file, and the
+   * idle callback which gets back to them once we're done */
+  GByteArray *pending;
+  guint resume_id;
 } ShareChannel;
 
 
@@ -197,6 +197,12 @@ static void nice_data_received_cb (NiceAgent *agent,
 static void set_current_channel (GTalkFileCollection *self,
     GabbleFileTransferChannel *channel);
 static void channel_disposed (gpointer data, GObject *where_the_object_was);
+static gboolean http_headers_complete (GabbleHttpParser *parser,
+    const gchar *start_line, gpointer user_data);
+static gboolean http_body (GabbleHttpParser *parser, const gchar *data,
+    gsize len, gpointer user_data);
+static gboolean http_message_complete (GabbleHttpParser *parser,
+    gpointer user_data);
 
 static void
 gtalk_file_collection_init (GTalkFileCollection *self)
@@ -897,6 +903,11 @@ static void
 content_new_share_channel_cb (WockyJingleContent *content, const gchar *name,
     guint share_channel_id, gpointer user_data)
 {
+  static const GabbleHttpParserCallbacks http_callbacks = {
+      http_headers_complete,
+      http_body,
+      http_message_complete
+  };
   GTalkFileCollection *self = GTALK_FILE_COLLECTION (user_data);
   ShareChannel *share_channel = g_slice_new0 (ShareChannel);
   NiceAgent *agent = nice_agent_new_reliable (g_main_context_default (),
@@ -911,11 +922,15 @@ content_new_share_channel_cb (WockyJingleContent *content, const gchar *name,
   if (test_mode)
     g_object_set (agent, "upnp", FALSE, NULL);
 
+  share_channel->collection = self;
   share_channel->agent = agent;
   share_channel->stream_id = stream_id;
   share_channel->component_id = NICE_COMPONENT_TYPE_RTP;
   share_channel->content = GABBLE_JINGLE_SHARE (content);
   share_channel->share_channel_id = share_channel_id;
+  share_channel->parser = gabble_http_parser_new (&http_callbacks,
+      share_channel);
+  share_channel->pending = g_byte_array_new ();
 
   if (self->priv->requested)
       share_channel->http_status = HTTP_SERVER_IDLE;
@@ -991,341 +1006,245 @@ free_share_channel (gpointer data)
 
   DEBUG ("Freeing jingle Share channel");
 
+  if (share_channel->resume_id != 0)
+    g_source_remove (share_channel->resume_id);
+
   tp_clear_pointer (&share_channel->write_buffer, g_free);
-  tp_clear_pointer (&share_channel->read_buffer, g_free);
+  g_byte_array_unref (share_channel->pending);
+  gabble_http_parser_free (share_channel->parser);
   g_object_unref (share_channel->agent);
   g_slice_free (ShareChannel, share_channel);
 }
 
 
-/* If buffer contains a line ending, 0-terminate the first line and
- * return a pointer to the beginning of the next line. Otherwise
- * return NULL. */
-static gchar *
-http_read_line (gchar *buffer, guint len)
+static void
+error_all_channels (GTalkFileCollection *self)
 {
-  gchar *p = memchr (buffer, '\n', len);
+  GList *i;
 
-  if (p != NULL)
+  for (i = self->priv->channels; i;)
     {
-      *p = 0;
-      if (p > buffer && *(p-1) == '\r')
-        *(p-1) = '\0';
-      p++;
-    }
+      GabbleFileTransferChannel *channel = i->data;
 
-  return p;
+      i = i->next;
+      gabble_file_transfer_channel_gtalk_file_collection_state_changed (
+          channel, GTALK_FILE_COLLECTION_STATE_ERROR, FALSE);
+    }
 }
 
-static guint
-http_data_received (GTalkFileCollection *self, ShareChannel *share_channel,
-    gchar *buffer, guint len)
+static void
+http_handle_request (GTalkFileCollection *self, ShareChannel *share_channel,
+    const gchar *request_line)
 {
+  gchar *response = NULL;
+  gchar *get_line = NULL;
+  GabbleJingleShareManifest *manifest = NULL;
+  gchar *source_url = NULL;
+  guint url_len;
+  gchar *separator = "";
+  gchar *filename = NULL;
+  GabbleFileTransferChannel *channel = NULL;
+
+  g_assert (self->priv->current_channel == NULL);
+
+  DEBUG ("Received request : %s ", request_line);
+
+  manifest = gabble_jingle_share_get_manifest (share_channel->content);
+  source_url = manifest->source_url;
+  url_len = (source_url != NULL? strlen (source_url) : 0);
+  if (source_url != NULL && source_url[url_len -1] != '/')
+    separator = "/";
 
-  switch (share_channel->http_status)
+  get_line = g_strdup_printf ("GET %s%s%%s HTTP/1.1",
+      (source_url != NULL ? source_url : ""),
+      separator);
+  filename = g_malloc (strlen (request_line) + 1);
+
+  if (sscanf (request_line, get_line, filename) == 1)
     {
-      case HTTP_SERVER_IDLE:
-        {
-          gchar *headers = http_read_line (buffer, len);
+      gchar *unescaped = g_uri_unescape_string (filename, NULL);
 
-          if (headers == NULL)
-            return 0;
+      g_free (filename);
+      filename = unescaped;
+      channel = get_channel_by_filename (self, filename);
+    }
 
-          share_channel->http_status = HTTP_SERVER_HEADERS;
-          share_channel->status_line = g_strdup (buffer);
+  if (channel != NULL)
+    {
+      guint64 size;
 
-          if (self->priv->current_channel != NULL)
-            {
-              DEBUG ("Received status line with current channel set");
-              gabble_file_transfer_channel_gtalk_file_collection_state_changed (
-                  self->priv->current_channel,
-                  GTALK_FILE_COLLECTION_STATE_COMPLETED, FALSE);
-              set_current_channel (self, NULL);
-            }
+      g_object_get (channel,
+          "size", &size,
+          NULL);
 
-          return headers - buffer;
-        }
-        break;
-      case HTTP_SERVER_HEADERS:
-        {
-          gchar *line = buffer;
-          gchar *next_line = http_read_line (buffer, len);
+      DEBUG ("Found valid filename, result : 200");
 
-          if (next_line == NULL)
-            return 0;
+      share_channel->http_status = HTTP_SERVER_SEND;
+      response = g_strdup_printf ("HTTP/1.1 200\r\n"
+          "Connection: Keep-Alive\r\n"
+          "Content-Length: %" G_GUINT64_FORMAT "\r\n"
+          "Content-Type: application/octet-stream\r\n\r\n",
+          size);
 
-          DEBUG ("Found server headers line (%" G_GSIZE_FORMAT ") : %s",
-              strlen (line), line);
-          /* FIXME: how about content-length and an actual body ? */
-          if (line[0] == '\0')
-            {
-              gchar *response = NULL;
-              gchar *get_line = NULL;
-              GabbleJingleShareManifest *manifest = NULL;
-              gchar *source_url = NULL;
-              guint url_len;
-              gchar *separator = "";
-              gchar *filename = NULL;
-              GabbleFileTransferChannel *channel = NULL;
-
-              g_assert (self->priv->current_channel == NULL);
-
-              DEBUG ("Found empty line, received request : %s ",
-                  share_channel->status_line);
-
-              manifest = gabble_jingle_share_get_manifest (
-                  share_channel->content);
-              source_url = manifest->source_url;
-              url_len = (source_url != NULL? strlen (source_url) : 0);
-              if (source_url != NULL && source_url[url_len -1] != '/')
-                separator = "/";
-
-              get_line = g_strdup_printf ("GET %s%s%%s HTTP/1.1",
-                  (source_url != NULL ? source_url : ""),
-                  separator);
-              filename = g_malloc (strlen (share_channel->status_line));
-
-              if (sscanf (share_channel->status_line, get_line, filename) == 1)
-                {
-                  gchar *unescaped = g_uri_unescape_string (filename, NULL);
-
-                  g_free (filename);
-                  filename = unescaped;
-                  channel = get_channel_by_filename (self, filename);
-                }
-
-              if (channel != NULL)
-                {
-                  guint64 size;
-
-                  g_object_get (channel,
-                      "size", &size,
-                      NULL);
-
-                  DEBUG ("Found valid filename, result : 200");
-
-                  share_channel->http_status = HTTP_SERVER_SEND;
-                  response = g_strdup_printf ("HTTP/1.1 200\r\n"
-                      "Connection: Keep-Alive\r\n"
-                      "Content-Length: %" G_GUINT64_FORMAT "\r\n"
-                      "Content-Type: application/octet-stream\r\n\r\n",
-                      size);
-
-                }
-              else
-                {
-                  DEBUG ("Unable to find valid filename (%s), result : 404",
-                      (filename != NULL? filename : ""));
-
-                  share_channel->http_status = HTTP_SERVER_IDLE;
-                  response = g_strdup_printf ("HTTP/1.1 404\r\n"
-                      "Connection: Keep-Alive\r\n"
-                      "Content-Length: 0\r\n\r\n");
-                }
-
-              /* FIXME: check for success of nice_agent_send */
-              nice_agent_send (share_channel->agent, share_channel->stream_id,
-                  share_channel->component_id, strlen (response), response);
-
-              g_free (response);
-              g_free (filename);
-              g_free (get_line);
-
-              /* Now that we sent our response, we can assign the current
-                 channel which sets it to OPEN (if non NULL) so data can
-                 start flowing */
-              self->priv->status = GTALK_FT_STATUS_TRANSFERRING;
-              set_current_channel (self, channel);
-            }
+    }
+  else
+    {
+      DEBUG ("Unable to find valid filename (%s), result : 404",
+          (filename != NULL? filename : ""));
 
-          return next_line - buffer;
-        }
-        break;
-      case HTTP_SERVER_SEND:
-        DEBUG ("received data when we're supposed to be sending data.. "
-            "not supposed to happen");
-        break;
-      case HTTP_CLIENT_IDLE:
-        DEBUG ("received data when we're supposed to be sending the GET.. "
-            "not supposed to happen");
-        break;
-      case HTTP_CLIENT_RECEIVE:
-        {
-          gchar *headers = http_read_line (buffer, len);
+      share_channel->http_status = HTTP_SERVER_IDLE;
+      response = g_strdup_printf ("HTTP/1.1 404\r\n"
+          "Connection: Keep-Alive\r\n"
+          "Content-Length: 0\r\n\r\n");
+    }
 
-          if (headers == NULL)
-            return 0;
+  /* FIXME: check for success of nice_agent_send */
+  nice_agent_send (share_channel->agent, share_channel->stream_id,
+      share_channel->component_id, strlen (response), response);
 
-          share_channel->http_status = HTTP_CLIENT_HEADERS;
-          share_channel->status_line = g_strdup (buffer);
+  g_free (response);
+  g_free (filename);
+  g_free (get_line);
 
-          return headers - buffer;
-        }
-      case HTTP_CLIENT_HEADERS:
+  /* Now that we sent our response, we can assign the current
+     channel which sets it to OPEN (if non NULL) so data can
+     start flowing */
+  self->priv->status = GTALK_FT_STATUS_TRANSFERRING;
+  set_current_channel (self, channel);
+}
+
+static gboolean
+http_headers_complete (GabbleHttpParser *parser, const gchar *start_line,
+    gpointer user_data)
+{
+  ShareChannel *share_channel = user_data;
+  GTalkFileCollection *self = share_channel->collection;
+
+  if (self->priv->requested)
+    {
+      if (self->priv->current_channel != NULL)
         {
-          gchar *line = buffer;
-          gchar *next_line = http_read_line (buffer, len);
+          DEBUG ("Received new request with current channel set");
+          gabble_file_transfer_channel_gtalk_file_collection_state_changed (
+              self->priv->current_channel,
+              GTALK_FILE_COLLECTION_STATE_COMPLETED, FALSE);
+          set_current_channel (self, NULL);
+        }
 
-          if (next_line == NULL)
-            return 0;
+      return TRUE;
+    }
 
-          DEBUG ("Found client headers line (%" G_GSIZE_FORMAT ") : %s",
-              strlen (line), line);
-          if (line[0] == '\0')
-            {
-              DEBUG ("Found empty line, GET response : %s",
-                  share_channel->status_line);
-
-              if (g_str_has_prefix (share_channel->status_line,
-                      "HTTP/1.1 200"))
-                {
-                  if (share_channel->is_chunked)
-                    {
-                      share_channel->http_status = HTTP_CLIENT_CHUNK_SIZE;
-                    }
-                  else
-                    {
-                      share_channel->http_status = HTTP_CLIENT_BODY;
-                      if (share_channel->content_length == 0)
-                        get_next_manifest_entry (self, share_channel, FALSE);
-                    }
-                }
-              else
-                {
-                  /* We expect content-length to be 0 and no chunks for
-                     non-200 statuses (404 error) */
-                  if (share_channel->is_chunked ||
-                      share_channel->content_length != 0)
-                    {
-                      GList *i;
-
-                      DEBUG ("Unexpected body for non-200 error!");
-                      for (i = self->priv->channels; i;)
-                        {
-                          GabbleFileTransferChannel *channel = i->data;
-
-                          i = i->next;
-                          gabble_file_transfer_channel_gtalk_file_collection_state_changed (
-                              channel, GTALK_FILE_COLLECTION_STATE_ERROR, FALSE);
-                        }
-                    }
-                  else
-                    {
-                      get_next_manifest_entry (self, share_channel, TRUE);
-                    }
-                }
-            }
-          else if (!g_ascii_strncasecmp (line, "Content-Length: ", 16))
-            {
-              share_channel->is_chunked = FALSE;
-              /* Check strtoull read all the length */
-              share_channel->content_length = g_ascii_strtoull (line + 16,
-                  NULL, 10);
-              DEBUG ("Found data length : %" G_GUINT64_FORMAT,
-                  share_channel->content_length);
-            }
-          else if (!g_ascii_strcasecmp (line,
-                  "Transfer-Encoding: chunked"))
-            {
-              share_channel->is_chunked = TRUE;
-              share_channel->content_length = 0;
-              DEBUG ("Found file is chunked");
-            }
+  DEBUG ("GET response : %s", start_line);
 
-          return next_line - buffer;
-        }
-        break;
-      case HTTP_CLIENT_CHUNK_SIZE:
-        {
-          gchar *line = buffer;
-          gchar *next_line = http_read_line (buffer, len);
+  share_channel->response_ok = g_str_has_prefix (start_line, "HTTP/1.1 200");
+
+  /* We expect content-length to be 0 and no chunks for
+     non-200 statuses (404 error) */
+  if (!share_channel->response_ok &&
+      (gabble_http_parser_is_chunked (parser) ||
+          gabble_http_parser_get_content_length (parser) != 0))
+    {
+      DEBUG ("Unexpected body for non-200 error!");
+      error_all_channels (self);
+      return FALSE;
+    }
 
-          if (next_line == NULL)
-            return 0;
+  return TRUE;
+}
 
-          /* FIXME : check validity of strtoul */
-          share_channel->content_length = strtoul (line, NULL, 16);
-          if (share_channel->content_length > 0)
-              share_channel->http_status = HTTP_CLIENT_BODY;
-          else
-              share_channel->http_status = HTTP_CLIENT_CHUNK_FINAL;
+static gboolean
+http_body (GabbleHttpParser *parser, const gchar *data, gsize len,
+    gpointer user_data)
+{
+  ShareChannel *share_channel = user_data;
+  GTalkFileCollection *self = share_channel->collection;
 
+  /* We have no use for the body of a request */
+  if (self->priv->requested)
+    return TRUE;
 
-          return next_line - buffer;
-        }
-        break;
-      case HTTP_CLIENT_BODY:
-        {
-          guint consumed = 0;
+  if (self->priv->current_channel == NULL)
+    {
+      DEBUG ("Unexpected current_channel == NULL!");
+      error_all_channels (self);
+      /* FIXME: Who knows what might happen here if we got destroyed
+         It shouldn't crash since our object isn't dereferences
+         anymore, but.. */
+      return FALSE;
+    }
 
-          if (len >= share_channel->content_length)
-            {
-              if (self->priv->current_channel == NULL)
-                {
-                  GList *i;
-
-                  DEBUG ("Unexpected current_channel == NULL!");
-                  for (i = self->priv->channels; i;)
-                    {
-                      GabbleFileTransferChannel *channel = i->data;
-
-                      i = i->next;
-                      gabble_file_transfer_channel_gtalk_file_collection_state_changed (
-                          channel, GTALK_FILE_COLLECTION_STATE_ERROR, FALSE);
-                    }
-                  /* FIXME: Who knows what might happen here if we got destroyed
-                     It shouldn't crash since our object isn't dereferences
-                     anymore, but.. */
-                  return len;
-                }
-              consumed = share_channel->content_length;
-              gabble_file_transfer_channel_gtalk_file_collection_data_received (
-                  self->priv->current_channel, buffer, consumed);
-              share_channel->content_length = 0;
-              if (share_channel->is_chunked)
-                share_channel->http_status = HTTP_CLIENT_CHUNK_END;
-              else
-                get_next_manifest_entry (self, share_channel, FALSE);
-            }
-          else
-            {
-              consumed = len;
-              share_channel->content_length -= len;
-              gabble_file_transfer_channel_gtalk_file_collection_data_received (
-                  self->priv->current_channel, buffer, consumed);
-            }
+  /* This points straight into the buffer libnice gave us */
+  gabble_file_transfer_channel_gtalk_file_collection_data_received (
+      self->priv->current_channel, data, len);
 
-          return consumed;
-        }
-        break;
-      case HTTP_CLIENT_CHUNK_END:
-        {
-          gchar *chunk = http_read_line (buffer, len);
+  return TRUE;
+}
 
-          if (chunk == NULL)
-            return 0;
+static gboolean
+http_message_complete (GabbleHttpParser *parser, gpointer user_data)
+{
+  ShareChannel *share_channel = user_data;
+  GTalkFileCollection *self = share_channel->collection;
 
-          share_channel->http_status = HTTP_CLIENT_CHUNK_SIZE;
+  if (self->priv->requested)
+    {
+      http_handle_request (self, share_channel,
+          gabble_http_parser_get_start_line (parser));
 
-          return chunk - buffer;
-        }
-        break;
-      case HTTP_CLIENT_CHUNK_FINAL:
-        {
-          gchar *end = http_read_line (buffer, len);
+      /* If our peer pipelined its next request, it has to wait until we're
+         done sending this file */
+      return (share_channel->http_status != HTTP_SERVER_SEND);
+    }
 
-          if (end == NULL)
-            return 0;
+  share_channel->http_status = HTTP_CLIENT_IDLE;
+  get_next_manifest_entry (self, share_channel, !share_channel->response_ok);
 
-          share_channel->http_status = HTTP_CLIENT_IDLE;
-          get_next_manifest_entry (self, share_channel, FALSE);
+  return TRUE;
+}
 
-          return end - buffer;
-        }
-        break;
+/* Returns how much of @buffer was used; the rest has to wait until we've
+ * finished sending the file we're sending */
+static gsize
+http_data_received (GTalkFileCollection *self, ShareChannel *share_channel,
+    const gchar *buffer, gsize len)
+{
+  gssize consumed = gabble_http_parser_feed (share_channel->parser, buffer,
+      len);
+
+  if (consumed < 0)
+    {
+      DEBUG ("Received invalid HTTP data");
+      error_all_channels (self);
+      return len;
     }
 
-  return 0;
+  /* Otherwise the parser only stops early if something went wrong, and there
+     is nothing more we can do with the rest */
+  if (share_channel->http_status != HTTP_SERVER_SEND)
+    return len;
+
+  return consumed;
+}
+
+static gboolean
+resume_pending_requests (gpointer user_data)
+{
+  GTalkFileCollection *self = GTALK_FILE_COLLECTION (user_data);
+  ShareChannel *share_channel = g_hash_table_lookup (self->priv->share_channels,
+      GINT_TO_POINTER (1));
+  GByteArray *pending = g_byte_array_ref (share_channel->pending);
+  gsize consumed;
+
+  share_channel->resume_id = 0;
+
+  DEBUG ("Going back to %u bytes of pipelined requests", pending->len);
+
+  consumed = http_data_received (self, share_channel,
+      (const gchar *) pending->data, pending->len);
+  g_byte_array_remove_range (pending, 0, consumed);
+  g_byte_array_unref (pending);
+
+  return FALSE;
 }
 
 static void
@@ -1338,45 +1257,17 @@ nice_data_received_cb (NiceAgent *agent,
 {
   GTalkFileCollection *self = GTALK_FILE_COLLECTION (user_data);
   ShareChannel *share_channel = get_share_channel (self, agent);
-  gchar *free_buffer = NULL;
+  gsize consumed = 0;
 
-  if (share_channel->read_buffer != NULL)
-    {
-      gchar *tmp = g_malloc (share_channel->read_len + len);
-
-      memcpy (tmp, share_channel->read_buffer, share_channel->read_len);
-      memcpy (tmp + share_channel->read_len, buffer, len);
-
-      free_buffer = buffer = tmp;
-      len += share_channel->read_len;
-
-      g_free (share_channel->read_buffer);
-      share_channel->read_buffer = NULL;
-      share_channel->read_len = 0;
-    }
-  while (len > 0)
-    {
-      guint consumed = http_data_received (self, share_channel, buffer, len);
-
-      if (consumed == 0)
-        {
-          share_channel->read_buffer = g_memdup (buffer, len);
-          share_channel->read_len = len;
-          break;
-        }
-      else
-        {
-          /* we assume http_data_received never returns consumed > len */
-          g_assert (consumed <= len);
-
-          len -= consumed;
-          buffer += consumed;
-        }
-    }
-
-  if (free_buffer != NULL)
-    g_free (free_buffer);
+  /* Data only has to be copied if it arrives while we're sending a file, or
+     while earlier requests are still waiting for their turn */
+  if (share_channel->http_status != HTTP_SERVER_SEND &&
+      share_channel->pending->len == 0)
+    consumed = http_data_received (self, share_channel, buffer, len);
 
+  if (consumed < len)
+    g_byte_array_append (share_channel->pending,
+        (const guint8 *) buffer + consumed, len - consumed);
 }
 
 static void
@@ -1658,6 +1549,9 @@ gtalk_file_collection_completed (GTalkFileCollection *self,
      completed. */
   share_channel->http_status = HTTP_SERVER_IDLE;
   self->priv->status = GTALK_FT_STATUS_WAITING;
+
+  if (share_channel->pending->len > 0 && share_channel->resume_id == 0)
+    share_channel->resume_id = g_idle_add (resume_pending_requests, self);
 }
 
 void
@@ -0,0 +1,391 @@
+/*
+ * http-parser.c - Source for an incremental HTTP/1.1 message parser
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "http-parser.h"
+
+#include <string.h>
+
+/* Google Share only ever sends a handful of short header lines, so anything
+ * longer than this is garbage rather than a header we should wait for. */
+#define MAX_LINE_LENGTH 8192
+
+/* Enough hex digits for any chunk size which fits in a guint64 */
+#define MAX_CHUNK_SIZE_DIGITS 16
+
+typedef enum
+{
+  STATE_START_LINE,
+  STATE_HEADERS,
+  STATE_BODY,
+  STATE_CHUNK_SIZE,
+  STATE_CHUNK_DATA,
+  STATE_CHUNK_END,
+  STATE_TRAILERS,
+  /* The whole message has been read but message_complete hasn't been
+   * called yet */
+  STATE_DONE,
+  STATE_ERROR
+} ParserState;
+
+struct _GabbleHttpParser
+{
+  GabbleHttpParserCallbacks callbacks;
+  gpointer user_data;
+
+  ParserState state;
+
+  /* The line we're reading; only start lines, headers and chunk sizes go
+   * through here, never the body. It's reused from one line to the next. */
+  GString *line;
+  GString *start_line;
+
+  gboolean chunked;
+  guint64 content_length;
+  /* What's left of the body or of the current chunk */
+  guint64 remaining;
+};
+
+/*
+ * gabble_http_parser_new:
+ * @callbacks: what to call as parts of a message are read; any of them may
+ *  be %NULL
+ * @user_data: passed to @callbacks
+ *
+ * Returns: a new parser, expecting the start of a request or response. A
+ *  message with neither a Content-Length nor a chunked Transfer-Encoding is
+ *  taken to have no body, as Google Share never closes the connection to end
+ *  one.
+ */
+GabbleHttpParser *
+gabble_http_parser_new (const GabbleHttpParserCallbacks *callbacks,
+    gpointer user_data)
+{
+  GabbleHttpParser *self = g_slice_new0 (GabbleHttpParser);
+
+  self->callbacks = *callbacks;
+  self->user_data = user_data;
+  self->line = g_string_sized_new (128);
+  self->start_line = g_string_sized_new (128);
+  self->state = STATE_START_LINE;
+
+  return self;
+}
+
+void
+gabble_http_parser_free (GabbleHttpParser *self)
+{
+  g_string_free (self->line, TRUE);
+  g_string_free (self->start_line, TRUE);
+  g_slice_free (GabbleHttpParser, self);
+}
+
+/*
+ * gabble_http_parser_reset:
+ *
+ * Forgets any partly-read message (or earlier error), so that the next data
+ * fed to the parser is taken to be the start of a new one.
+ */
+void
+gabble_http_parser_reset (GabbleHttpParser *self)
+{
+  g_string_truncate (self->line, 0);
+  g_string_truncate (self->start_line, 0);
+  self->chunked = FALSE;
+  self->content_length = 0;
+  self->remaining = 0;
+  self->state = STATE_START_LINE;
+}
+
+const gchar *
+gabble_http_parser_get_start_line (GabbleHttpParser *self)
+{
+  return self->start_line->str;
+}
+
+gboolean
+gabble_http_parser_is_chunked (GabbleHttpParser *self)
+{
+  return self->chunked;
+}
+
+guint64
+gabble_http_parser_get_content_length (GabbleHttpParser *self)
+{
+  return self->content_length;
+}
+
+/* Appends as much of the current line as there is in [*data, end) to
+ * self->line, and moves *data past it. Returns TRUE if the line is complete,
+ * in which case its line ending has been stripped. */
+static gboolean
+read_line (GabbleHttpParser *self,
+    const gchar **data,
+    const gchar *end)
+{
+  const gchar *nl = memchr (*data, '\n', end - *data);
+  const gchar *stop = (nl != NULL ? nl : end);
+
+  g_string_append_len (self->line, *data, stop - *data);
+  *data = (nl != NULL ? nl + 1 : end);
+
+  if (self->line->len > MAX_LINE_LENGTH)
+    {
+      self->state = STATE_ERROR;
+      return FALSE;
+    }
+
+  if (nl == NULL)
+    return FALSE;
+
+  if (self->line->len > 0 && self->line->str[self->line->len - 1] == '\r')
+    g_string_truncate (self->line, self->line->len - 1);
+
+  return TRUE;
+}
+
+static gboolean
+parse_content_length (const gchar *value,
+    guint64 *length)
+{
+  gchar *end;
+
+  if (!g_ascii_isdigit (*value))
+    return FALSE;
+
+  *length = g_ascii_strtoull (value, &end, 10);
+
+  return (*end == '\0');
+}
+
+static gboolean
+parse_header (GabbleHttpParser *self,
+    gchar *line)
+{
+  gchar *colon = strchr (line, ':');
+  gchar *name, *value;
+
+  if (colon == NULL)
+    return FALSE;
+
+  *colon = '\0';
+  name = g_strstrip (line);
+  value = g_strstrip (colon + 1);
+
+  if (!g_ascii_strcasecmp (name, "Content-Length"))
+    {
+      if (!parse_content_length (value, &self->content_length))
+        return FALSE;
+    }
+  else if (!g_ascii_strcasecmp (name, "Transfer-Encoding"))
+    {
+      /* Only the last coding applied matters to us */
+      gchar *coding = strrchr (value, ',');
+
+      coding = (coding != NULL ? g_strstrip (coding + 1) : value);
+      self->chunked = !g_ascii_strcasecmp (coding, "chunked");
+    }
+
+  return TRUE;
+}
+
+static gboolean
+parse_chunk_size (const gchar *line,
+    guint64 *size)
+{
+  const gchar *p;
+
+  *size = 0;
+
+  for (p = line; g_ascii_isxdigit (*p); p++)
+    {
+      if (p - line == MAX_CHUNK_SIZE_DIGITS)
+        return FALSE;
+
+      *size = (*size << 4) | g_ascii_xdigit_value (*p);
+    }
+
+  if (p == line)
+    return FALSE;
+
+  /* Anything after the size must be a chunk extension, which we ignore */
+  while (*p == ' ' || *p == '\t')
+    p++;
+
+  return (*p == '\0' || *p == ';');
+}
+
+/* Works out where to go once the headers have been read */
+static void
+headers_done (GabbleHttpParser *self)
+{
+  if (self->chunked)
+    {
+      self->state = STATE_CHUNK_SIZE;
+    }
+  else if (self->content_length > 0)
+    {
+      self->remaining = self->content_length;
+      self->state = STATE_BODY;
+    }
+  else
+    {
+      self->state = STATE_DONE;
+    }
+}
+
+/*
+ * gabble_http_parser_feed:
+ * @data: the next bytes of the stream
+ * @len: the length of @data
+ *
+ * Parses as much of @data as it can, calling the parser's callbacks as it
+ * goes. Body data is passed to the body callback straight out of @data, in as
+ * few pieces as the chunking allows. Partial lines are kept by the parser, so
+ * @data can be split anywhere.
+ *
+ * Returns: the number of bytes of @data used, which is less than @len only
+ *  if a callback stopped the parser (for instance, because the caller isn't
+ *  ready for the next pipelined message yet); or -1 if the stream isn't
+ *  valid HTTP, in which case the parser must be reset before it's used
+ *  again.
+ */
+gssize
+gabble_http_parser_feed (GabbleHttpParser *self,
+    const gchar *data,
+    gsize len)
+{
+  const gchar *p = data;
+  const gchar *end = data + len;
+  gboolean carry_on = TRUE;
+
+  while (carry_on && (p < end || self->state == STATE_DONE))
+    {
+      switch (self->state)
+        {
+          case STATE_START_LINE:
+            if (!read_line (self, &p, end))
+              break;
+
+            /* Empty lines between messages are allowed, and skipped */
+            if (self->line->len > 0)
+              {
+                g_string_assign (self->start_line, self->line->str);
+                self->chunked = FALSE;
+                self->content_length = 0;
+                self->state = STATE_HEADERS;
+              }
+
+            g_string_truncate (self->line, 0);
+            break;
+
+          case STATE_HEADERS:
+            if (!read_line (self, &p, end))
+              break;
+
+            if (self->line->len > 0)
+              {
+                if (!parse_header (self, self->line->str))
+                  self->state = STATE_ERROR;
+
+                g_string_truncate (self->line, 0);
+                break;
+              }
+
+            headers_done (self);
+
+            if (self->callbacks.headers_complete != NULL)
+              carry_on = self->callbacks.headers_complete (self,
+                  self->start_line->str, self->user_data);
+            break;
+
+          case STATE_BODY:
+          case STATE_CHUNK_DATA:
+            {
+              const gchar *body = p;
+              gsize n = MIN (self->remaining, (guint64) (end - p));
+
+              p += n;
+              self->remaining -= n;
+
+              if (self->remaining == 0)
+                self->state = (self->state == STATE_BODY ? STATE_DONE :
+                    STATE_CHUNK_END);
+
+              if (self->callbacks.body != NULL)
+                carry_on = self->callbacks.body (self, body, n,
+                    self->user_data);
+            }
+            break;
+
+          case STATE_CHUNK_SIZE:
+            if (!read_line (self, &p, end))
+              break;
+
+            if (!parse_chunk_size (self->line->str, &self->remaining))
+              self->state = STATE_ERROR;
+            else if (self->remaining == 0)
+              self->state = STATE_TRAILERS;
+            else
+              self->state = STATE_CHUNK_DATA;
+
+            g_string_truncate (self->line, 0);
+            break;
+
+          case STATE_CHUNK_END:
+            if (!read_line (self, &p, end))
+              break;
+
+            if (self->line->len > 0)
+              self->state = STATE_ERROR;
+            else
+              self->state = STATE_CHUNK_SIZE;
+
+            g_string_truncate (self->line, 0);
+            break;
+
+          case STATE_TRAILERS:
+            if (!read_line (self, &p, end))
+              break;
+
+            /* Nothing we care about is sent in trailers */
+            if (self->line->len == 0)
+              self->state = STATE_DONE;
+
+            g_string_truncate (self->line, 0);
+            break;
+
+          case STATE_DONE:
+            self->state = STATE_START_LINE;
+
+            if (self->callbacks.message_complete != NULL)
+              carry_on = self->callbacks.message_complete (self,
+                  self->user_data);
+            break;
+
+          case STATE_ERROR:
+            return -1;
+        }
+    }
+
+  if (self->state == STATE_ERROR)
+    return -1;
+
+  return p - data;
+}
@@ -0,0 +1,60 @@
+/*
+ * http-parser.h - Header for an incremental HTTP/1.1 message parser
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_HTTP_PARSER_H
+#define GABBLE_HTTP_PARSER_H
+
+#include <glib.h>
+
+G_BEGIN_DECLS
+
+typedef struct _GabbleHttpParser GabbleHttpParser;
+
+/* Each callback returns FALSE to stop the parser where it is; feeding it
+ * the rest of the data later carries on from there. */
+typedef struct
+{
+  gboolean (* headers_complete) (GabbleHttpParser *parser,
+      const gchar *start_line,
+      gpointer user_data);
+  gboolean (* body) (GabbleHttpParser *parser,
+      const gchar *data,
+      gsize len,
+      gpointer user_data);
+  gboolean (* message_complete) (GabbleHttpParser *parser,
+      gpointer user_data);
+} GabbleHttpParserCallbacks;
+
+GabbleHttpParser *gabble_http_parser_new (
+    const GabbleHttpParserCallbacks *callbacks,
+    gpointer user_data);
+void gabble_http_parser_free (GabbleHttpParser *self);
+
+gssize gabble_http_parser_feed (GabbleHttpParser *self,
+    const gchar *data,
+    gsize len);
+void gabble_http_parser_reset (GabbleHttpParser *self);
+
+const gchar *gabble_http_parser_get_start_line (GabbleHttpParser *self);
+gboolean gabble_http_parser_is_chunked (GabbleHttpParser *self);
+guint64 gabble_http_parser_get_content_length (GabbleHttpParser *self);
+
+G_END_DECLS
+
+#endif /* GABBLE_HTTP_PARSER_H */
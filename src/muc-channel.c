@@ -34,6 +34,7 @@
 #define DEBUG_FLAG GABBLE_DEBUG_MUC
 #include "connection.h"
 #include "conn-aliasing.h"
+#include "conn-presence.h"
 #include "conn-util.h"
 #include "debug.h"
 #include "disco.h"
@@ -175,6 +176,16 @@ struct _GabbleMucChannelPrivate
   TpBaseRoomConfig *room_config;
   GHashTable *properties_being_updated;
 
+  /* The disco#info request for the room's properties, if there's one in
+   * flight, and whether they might have changed since we sent it */
+  GabbleDiscoRequest *properties_request;
+  gboolean properties_stale;
+  /* TRUE if we asked for the room's properties straight after our join
+   * presence, so the answer will be as of when we joined */
+  gboolean properties_requested_with_join;
+  /* TRUE until the answer to that request arrives */
+  gboolean properties_join_request_pending;
+
   /* Room interface */
   gchar *room_name;
   gchar *server;
@@ -198,6 +209,10 @@ struct _GabbleMucChannelPrivate
   /* tube ID => owned GabbleTubeIface */
   GHashTable *tubes;
 
+  /* handle of another occupant => owned WockyStanza, the last presence we
+   * dealt with from them */
+  GHashTable *occupants;
+
 #ifdef ENABLE_VOIP
   /* Current active call */
   GabbleCallMucChannel *call;
@@ -256,8 +271,11 @@ gabble_muc_channel_init (GabbleMucChannel *self)
 
   priv->tubes = g_hash_table_new_full (g_direct_hash, g_direct_equal,
       NULL, (GDestroyNotify) g_object_unref);
+  priv->occupants = g_hash_table_new_full (g_direct_hash, g_direct_equal,
+      NULL, g_object_unref);
 }
 
+static void room_properties_update (GabbleMucChannel *chan);
 static TpHandle create_room_identity (GabbleMucChannel *)
   G_GNUC_WARN_UNUSED_RESULT;
 
@@ -662,12 +680,34 @@ properties_disco_cb (GabbleDisco *disco,
   WockyNode *lm_node;
   WockyNodeIter i;
   WockyNode *child;
+  gboolean join_request;
 
   g_assert (GABBLE_IS_MUC_CHANNEL (chan));
 
+  priv->properties_request = NULL;
+  join_request = priv->properties_join_request_pending;
+  priv->properties_join_request_pending = FALSE;
+
+  /* Something changed while we were waiting, so this answer may be out of
+   * date already; we use it anyway, but ask again. */
+  if (priv->properties_stale)
+    room_properties_update (chan);
+
   if (error)
     {
       DEBUG ("got error %s", error->message);
+
+      /* Perhaps the room didn't exist until our join presence created it,
+       * so ask again once we're in: handle_perms() will, unless it already
+       * has been called, in which case we're in now. */
+      if (join_request)
+        {
+          if (priv->properties_requested_with_join)
+            priv->properties_requested_with_join = FALSE;
+          else if (priv->properties_request == NULL)
+            room_properties_update (chan);
+        }
+
       return;
     }
 
@@ -736,9 +776,20 @@ room_properties_update (GabbleMucChannel *chan)
   base = TP_BASE_CHANNEL (chan);
   conn = GABBLE_CONNECTION (tp_base_channel_get_connection (base));
 
-  if (gabble_disco_request (conn->disco, GABBLE_DISCO_TYPE_INFO,
-        priv->jid, NULL, properties_disco_cb, chan, G_OBJECT (chan),
-        &error) == NULL)
+  /* Don't have more than one request in flight at once */
+  if (priv->properties_request != NULL)
+    {
+      DEBUG ("already asking for the room's properties");
+      priv->properties_stale = TRUE;
+      return;
+    }
+
+  priv->properties_stale = FALSE;
+  priv->properties_request = gabble_disco_request (conn->disco,
+      GABBLE_DISCO_TYPE_INFO, priv->jid, NULL, properties_disco_cb, chan,
+      G_OBJECT (chan), &error);
+
+  if (priv->properties_request == NULL)
     {
       DEBUG ("disco query failed: '%s'", error->message);
       g_error_free (error);
@@ -793,6 +844,20 @@ send_join_request (GabbleMucChannel *gmuc)
   GabbleMucChannelPrivate *priv = gmuc->priv;
 
   wocky_muc_join (priv->wmuc, NULL);
+
+  /* Rather than waiting until we've joined to ask about the room, ask now:
+   * the server deals with our presence first, so the answer is the same,
+   * but we get it a round trip sooner. */
+  priv->properties_requested_with_join = TRUE;
+  priv->properties_join_request_pending = TRUE;
+  room_properties_update (gmuc);
+
+  /* If we couldn't even ask, we'll have to once we're in */
+  if (priv->properties_request == NULL)
+    {
+      priv->properties_requested_with_join = FALSE;
+      priv->properties_join_request_pending = FALSE;
+    }
 }
 
 static void
@@ -1303,6 +1368,7 @@ gabble_muc_channel_dispose (GObject *object)
   tp_clear_object (&priv->room_config);
 
   tp_clear_pointer (&priv->tubes, g_hash_table_unref);
+  tp_clear_pointer (&priv->occupants, g_hash_table_unref);
 
   if (G_OBJECT_CLASS (gabble_muc_channel_parent_class)->dispose)
     G_OBJECT_CLASS (gabble_muc_channel_parent_class)->dispose (object);
@@ -2468,6 +2534,8 @@ handle_left (GObject *source,
 
   reason = muc_status_codes_to_change_reason (codes);
 
+  g_hash_table_remove (gmuc->priv->occupants, GUINT_TO_POINTER (member));
+
   /* handle_tube_presence creates tubes if need be, so bypass it here: */
   tubes_presence_update (gmuc, member, wocky_stanza_get_top_node (stanza));
 
@@ -2497,7 +2565,13 @@ handle_perms (GObject *source,
   priv->self_role = wocky_muc_role (wmuc);
   priv->self_affil = wocky_muc_affiliation (wmuc);
 
-  room_properties_update (gmuc);
+  /* We've either just joined, in which case we asked about the room along
+   * with our join presence, or our permissions have changed. */
+  if (priv->properties_requested_with_join)
+    priv->properties_requested_with_join = FALSE;
+  else
+    room_properties_update (gmuc);
+
   update_permissions (gmuc);
 
   handle_tube_presence (gmuc, myself, stanza);
@@ -2560,8 +2634,21 @@ handle_renamed (GObject *source,
       GUINT_TO_POINTER (GABBLE_JID_ROOM_MEMBER), NULL);
   TpHandle userid = tp_handle_ensure (contact_repo, me2,
       GUINT_TO_POINTER (GABBLE_JID_ROOM_MEMBER), NULL);
+  TpHandle old_handle = TP_GROUP_MIXIN (gmuc)->self_handle;
+  WockyStanza *last = g_hash_table_lookup (gmuc->priv->occupants,
+      GUINT_TO_POINTER (old_handle));
 
-  tp_intset_add (old_self, TP_GROUP_MIXIN (gmuc)->self_handle);
+  /* Whatever we last heard under our old nick is now under the new one */
+  if (last != NULL)
+    {
+      g_object_ref (last);
+      g_hash_table_remove (gmuc->priv->occupants,
+          GUINT_TO_POINTER (old_handle));
+      g_hash_table_insert (gmuc->priv->occupants, GUINT_TO_POINTER (myself),
+          last);
+    }
+
+  tp_intset_add (old_self, old_handle);
   tp_group_mixin_change_self_handle (data, myself);
   tp_group_mixin_add_handle_owner (data, myself, userid);
   tp_group_mixin_change_members (data, "", NULL, old_self, NULL, NULL, 0, 0);
@@ -2571,6 +2658,27 @@ handle_renamed (GObject *source,
   tp_intset_destroy (old_self);
 }
 
+/* Records @stanza as the latest presence from @handle, another occupant of
+ * the room. Returns FALSE if it's the same as the last one, in which case
+ * there's nothing new to tell anyone. */
+static gboolean
+occupant_presence_changed (GabbleMucChannel *gmuc,
+    TpHandle handle,
+    WockyStanza *stanza)
+{
+  GabbleMucChannelPrivate *priv = gmuc->priv;
+  WockyStanza *last = g_hash_table_lookup (priv->occupants,
+      GUINT_TO_POINTER (handle));
+
+  if (last != NULL && wocky_node_equal (wocky_stanza_get_top_node (last),
+          wocky_stanza_get_top_node (stanza)))
+    return FALSE;
+
+  g_hash_table_insert (priv->occupants, GUINT_TO_POINTER (handle),
+      g_object_ref (stanza));
+  return TRUE;
+}
+
 static void
 update_roster_presence (GabbleMucChannel *gmuc,
     WockyMucMember *member,
@@ -2582,6 +2690,7 @@ update_roster_presence (GabbleMucChannel *gmuc,
   TpBaseChannel *base = TP_BASE_CHANNEL (gmuc);
   GabbleConnection *conn =
       GABBLE_CONNECTION (tp_base_channel_get_connection (base));
+  WockyStanza *stanza = (WockyStanza *) member->presence_stanza;
   TpHandle owner = 0;
   TpHandle handle = tp_handle_ensure (contact_repo, member->from,
       GUINT_TO_POINTER (GABBLE_JID_ROOM_MEMBER), NULL);
@@ -2596,24 +2705,22 @@ update_roster_presence (GabbleMucChannel *gmuc,
         tp_handle_set_add (owners, owner);
     }
 
-  gabble_presence_parse_presence_message (conn->presence_cache,
-      handle, member->from, (WockyStanza *) member->presence_stanza);
-
   tp_handle_set_add (members, handle);
   g_hash_table_insert (omap,
       GUINT_TO_POINTER (handle),
       GUINT_TO_POINTER (owner));
 
-  /* make a note of the fact that owner JIDs are visible to us    */
   /* notify whomever that an identifiable contact joined the MUC  */
   if (owner != 0)
-    {
-      tp_group_mixin_change_flags (G_OBJECT (gmuc), 0,
-          TP_CHANNEL_GROUP_FLAG_HANDLE_OWNERS_NOT_AVAILABLE);
-      g_signal_emit (gmuc, signals[CONTACT_JOIN], 0, owner);
-    }
+    g_signal_emit (gmuc, signals[CONTACT_JOIN], 0, owner);
+
+  /* Remember it, so we can tell if they send it again */
+  g_hash_table_insert (gmuc->priv->occupants, GUINT_TO_POINTER (handle),
+      g_object_ref (stanza));
 
-  handle_tube_presence (gmuc, handle, member->presence_stanza);
+  gabble_presence_parse_presence_message (conn->presence_cache,
+      handle, member->from, stanza);
+  handle_tube_presence (gmuc, handle, stanza);
 }
 
 /* connect to wocky_muc SIG_JOINED which we should receive when we receive   *
@@ -2640,12 +2747,23 @@ handle_join (WockyMuc *muc,
   GHashTableIter iter;
   WockyMucMember *member;
 
+  /* A big room's occupants all arrive at once, so rather than signalling
+   * each of their presences, we signal them together. */
+  conn_presence_hold_updates (GABBLE_CONNECTION (base_conn), TRUE);
+
   g_hash_table_iter_init (&iter, member_jids);
 
   while (g_hash_table_iter_next (&iter, NULL, (gpointer *)&member))
     update_roster_presence (gmuc, member, contact_repo,
       members, owners, omap);
 
+  conn_presence_hold_updates (GABBLE_CONNECTION (base_conn), FALSE);
+
+  /* make a note of the fact that owner JIDs are visible to us */
+  if (!tp_handle_set_is_empty (owners))
+    tp_group_mixin_change_flags (G_OBJECT (gmuc), 0,
+        TP_CHANNEL_GROUP_FLAG_HANDLE_OWNERS_NOT_AVAILABLE);
+
   g_hash_table_insert (omap,
       GUINT_TO_POINTER (myself),
       GUINT_TO_POINTER (tp_base_connection_get_self_handle (base_conn)));
@@ -2680,27 +2798,20 @@ handle_join (WockyMuc *muc,
   g_hash_table_unref (member_jids);
 }
 
-/* connect to wocky-muc:SIG_PRESENCE, which is fired for presences that are *
- * NOT our own after the initial roster has been received:                  */
+/* Tells everyone about a new presence from @who, another occupant of the
+ * room, whose handle is @handle */
 static void
-handle_presence (GObject *source,
-    WockyStanza *stanza,
-    guint codes,
+update_occupant (GabbleMucChannel *gmuc,
     WockyMucMember *who,
-    gpointer data)
+    TpHandle handle,
+    WockyStanza *stanza)
 {
-  GabbleMucChannel *gmuc = GABBLE_MUC_CHANNEL (data);
-#ifdef ENABLE_VOIP
-  GabbleMucChannelPrivate *priv = gmuc->priv;
-#endif
   TpBaseChannel *base = TP_BASE_CHANNEL (gmuc);
   TpBaseConnection *base_conn = tp_base_channel_get_connection (base);
   GabbleConnection *conn = GABBLE_CONNECTION (base_conn);
   TpHandleRepoIface *contact_repo =
       tp_base_connection_get_handles (base_conn, TP_HANDLE_TYPE_CONTACT);
   TpHandle owner = 0;
-  TpHandle handle = tp_handle_ensure (contact_repo, who->from,
-      GUINT_TO_POINTER (GABBLE_JID_ROOM_MEMBER), NULL);
   TpHandleSet *handles = tp_handle_set_new (contact_repo);
 
   /* is the 'real' jid field of the presence set? If so, use it: */
@@ -2714,7 +2825,7 @@ handle_presence (GObject *source,
         }
       else /* note that JIDs are known to us in this MUC */
         {
-          tp_group_mixin_change_flags (G_OBJECT (data), 0,
+          tp_group_mixin_change_flags (G_OBJECT (gmuc), 0,
               TP_CHANNEL_GROUP_FLAG_HANDLE_OWNERS_NOT_AVAILABLE);
         }
     }
@@ -2724,14 +2835,43 @@ handle_presence (GObject *source,
 
   /* add the member in quesion */
   tp_handle_set_add (handles, handle);
-  tp_group_mixin_change_members (data, "", tp_handle_set_peek (handles),
-      NULL, NULL, NULL, 0, 0);
+  tp_group_mixin_change_members (G_OBJECT (gmuc), "",
+      tp_handle_set_peek (handles), NULL, NULL, NULL, 0, 0);
 
   /* record the owner (0 for no owner) */
-  tp_group_mixin_add_handle_owner (data, handle, owner);
+  tp_group_mixin_add_handle_owner (G_OBJECT (gmuc), handle, owner);
 
   handle_tube_presence (gmuc, handle, stanza);
 
+  tp_handle_set_destroy (handles);
+}
+
+/* connect to wocky-muc:SIG_PRESENCE, which is fired for presences that are *
+ * NOT our own after the initial roster has been received:                  */
+static void
+handle_presence (GObject *source,
+    WockyStanza *stanza,
+    guint codes,
+    WockyMucMember *who,
+    gpointer data)
+{
+  GabbleMucChannel *gmuc = GABBLE_MUC_CHANNEL (data);
+#ifdef ENABLE_VOIP
+  GabbleMucChannelPrivate *priv = gmuc->priv;
+#endif
+  TpBaseChannel *base = TP_BASE_CHANNEL (gmuc);
+  TpHandleRepoIface *contact_repo = tp_base_connection_get_handles (
+      tp_base_channel_get_connection (base), TP_HANDLE_TYPE_CONTACT);
+  TpHandle handle = tp_handle_ensure (contact_repo, who->from,
+      GUINT_TO_POINTER (GABBLE_JID_ROOM_MEMBER), NULL);
+
+  /* Servers repeat presences they've already sent us, and clients broadcast
+   * the same one again; in a busy room, there are lots of these. */
+  if (occupant_presence_changed (gmuc, handle, stanza))
+    update_occupant (gmuc, who, handle, stanza);
+  else
+    DEBUG ("presence from %s hasn't changed; ignoring it", who->from);
+
 #ifdef ENABLE_VOIP
   if (!priv->call_initiating && priv->call == NULL)
     {
@@ -2747,8 +2887,6 @@ handle_presence (GObject *source,
         }
     }
 #endif
-
-  tp_handle_set_destroy (handles);
 }
 
 /* ************************************************************************ */
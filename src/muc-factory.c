@@ -90,6 +90,14 @@ struct _GabbleMucFactoryPrivate
    * Borrowed TpExportableChannel => GSList of gpointer */
   GHashTable *queued_requests;
 
+  /* Text channels which are ready, but which we haven't announced yet,
+   * mapped to the requests they satisfy, as in queued_requests. We announce
+   * them from an idle callback so that rooms we finish joining at the same
+   * time (because their join presences were answered together, say) are
+   * announced together. */
+  GHashTable *ready_channels;
+  guint announce_ready_id;
+
   gboolean dispose_has_run;
 };
 
@@ -117,6 +125,8 @@ gabble_muc_factory_init (GabbleMucFactory *fac)
 
   priv->queued_requests = g_hash_table_new_full (g_direct_hash,
       g_direct_equal, NULL, NULL);
+  priv->ready_channels = g_hash_table_new_full (g_direct_hash,
+      g_direct_equal, NULL, NULL);
 
   priv->conn = NULL;
   priv->dispose_has_run = FALSE;
@@ -152,6 +162,7 @@ gabble_muc_factory_dispose (GObject *object)
   g_assert (priv->text_channels == NULL);
   g_assert (priv->text_needed_for_tube == NULL);
   g_assert (priv->queued_requests == NULL);
+  g_assert (priv->ready_channels == NULL);
 
   g_hash_table_foreach (priv->disco_requests, cancel_disco_request,
       priv->conn->disco);
@@ -221,6 +232,51 @@ gabble_muc_factory_class_init (GabbleMucFactoryClass *gabble_muc_factory_class)
   g_object_class_install_property (object_class, PROP_CONNECTION, param_spec);
 }
 
+/* Announces every channel which has finished joining since we last did, in
+ * one NewChannels signal */
+static void
+announce_ready_channels (GabbleMucFactory *fac)
+{
+  GabbleMucFactoryPrivate *priv = fac->priv;
+  GHashTableIter iter;
+  gpointer value;
+
+  if (priv->announce_ready_id != 0)
+    {
+      g_source_remove (priv->announce_ready_id);
+      priv->announce_ready_id = 0;
+    }
+
+  if (g_hash_table_size (priv->ready_channels) == 0)
+    return;
+
+  DEBUG ("announcing %u channels", g_hash_table_size (priv->ready_channels));
+
+  g_hash_table_iter_init (&iter, priv->ready_channels);
+  while (g_hash_table_iter_next (&iter, NULL, &value))
+    g_hash_table_iter_replace (&iter, g_slist_reverse (value));
+
+  tp_channel_manager_emit_new_channels (fac, priv->ready_channels);
+
+  g_hash_table_iter_init (&iter, priv->ready_channels);
+  while (g_hash_table_iter_next (&iter, NULL, &value))
+    {
+      g_slist_free (value);
+      g_hash_table_iter_remove (&iter);
+    }
+}
+
+static gboolean
+announce_ready_channels_cb (gpointer user_data)
+{
+  GabbleMucFactory *fac = GABBLE_MUC_FACTORY (user_data);
+
+  fac->priv->announce_ready_id = 0;
+  announce_ready_channels (fac);
+
+  return FALSE;
+}
+
 /**
  * muc_channel_closed_cb:
  *
@@ -235,6 +291,12 @@ muc_channel_closed_cb (GabbleMucChannel *chan, gpointer user_data)
   TpBaseChannel *base = TP_BASE_CHANNEL (chan);
   TpHandle room_handle;
 
+  /* If it was waiting to be announced, it has to be announced before it can
+   * be closed */
+  if (priv->ready_channels != NULL &&
+      g_hash_table_lookup_extended (priv->ready_channels, chan, NULL, NULL))
+    announce_ready_channels (fac);
+
   /* channel is actually reappearing, announce it */
   if (tp_base_channel_is_respawning (base))
     {
@@ -275,20 +337,38 @@ muc_ready_cb (GabbleMucChannel *text_chan,
   requests_satisfied_text = g_hash_table_lookup (
       priv->queued_requests, text_chan);
   g_hash_table_steal (priv->queued_requests, text_chan);
-  requests_satisfied_text = g_slist_reverse (requests_satisfied_text);
+
+  tube_channels = g_hash_table_lookup (priv->text_needed_for_tube, text_chan);
 
   /* only announce channels which are on the bus (requested or
    * requested with an invite, not channels only around because they
    * have to be) */
   if (tp_base_channel_is_registered (base))
     {
+      if (tube_channels == NULL)
+        {
+          /* Wait and see whether any other rooms are ready too */
+          g_hash_table_insert (priv->ready_channels, text_chan,
+              requests_satisfied_text);
+
+          if (priv->announce_ready_id == 0)
+            priv->announce_ready_id = g_idle_add (announce_ready_channels_cb,
+                fac);
+
+          return;
+        }
+
+      /* The tube channels have to come after this one, and this one after
+       * any that are waiting. */
+      announce_ready_channels (fac);
+
+      requests_satisfied_text = g_slist_reverse (requests_satisfied_text);
       tp_channel_manager_emit_new_channel (fac,
           TP_EXPORTABLE_CHANNEL (text_chan), requests_satisfied_text);
+      g_slist_free (requests_satisfied_text);
     }
 
   /* Announce tube channels now */
-  tube_channels = g_hash_table_lookup (priv->text_needed_for_tube, text_chan);
-
   if (tube_channels != NULL)
     {
       GList *l;
@@ -402,6 +482,8 @@ muc_channel_new_call (GabbleMucChannel *muc,
 
   DEBUG ("Emitting new Call channel");
 
+  /* The room has to be announced first */
+  announce_ready_channels (fac);
   tp_channel_manager_emit_new_channel (fac,
       TP_EXPORTABLE_CHANNEL (call), requests);
 
@@ -420,8 +502,11 @@ muc_channel_new_tube (GabbleMucChannel *channel,
   /* If the muc channel is ready announce the tube channel right away
    * otherwise wait for the text channel to be ready */
   if (_gabble_muc_channel_is_ready (channel))
-    tp_channel_manager_emit_new_channel (fac,
-        TP_EXPORTABLE_CHANNEL (tube), NULL);
+    {
+      announce_ready_channels (fac);
+      tp_channel_manager_emit_new_channel (fac,
+          TP_EXPORTABLE_CHANNEL (tube), NULL);
+    }
   else
     gabble_muc_factory_associate_tube (fac, channel, tube);
 
@@ -909,6 +994,27 @@ gabble_muc_factory_close_all (GabbleMucFactory *self)
   tp_clear_pointer (&priv->queued_requests, g_hash_table_unref);
   tp_clear_pointer (&priv->text_needed_for_tube, g_hash_table_unref);
 
+  if (priv->announce_ready_id != 0)
+    {
+      g_source_remove (priv->announce_ready_id);
+      priv->announce_ready_id = 0;
+    }
+
+  if (priv->ready_channels != NULL)
+    {
+      GHashTableIter iter;
+      gpointer value;
+
+      g_hash_table_iter_init (&iter, priv->ready_channels);
+      while (g_hash_table_iter_next (&iter, NULL, &value))
+        {
+          cancel_queued_requests (self, value);
+          g_hash_table_iter_steal (&iter);
+        }
+    }
+
+  tp_clear_pointer (&priv->ready_channels, g_hash_table_unref);
+
   /* Use a temporary variable because we don't want
    * muc_channel_closed_cb remove the channel from the hash table a
    * second time */
@@ -1459,7 +1565,17 @@ handle_text_channel_request (GabbleMucFactory *self,
             }
           else
             {
-              if (tp_base_channel_is_registered (TP_BASE_CHANNEL (text_chan)))
+              gpointer pending;
+
+              if (g_hash_table_lookup_extended (priv->ready_channels,
+                    text_chan, NULL, &pending))
+                {
+                  /* It'll satisfy this request too when it's announced */
+                  g_hash_table_insert (priv->ready_channels, text_chan,
+                      g_slist_prepend (pending, request_token));
+                }
+              else if (tp_base_channel_is_registered (
+                    TP_BASE_CHANNEL (text_chan)))
                 {
                   tp_channel_manager_emit_request_already_satisfied (self,
                       request_token, TP_EXPORTABLE_CHANNEL (text_chan));
@@ -1558,6 +1674,7 @@ handle_tube_channel_request (GabbleMucFactory *self,
 
       request_tokens = g_slist_prepend (NULL, request_token);
 
+      announce_ready_channels (self);
       tp_channel_manager_emit_new_channel (self,
           TP_EXPORTABLE_CHANNEL (new_channel), request_tokens);
 
@@ -25,6 +25,7 @@
 
 #define NS_AMP                  "http://jabber.org/protocol/amp"
 #define NS_BYTESTREAMS          "http://jabber.org/protocol/bytestreams"
+#define NS_CLIENT_STATE_INDICATION "urn:xmpp:csi:0"
 #define NS_CHAT_STATES          "http://jabber.org/protocol/chatstates"
 #define NS_DISCO_INFO           "http://jabber.org/protocol/disco#info"
 #define NS_DISCO_ITEMS          "http://jabber.org/protocol/disco#items"
@@ -106,9 +107,12 @@
 #define NS_RECEIPTS             "urn:xmpp:receipts"
 #define NS_REGISTER             "jabber:iq:register"
 #define NS_ROSTER               "jabber:iq:roster"
+#define NS_ROSTER_VER           "urn:xmpp:features:rosterver"
+#define NS_RSM                  "http://jabber.org/protocol/rsm"
 #define NS_SEARCH               "jabber:iq:search"
 #define NS_SI                   "http://jabber.org/protocol/si"
 #define NS_SI_MULTIPLE          "http://telepathy.freedesktop.org/xmpp/si-multiple"
+#define NS_STREAM_MANAGEMENT    "urn:xmpp:sm:3"
 #define NS_TUBES                "http://telepathy.freedesktop.org/xmpp/tubes"
 #define NS_MUJI                 "http://telepathy.freedesktop.org/xmpp/muji"
 #define NS_VCARD_TEMP           "vcard-temp"
@@ -22,6 +22,8 @@
 
 #include "plugin-loader.h"
 
+#include <string.h>
+
 #include <glib.h>
 
 #ifdef ENABLE_PLUGINS
@@ -38,15 +40,49 @@ G_DEFINE_TYPE(GabblePluginLoader,
     gabble_plugin_loader,
     G_TYPE_OBJECT)
 
+/* The group in a plugin's manifest which describes it */
+#define MANIFEST_GROUP "Gabble Plugin"
+
+/* A plugin's manifest is called this, with the module's suffix replaced */
+#define MANIFEST_SUFFIX ".plugin"
+
+typedef struct {
+    gchar *path;
+
+    /* If the module has a manifest, what it says the plugin implements; we
+     * don't load it until we need one of those. If it doesn't, we load it
+     * straight away, and these are all NULL. */
+    gboolean has_manifest;
+    gchar **sidecars;
+    gchar **statuses;
+    gchar **privacy_lists;
+    gboolean channel_managers;
+
+    /* Whether we've tried to load the module yet, and the plugin if it
+     * worked */
+    gboolean loaded;
+    GabblePlugin *plugin;
+} PluginEntry;
+
 struct _GabblePluginLoaderPrivate {
+    /* owned PluginEntrys */
     GPtrArray *plugins;
 };
 
-#ifdef ENABLE_PLUGINS
 static void
-plugin_loader_try_to_load (
-    GabblePluginLoader *self,
-    const gchar *path)
+plugin_entry_free (PluginEntry *entry)
+{
+  g_free (entry->path);
+  g_strfreev (entry->sidecars);
+  g_strfreev (entry->statuses);
+  g_strfreev (entry->privacy_lists);
+  tp_clear_object (&entry->plugin);
+  g_slice_free (PluginEntry, entry);
+}
+
+#ifdef ENABLE_PLUGINS
+static GabblePlugin *
+plugin_loader_try_to_load (const gchar *path)
 {
   GModule *m = g_module_open (path, G_MODULE_BIND_LOCAL);
   gpointer func;
@@ -63,14 +99,14 @@ plugin_loader_try_to_load (
       else
         DEBUG ("%s: %s", path, e);
 
-      return;
+      return NULL;
     }
 
   if (!g_module_symbol (m, "gabble_plugin_create", &func))
     {
       DEBUG ("%s", g_module_error ());
       g_module_close (m);
-      return;
+      return NULL;
     }
 
   /* We're about to try to instantiate an object. This installs the
@@ -105,9 +141,119 @@ plugin_loader_try_to_load (
           gabble_plugin_get_name (plugin), version, path, sidecars);
 
       g_free (sidecars);
+    }
 
-      g_ptr_array_add (self->priv->plugins, plugin);
+  return plugin;
+}
+
+/*
+ * plugin_entry_get_plugin:
+ * @entry: a plugin we know about
+ *
+ * Returns: (transfer none): @entry's plugin, loading its module if we
+ *  haven't already, or %NULL if it couldn't be loaded
+ */
+static GabblePlugin *
+plugin_entry_get_plugin (PluginEntry *entry)
+{
+  if (!entry->loaded)
+    {
+      entry->loaded = TRUE;
+      entry->plugin = plugin_loader_try_to_load (entry->path);
     }
+
+  return entry->plugin;
+}
+
+static gchar **
+manifest_dup_list (GKeyFile *manifest,
+    const gchar *key)
+{
+  gchar **list = g_key_file_get_string_list (manifest, MANIFEST_GROUP, key,
+      NULL, NULL);
+
+  if (list == NULL)
+    list = g_new0 (gchar *, 1);
+
+  return list;
+}
+
+/*
+ * plugin_entry_read_manifest:
+ * @entry: a plugin we haven't loaded yet
+ *
+ * Looks for a manifest next to @entry's module, saying which sidecars,
+ * presence statuses, privacy lists and channel managers it has, so that we
+ * can put off loading it until one of them is needed. For instance,
+ * libfoo.so's manifest would be libfoo.plugin, containing:
+ *
+ * |[
+ * [Gabble Plugin]
+ * Sidecars=org.example.Foo;org.example.Foo.Bar;
+ * PresenceStatuses=foo-busy;
+ * PrivacyLists=foo-busy-list;
+ * ChannelManagers=false
+ * ]|
+ *
+ * Any of the keys may be omitted, meaning it has none of them.
+ *
+ * Returns: %TRUE if @entry has a manifest
+ */
+static gboolean
+plugin_entry_read_manifest (PluginEntry *entry)
+{
+  GKeyFile *manifest = g_key_file_new ();
+  gchar *stem = g_strndup (entry->path,
+      strlen (entry->path) - strlen ("." G_MODULE_SUFFIX));
+  gchar *path = g_strconcat (stem, MANIFEST_SUFFIX, NULL);
+  GError *error = NULL;
+
+  if (!g_key_file_load_from_file (manifest, path, G_KEY_FILE_NONE, &error))
+    {
+      DEBUG ("no manifest for %s: %s", entry->path, error->message);
+      g_clear_error (&error);
+    }
+  else if (!g_key_file_has_group (manifest, MANIFEST_GROUP))
+    {
+      DEBUG ("%s has no [" MANIFEST_GROUP "] group; ignoring it", path);
+    }
+  else
+    {
+      entry->has_manifest = TRUE;
+      entry->sidecars = manifest_dup_list (manifest, "Sidecars");
+      entry->statuses = manifest_dup_list (manifest, "PresenceStatuses");
+      entry->privacy_lists = manifest_dup_list (manifest, "PrivacyLists");
+      entry->channel_managers = g_key_file_get_boolean (manifest,
+          MANIFEST_GROUP, "ChannelManagers", NULL);
+    }
+
+  g_free (path);
+  g_free (stem);
+  g_key_file_free (manifest);
+  return entry->has_manifest;
+}
+
+static void
+plugin_loader_add (
+    GabblePluginLoader *self,
+    const gchar *path)
+{
+  PluginEntry *entry = g_slice_new0 (PluginEntry);
+
+  entry->path = g_strdup (path);
+
+  if (plugin_entry_read_manifest (entry))
+    {
+      DEBUG ("found a manifest for %s; not loading it until it's needed",
+          path);
+    }
+  else if (plugin_entry_get_plugin (entry) == NULL)
+    {
+      plugin_entry_free (entry);
+      return;
+    }
+
+  g_ptr_array_add (self->priv->plugins, entry);
 }
 
 static void
@@ -156,7 +302,7 @@ gabble_plugin_loader_probe (GabblePluginLoader *self)
             continue;
 
           path = g_build_filename (*ptr, file, NULL);
-          plugin_loader_try_to_load (self, path);
+          plugin_loader_add (self, path);
           g_free (path);
         }
 
@@ -165,6 +311,12 @@ gabble_plugin_loader_probe (GabblePluginLoader *self)
 
   g_strfreev (dir_array);
 }
+#else
+static GabblePlugin *
+plugin_entry_get_plugin (PluginEntry *entry)
+{
+  return entry->plugin;
+}
 #endif
 
 static void
@@ -174,7 +326,8 @@ gabble_plugin_loader_init (GabblePluginLoader *self)
       GABBLE_TYPE_PLUGIN_LOADER, GabblePluginLoaderPrivate);
 
   self->priv = priv;
-  priv->plugins = g_ptr_array_new_with_free_func (g_object_unref);
+  priv->plugins = g_ptr_array_new_with_free_func (
+      (GDestroyNotify) plugin_entry_free);
 }
 
 static GObject *
@@ -290,9 +443,17 @@ gabble_plugin_loader_create_sidecar (
 
   for (i = 0; i < priv->plugins->len; i++)
     {
-      GabblePlugin *p = g_ptr_array_index (priv->plugins, i);
+      PluginEntry *entry = g_ptr_array_index (priv->plugins, i);
+      GabblePlugin *p;
 
-      if (gabble_plugin_implements_sidecar (p, sidecar_interface))
+      if (entry->has_manifest &&
+          !tp_strv_contains ((const gchar * const *) entry->sidecars,
+              sidecar_interface))
+        continue;
+
+      p = plugin_entry_get_plugin (entry);
+
+      if (p != NULL && gabble_plugin_implements_sidecar (p, sidecar_interface))
         {
           GSimpleAsyncResult *res = g_simple_async_result_new (G_OBJECT (self),
               callback, user_data, gabble_plugin_loader_create_sidecar);
@@ -344,9 +505,19 @@ gabble_plugin_loader_append_statuses (
 
   for (i = 0; i < priv->plugins->len; i++)
     {
-      GabblePlugin *p = g_ptr_array_index (priv->plugins, i);
-      const TpPresenceStatusSpec *statuses =
-          gabble_plugin_get_custom_presence_statuses (p);
+      PluginEntry *entry = g_ptr_array_index (priv->plugins, i);
+      GabblePlugin *p;
+      const TpPresenceStatusSpec *statuses;
+
+      if (entry->has_manifest && entry->statuses[0] == NULL)
+        continue;
+
+      p = plugin_entry_get_plugin (entry);
+
+      if (p == NULL)
+        continue;
+
+      statuses = gabble_plugin_get_custom_presence_statuses (p);
 
       if (statuses != NULL)
         {
@@ -370,13 +541,24 @@ gabble_plugin_loader_presence_status_for_privacy_list (
 
   for (i = 0; i < priv->plugins->len; i++)
     {
-      GabblePlugin *p = g_ptr_array_index (priv->plugins, i);
-      const gchar *status =
-        gabble_plugin_presence_status_for_privacy_list (p, list_name);
+      PluginEntry *entry = g_ptr_array_index (priv->plugins, i);
+      GabblePlugin *p;
+      const gchar *status;
+
+      if (entry->has_manifest &&
+          !tp_strv_contains ((const gchar * const *) entry->privacy_lists,
+              list_name))
+        continue;
+
+      p = plugin_entry_get_plugin (entry);
+
+      if (p == NULL)
+        continue;
+
+      status = gabble_plugin_presence_status_for_privacy_list (p, list_name);
 
       if (status != NULL)
         return status;
-
     }
 
   return NULL;
@@ -399,9 +581,21 @@ gabble_plugin_loader_create_channel_managers (
 
   for (i = 0; i < self->priv->plugins->len; i++)
     {
-      GabblePlugin *plugin = g_ptr_array_index (self->priv->plugins, i);
+      PluginEntry *entry = g_ptr_array_index (self->priv->plugins, i);
+      GabblePlugin *plugin;
       GPtrArray *managers;
 
+      /* Channel managers have to exist from the start, to be listed in
+       * RequestableChannelClasses, so a plugin which has any is loaded when
+       * the first connection is made. */
+      if (entry->has_manifest && !entry->channel_managers)
+        continue;
+
+      plugin = plugin_entry_get_plugin (entry);
+
+      if (plugin == NULL)
+        continue;
+
       managers = gabble_plugin_create_channel_managers (plugin,
           plugin_connection);
 
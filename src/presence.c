@@ -25,7 +25,7 @@
 #include <telepathy-glib/telepathy-glib.h>
 #include <wocky/wocky.h>
 
-#include "gabble/capabilities.h"
+#include "capabilities.h"
 #include "conn-presence.h"
 #include "presence-cache.h"
 #include "namespaces.h"
@@ -47,6 +47,12 @@ typedef struct _Resource Resource;
 
 struct _Resource {
     gchar *name;
+    /* our link in GabblePresencePrivate.resources */
+    GList *link;
+    /* The resource which was the most preferable when this one was
+     * considered by find_best_resource(), if it didn't trump it; or NULL if
+     * this resource was the most preferable at that point. */
+    Resource *beaten_by;
     guint client_type;
     GabbleCapabilitySet *cap_set;
     GPtrArray *data_forms;
@@ -61,14 +67,26 @@ struct _Resource {
 };
 
 struct _GabblePresencePrivate {
-    /* The aggregated caps of all the contacts' resources. */
-    GabbleCapabilitySet *cap_set;
+    /* The aggregated caps of all the contacts' resources, kept up to date as
+     * individual resources come, go and change their caps. */
+    GabbleCapabilityUnion *caps;
+    /* TRUE if @caps doesn't correspond to @resources (because it holds caps
+     * for the bare JID, or for resources we've since thrown away) and must
+     * be rebuilt the next time a resource changes. */
+    gboolean caps_stale;
 
     /* The aggregated data forms of all the contacts' resources */
     GPtrArray *data_forms;
+    /* TRUE if @data_forms must be rebuilt from @resources before use */
+    gboolean data_forms_stale;
 
     gchar *no_resource_status_message;
-    GSList *resources;
+    /* Resource *, in the order we first saw them */
+    GQueue resources;
+    /* borrowed Resource.name → borrowed Resource */
+    GHashTable *resources_by_name;
+    /* The resource whose presence we're currently showing, or NULL */
+    Resource *best;
     guint olpc_views;
 
     gchar *active_resource;
@@ -106,15 +124,13 @@ _resource_free (Resource *resource)
 static void
 gabble_presence_finalize (GObject *object)
 {
-  GSList *i;
   GabblePresence *presence = GABBLE_PRESENCE (object);
   GabblePresencePrivate *priv = presence->priv;
 
-  for (i = priv->resources; NULL != i; i = i->next)
-    _resource_free (i->data);
-
-  g_slist_free (priv->resources);
-  gabble_capability_set_free (priv->cap_set);
+  g_hash_table_unref (priv->resources_by_name);
+  g_queue_foreach (&priv->resources, (GFunc) _resource_free, NULL);
+  g_queue_clear (&priv->resources);
+  gabble_capability_union_free (priv->caps);
   g_ptr_array_unref (priv->data_forms);
 
   g_free (presence->nickname);
@@ -140,10 +156,11 @@ gabble_presence_init (GabblePresence *self)
       GABBLE_TYPE_PRESENCE, GabblePresencePrivate);
 
   priv = self->priv;
-  priv->cap_set = gabble_capability_set_new ();
+  priv->caps = gabble_capability_union_new ();
   priv->data_forms = g_ptr_array_new_with_free_func (
       (GDestroyNotify) g_object_unref);
-  priv->resources = NULL;
+  g_queue_init (&priv->resources);
+  priv->resources_by_name = g_hash_table_new (g_str_hash, g_str_equal);
 
   self->status = GABBLE_PRESENCE_UNKNOWN;
 }
@@ -190,40 +207,107 @@ resource_better_than (
     return (a->priority > b->priority);
 }
 
+/* This doesn't use resource_better_than() because phone preferences take
+ * priority above all others whereas this is only using the PC thing as a
+ * last-ditch tiebreak. wjt looked into changing this but gave up because
+ * it's messy and the phone preference stuff will go away when we do
+ * Jingle call forking anyway:
+ * <https://bugs.freedesktop.org/show_bug.cgi?id=26673>
+ */
+static gboolean
+resource_trumps (Resource *r,
+    Resource *best)
+{
+  /* trump existing status & message if it's more present
+   * or has the same presence and was more recently available
+   * or has the same presence and a higher priority */
+  return (best == NULL ||
+      r->status > best->status ||
+      (r->status == best->status &&
+          (r->last_available > best->last_available ||
+           r->priority > best->priority)) ||
+      (r->client_type & GABBLE_CLIENT_TYPE_PC
+          && !(best->client_type & GABBLE_CLIENT_TYPE_PC)));
+}
+
+static void
+rebuild_caps (GabblePresence *presence)
+{
+  GabblePresencePrivate *priv = presence->priv;
+  GList *l;
+
+  gabble_capability_union_clear (priv->caps);
+
+  for (l = priv->resources.head; l != NULL; l = l->next)
+    {
+      Resource *r = l->data;
+
+      gabble_capability_union_add (priv->caps, r->cap_set);
+    }
+
+  priv->caps_stale = FALSE;
+}
+
+static void
+ensure_data_forms (GabblePresence *presence)
+{
+  GabblePresencePrivate *priv = presence->priv;
+  GList *l;
+
+  if (!priv->data_forms_stale)
+    return;
+
+  g_ptr_array_set_size (priv->data_forms, 0);
+
+  for (l = priv->resources.head; l != NULL; l = l->next)
+    {
+      Resource *r = l->data;
+
+      /* TODO: deal with duplicates */
+      g_ptr_array_foreach (r->data_forms, (GFunc) g_object_ref, NULL);
+      tp_g_ptr_array_extend (priv->data_forms, r->data_forms);
+    }
+
+  priv->data_forms_stale = FALSE;
+}
+
 gboolean
 gabble_presence_has_cap (GabblePresence *presence,
     const gchar *ns)
 {
   g_return_val_if_fail (presence != NULL, FALSE);
 
-  return gabble_capability_set_has (presence->priv->cap_set, ns);
+  return gabble_capability_set_has (
+      gabble_capability_union_peek (presence->priv->caps), ns);
 }
 
 GabbleCapabilitySet *
 gabble_presence_dup_caps (GabblePresence *presence)
 {
   g_return_val_if_fail (presence != NULL, NULL);
-  return gabble_capability_set_copy (presence->priv->cap_set);
+  return gabble_capability_set_copy (
+      gabble_capability_union_peek (presence->priv->caps));
 }
 
 const GabbleCapabilitySet *
 gabble_presence_peek_caps (GabblePresence *presence)
 {
   g_return_val_if_fail (presence != NULL, NULL);
-  return presence->priv->cap_set;
+  return gabble_capability_union_peek (presence->priv->caps);
 }
 
 GPtrArray *
 gabble_presence_peek_data_forms (GabblePresence *presence)
 {
   g_return_val_if_fail (presence != NULL, NULL);
+  ensure_data_forms (presence);
   return presence->priv->data_forms;
 }
 
 gboolean
 gabble_presence_has_resources (GabblePresence *self)
 {
-  return (self->priv->resources != NULL);
+  return !g_queue_is_empty (&self->priv->resources);
 }
 
 /*
@@ -246,12 +330,12 @@ gabble_presence_pick_resource_by_caps (
     gconstpointer user_data)
 {
   GabblePresencePrivate *priv = presence->priv;
-  GSList *i;
+  GList *i;
   Resource *chosen = NULL;
 
   g_return_val_if_fail (presence != NULL, NULL);
 
-  for (i = priv->resources; NULL != i; i = i->next)
+  for (i = priv->resources.head; NULL != i; i = i->next)
     {
       Resource *res = (Resource *) i->data;
 
@@ -274,18 +358,17 @@ gabble_presence_resource_has_caps (GabblePresence *presence,
                                    GabbleCapabilitySetPredicate predicate,
                                    gconstpointer user_data)
 {
-  GabblePresencePrivate *priv = presence->priv;
-  GSList *i;
+  Resource *res;
 
-  for (i = priv->resources; NULL != i; i = i->next)
-    {
-      Resource *res = (Resource *) i->data;
+  if (resource == NULL)
+    return FALSE;
 
-      if (!tp_strdiff (res->name, resource))
-        return predicate (res->cap_set, user_data);
-    }
+  res = g_hash_table_lookup (presence->priv->resources_by_name, resource);
 
-  return FALSE;
+  if (res == NULL)
+    return FALSE;
+
+  return predicate (res->cap_set, user_data);
 }
 
 static void
@@ -299,6 +382,40 @@ extend_and_dup (GPtrArray *target,
   tp_g_ptr_array_extend (target, source);
 }
 
+static void
+resource_add_caps (Resource *res,
+    const GabbleCapabilitySet *cap_set)
+{
+  GabbleCapabilitySet *old = res->cap_set;
+
+  if (gabble_capability_set_size (old) == 0)
+    {
+      /* In the common case, all the caps come from one verification string,
+       * so we can share them with every other resource using the same
+       * client. */
+      res->cap_set = gabble_capability_set_intern (cap_set);
+    }
+  else
+    {
+      /* Interned sets can't be modified, so this can't update res->cap_set
+       * in place. */
+      res->cap_set = gabble_capability_set_copy (old);
+      gabble_capability_set_update (res->cap_set, cap_set);
+    }
+
+  gabble_capability_set_free (old);
+}
+
+static Resource *
+_find_resource (GabblePresence *presence, const gchar *resource)
+{
+  /* you've been warned! */
+  g_return_val_if_fail (presence != NULL, NULL);
+  g_return_val_if_fail (resource != NULL, NULL);
+
+  return g_hash_table_lookup (presence->priv->resources_by_name, resource);
+}
+
 void
 gabble_presence_set_capabilities (GabblePresence *presence,
                                   const gchar *resource,
@@ -307,9 +424,9 @@ gabble_presence_set_capabilities (GabblePresence *presence,
                                   guint serial)
 {
   GabblePresencePrivate *priv = presence->priv;
-  GSList *i;
+  Resource *tmp;
 
-  if (resource == NULL && priv->resources != NULL)
+  if (resource == NULL && !g_queue_is_empty (&priv->resources))
     {
       /* This is consistent with the handling of presence: if we get presence
        * from a bare JID, we throw away all the resources, and if we get
@@ -321,127 +438,130 @@ gabble_presence_set_capabilities (GabblePresence *presence,
       return;
     }
 
-  gabble_capability_set_clear (priv->cap_set);
-  g_ptr_array_set_size (priv->data_forms, 0);
-
   if (resource == NULL)
     {
       DEBUG ("Setting capabilities for bare JID");
-      gabble_capability_set_update (priv->cap_set, cap_set);
+      gabble_capability_union_clear (priv->caps);
+      gabble_capability_union_add (priv->caps, cap_set);
+      priv->caps_stale = TRUE;
+
+      g_ptr_array_set_size (priv->data_forms, 0);
       extend_and_dup (priv->data_forms, (GPtrArray *) data_forms);
+      priv->data_forms_stale = FALSE;
       return;
     }
 
   DEBUG ("about to add caps to resource %s with serial %u", resource, serial);
 
-  for (i = priv->resources; NULL != i; i = i->next)
-    {
-      Resource *tmp = (Resource *) i->data;
+  /* Any caps we had for the bare JID are overridden by those of the
+   * resources. */
+  if (priv->caps_stale)
+    rebuild_caps (presence);
 
-      /* This does not use _find_resource() because it also refreshes
-       * priv->cap_set as we go.
-       */
-      if (0 == strcmp (tmp->name, resource))
-        {
-          DEBUG ("found resource %s", resource);
+  priv->data_forms_stale = TRUE;
 
-          if (serial > tmp->caps_serial)
-            {
-              DEBUG ("new serial %u, old %u, clearing caps", serial,
-                tmp->caps_serial);
-              tmp->caps_serial = serial;
-              gabble_capability_set_clear (tmp->cap_set);
-              g_ptr_array_set_size (tmp->data_forms, 0);
-            }
+  tmp = _find_resource (presence, resource);
 
-          if (serial >= tmp->caps_serial)
-            {
-              DEBUG ("updating caps for resource %s", resource);
+  if (tmp != NULL)
+    {
+      DEBUG ("found resource %s", resource);
 
-              gabble_capability_set_update (tmp->cap_set, cap_set);
+      /* Only this resource's contribution to the aggregate changes, so
+       * there's no need to look at any of the others. */
+      gabble_capability_union_remove (priv->caps, tmp->cap_set);
 
-              /* TODO: deal with duplicates */
-              extend_and_dup (tmp->data_forms, (GPtrArray *) data_forms);
-            }
+      if (serial > tmp->caps_serial)
+        {
+          DEBUG ("new serial %u, old %u, clearing caps", serial,
+            tmp->caps_serial);
+          tmp->caps_serial = serial;
+          gabble_capability_set_free (tmp->cap_set);
+          tmp->cap_set = gabble_capability_set_new ();
+          g_ptr_array_set_size (tmp->data_forms, 0);
         }
 
-      gabble_capability_set_update (priv->cap_set, tmp->cap_set);
+      if (serial >= tmp->caps_serial)
+        {
+          DEBUG ("updating caps for resource %s", resource);
 
-      /* TODO: deal with duplicates */
-      extend_and_dup (priv->data_forms, tmp->data_forms);
+          resource_add_caps (tmp, cap_set);
+
+          /* TODO: deal with duplicates */
+          extend_and_dup (tmp->data_forms, (GPtrArray *) data_forms);
+        }
+
+      gabble_capability_union_add (priv->caps, tmp->cap_set);
     }
 
   g_signal_emit_by_name (presence, "capabilities-changed");
 }
 
-static Resource *
-_find_resource (GabblePresence *presence, const gchar *resource)
+/* resource_trumps() isn't transitive, so which resource wins depends on the
+ * order in which we consider them. This considers @r after all those before
+ * it in the list. */
+static void
+consider_resource (GabblePresence *presence,
+    Resource *r)
 {
-  GSList *i;
-
-  /* you've been warned! */
-  g_return_val_if_fail (presence != NULL, NULL);
-  g_return_val_if_fail (resource != NULL, NULL);
+  GabblePresencePrivate *priv = presence->priv;
 
-  for (i = presence->priv->resources; NULL != i; i = i->next)
+  if (resource_trumps (r, priv->best))
     {
-      Resource *res = i->data;
-
-      if (!tp_strdiff (res->name, resource))
-        return res;
+      r->beaten_by = NULL;
+      priv->best = r;
     }
+  else
+    {
+      r->beaten_by = priv->best;
+    }
+}
 
-  return NULL;
+/* Looks at every resource to find the most preferable one. */
+static void
+find_best_resource (GabblePresence *presence)
+{
+  GabblePresencePrivate *priv = presence->priv;
+  GList *i;
+
+  priv->best = NULL;
+
+  for (i = priv->resources.head; NULL != i; i = i->next)
+    consider_resource (presence, i->data);
+}
+
+/* Called when @res, which was already in the list, has just changed. If it
+ * was beaten by another resource last time we looked, and still is, then
+ * the outcome is the same as before; otherwise we have to look at every
+ * resource again. */
+static void
+resource_changed (GabblePresence *presence,
+    Resource *res)
+{
+  if (res->beaten_by == NULL || resource_trumps (res, res->beaten_by))
+    find_best_resource (presence);
 }
 
+/* update presence->* based on the most preferable Resource */
 static gboolean
 aggregate_resources (GabblePresence *presence)
 {
   GabblePresencePrivate *priv = presence->priv;
-  GSList *i;
-  Resource *best = NULL;
+  Resource *best = priv->best;
   guint old_client_types = presence->client_types;
 
-  /* select the most preferable Resource and update presence->* based on our
-   * choice */
-  gabble_capability_set_clear (priv->cap_set);
   presence->status = GABBLE_PRESENCE_OFFLINE;
 
-  for (i = priv->resources; NULL != i; i = i->next)
-    {
-      Resource *r = (Resource *) i->data;
-
-      gabble_capability_set_update (priv->cap_set, r->cap_set);
-
-      /* This doesn't use resource_better_than() because phone preferences take
-       * priority above all others whereas this is only using the PC thing as a
-       * last-ditch tiebreak. wjt looked into changing this but gave up because
-       * it's messy and the phone preference stuff will go away when we do
-       * Jingle call forking anyway:
-       * <https://bugs.freedesktop.org/show_bug.cgi?id=26673>
-       */
-
-      /* trump existing status & message if it's more present
-       * or has the same presence and was more recently available
-       * or has the same presence and a higher priority */
-      if (best == NULL ||
-          r->status > best->status ||
-          (r->status == best->status &&
-              (r->last_available > best->last_available ||
-               r->priority > best->priority)) ||
-          (r->client_type & GABBLE_CLIENT_TYPE_PC
-              && !(best->client_type & GABBLE_CLIENT_TYPE_PC)))
-        best = r;
-    }
-
   if (best != NULL)
     {
       presence->status = best->status;
       presence->status_message = best->status_message;
       presence->client_types = best->client_type;
 
-      g_free (priv->active_resource);
-      priv->active_resource = g_strdup (best->name);
+      if (tp_strdiff (priv->active_resource, best->name))
+        {
+          g_free (priv->active_resource);
+          priv->active_resource = g_strdup (best->name);
+        }
     }
 
   if (presence->status <= GABBLE_PRESENCE_HIDDEN && priv->olpc_views > 0)
@@ -469,7 +589,6 @@ gabble_presence_update (GabblePresence *presence,
   Resource *res;
   GabblePresenceId old_status;
   gchar *old_status_message;
-  GSList *i;
   gboolean ret = FALSE;
 
   /* save our current state */
@@ -481,11 +600,14 @@ gabble_presence_update (GabblePresence *presence,
       /* presence from a JID with no resource: free all resources and set
        * presence directly */
 
-      for (i = priv->resources; i; i = i->next)
-        _resource_free (i->data);
-
-      g_slist_free (priv->resources);
-      priv->resources = NULL;
+      /* As before, we keep showing whatever caps and data forms we had until
+       * we hear about them again. */
+      ensure_data_forms (presence);
+      g_hash_table_remove_all (priv->resources_by_name);
+      g_queue_foreach (&priv->resources, (GFunc) _resource_free, NULL);
+      g_queue_clear (&priv->resources);
+      priv->best = NULL;
+      priv->caps_stale = TRUE;
 
       if (tp_strdiff (priv->no_resource_status_message, status_message))
         {
@@ -498,6 +620,11 @@ gabble_presence_update (GabblePresence *presence,
       goto OUT;
     }
 
+  /* Any caps we had for the bare JID are overridden by those of the
+   * resources. */
+  if (priv->caps_stale)
+    rebuild_caps (presence);
+
   res = _find_resource (presence, resource);
 
   /* remove, create or update a Resource as appropriate */
@@ -505,27 +632,36 @@ gabble_presence_update (GabblePresence *presence,
     {
       if (NULL != res)
         {
-          priv->resources = g_slist_remove (priv->resources, res);
-          _resource_free (res);
-          res = NULL;
-
-          /* recalculate aggregate capability mask */
-          gabble_capability_set_clear (priv->cap_set);
+          gabble_capability_union_remove (priv->caps, res->cap_set);
+          g_hash_table_remove (priv->resources_by_name, res->name);
+          g_queue_delete_link (&priv->resources, res->link);
+          priv->data_forms_stale = TRUE;
 
-          for (i = priv->resources; i; i = i->next)
+          if (res->beaten_by == NULL)
             {
-              Resource *r = (Resource *) i->data;
-
-              gabble_capability_set_update (priv->cap_set, r->cap_set);
+              _resource_free (res);
+              find_best_resource (presence);
             }
+          else
+            {
+              /* Nobody else refers to a resource which was beaten, so
+               * removing one doesn't change the outcome. */
+              _resource_free (res);
+            }
+
+          res = NULL;
         }
     }
   else
     {
-      if (NULL == res)
+      gboolean is_new = (res == NULL);
+
+      if (is_new)
         {
           res = _resource_new (g_strdup (resource));
-          priv->resources = g_slist_append (priv->resources, res);
+          g_queue_push_tail (&priv->resources, res);
+          res->link = priv->resources.tail;
+          g_hash_table_insert (priv->resources_by_name, res->name, res);
         }
 
       res->status = status;
@@ -540,12 +676,13 @@ gabble_presence_update (GabblePresence *presence,
 
       if (res->status >= GABBLE_PRESENCE_AVAILABLE)
           res->last_available = now;
-    }
 
-  /* select the most preferable Resource and update presence->* based on our
-   * choice */
-  gabble_capability_set_clear (priv->cap_set);
-  presence->status = GABBLE_PRESENCE_OFFLINE;
+      /* new resources go at the end of the list, so are considered last */
+      if (is_new)
+        consider_resource (presence, res);
+      else
+        resource_changed (presence, res);
+    }
 
   /* use the status message from any offline Resource we're
    * keeping around just because it has a message on it */
@@ -650,7 +787,8 @@ gabble_presence_as_message (GabblePresence *presence,
   GabblePresencePrivate *priv = presence->priv;
   WockyStanza *message;
   WockyStanzaSubType subtype;
-  Resource *res = priv->resources->data; /* pick first resource */
+  /* pick first resource */
+  Resource *res = g_queue_peek_head (&priv->resources);
 
   g_assert (NULL != res);
 
@@ -680,7 +818,7 @@ gabble_presence_as_message (GabblePresence *presence,
 gchar *
 gabble_presence_dump (GabblePresence *presence)
 {
-  GSList *i;
+  GList *i;
   GString *ret = g_string_new ("");
   gchar *tmp;
   GabblePresencePrivate *priv = presence->priv;
@@ -700,9 +838,10 @@ gabble_presence_dump (GabblePresence *presence)
     presence->status_message,
     presence->keep_unavailable);
 
-  if (priv->cap_set != NULL)
+  if (priv->caps != NULL)
     {
-      tmp = gabble_capability_set_dump (priv->cap_set, "  ");
+      tmp = gabble_capability_set_dump (
+          gabble_capability_union_peek (priv->caps), "  ");
       g_string_append (ret, "capabilities:\n");
       g_string_append (ret, tmp);
       g_free (tmp);
@@ -710,7 +849,7 @@ gabble_presence_dump (GabblePresence *presence)
 
   g_string_append_printf (ret, "resources:\n");
 
-  for (i = priv->resources; i; i = i->next)
+  for (i = priv->resources.head; i; i = i->next)
     {
       Resource *res = (Resource *) i->data;
 
@@ -730,7 +869,7 @@ gabble_presence_dump (GabblePresence *presence)
         }
     }
 
-  if (priv->resources == NULL)
+  if (g_queue_is_empty (&priv->resources))
     g_string_append_printf (ret, "  (none)\n");
 
   return g_string_free (ret, FALSE);
@@ -827,7 +966,8 @@ gabble_presence_pick_best_feature (GabblePresence *presence,
 
   for (row = table; row->result != NULL; row++)
     {
-      if (row->considered && predicate (presence->priv->cap_set,
+      if (row->considered && predicate (
+            gabble_capability_union_peek (presence->priv->caps),
             row->check_data))
         {
           return row->result;
@@ -847,7 +987,7 @@ gabble_presence_update_client_types (GabblePresence *presence,
 {
   Resource *res;
 
-  if (resource == NULL && presence->priv->resources != NULL)
+  if (resource == NULL && gabble_presence_has_resources (presence))
     {
       DEBUG ("Ignoring client types for NULL resource since we have "
           "presence for some resources");
@@ -868,6 +1008,7 @@ gabble_presence_update_client_types (GabblePresence *presence,
     return FALSE;
 
   res->client_type = client_types;
+  resource_changed (presence, res);
   return aggregate_resources (presence);
 }
 
@@ -906,6 +1047,7 @@ gabble_presence_get_data_forms (WockyXep0115Capabilities *caps)
 {
   GabblePresence *presence = GABBLE_PRESENCE (caps);
 
+  ensure_data_forms (presence);
   return presence->priv->data_forms;
 }
 
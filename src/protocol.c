@@ -102,6 +102,10 @@ static TpCMParamSpec jabber_params[] = {
     TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GINT_TO_POINTER(FALSE),
     0 /* unused */, NULL, NULL },
 
+  { "parallel-connect", DBUS_TYPE_BOOLEAN_AS_STRING, G_TYPE_BOOLEAN,
+    TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GINT_TO_POINTER(FALSE),
+    0 /* unused */, NULL, NULL },
+
   { "https-proxy-server", DBUS_TYPE_STRING_AS_STRING, G_TYPE_STRING, 0, NULL,
     0 /* unused */,
     /* FIXME: validate properly */
@@ -162,6 +166,11 @@ static TpCMParamSpec jabber_params[] = {
     TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT, GUINT_TO_POINTER (30),
     0 /* unused */, NULL, NULL },
 
+  { "search-page-size", "u", G_TYPE_UINT,
+    TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT,
+    GUINT_TO_POINTER (GABBLE_PARAMS_DEFAULT_SEARCH_PAGE_SIZE),
+    0 /* unused */, NULL, NULL },
+
   { TP_PROP_CONNECTION_INTERFACE_CONTACT_LIST_DOWNLOAD_AT_CONNECTION,
     DBUS_TYPE_BOOLEAN_AS_STRING, G_TYPE_BOOLEAN,
     TP_CONN_MGR_PARAM_FLAG_HAS_DEFAULT | TP_CONN_MGR_PARAM_FLAG_DBUS_PROPERTY,
@@ -247,6 +256,7 @@ struct ParamMapping {
   SAME ("require-encryption"),
   SAME ("register"),
   SAME ("low-bandwidth"),
+  SAME ("parallel-connect"),
   SAME ("https-proxy-server"),
   SAME ("https-proxy-port"),
   SAME ("fallback-conference-server"),
@@ -258,6 +268,7 @@ struct ParamMapping {
   SAME ("alias"),
   SAME ("fallback-socks5-proxies"),
   SAME ("keepalive-interval"),
+  SAME ("search-page-size"),
   MAP (TP_PROP_CONNECTION_INTERFACE_CONTACT_LIST_DOWNLOAD_AT_CONNECTION,
        "download-roster-at-connection"),
   MAP (GABBLE_PROP_CONNECTION_INTERFACE_GABBLE_DECLOAK_DECLOAK_AUTOMATICALLY,
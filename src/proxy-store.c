@@ -0,0 +1,488 @@
+/*
+ * proxy-store.c - Source for the local SOCKS5 proxy store
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "proxy-store.h"
+
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_BYTESTREAM
+
+#include "cache-file.h"
+#include "debug.h"
+
+/* Proxies we haven't heard from for this long (in seconds) are forgotten */
+#define FORGET_AFTER (7 * 24 * 60 * 60)
+
+/* What we assume it takes (in microseconds) to connect to a proxy we have
+ * never managed to connect to */
+#define UNKNOWN_LATENCY G_USEC_PER_SEC
+
+/* The group holding the list of proxies we were given by the proxies
+ * service. It has a space in it, so it can't be mistaken for a proxy. */
+#define LIST_GROUP "Proxies List"
+
+typedef struct
+{
+  gchar *host;
+  guint16 port;
+  gboolean fallback;
+
+  guint successes;
+  guint failures;
+  /* Smoothed time (in microseconds) it took to get through the SOCKS5
+   * handshake, or 0 if we never did */
+  gint64 latency;
+
+  /* When we last used the proxy, in seconds since the epoch */
+  gint64 stamp;
+} ProxyRecord;
+
+struct _GabbleProxyStore
+{
+  gchar *account;
+
+  /* jid (owned gchar *) → owned ProxyRecord */
+  GHashTable *proxies;
+
+  /* owned jids, and when we fetched them */
+  GSList *list;
+  gint64 list_stamp;
+
+  /* Results tend to arrive in bursts (one per bytestream), so we wait a
+   * little before writing them out. */
+  GabbleCacheSaver saver;
+};
+
+static GabbleCacheFile cache = GABBLE_CACHE_FILE_INIT ("GABBLE_PROXY_CACHE",
+    "proxies", ".ini");
+
+static void
+proxy_record_free (ProxyRecord *record)
+{
+  g_free (record->host);
+  g_slice_free (ProxyRecord, record);
+}
+
+static gint64
+now (void)
+{
+  return g_get_real_time () / G_USEC_PER_SEC;
+}
+
+static void
+load_list (GabbleProxyStore *self,
+    GKeyFile *key_file)
+{
+  gchar **jids;
+  guint i;
+
+  jids = g_key_file_get_string_list (key_file, LIST_GROUP, "Jids", NULL,
+      NULL);
+  if (jids == NULL)
+    return;
+
+  for (i = 0; jids[i] != NULL; i++)
+    self->list = g_slist_prepend (self->list, g_strdup (jids[i]));
+
+  self->list = g_slist_reverse (self->list);
+  self->list_stamp = g_key_file_get_int64 (key_file, LIST_GROUP, "Stamp",
+      NULL);
+
+  g_strfreev (jids);
+}
+
+static void
+load_proxy (GabbleProxyStore *self,
+    GKeyFile *key_file,
+    const gchar *jid)
+{
+  ProxyRecord *record;
+  gchar *host;
+  gint port;
+  gint64 stamp;
+
+  host = g_key_file_get_string (key_file, jid, "Host", NULL);
+  port = g_key_file_get_integer (key_file, jid, "Port", NULL);
+  stamp = g_key_file_get_int64 (key_file, jid, "Stamp", NULL);
+
+  if (host == NULL || port <= 0 || port > G_MAXUINT16)
+    {
+      DEBUG ("stored proxy %s is unusable; ignoring it", jid);
+      g_free (host);
+      return;
+    }
+
+  if (now () - stamp > FORGET_AFTER)
+    {
+      DEBUG ("haven't used %s for a long time; forgetting it", jid);
+      g_free (host);
+      self->saver.dirty = TRUE;
+      return;
+    }
+
+  record = g_slice_new0 (ProxyRecord);
+  record->host = host;
+  record->port = port;
+  record->fallback = g_key_file_get_boolean (key_file, jid, "Fallback",
+      NULL);
+  record->successes = g_key_file_get_integer (key_file, jid, "Successes",
+      NULL);
+  record->failures = g_key_file_get_integer (key_file, jid, "Failures",
+      NULL);
+  record->latency = g_key_file_get_int64 (key_file, jid, "Latency", NULL);
+  record->stamp = stamp;
+
+  g_hash_table_insert (self->proxies, g_strdup (jid), record);
+}
+
+static void
+load (GabbleProxyStore *self)
+{
+  GBytes *bytes = gabble_cache_file_read (&cache, self->account);
+  GKeyFile *key_file;
+  gchar **groups;
+  guint i;
+  GError *error = NULL;
+
+  if (bytes == NULL)
+    return;
+
+  key_file = g_key_file_new ();
+
+  if (!g_key_file_load_from_data (key_file, g_bytes_get_data (bytes, NULL),
+        g_bytes_get_size (bytes), G_KEY_FILE_NONE, &error))
+    {
+      DEBUG ("stored proxies for %s are unusable; ignoring them: %s",
+          self->account, error->message);
+      g_clear_error (&error);
+      goto out;
+    }
+
+  groups = g_key_file_get_groups (key_file, NULL);
+
+  for (i = 0; groups[i] != NULL; i++)
+    {
+      if (!tp_strdiff (groups[i], LIST_GROUP))
+        load_list (self, key_file);
+      else
+        load_proxy (self, key_file, groups[i]);
+    }
+
+  g_strfreev (groups);
+
+  DEBUG ("loaded %u proxies and a list of %u for %s",
+      g_hash_table_size (self->proxies), g_slist_length (self->list),
+      self->account);
+
+out:
+  g_key_file_free (key_file);
+  g_bytes_unref (bytes);
+}
+
+static void save (gpointer user_data);
+
+/*
+ * gabble_proxy_store_new:
+ * @account: the bare JID whose proxies are to be stored
+ *
+ * Returns: a new store, populated with what we learnt about SOCKS5 proxies
+ *  last time we were connected to @account (if anything).
+ */
+GabbleProxyStore *
+gabble_proxy_store_new (const gchar *account)
+{
+  GabbleProxyStore *self;
+
+  g_return_val_if_fail (account != NULL, NULL);
+
+  self = g_slice_new0 (GabbleProxyStore);
+  self->account = g_strdup (account);
+  self->proxies = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+      (GDestroyNotify) proxy_record_free);
+  gabble_cache_saver_init (&self->saver, save, self);
+
+  load (self);
+
+  return self;
+}
+
+void
+gabble_proxy_store_free (GabbleProxyStore *self)
+{
+  if (self == NULL)
+    return;
+
+  gabble_proxy_store_flush (self);
+
+  g_hash_table_unref (self->proxies);
+  g_slist_foreach (self->list, (GFunc) g_free, NULL);
+  g_slist_free (self->list);
+  g_free (self->account);
+  g_slice_free (GabbleProxyStore, self);
+}
+
+static void
+changed (GabbleProxyStore *self)
+{
+  gabble_cache_saver_changed (&self->saver);
+}
+
+/*
+ * gabble_proxy_store_dup_list:
+ * @max_age: how old (in seconds) the list can be
+ * @stamp: (out): when we fetched the list, in seconds since the epoch
+ *
+ * Returns: (transfer full): a copy of the list of proxy JIDs last passed to
+ *  gabble_proxy_store_set_list(), or %NULL if we don't have one which is
+ *  recent enough
+ */
+GSList *
+gabble_proxy_store_dup_list (GabbleProxyStore *self,
+    gint64 max_age,
+    gint64 *stamp)
+{
+  GSList *copy = NULL, *l;
+
+  if (now () - self->list_stamp > max_age)
+    return NULL;
+
+  for (l = self->list; l != NULL; l = g_slist_next (l))
+    copy = g_slist_prepend (copy, g_strdup (l->data));
+
+  *stamp = self->list_stamp;
+  return g_slist_reverse (copy);
+}
+
+/*
+ * gabble_proxy_store_set_list:
+ * @jids: a list of proxy JIDs (gchar *)
+ * @stamp: when we fetched them, in seconds since the epoch
+ *
+ * Records the list of proxies we were given by the proxies service.
+ */
+void
+gabble_proxy_store_set_list (GabbleProxyStore *self,
+    GSList *jids,
+    gint64 stamp)
+{
+  GSList *l;
+
+  g_slist_foreach (self->list, (GFunc) g_free, NULL);
+  g_slist_free (self->list);
+  self->list = NULL;
+
+  for (l = jids; l != NULL; l = g_slist_next (l))
+    self->list = g_slist_prepend (self->list, g_strdup (l->data));
+
+  self->list = g_slist_reverse (self->list);
+  self->list_stamp = stamp;
+  changed (self);
+}
+
+/*
+ * gabble_proxy_store_foreach:
+ * @max_age: how long ago (in seconds) we must have used a proxy for it to
+ *  be included
+ *
+ * Calls @func for every proxy we have used recently.
+ */
+void
+gabble_proxy_store_foreach (GabbleProxyStore *self,
+    gint64 max_age,
+    GabbleProxyStoreFunc func,
+    gpointer user_data)
+{
+  GHashTableIter iter;
+  gpointer k, v;
+  gint64 t = now ();
+
+  g_hash_table_iter_init (&iter, self->proxies);
+  while (g_hash_table_iter_next (&iter, &k, &v))
+    {
+      ProxyRecord *record = v;
+
+      if (t - record->stamp <= max_age)
+        func (k, record->host, record->port, record->fallback, user_data);
+    }
+}
+
+/*
+ * gabble_proxy_store_is_fresh:
+ * @max_age: a number of seconds
+ *
+ * Returns: %TRUE if we have used @jid in the last @max_age seconds, so its
+ *  address needn't be asked for again
+ */
+gboolean
+gabble_proxy_store_is_fresh (GabbleProxyStore *self,
+    const gchar *jid,
+    gint64 max_age)
+{
+  ProxyRecord *record = g_hash_table_lookup (self->proxies, jid);
+
+  return record != NULL && now () - record->stamp <= max_age;
+}
+
+/*
+ * gabble_proxy_store_get_cost:
+ *
+ * Returns: how long (in microseconds) we expect it to take to get through to
+ *  @jid, taking into account how often we didn't get through at all. Lower
+ *  is better; proxies we know nothing about come between those which have
+ *  worked and those which haven't.
+ */
+gdouble
+gabble_proxy_store_get_cost (GabbleProxyStore *self,
+    const gchar *jid)
+{
+  ProxyRecord *record = g_hash_table_lookup (self->proxies, jid);
+  gdouble latency;
+  guint attempts;
+
+  if (record == NULL)
+    return UNKNOWN_LATENCY * 2;
+
+  latency = record->latency > 0 ? record->latency : UNKNOWN_LATENCY;
+  attempts = record->successes + record->failures;
+
+  /* The smoothed success rate is (successes + 1) / (attempts + 2) */
+  return latency * (attempts + 2) / (record->successes + 1);
+}
+
+/*
+ * gabble_proxy_store_record:
+ * @jid: the proxy's JID
+ * @host: the address we connected to
+ * @port: the port we connected to
+ * @fallback: %TRUE if the proxy came from the fallback proxies rather than
+ *  our server
+ * @connected: %TRUE if we got through the SOCKS5 handshake
+ * @latency: if @connected, how long it took, in microseconds
+ *
+ * Records the outcome of trying to use a proxy, to be saved shortly.
+ */
+void
+gabble_proxy_store_record (GabbleProxyStore *self,
+    const gchar *jid,
+    const gchar *host,
+    guint16 port,
+    gboolean fallback,
+    gboolean connected,
+    gint64 latency)
+{
+  ProxyRecord *record = g_hash_table_lookup (self->proxies, jid);
+
+  if (record == NULL)
+    {
+      record = g_slice_new0 (ProxyRecord);
+      g_hash_table_insert (self->proxies, g_strdup (jid), record);
+    }
+
+  if (tp_strdiff (record->host, host))
+    {
+      g_free (record->host);
+      record->host = g_strdup (host);
+    }
+
+  record->port = port;
+  record->fallback = fallback;
+  record->stamp = now ();
+
+  if (connected)
+    {
+      record->successes++;
+
+      if (record->latency == 0)
+        record->latency = MAX (latency, 1);
+      else
+        record->latency = MAX ((record->latency * 3 + latency) / 4, 1);
+    }
+  else
+    {
+      record->failures++;
+    }
+
+  DEBUG ("%s: %u successes, %u failures, %" G_GINT64_FORMAT " us", jid,
+      record->successes, record->failures, record->latency);
+
+  changed (self);
+}
+
+static void
+save_proxy (const gchar *jid,
+    ProxyRecord *record,
+    GKeyFile *key_file)
+{
+  g_key_file_set_string (key_file, jid, "Host", record->host);
+  g_key_file_set_integer (key_file, jid, "Port", record->port);
+  g_key_file_set_boolean (key_file, jid, "Fallback", record->fallback);
+  g_key_file_set_integer (key_file, jid, "Successes", record->successes);
+  g_key_file_set_integer (key_file, jid, "Failures", record->failures);
+  g_key_file_set_int64 (key_file, jid, "Latency", record->latency);
+  g_key_file_set_int64 (key_file, jid, "Stamp", record->stamp);
+}
+
+static void
+save (gpointer user_data)
+{
+  GabbleProxyStore *self = user_data;
+  GKeyFile *key_file;
+  gchar *data;
+  gsize length;
+
+  key_file = g_key_file_new ();
+
+  if (self->list != NULL)
+    {
+      const gchar **jids = g_new0 (const gchar *,
+          g_slist_length (self->list) + 1);
+      GSList *l;
+      guint i = 0;
+
+      for (l = self->list; l != NULL; l = g_slist_next (l))
+        jids[i++] = l->data;
+
+      g_key_file_set_string_list (key_file, LIST_GROUP, "Jids", jids, i);
+      g_key_file_set_int64 (key_file, LIST_GROUP, "Stamp", self->list_stamp);
+      g_free (jids);
+    }
+
+  g_hash_table_foreach (self->proxies, (GHFunc) save_proxy, key_file);
+
+  data = g_key_file_to_data (key_file, &length, NULL);
+
+  DEBUG ("saving %u proxies for %s", g_hash_table_size (self->proxies),
+      self->account);
+  gabble_cache_file_write (&cache, self->account, data, length);
+
+  g_free (data);
+  g_key_file_free (key_file);
+}
+
+/*
+ * gabble_proxy_store_flush:
+ *
+ * Writes any outstanding changes out immediately.
+ */
+void
+gabble_proxy_store_flush (GabbleProxyStore *self)
+{
+  gabble_cache_saver_flush (&self->saver);
+}
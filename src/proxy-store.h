@@ -0,0 +1,67 @@
+/*
+ * proxy-store.h - Header for the local SOCKS5 proxy store
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_PROXY_STORE_H
+#define GABBLE_PROXY_STORE_H
+
+#include <glib.h>
+
+G_BEGIN_DECLS
+
+typedef struct _GabbleProxyStore GabbleProxyStore;
+
+typedef void (* GabbleProxyStoreFunc) (const gchar *jid,
+    const gchar *host,
+    guint16 port,
+    gboolean fallback,
+    gpointer user_data);
+
+GabbleProxyStore *gabble_proxy_store_new (const gchar *account);
+void gabble_proxy_store_free (GabbleProxyStore *self);
+
+GSList *gabble_proxy_store_dup_list (GabbleProxyStore *self,
+    gint64 max_age,
+    gint64 *stamp);
+void gabble_proxy_store_set_list (GabbleProxyStore *self,
+    GSList *jids,
+    gint64 stamp);
+
+void gabble_proxy_store_foreach (GabbleProxyStore *self,
+    gint64 max_age,
+    GabbleProxyStoreFunc func,
+    gpointer user_data);
+gboolean gabble_proxy_store_is_fresh (GabbleProxyStore *self,
+    const gchar *jid,
+    gint64 max_age);
+gdouble gabble_proxy_store_get_cost (GabbleProxyStore *self,
+    const gchar *jid);
+
+void gabble_proxy_store_record (GabbleProxyStore *self,
+    const gchar *jid,
+    const gchar *host,
+    guint16 port,
+    gboolean fallback,
+    gboolean connected,
+    gint64 latency);
+
+void gabble_proxy_store_flush (GabbleProxyStore *self);
+
+G_END_DECLS
+
+#endif /* GABBLE_PROXY_STORE_H */
@@ -70,6 +70,11 @@ struct _GabbleRoomlistChannelPrivate
 
 #define ROOM_SIGNAL_INTERVAL 300
 
+/* Rooms are listed this many at a time (using XEP-0059 on servers which
+ * support it), and signalled at least this many at a time, so that we don't
+ * hold on to every room on a big server at once. */
+#define ROOM_PAGE_SIZE 100
+
 static gboolean emit_room_signal (gpointer data);
 static void gabble_roomlist_channel_close (TpBaseChannel *base);
 
@@ -419,6 +424,9 @@ room_info_cb (gpointer pipeline, GabbleDiscoItem *item, gpointer user_data)
   DEBUG ("adding new room signal data to pending: %s", jid);
   g_ptr_array_add (priv->pending_room_signals, g_value_get_boxed (&room));
   g_hash_table_unref (keys);
+
+  if (priv->pending_room_signals->len >= ROOM_PAGE_SIZE)
+    emit_room_signal (chan);
 }
 
 static void
@@ -502,12 +510,23 @@ gabble_roomlist_channel_list_rooms (TpSvcChannelTypeRoomList *iface,
   GabbleConnection *conn =
       GABBLE_CONNECTION (tp_base_channel_get_connection (base));
 
+  if (priv->listing)
+    {
+      DEBUG ("already listing rooms");
+      tp_svc_channel_type_room_list_return_from_list_rooms (context);
+      return;
+    }
+
   priv->listing = TRUE;
   tp_svc_channel_type_room_list_emit_listing_rooms (iface, TRUE);
 
   if (priv->disco_pipeline == NULL)
-    priv->disco_pipeline = gabble_disco_pipeline_init (conn->disco,
-        room_info_cb, rooms_end_cb, self);
+    {
+      priv->disco_pipeline = gabble_disco_pipeline_init (conn->disco,
+          room_info_cb, rooms_end_cb, self);
+      gabble_disco_pipeline_set_page_size (priv->disco_pipeline,
+          ROOM_PAGE_SIZE);
+    }
 
   gabble_disco_pipeline_run (priv->disco_pipeline, priv->conference_server);
 
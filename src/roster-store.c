@@ -0,0 +1,265 @@
+/*
+ * roster-store.c - Source for the local XEP-0237 roster store
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "roster-store.h"
+
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_ROSTER
+
+#include "cache-file.h"
+#include "debug.h"
+#include "namespaces.h"
+
+struct _GabbleRosterStore
+{
+  gchar *account;
+  gchar *version;
+
+  /* jid (owned gchar *) → copy of its <item/> (owned WockyNodeTree *) */
+  GHashTable *items;
+
+  /* Pushes tend to arrive in bursts (for instance, straight after the
+   * initial roster query when the server sends us the changes since our
+   * cached version), so we wait a little before writing them out. */
+  GabbleCacheSaver saver;
+};
+
+static GabbleCacheFile cache = GABBLE_CACHE_FILE_INIT ("GABBLE_ROSTER_CACHE",
+    "rosters", ".xml");
+
+/* Copies every <item/> of @query_node into our table; items with
+ * subscription='remove' are dropped from it. */
+static void
+store_items (GabbleRosterStore *self,
+    WockyNode *query_node)
+{
+  WockyNodeIter i;
+  WockyNode *item_node;
+
+  wocky_node_iter_init (&i, query_node, "item", NULL);
+  while (wocky_node_iter_next (&i, &item_node))
+    {
+      const gchar *jid = wocky_node_get_attribute (item_node, "jid");
+
+      if (jid == NULL)
+        continue;
+
+      if (!tp_strdiff (wocky_node_get_attribute (item_node, "subscription"),
+            "remove"))
+        g_hash_table_remove (self->items, jid);
+      else
+        g_hash_table_insert (self->items, g_strdup (jid),
+            wocky_node_tree_new_from_node (item_node));
+    }
+}
+
+static void
+load (GabbleRosterStore *self)
+{
+  GBytes *bytes = gabble_cache_file_read (&cache, self->account);
+  WockyXmppReader *reader;
+  WockyStanza *stanza;
+  WockyNode *query_node = NULL;
+
+  if (bytes == NULL)
+    return;
+
+  reader = wocky_xmpp_reader_new_no_stream ();
+  wocky_xmpp_reader_push (reader, g_bytes_get_data (bytes, NULL),
+      g_bytes_get_size (bytes));
+  stanza = wocky_xmpp_reader_pop_stanza (reader);
+
+  if (stanza != NULL)
+    query_node = wocky_node_get_child_ns (wocky_stanza_get_top_node (stanza),
+        "query", NS_ROSTER);
+
+  if (query_node != NULL &&
+      wocky_node_get_attribute (query_node, "ver") != NULL)
+    {
+      self->version = g_strdup (wocky_node_get_attribute (query_node, "ver"));
+      store_items (self, query_node);
+
+      DEBUG ("loaded %u items at version '%s' for %s",
+          g_hash_table_size (self->items), self->version, self->account);
+    }
+  else
+    {
+      DEBUG ("stored roster for %s is unusable; ignoring it", self->account);
+    }
+
+  if (stanza != NULL)
+    g_object_unref (stanza);
+
+  g_object_unref (reader);
+  g_bytes_unref (bytes);
+}
+
+static void save (gpointer user_data);
+
+/*
+ * gabble_roster_store_new:
+ * @account: the bare JID whose roster is to be stored
+ *
+ * Returns: a new store, populated with the roster we saved last time we were
+ *  connected to @account (if any).
+ */
+GabbleRosterStore *
+gabble_roster_store_new (const gchar *account)
+{
+  GabbleRosterStore *self;
+
+  g_return_val_if_fail (account != NULL, NULL);
+
+  self = g_slice_new0 (GabbleRosterStore);
+  self->account = g_strdup (account);
+  self->items = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+      g_object_unref);
+  gabble_cache_saver_init (&self->saver, save, self);
+
+  load (self);
+
+  return self;
+}
+
+void
+gabble_roster_store_free (GabbleRosterStore *self)
+{
+  if (self == NULL)
+    return;
+
+  gabble_roster_store_flush (self);
+
+  g_hash_table_unref (self->items);
+  g_free (self->version);
+  g_free (self->account);
+  g_slice_free (GabbleRosterStore, self);
+}
+
+/*
+ * gabble_roster_store_get_version:
+ *
+ * Returns: the 'ver' of the stored roster, or %NULL if we don't have a
+ *  roster we could ask the server to compare against.
+ */
+const gchar *
+gabble_roster_store_get_version (GabbleRosterStore *self)
+{
+  return self->version;
+}
+
+/*
+ * gabble_roster_store_update:
+ * @query_node: a <query xmlns='jabber:iq:roster'/> from the server
+ * @replace: %TRUE if @query_node is a complete roster (a reply to our roster
+ *  query), %FALSE if it's a roster push
+ *
+ * Records the contents of @query_node, to be saved shortly.
+ */
+void
+gabble_roster_store_update (GabbleRosterStore *self,
+    WockyNode *query_node,
+    gboolean replace)
+{
+  const gchar *ver = wocky_node_get_attribute (query_node, "ver");
+
+  if (replace)
+    g_hash_table_remove_all (self->items);
+
+  store_items (self, query_node);
+
+  /* A complete roster without a 'ver' means the server has stopped
+   * versioning it; a push without one leaves us unable to tell whether
+   * we're in sync, so either way our copy mustn't be trusted next time. */
+  g_free (self->version);
+  self->version = g_strdup (ver);
+
+  gabble_cache_saver_changed (&self->saver);
+}
+
+/*
+ * gabble_roster_store_fill_query:
+ * @query_node: a <query xmlns='jabber:iq:roster'/>
+ *
+ * Adds a copy of every stored <item/> to @query_node, which can then be
+ * processed as if the server had sent us the whole roster.
+ */
+void
+gabble_roster_store_fill_query (GabbleRosterStore *self,
+    WockyNode *query_node)
+{
+  GHashTableIter iter;
+  gpointer v;
+
+  g_hash_table_iter_init (&iter, self->items);
+  while (g_hash_table_iter_next (&iter, NULL, &v))
+    wocky_node_add_node_tree (query_node, v);
+
+  if (self->version != NULL)
+    wocky_node_set_attribute (query_node, "ver", self->version);
+}
+
+static void
+save (gpointer user_data)
+{
+  GabbleRosterStore *self = user_data;
+  WockyStanza *stanza;
+  WockyNode *query_node;
+  WockyXmppWriter *writer;
+  const guint8 *data;
+  gsize length;
+
+  if (self->version == NULL)
+    {
+      DEBUG ("roster for %s is unversioned; not keeping it", self->account);
+      gabble_cache_file_remove (&cache, self->account);
+      return;
+    }
+
+  stanza = wocky_stanza_build (WOCKY_STANZA_TYPE_IQ,
+      WOCKY_STANZA_SUB_TYPE_RESULT, NULL, NULL,
+        '(', "query",
+          ':', NS_ROSTER,
+          '*', &query_node,
+        ')',
+      NULL);
+  gabble_roster_store_fill_query (self, query_node);
+
+  writer = wocky_xmpp_writer_new_no_stream ();
+  wocky_xmpp_writer_write_stanza (writer, stanza, &data, &length);
+
+  DEBUG ("saving %u items at version '%s' for %s",
+      g_hash_table_size (self->items), self->version, self->account);
+  gabble_cache_file_write (&cache, self->account, data, length);
+
+  g_object_unref (writer);
+  g_object_unref (stanza);
+}
+
+/*
+ * gabble_roster_store_flush:
+ *
+ * Writes any outstanding changes out immediately.
+ */
+void
+gabble_roster_store_flush (GabbleRosterStore *self)
+{
+  gabble_cache_saver_flush (&self->saver);
+}
@@ -0,0 +1,46 @@
+/*
+ * roster-store.h - Header for the local XEP-0237 roster store
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_ROSTER_STORE_H
+#define GABBLE_ROSTER_STORE_H
+
+#include <glib.h>
+
+#include <wocky/wocky.h>
+
+G_BEGIN_DECLS
+
+typedef struct _GabbleRosterStore GabbleRosterStore;
+
+GabbleRosterStore *gabble_roster_store_new (const gchar *account);
+void gabble_roster_store_free (GabbleRosterStore *self);
+
+const gchar *gabble_roster_store_get_version (GabbleRosterStore *self);
+
+void gabble_roster_store_update (GabbleRosterStore *self,
+    WockyNode *query_node,
+    gboolean replace);
+void gabble_roster_store_fill_query (GabbleRosterStore *self,
+    WockyNode *query_node);
+
+void gabble_roster_store_flush (GabbleRosterStore *self);
+
+G_END_DECLS
+
+#endif /* GABBLE_ROSTER_STORE_H */
@@ -39,6 +39,7 @@
 #include "debug.h"
 #include "namespaces.h"
 #include "presence-cache.h"
+#include "roster-store.h"
 #include "util.h"
 
 #define GOOGLE_ROSTER_VERSION "2"
@@ -70,6 +71,16 @@ struct _GabbleRosterPrivate
    * accepted during this session */
   TpHandleSet *pre_authorized;
 
+  /* our local copy of the roster, if the server supports XEP-0237 roster
+   * versioning */
+  GabbleRosterStore *store;
+
+  /* Non-NULL if we asked for the roster before we were connected (see
+   * gabble_roster_prefetch()): the reply, and any roster pushes that follow
+   * it, are held here until we are. */
+  GQueue *held;
+  gboolean prefetched;
+
   gboolean received;
   gboolean dispose_has_run;
 };
@@ -1364,6 +1375,8 @@ static void roster_item_apply_edits (GabbleRoster *roster, TpHandle contact,
 
 /**
  * got_roster_iq:
+ * @from_store: %TRUE if @message was built from our local roster store
+ *  rather than received from the server
  *
  * Called by loudmouth when we get an incoming <iq>. This handler
  * is concerned only with roster queries, and allows other handlers
@@ -1373,7 +1386,8 @@ static void roster_item_apply_edits (GabbleRoster *roster, TpHandle contact,
  */
 static gboolean
 got_roster_iq (GabbleRoster *roster,
-    WockyStanza *message)
+    WockyStanza *message,
+    gboolean from_store)
 {
   GabbleRosterPrivate *priv = roster->priv;
   WockyNode *iq_node, *query_node;
@@ -1412,6 +1426,10 @@ got_roster_iq (GabbleRoster *roster,
 
   process_roster (roster, query_node);
 
+  if (priv->store != NULL && !from_store)
+    gabble_roster_store_update (priv->store, query_node,
+        sub_type == WOCKY_STANZA_SUB_TYPE_RESULT);
+
   if (sub_type == WOCKY_STANZA_SUB_TYPE_RESULT)
     {
       /* We are handling the response to our initial roster request. */
@@ -1465,6 +1483,7 @@ got_roster_iq (GabbleRoster *roster,
       /* The roster is now complete and we can emit signals... */
       tp_base_contact_list_set_list_received ((TpBaseContactList *) roster);
       priv->received = TRUE;
+      gabble_connection_mark_phase (priv->conn, "roster");
 
       /* ... and carry out any pending edits */
       for (;
@@ -1491,8 +1510,18 @@ gabble_roster_iq_cb (WockyPorter *porter,
                      gpointer user_data)
 {
   GabbleRoster *roster = GABBLE_ROSTER (user_data);
+  WockyStanzaSubType sub_type;
+
+  wocky_stanza_get_type_info (message, NULL, &sub_type);
 
-  return got_roster_iq (roster, message);
+  if (roster->priv->held != NULL && sub_type == WOCKY_STANZA_SUB_TYPE_SET)
+    {
+      /* This has to be applied after the roster we're holding on to */
+      g_queue_push_tail (roster->priv->held, g_object_ref (message));
+      return TRUE;
+    }
+
+  return got_roster_iq (roster, message, FALSE);
 }
 
 static void
@@ -1737,6 +1766,13 @@ gabble_roster_close_all (GabbleRoster *self)
 
   tp_clear_pointer (&priv->groups, g_hash_table_unref);
   tp_clear_pointer (&priv->pre_authorized, tp_handle_set_destroy);
+  tp_clear_pointer (&priv->store, gabble_roster_store_free);
+
+  if (self->priv->held != NULL)
+    {
+      g_queue_free_full (self->priv->held, g_object_unref);
+      self->priv->held = NULL;
+    }
 
   if (self->priv->cancel_on_disconnect != NULL)
     g_cancellable_cancel (self->priv->cancel_on_disconnect);
@@ -1760,6 +1796,36 @@ gabble_roster_close_all (GabbleRoster *self)
     }
 }
 
+static void
+handle_roster_reply (GabbleRoster *self,
+    WockyStanza *response)
+{
+  if (self->priv->store != NULL &&
+      gabble_roster_store_get_version (self->priv->store) != NULL &&
+      wocky_node_get_child_ns (wocky_stanza_get_top_node (response),
+          "query", WOCKY_XMPP_NS_ROSTER) == NULL)
+    {
+      /* XEP-0237 §2.6.3: the server has nothing newer than the
+       * version we asked for, so our stored copy is the roster;
+       * any differences will follow as roster pushes. */
+      WockyStanza *stored;
+      WockyNode *query_node;
+
+      DEBUG ("stored roster version '%s' is current",
+          gabble_roster_store_get_version (self->priv->store));
+
+      stored = _gabble_roster_message_new (self,
+          WOCKY_STANZA_SUB_TYPE_RESULT, &query_node);
+      gabble_roster_store_fill_query (self->priv->store, query_node);
+      got_roster_iq (self, stored, TRUE);
+      g_object_unref (stored);
+    }
+  else
+    {
+      got_roster_iq (self, response, FALSE);
+    }
+}
+
 static void
 roster_received_cb (GObject *source_object,
     GAsyncResult *result,
@@ -1772,17 +1838,23 @@ roster_received_cb (GObject *source_object,
       WockyStanza *response;
       GError *error = NULL;
 
-      if (conn_util_send_iq_finish ((GabbleConnection *) source_object,
+      if (!conn_util_send_iq_finish ((GabbleConnection *) source_object,
             result, &response, &error))
         {
-          got_roster_iq (self, response);
-
-          g_object_unref (response);
+          DEBUG ("%s", error->message);
+          g_clear_error (&error);
+        }
+      else if (self->priv->held != NULL)
+        {
+          /* Any pushes we've held on to so far are already reflected in
+           * this, but they do no harm if they're applied again. */
+          DEBUG ("holding on to the roster until we're connected");
+          g_queue_push_head (self->priv->held, response);
         }
       else
         {
-          DEBUG ("%s", error->message);
-          g_clear_error (&error);
+          handle_roster_reply (self, response);
+          g_object_unref (response);
         }
     }
 
@@ -1790,6 +1862,95 @@ roster_received_cb (GObject *source_object,
   tp_weak_ref_destroy (weak_ref);
 }
 
+/* Handles the roster, and the pushes after it, that we got before we were
+ * connected */
+static void
+release_held_roster (GabbleRoster *self)
+{
+  GQueue *held = self->priv->held;
+  WockyStanza *stanza;
+
+  self->priv->held = NULL;
+
+  while ((stanza = g_queue_pop_head (held)) != NULL)
+    {
+      WockyStanzaSubType sub_type;
+
+      wocky_stanza_get_type_info (stanza, NULL, &sub_type);
+
+      if (sub_type == WOCKY_STANZA_SUB_TYPE_RESULT)
+        handle_roster_reply (self, stanza);
+      else
+        got_roster_iq (self, stanza, FALSE);
+
+      g_object_unref (stanza);
+    }
+
+  g_queue_free (held);
+}
+
+static void
+gabble_roster_request_roster (GabbleRoster *self)
+{
+  GabbleRosterPrivate *priv = self->priv;
+  WockyStanza *stanza;
+  WockyNode *query_node;
+
+  stanza = _gabble_roster_message_new (self, WOCKY_STANZA_SUB_TYPE_GET,
+      &query_node);
+
+  if (priv->conn->features & GABBLE_CONNECTION_FEATURES_ROSTER_VERSIONING)
+    {
+      const gchar *ver;
+
+      if (priv->store == NULL)
+        priv->store = gabble_roster_store_new (
+            conn_util_get_bare_self_jid (priv->conn));
+
+      /* An empty 'ver' tells the server that we support versioning but have
+       * nothing stored, so it should send us everything. */
+      ver = gabble_roster_store_get_version (priv->store);
+      wocky_node_set_attribute (query_node, "ver", ver != NULL ? ver : "");
+    }
+
+  conn_util_send_iq_async (priv->conn, stanza, priv->cancel_on_disconnect,
+      roster_received_cb, tp_weak_ref_new (self, NULL, NULL));
+
+  g_object_unref (stanza);
+}
+
+/*
+ * gabble_roster_prefetch:
+ *
+ * Asks for the roster while the connection is still being set up, rather
+ * than once it's connected, to save a round trip. The reply isn't acted on
+ * until the connection is connected, so nothing appears to change as far as
+ * clients are concerned; it just turns up sooner.
+ *
+ * This must only be called once the server's disco reply has been received,
+ * since what we ask for depends on what the server supports.
+ */
+void
+gabble_roster_prefetch (GabbleRoster *self)
+{
+  GabbleRosterPrivate *priv = self->priv;
+
+  g_return_if_fail (!priv->prefetched);
+
+  if (!tp_base_contact_list_get_download_at_connection (
+          (TpBaseContactList *) self))
+    return;
+
+  DEBUG ("requesting roster before we're connected");
+  priv->prefetched = TRUE;
+  priv->held = g_queue_new ();
+
+  if (priv->cancel_on_disconnect == NULL)
+    priv->cancel_on_disconnect = g_cancellable_new ();
+
+  gabble_roster_request_roster (self);
+}
+
 static void
 gabble_roster_porter_available_cb (GabbleConnection *conn,
     WockyPorter *porter,
@@ -1824,23 +1985,22 @@ connection_status_changed_cb (GabbleConnection *conn,
     {
     case TP_CONNECTION_STATUS_CONNECTED:
         {
-          WockyStanza *stanza;
           TpBaseContactList *base = TP_BASE_CONTACT_LIST (self);
 
+          if (self->priv->prefetched)
+            {
+              if (self->priv->held != NULL)
+                release_held_roster (self);
+
+              break;
+            }
+
           self->priv->cancel_on_disconnect = g_cancellable_new ();
 
           if (tp_base_contact_list_get_download_at_connection (base))
             {
               DEBUG ("requesting roster");
-
-              stanza = _gabble_roster_message_new (self, WOCKY_STANZA_SUB_TYPE_GET,
-                  NULL);
-
-              conn_util_send_iq_async (conn, stanza,
-                  self->priv->cancel_on_disconnect,
-                  roster_received_cb, tp_weak_ref_new (self, NULL, NULL));
-
-              g_object_unref (stanza);
+              gabble_roster_request_roster (self);
             }
           else
             {
@@ -2991,18 +3151,8 @@ gabble_roster_download_async (TpBaseContactList *base,
 
   if (!tp_base_contact_list_get_download_at_connection (base))
     {
-      WockyStanza *stanza;
-
       DEBUG ("Downloading roster requested");
-
-      stanza = _gabble_roster_message_new (self, WOCKY_STANZA_SUB_TYPE_GET,
-          NULL);
-
-      conn_util_send_iq_async (self->priv->conn, stanza,
-          self->priv->cancel_on_disconnect,
-          roster_received_cb, tp_weak_ref_new (self, NULL, NULL));
-
-      g_object_unref (stanza);
+      gabble_roster_request_roster (self);
     }
   else
     {
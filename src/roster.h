@@ -59,6 +59,7 @@ struct _GabbleRoster {
 };
 
 GabbleRoster *gabble_roster_new (GabbleConnection *);
+void gabble_roster_prefetch (GabbleRoster *roster);
 
 gboolean gabble_roster_handle_sends_presence_to_us (GabbleRoster *,
     TpHandle);
@@ -30,6 +30,7 @@
 
 #define DEBUG_FLAG GABBLE_DEBUG_SEARCH
 #include <gabble/error.h>
+#include "conn-util.h"
 #include "connection.h"
 #include "debug.h"
 #include "gabble-signals-marshal.h"
@@ -43,6 +44,7 @@ enum
   PROP_AVAILABLE_SEARCH_KEYS,
   PROP_SERVER,
   PROP_LIMIT,
+  PROP_PAGE_SIZE,
   LAST_PROPERTY
 };
 
@@ -74,7 +76,26 @@ struct _GabbleSearchChannelPrivate
    * supported by this server. */
   GPtrArray *boolean_keys;
 
+  /* Results which haven't been passed on to the client yet; flushed every
+   * page_size results, so that a huge result set doesn't have to be built up
+   * in one go. */
   GHashTable *results;
+  /* TRUE once SearchResultReceived has been emitted at least once */
+  gboolean results_emitted;
+
+  /* XEP-0059 paging. If page_size is 0, the whole result set is asked for
+   * at once. */
+  guint page_size;
+  /* owned tp_name => owned value, kept to build the query for each page */
+  GHashTable *terms;
+  /* The <last/> of the page before, or NULL when asking for the first */
+  gchar *after;
+  guint page_results;
+  guint results_seen;
+  /* G_MAXUINT if the server hasn't said */
+  guint results_count;
+  /* Cancels the page we're waiting for, if any */
+  GCancellable *cancellable;
 
   /* TRUE if the channel is ready to be used (we received the keys supported
    * by the server). */
@@ -539,6 +560,32 @@ ht_lookup_and_remove (GHashTable *info_map,
   return ret;
 }
 
+/*
+ * flush_results:
+ * @chan: a search channel
+ * @last: %TRUE if there are no more results to come
+ *
+ * Passes the results we've got so far on to the client. The last call always
+ * emits SearchResultReceived if it's never been emitted, even if there were
+ * no results at all.
+ */
+static void
+flush_results (GabbleSearchChannel *chan,
+    gboolean last)
+{
+  GabbleSearchChannelPrivate *priv = chan->priv;
+
+  if (g_hash_table_size (priv->results) == 0 &&
+      (priv->results_emitted || !last))
+    return;
+
+  DEBUG ("passing on %u results", g_hash_table_size (priv->results));
+  tp_svc_channel_type_contact_search_emit_search_result_received (chan,
+      priv->results);
+  priv->results_emitted = TRUE;
+  g_hash_table_remove_all (priv->results);
+}
+
 static void
 add_search_result (GabbleSearchChannel *chan,
     GHashTable *info_map)
@@ -612,6 +659,10 @@ add_search_result (GabbleSearchChannel *chan,
     }
 
   g_hash_table_insert (chan->priv->results, g_strdup (jid), info);
+
+  if (chan->priv->page_size > 0 &&
+      g_hash_table_size (chan->priv->results) >= chan->priv->page_size)
+    flush_results (chan, FALSE);
 }
 
 static void
@@ -700,6 +751,7 @@ parse_unextended_search_results (GabbleSearchChannel *chan,
   wocky_node_iter_init (&i, query_node, "item", NULL);
   while (wocky_node_iter_next (&i, &item))
     {
+      chan->priv->page_results++;
       parse_result_item (chan, item);
     }
 
@@ -726,7 +778,10 @@ parse_extended_search_results (GabbleSearchChannel *chan,
   while (wocky_node_iter_next (&i, &item))
     {
       if (!tp_strdiff (item->name, "item"))
-        parse_extended_result_item (chan, item);
+        {
+          chan->priv->page_results++;
+          parse_extended_result_item (chan, item);
+        }
       else if (!tp_strdiff (item->name, "reported"))
         /* Ignore <reported> node */
         continue;
@@ -751,64 +806,6 @@ parse_search_results (GabbleSearchChannel *chan,
     return parse_unextended_search_results (chan, query_node, error);
 }
 
-static void
-search_reply_cb (GabbleConnection *conn,
-                 WockyStanza *sent_msg,
-                 WockyStanza *reply_msg,
-                 GObject *object,
-                 gpointer user_data)
-{
-  GabbleSearchChannel *chan = GABBLE_SEARCH_CHANNEL (object);
-  WockyNode *query_node;
-  GError *stanza_error = NULL;
-  GError *err = NULL;
-
-  DEBUG ("called");
-
-  if (chan->priv->state != TP_CHANNEL_CONTACT_SEARCH_STATE_IN_PROGRESS)
-    {
-      DEBUG ("state is %s, not in progress; ignoring results",
-          states[chan->priv->state]);
-      return;
-    }
-
-  query_node = wocky_node_get_child_ns (
-      wocky_stanza_get_top_node (reply_msg), "query", NS_SEARCH);
-
-  if (wocky_stanza_extract_errors (reply_msg, NULL, &stanza_error, NULL, NULL))
-    {
-      gabble_set_tp_error_from_wocky (stanza_error, &err);
-      g_clear_error (&stanza_error);
-    }
-  else if (NULL == query_node)
-    {
-      err = g_error_new (TP_ERROR, TP_ERROR_NOT_AVAILABLE,
-          "%s is broken: its iq reply didn't contain a <query/>",
-          chan->priv->server);
-    }
-  else
-    {
-      parse_search_results (chan, query_node, &err);
-    }
-
-  if (err == NULL)
-    {
-      /* fire SearchStateChanged */
-      tp_svc_channel_type_contact_search_emit_search_result_received (chan,
-          chan->priv->results);
-
-      change_search_state (chan, TP_CHANNEL_CONTACT_SEARCH_STATE_COMPLETED,
-          NULL);
-    }
-  else
-    {
-      DEBUG ("Searching failed: %s", err->message);
-      change_search_state (chan, TP_CHANNEL_CONTACT_SEARCH_STATE_FAILED,
-          err);
-      g_error_free (err);
-    }
-}
-
 static gboolean
 validate_terms (GabbleSearchChannel *chan,
                 GHashTable *terms,
@@ -913,53 +910,210 @@ build_extended_query (GabbleSearchChannel *self,
     }
 }
 
+/*
+ * more_pages:
+ * @chan: a search channel
+ * @query_node: the <query/> from the page we've just got
+ *
+ * Returns: %TRUE if the server has more results for us, in which case
+ *  priv->after has been updated to ask for them.
+ */
 static gboolean
-do_search (GabbleSearchChannel *chan,
-           GHashTable *terms,
-           GError **error)
+more_pages (GabbleSearchChannel *chan,
+    WockyNode *query_node)
+{
+  GabbleSearchChannelPrivate *priv = chan->priv;
+  WockyNode *set;
+  const gchar *last, *count;
+
+  if (priv->page_size == 0)
+    return FALSE;
+
+  /* If the server ignored our <set/>, it's sent us everything at once */
+  set = wocky_node_get_child_ns (query_node, "set", NS_RSM);
+  if (set == NULL)
+    return FALSE;
+
+  priv->results_seen += priv->page_results;
+
+  count = wocky_node_get_content_from_child (set, "count");
+  if (count != NULL)
+    priv->results_count = (guint) g_ascii_strtoull (count, NULL, 10);
+
+  last = wocky_node_get_content_from_child (set, "last");
+
+  /* An empty page, or one which ends where the one before did, means we've
+   * run off the end of the results (or that the server is confused) */
+  if (priv->page_results == 0 || last == NULL ||
+      !tp_strdiff (last, priv->after))
+    return FALSE;
+
+  if (priv->results_count != G_MAXUINT &&
+      priv->results_seen >= priv->results_count)
+    return FALSE;
+
+  g_free (priv->after);
+  priv->after = g_strdup (last);
+  return TRUE;
+}
+
+static void request_page (GabbleSearchChannel *chan);
+
+static void
+search_page_cb (GObject *source,
+    GAsyncResult *result,
+    gpointer user_data)
+{
+  GabbleSearchChannel *chan = GABBLE_SEARCH_CHANNEL (user_data);
+  GabbleSearchChannelPrivate *priv = chan->priv;
+  WockyStanza *reply = NULL;
+  WockyNode *query_node;
+  GError *err = NULL;
+
+  DEBUG ("called");
+
+  /* Close() cancels the page but leaves the state alone, so there's no one
+   * left to tell about this, however it turned out */
+  if (tp_base_channel_is_destroyed (TP_BASE_CHANNEL (chan)))
+    {
+      DEBUG ("channel has been closed; ignoring results");
+      goto out;
+    }
+
+  /* This includes the page having been cancelled by Stop() */
+  if (priv->state != TP_CHANNEL_CONTACT_SEARCH_STATE_IN_PROGRESS)
+    {
+      DEBUG ("state is %s, not in progress; ignoring results",
+          states[priv->state]);
+      goto out;
+    }
+
+  tp_clear_object (&priv->cancellable);
+
+  if (conn_util_send_iq_finish (GABBLE_CONNECTION (source), result, &reply,
+          &err))
+    {
+      query_node = wocky_node_get_child_ns (
+          wocky_stanza_get_top_node (reply), "query", NS_SEARCH);
+
+      if (NULL == query_node)
+        {
+          err = g_error_new (TP_ERROR, TP_ERROR_NOT_AVAILABLE,
+              "%s is broken: its iq reply didn't contain a <query/>",
+              priv->server);
+        }
+      else if (parse_search_results (chan, query_node, &err) &&
+          more_pages (chan, query_node))
+        {
+          /* Let the client have this page while we wait for the next */
+          flush_results (chan, FALSE);
+          request_page (chan);
+          goto out;
+        }
+    }
+
+  if (err == NULL)
+    {
+      flush_results (chan, TRUE);
+      change_search_state (chan, TP_CHANNEL_CONTACT_SEARCH_STATE_COMPLETED,
+          NULL);
+    }
+  else
+    {
+      DEBUG ("Searching failed: %s", err->message);
+      change_search_state (chan, TP_CHANNEL_CONTACT_SEARCH_STATE_FAILED,
+          err);
+      g_error_free (err);
+    }
+
+out:
+  tp_clear_object (&reply);
+  g_object_unref (chan);
+}
+
+static void
+request_page (GabbleSearchChannel *chan)
 {
+  GabbleSearchChannelPrivate *priv = chan->priv;
   TpBaseChannel *base = TP_BASE_CHANNEL (chan);
   TpBaseConnection *base_conn = tp_base_channel_get_connection (base);
   WockyStanza *msg;
   WockyNode *query;
-  gboolean ret;
-
-  DEBUG ("called");
-
-  if (!validate_terms (chan, terms, error))
-    return FALSE;
 
   msg = wocky_stanza_build (WOCKY_STANZA_TYPE_IQ, WOCKY_STANZA_SUB_TYPE_SET,
-      NULL, chan->priv->server,
+      NULL, priv->server,
       '(', "query", ':', NS_SEARCH,
         '*', &query,
       ')', NULL);
 
-  if (chan->priv->xforms)
+  if (priv->xforms)
     {
-      build_extended_query (chan, query, terms);
+      build_extended_query (chan, query, priv->terms);
     }
   else
     {
-      build_unextended_query (chan, query, terms);
+      build_unextended_query (chan, query, priv->terms);
     }
 
-  DEBUG ("Sending search");
-
-  if (_gabble_connection_send_with_reply (GABBLE_CONNECTION (base_conn), msg,
-          search_reply_cb, (GObject *) chan, NULL, error))
+  if (priv->page_size > 0)
     {
-      ret = TRUE;
-      change_search_state (chan,
-          TP_CHANNEL_CONTACT_SEARCH_STATE_IN_PROGRESS, NULL);
+      WockyNode *set = wocky_node_add_child_ns (query, "set", NS_RSM);
+      gchar *max = g_strdup_printf ("%u", priv->page_size);
+
+      wocky_node_add_child_with_content (set, "max", max);
+
+      if (priv->after != NULL)
+        wocky_node_add_child_with_content (set, "after", priv->after);
+
+      g_free (max);
     }
-  else
+
+  DEBUG ("Sending search%s%s", priv->after == NULL ? "" : " after ",
+      priv->after == NULL ? "" : priv->after);
+
+  priv->page_results = 0;
+  priv->cancellable = g_cancellable_new ();
+  conn_util_send_iq_async (GABBLE_CONNECTION (base_conn), msg,
+      priv->cancellable, search_page_cb, g_object_ref (chan));
+
+  g_object_unref (msg);
+}
+
+/* Stops waiting for the page we asked for, if there is one */
+static void
+cancel_page (GabbleSearchChannel *chan)
+{
+  GabbleSearchChannelPrivate *priv = chan->priv;
+
+  if (priv->cancellable != NULL)
     {
-      ret = FALSE;
+      DEBUG ("cancelling the page we were waiting for");
+      g_cancellable_cancel (priv->cancellable);
+      tp_clear_object (&priv->cancellable);
     }
+}
 
-  g_object_unref (msg);
-  return ret;
+static gboolean
+do_search (GabbleSearchChannel *chan,
+           GHashTable *terms,
+           GError **error)
+{
+  GabbleSearchChannelPrivate *priv = chan->priv;
+
+  DEBUG ("called");
+
+  if (!validate_terms (chan, terms, error))
+    return FALSE;
+
+  priv->terms = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+      g_free);
+  tp_g_hash_table_update (priv->terms, terms, (GBoxedCopyFunc) g_strdup,
+      (GBoxedCopyFunc) g_strdup);
+
+  request_page (chan);
+  change_search_state (chan, TP_CHANNEL_CONTACT_SEARCH_STATE_IN_PROGRESS,
+      NULL);
+  return TRUE;
 }
 
 /* GObject implementation */
@@ -1005,6 +1159,7 @@ gabble_search_channel_constructor (GType type,
 
   chan->priv->results = g_hash_table_new_full (g_str_hash, g_str_equal,
       g_free, (GDestroyNotify) free_info);
+  chan->priv->results_count = G_MAXUINT;
 
   request_search_fields (chan);
 
@@ -1034,6 +1189,9 @@ gabble_search_channel_finalize (GObject *obj)
   g_ptr_array_unref (priv->boolean_keys);
 
   g_hash_table_unref (chan->priv->results);
+  tp_clear_pointer (&priv->terms, g_hash_table_unref);
+  g_free (priv->after);
+  g_assert (priv->cancellable == NULL);
 
   if (G_OBJECT_CLASS (gabble_search_channel_parent_class)->finalize)
     G_OBJECT_CLASS (gabble_search_channel_parent_class)->finalize (obj);
@@ -1061,6 +1219,9 @@ gabble_search_channel_get_property (GObject *object,
       case PROP_LIMIT:
         g_value_set_uint (value, 0);
         break;
+      case PROP_PAGE_SIZE:
+        g_value_set_uint (value, chan->priv->page_size);
+        break;
       default:
         G_OBJECT_WARN_INVALID_PROPERTY_ID (object, property_id, pspec);
         break;
@@ -1081,6 +1242,9 @@ gabble_search_channel_set_property (GObject *object,
         chan->priv->server = g_value_dup_string (value);
         g_assert (chan->priv->server != NULL);
         break;
+      case PROP_PAGE_SIZE:
+        chan->priv->page_size = g_value_get_uint (value);
+        break;
       default:
         G_OBJECT_WARN_INVALID_PROPERTY_ID (object, property_id, pspec);
         break;
@@ -1116,6 +1280,16 @@ gabble_search_channel_get_object_path_suffix (TpBaseChannel *base)
   return ret;
 }
 
+static void
+gabble_search_channel_close (TpBaseChannel *base)
+{
+  GabbleSearchChannel *self = GABBLE_SEARCH_CHANNEL (base);
+
+  /* The page we're waiting for holds a reference to us */
+  cancel_page (self);
+  tp_base_channel_destroyed (base);
+}
+
 static void
 gabble_search_channel_class_init (GabbleSearchChannelClass *klass)
 {
@@ -1144,10 +1318,7 @@ gabble_search_channel_class_init (GabbleSearchChannelClass *klass)
       gabble_search_channel_fill_immutable_properties;
   base_class->get_object_path_suffix =
       gabble_search_channel_get_object_path_suffix;
-  /* We don't have to do any special clean-up when told to close, so we can
-   * just roll over and die immediately.
-   */
-  base_class->close = tp_base_channel_destroyed;
+  base_class->close = gabble_search_channel_close;
 
   param_spec = g_param_spec_uint ("search-state", "Search state",
       "The current state of the search represented by this channel",
@@ -1178,6 +1349,14 @@ gabble_search_channel_class_init (GabbleSearchChannelClass *klass)
   g_object_class_install_property (object_class, PROP_LIMIT,
       param_spec);
 
+  param_spec = g_param_spec_uint ("page-size", "Page size",
+      "How many results to ask the server for at once using XEP-0059, and "
+      "to pass on in each SearchResultReceived; 0 to ask for them all at once",
+      0, G_MAXUINT, GABBLE_PARAMS_DEFAULT_SEARCH_PAGE_SIZE,
+      G_PARAM_CONSTRUCT_ONLY | G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS);
+  g_object_class_install_property (object_class, PROP_PAGE_SIZE,
+      param_spec);
+
   /* Emitted when we get a reply from the server about which search keys it
    * supports.  Its three arguments are the components of a GError.  If the
    * server gave us a set of search keys, and they were sane, all components
@@ -1243,6 +1422,7 @@ gabble_search_channel_stop (TpSvcChannelTypeContactSearch *self,
         {
           GError e = { TP_ERROR, TP_ERROR_CANCELLED, "Stop() called" };
 
+          cancel_page (chan);
           change_search_state (chan,
               TP_CHANNEL_CONTACT_SEARCH_STATE_FAILED, &e);
           /* Deliberately falling through to return from the method: */
@@ -442,13 +442,17 @@ new_search_channel (GabbleSearchManager *self,
   GabbleSearchManagerPrivate *priv = self->priv;
   GabbleSearchChannel *chan;
   TpBaseConnection *base_conn = TP_BASE_CONNECTION (priv->conn);
+  guint page_size;
 
   g_assert (server != NULL);
 
+  g_object_get (priv->conn, "search-page-size", &page_size, NULL);
+
   chan = g_object_new (GABBLE_TYPE_SEARCH_CHANNEL,
       "connection", priv->conn,
       "server", server,
       "initiator-handle", tp_base_connection_get_self_handle (base_conn),
+      "page-size", page_size,
       NULL);
   g_hash_table_insert (priv->channels, chan, priv->channels);
   g_signal_connect (chan, "closed", (GCallback) search_channel_closed_cb, self);
@@ -0,0 +1,304 @@
+/*
+ * stream-management.c - Source for XEP-0198 stream management
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "stream-management.h"
+
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_CONNECTION
+#include "debug.h"
+#include "namespaces.h"
+
+/* How many stanzas we send before asking the server which it has got */
+#define ACK_REQUEST_INTERVAL 5
+
+typedef enum
+{
+  STATE_REQUESTED,
+  STATE_ENABLED,
+  STATE_FAILED
+} State;
+
+struct _GabbleStreamManagement
+{
+  WockyPorter *porter;
+  guint handler_id;
+  gulong sending_id;
+  guint ack_request_id;
+
+  State state;
+
+  /* Stanzas we've received since the server enabled stream management, and
+   * sent since we asked it to; both wrap around, as the XEP says. */
+  guint32 received;
+  guint32 sent;
+  /* What the server last told us it had received */
+  guint32 acked;
+  /* The value of sent when we last asked the server to tell us */
+  guint32 requested;
+};
+
+/*
+ * gabble_stream_management_is_supported:
+ * @features: the stream features the server sent once we'd authenticated
+ *
+ * Returns: %TRUE if the server supports XEP-0198 stream management
+ */
+gboolean
+gabble_stream_management_is_supported (WockyStanza *features)
+{
+  return (wocky_node_get_child_ns (wocky_stanza_get_top_node (features),
+        "sm", NS_STREAM_MANAGEMENT) != NULL);
+}
+
+/* Only these count towards the numbers the two ends tell each other; our
+ * <r/>s and <a/>s, and the server's, don't. */
+static gboolean
+is_countable (WockyStanza *stanza)
+{
+  WockyStanzaType type;
+
+  wocky_stanza_get_type_info (stanza, &type, NULL);
+
+  return (type == WOCKY_STANZA_TYPE_MESSAGE ||
+      type == WOCKY_STANZA_TYPE_PRESENCE ||
+      type == WOCKY_STANZA_TYPE_IQ);
+}
+
+static void
+send_nonza (GabbleStreamManagement *self,
+    const gchar *name,
+    guint32 h,
+    gboolean with_h)
+{
+  WockyStanza *nonza = wocky_stanza_new (name, NS_STREAM_MANAGEMENT);
+
+  if (with_h)
+    {
+      gchar *value = g_strdup_printf ("%u", h);
+
+      wocky_node_set_attribute (wocky_stanza_get_top_node (nonza), "h", value);
+      g_free (value);
+    }
+
+  wocky_porter_send (self->porter, nonza);
+  g_object_unref (nonza);
+}
+
+static gboolean
+request_ack (gpointer user_data)
+{
+  GabbleStreamManagement *self = user_data;
+
+  self->ack_request_id = 0;
+  self->requested = self->sent;
+  send_nonza (self, "r", 0, FALSE);
+
+  return FALSE;
+}
+
+static gboolean
+parse_h (WockyNode *node,
+    guint32 *h)
+{
+  const gchar *value = wocky_node_get_attribute (node, "h");
+  gchar *end;
+  guint64 parsed;
+
+  if (value == NULL || !g_ascii_isdigit (*value))
+    return FALSE;
+
+  parsed = g_ascii_strtoull (value, &end, 10);
+
+  if (*end != '\0' || parsed > G_MAXUINT32)
+    return FALSE;
+
+  *h = parsed;
+  return TRUE;
+}
+
+static void
+got_ack (GabbleStreamManagement *self,
+    guint32 h)
+{
+  /* Unsigned arithmetic copes with the counters wrapping around */
+  guint32 outstanding = self->sent - self->acked;
+  guint32 newly_acked = h - self->acked;
+
+  if (newly_acked > outstanding)
+    {
+      DEBUG ("server acknowledged %u stanzas, but only %u were outstanding; "
+          "ignoring it", newly_acked, outstanding);
+      return;
+    }
+
+  self->acked = h;
+}
+
+static gboolean
+stanza_received_cb (WockyPorter *porter,
+    WockyStanza *stanza,
+    gpointer user_data)
+{
+  GabbleStreamManagement *self = user_data;
+  WockyNode *node = wocky_stanza_get_top_node (stanza);
+  guint32 h;
+
+  if (tp_strdiff (wocky_node_get_ns (node), NS_STREAM_MANAGEMENT))
+    {
+      if (self->state == STATE_ENABLED && is_countable (stanza))
+        self->received++;
+
+      /* Let it be handled as usual */
+      return FALSE;
+    }
+
+  if (!tp_strdiff (node->name, "enabled"))
+    {
+      DEBUG ("stream management enabled");
+      self->state = STATE_ENABLED;
+    }
+  else if (!tp_strdiff (node->name, "failed"))
+    {
+      DEBUG ("server refused to enable stream management");
+      self->state = STATE_FAILED;
+    }
+  else if (self->state != STATE_ENABLED)
+    {
+      DEBUG ("ignoring <%s/> as stream management isn't enabled",
+          node->name);
+    }
+  else if (!tp_strdiff (node->name, "r"))
+    {
+      send_nonza (self, "a", self->received, TRUE);
+    }
+  else if (!tp_strdiff (node->name, "a"))
+    {
+      if (parse_h (node, &h))
+        got_ack (self, h);
+      else
+        DEBUG ("ignoring <a/> with invalid h='%s'",
+            wocky_node_get_attribute (node, "h"));
+    }
+  else
+    {
+      DEBUG ("ignoring unknown <%s/>", node->name);
+    }
+
+  return TRUE;
+}
+
+static void
+sending_cb (WockyPorter *porter,
+    WockyStanza *stanza,
+    gpointer user_data)
+{
+  GabbleStreamManagement *self = user_data;
+
+  /* Whitespace pings, and anything sent once the server has refused */
+  if (stanza == NULL || self->state == STATE_FAILED ||
+      !is_countable (stanza))
+    return;
+
+  self->sent++;
+
+  /* The porter is in the middle of sending, so we ask once it's done. The
+   * server counts from when it gets our <enable/>, so we count from when we
+   * send it, but we can't ask until it has said yes. */
+  if (self->state == STATE_ENABLED &&
+      self->sent - self->requested >= ACK_REQUEST_INTERVAL &&
+      self->ack_request_id == 0)
+    self->ack_request_id = g_idle_add (request_ack, self);
+}
+
+/*
+ * gabble_stream_management_new:
+ * @porter: the porter for a stream on which we've just bound a resource, to
+ *  a server for which gabble_stream_management_is_supported() is %TRUE
+ *
+ * Asks the server to enable stream management on the stream. Once it has,
+ * we answer the server's requests to tell it how many stanzas we've
+ * received, and ask it every few stanzas how many of ours it has received.
+ *
+ * Returns: a new object to do all of the above; free it with
+ *  gabble_stream_management_free() before @porter is closed.
+ */
+GabbleStreamManagement *
+gabble_stream_management_new (WockyPorter *porter)
+{
+  GabbleStreamManagement *self = g_slice_new0 (GabbleStreamManagement);
+
+  self->porter = g_object_ref (porter);
+  self->state = STATE_REQUESTED;
+
+  /* Stanzas from contacts count too, so we have to see everything */
+  self->handler_id = wocky_porter_register_handler_from_anyone (porter,
+      WOCKY_STANZA_TYPE_NONE, WOCKY_STANZA_SUB_TYPE_NONE,
+      WOCKY_PORTER_HANDLER_PRIORITY_MAX, stanza_received_cb, self, NULL);
+  self->sending_id = g_signal_connect (porter, "sending",
+      G_CALLBACK (sending_cb), self);
+
+  /* We don't ask to be able to resume the stream: we'd have to resume it
+   * before binding a resource, and WockyConnector always binds one. So we
+   * don't keep the stanzas the server hasn't acknowledged either, as we'd
+   * have no stream to send them again on. */
+  send_nonza (self, "enable", 0, FALSE);
+
+  return self;
+}
+
+void
+gabble_stream_management_free (GabbleStreamManagement *self)
+{
+  guint unacked = gabble_stream_management_get_unacked (self);
+
+  if (unacked > 0)
+    DEBUG ("the server never acknowledged the last %u stanzas", unacked);
+
+  if (self->ack_request_id != 0)
+    g_source_remove (self->ack_request_id);
+
+  wocky_porter_unregister_handler (self->porter, self->handler_id);
+  g_signal_handler_disconnect (self->porter, self->sending_id);
+  g_object_unref (self->porter);
+
+  g_slice_free (GabbleStreamManagement, self);
+}
+
+gboolean
+gabble_stream_management_is_enabled (GabbleStreamManagement *self)
+{
+  return (self->state == STATE_ENABLED);
+}
+
+/*
+ * gabble_stream_management_get_unacked:
+ *
+ * Returns: how many stanzas we've sent that the server hasn't told us it has
+ *  received; or 0 if the server refused to enable stream management
+ */
+guint
+gabble_stream_management_get_unacked (GabbleStreamManagement *self)
+{
+  if (self->state == STATE_FAILED)
+    return 0;
+
+  return self->sent - self->acked;
+}
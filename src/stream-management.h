@@ -0,0 +1,40 @@
+/*
+ * stream-management.h - Header for XEP-0198 stream management
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_STREAM_MANAGEMENT_H
+#define GABBLE_STREAM_MANAGEMENT_H
+
+#include <glib.h>
+#include <wocky/wocky.h>
+
+G_BEGIN_DECLS
+
+typedef struct _GabbleStreamManagement GabbleStreamManagement;
+
+gboolean gabble_stream_management_is_supported (WockyStanza *features);
+
+GabbleStreamManagement *gabble_stream_management_new (WockyPorter *porter);
+void gabble_stream_management_free (GabbleStreamManagement *self);
+
+gboolean gabble_stream_management_is_enabled (GabbleStreamManagement *self);
+guint gabble_stream_management_get_unacked (GabbleStreamManagement *self);
+
+G_END_DECLS
+
+#endif /* GABBLE_STREAM_MANAGEMENT_H */
@@ -140,6 +140,8 @@ struct _GabbleTubeDBusPrivate
   GSList *dbus_msg_queue;
   /* current size of the queue in bytes. The maximum is MAX_QUEUE_SIZE */
   unsigned long dbus_msg_queue_size;
+  /* the connection-wide budget the queue also counts against */
+  GabbleBytestreamBudget *budget;
   /* mapping of contact handle -> D-Bus name (empty for 1-1 D-Bus tubes) */
   GHashTable *dbus_names;
   /* mapping of D-Bus name -> contact handle */
@@ -312,6 +314,8 @@ new_connection_cb (DBusServer *server,
       dbus_connection_send (priv->dbus_conn, msg, &serial);
       dbus_message_unref (msg);
     }
+  gabble_bytestream_budget_remove_buffered (priv->budget, tube,
+      priv->dbus_msg_queue_size);
   priv->dbus_msg_queue = NULL;
   priv->dbus_msg_queue_size = 0;
 }
@@ -557,6 +561,12 @@ gabble_tube_dbus_dispose (GObject *object)
       priv->dbus_msg_queue_size = 0;
     }
 
+  if (priv->budget != NULL)
+    {
+      gabble_bytestream_budget_remove_stream (priv->budget, self);
+      tp_clear_pointer (&priv->budget, gabble_bytestream_budget_unref);
+    }
+
   tp_clear_pointer (&priv->dbus_srv_addr, g_free);
   tp_clear_pointer (&priv->socket_path, g_free);
   tp_clear_pointer (&priv->dbus_local_name, g_free);
@@ -712,6 +722,7 @@ gabble_tube_dbus_constructed (GObject *obj)
   TpHandleRepoIface *contact_repo = tp_base_connection_get_handles (
       base_conn, TP_HANDLE_TYPE_CONTACT);
   guint access_control;
+  gchar *name;
 
   void (*chain_up) (GObject *) =
     ((GObjectClass *) gabble_tube_dbus_parent_class)->constructed;
@@ -722,6 +733,12 @@ gabble_tube_dbus_constructed (GObject *obj)
   priv->dbus_names = g_hash_table_new_full (g_direct_hash, g_direct_equal,
       NULL, g_free);
 
+  priv->budget = gabble_bytestream_budget_ref (
+      gabble_bytestream_factory_get_budget (conn->bytestream_factory));
+  name = g_strdup_printf ("D-Bus tube %" G_GUINT64_FORMAT, priv->id);
+  gabble_bytestream_budget_add_stream (priv->budget, self, name, NULL);
+  g_free (name);
+
   g_assert (priv->self_handle != 0);
   if (cls->target_handle_type == TP_HANDLE_TYPE_ROOM)
     {
@@ -1172,18 +1189,21 @@ message_received (GabbleTubeDBus *tube,
       DEBUG ("no D-Bus connection: queuing the message");
 
       /* If the application never connects to the private dbus connection, we
-       * don't want to eat all the memory. Only queue MAX_QUEUE_SIZE bytes. If
-       * there are more messages, drop them. */
-      if (priv->dbus_msg_queue_size + len > MAX_QUEUE_SIZE)
+       * don't want to eat all the memory. Only queue MAX_QUEUE_SIZE bytes, and
+       * not more than the connection's bytestreams can spare. If there are
+       * more messages, drop them. */
+      if (priv->dbus_msg_queue_size + len > MAX_QUEUE_SIZE ||
+          !gabble_bytestream_budget_may_buffer (priv->budget, tube, len))
         {
-          DEBUG ("D-Bus message queue size limit reached (%u bytes). "
+          DEBUG ("D-Bus message queue size limit reached (%lu bytes). "
                  "Ignore this message.",
-                 MAX_QUEUE_SIZE);
+                 priv->dbus_msg_queue_size);
           goto unref;
         }
 
       priv->dbus_msg_queue = g_slist_prepend (priv->dbus_msg_queue, msg);
       priv->dbus_msg_queue_size += len;
+      gabble_bytestream_budget_add_buffered (priv->budget, tube, len);
 
       /* returns without unref the message */
       return;
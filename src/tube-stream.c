@@ -47,6 +47,7 @@
 
 #include "bytestream-factory.h"
 #include "bytestream-iface.h"
+#include "bytestream-socks5.h"
 #include "connection.h"
 #include "debug.h"
 #include "disco.h"
@@ -340,6 +341,25 @@ add_transport (GabbleTubeStream *self,
   gibber_transport_block_receiving (transport, FALSE);
 }
 
+/* Once a SOCKS5 bytestream and its local socket are both up, the kernel can
+ * move data between the two sockets itself rather than have us copy it out
+ * of one and into the other. Other bytestreams keep going through us. */
+static void
+try_forwarding (GabbleTubeStream *self,
+    GabbleBytestreamIface *bytestream,
+    GibberTransport *transport)
+{
+  if (!GABBLE_IS_BYTESTREAM_SOCKS5 (bytestream))
+    return;
+
+  if (gibber_transport_get_state (transport) != GIBBER_TRANSPORT_CONNECTED)
+    return;
+
+  if (gabble_bytestream_socks5_forward (GABBLE_BYTESTREAM_SOCKS5 (bytestream),
+        transport))
+    DEBUG ("SOCKS5 bytestream and local socket joined");
+}
+
 static void
 bytestream_write_blocked_cb (GabbleBytestreamIface *bytestream,
                              gboolean blocked,
@@ -381,6 +401,7 @@ extra_bytestream_state_changed_cb (GabbleBytestreamIface *bytestream,
       g_assert (transport != NULL);
 
       add_transport (self, transport, bytestream);
+      try_forwarding (self, bytestream, transport);
     }
   else if (state == GABBLE_BYTESTREAM_STATE_CLOSED)
     {
@@ -718,6 +739,7 @@ local_new_connection_cb (GibberListener *listener,
   /* Block the transport while there is no open bytestream to transfer
    * its data. */
   gibber_transport_block_receiving (transport, TRUE);
+  gibber_fd_transport_set_high_throughput (GIBBER_FD_TRANSPORT (transport), 0);
 
   if (!check_incoming_connection (self, transport))
     {
@@ -892,6 +914,7 @@ transport_connected_cb (GibberTransport *transport,
     return;
 
   gabble_bytestream_iface_block_reading (bytestream, FALSE);
+  try_forwarding (data->self, bytestream, transport);
 }
 
 static GibberTransport *
@@ -945,6 +968,7 @@ new_connection_to_socket (GabbleTubeStream *self,
   /* Block the transport while there is no open bytestream to transfer
    * its data. */
   gibber_transport_block_receiving (transport, TRUE);
+  gibber_fd_transport_set_high_throughput (GIBBER_FD_TRANSPORT (transport), 0);
 
   generate_connection_id (self, transport);
 
@@ -0,0 +1,426 @@
+/*
+ * watchdog.c - Source for the main loop latency watchdog
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#include "config.h"
+#include "watchdog.h"
+
+#include <errno.h>
+#include <stdlib.h>
+#include <string.h>
+
+#ifdef G_OS_UNIX
+# include <pthread.h>
+# include <signal.h>
+#endif
+
+#ifdef HAVE_EXECINFO_H
+# include <execinfo.h>
+#endif
+
+#include <telepathy-glib/telepathy-glib.h>
+
+#define DEBUG_FLAG GABBLE_DEBUG_CONNECTION
+#include "debug.h"
+
+/* How often we check that the main loop is keeping up */
+#define PROBE_INTERVAL_MS 50
+
+/* What counts as slow if whoever started us doesn't say */
+#define DEFAULT_THRESHOLD_MS 100
+
+/* How many of the slowest callbacks we remember */
+#define MAX_SLOW_CALLBACKS 10
+
+/* How many frames of a slow callback's stack we keep */
+#define MAX_FRAMES 32
+
+/* We interrupt the main thread with this to see what it's stuck in, as a
+ * sampling profiler would */
+#define SAMPLE_SIGNAL SIGPROF
+
+/* The upper bound of each of the histogram's buckets, in microseconds */
+static const guint64 bucket_bounds[] = {
+    1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000,
+    1000000, 2000000, 5000000, G_MAXUINT64
+};
+
+typedef struct {
+    gchar *source_name;
+    guint64 duration;
+    gchar **stack;
+} SlowCallback;
+
+typedef struct {
+    guint threshold_ms;
+    guint probe_id;
+    gint64 last_probe;
+
+    /* How many times the probe has been late by up to each bucket's bound */
+    guint counts[G_N_ELEMENTS (bucket_bounds)];
+    /* owned SlowCallbacks, slowest first */
+    GPtrArray *slow_callbacks;
+
+#ifdef G_OS_UNIX
+    pthread_t main_thread;
+    GThread *sampler;
+
+    /* The rest are shared with the sampler thread, under the mutex */
+    GMutex mutex;
+    GCond cond;
+    gboolean stopping;
+    /* When the probe last ran, and whether we've sampled since */
+    gint64 heartbeat;
+    gboolean sampled;
+#endif
+} Watchdog;
+
+static Watchdog *watchdog = NULL;
+
+#ifdef G_OS_UNIX
+/* Filled in by sample_cb(), on the main thread while it's stuck, and read
+ * by probe_cb() once it isn't */
+static volatile sig_atomic_t have_sample = 0;
+static gchar sample_source_name[64];
+# ifdef HAVE_EXECINFO_H
+static gpointer sample_frames[MAX_FRAMES];
+static gint sample_n_frames = 0;
+# endif
+#endif
+
+static void
+slow_callback_free (SlowCallback *cb)
+{
+  g_free (cb->source_name);
+  g_strfreev (cb->stack);
+  g_slice_free (SlowCallback, cb);
+}
+
+static gint
+slow_callback_cmp (gconstpointer a,
+    gconstpointer b)
+{
+  const SlowCallback *cb_a = *(SlowCallback * const *) a;
+  const SlowCallback *cb_b = *(SlowCallback * const *) b;
+
+  if (cb_a->duration == cb_b->duration)
+    return 0;
+
+  return (cb_a->duration > cb_b->duration ? -1 : 1);
+}
+
+/* Takes ownership of @stack */
+static void
+record_slow_callback (Watchdog *self,
+    guint64 duration,
+    const gchar *source_name,
+    gchar **stack)
+{
+  GPtrArray *slow = self->slow_callbacks;
+  SlowCallback *cb;
+
+  DEBUG ("the main loop was blocked for %" G_GUINT64_FORMAT " ms by '%s'",
+      duration / 1000, source_name);
+
+  if (slow->len == MAX_SLOW_CALLBACKS &&
+      duration <= ((SlowCallback *) g_ptr_array_index (slow,
+          slow->len - 1))->duration)
+    {
+      g_strfreev (stack);
+      return;
+    }
+
+  cb = g_slice_new (SlowCallback);
+  cb->source_name = g_strdup (source_name);
+  cb->duration = duration;
+  cb->stack = stack;
+
+  g_ptr_array_add (slow, cb);
+  g_ptr_array_sort (slow, slow_callback_cmp);
+
+  if (slow->len > MAX_SLOW_CALLBACKS)
+    g_ptr_array_remove_index (slow, slow->len - 1);
+}
+
+#ifdef G_OS_UNIX
+static void
+sample_cb (int signum)
+{
+  int saved_errno = errno;
+  GSource *source = g_main_current_source ();
+  const gchar *name = NULL;
+
+  /* Nothing in here may allocate memory, or take a lock that whatever we've
+   * interrupted might be holding. */
+  if (source != NULL)
+    name = g_source_get_name (source);
+
+  g_strlcpy (sample_source_name, name != NULL ? name : "",
+      sizeof (sample_source_name));
+# ifdef HAVE_EXECINFO_H
+  sample_n_frames = backtrace (sample_frames, MAX_FRAMES);
+# endif
+  have_sample = 1;
+
+  errno = saved_errno;
+}
+
+static void
+install_sample_handler (void)
+{
+  struct sigaction action;
+
+  memset (&action, 0, sizeof (action));
+  action.sa_handler = sample_cb;
+  action.sa_flags = SA_RESTART;
+  sigemptyset (&action.sa_mask);
+  sigaction (SAMPLE_SIGNAL, &action, NULL);
+
+  /* The first call on a thread may allocate, which mustn't happen in
+   * sample_cb(); likewise for backtrace(), which may load libgcc. */
+  g_main_current_source ();
+# ifdef HAVE_EXECINFO_H
+  sample_n_frames = backtrace (sample_frames, MAX_FRAMES);
+# endif
+}
+
+static gchar **
+sample_dup_stack (void)
+{
+  GPtrArray *stack = g_ptr_array_new ();
+# ifdef HAVE_EXECINFO_H
+  gchar **symbols = backtrace_symbols (sample_frames, sample_n_frames);
+  gint i;
+
+  /* The first two frames are sample_cb() and the signal trampoline */
+  for (i = 2; symbols != NULL && i < sample_n_frames; i++)
+    g_ptr_array_add (stack, g_strdup (symbols[i]));
+
+  free (symbols);
+# endif
+
+  g_ptr_array_add (stack, NULL);
+  return (gchar **) g_ptr_array_free (stack, FALSE);
+}
+
+static gpointer
+sampler_thread (gpointer user_data)
+{
+  Watchdog *self = user_data;
+  gint64 stuck_after = (PROBE_INTERVAL_MS + self->threshold_ms) *
+      G_TIME_SPAN_MILLISECOND;
+
+  g_mutex_lock (&self->mutex);
+
+  while (!self->stopping)
+    {
+      gint64 deadline = self->heartbeat + stuck_after;
+
+      if (self->sampled)
+        {
+          /* We've seen what it's stuck in; wait for it to get unstuck */
+          g_cond_wait (&self->cond, &self->mutex);
+        }
+      else if (g_get_monotonic_time () >= deadline)
+        {
+          /* The probe is well overdue, so something's hogging the main
+           * loop. Let's see what. */
+          self->sampled = TRUE;
+          pthread_kill (self->main_thread, SAMPLE_SIGNAL);
+        }
+      else
+        {
+          g_cond_wait_until (&self->cond, &self->mutex, deadline);
+        }
+    }
+
+  g_mutex_unlock (&self->mutex);
+
+  return NULL;
+}
+#endif
+
+static gboolean
+probe_cb (gpointer user_data)
+{
+  Watchdog *self = user_data;
+  gint64 now = g_get_monotonic_time ();
+  gint64 late = now - self->last_probe -
+      PROBE_INTERVAL_MS * G_TIME_SPAN_MILLISECOND;
+  gboolean slow;
+  guint i;
+
+  self->last_probe = now;
+  late = MAX (late, 0);
+  slow = (late >= self->threshold_ms * G_TIME_SPAN_MILLISECOND);
+
+  for (i = 0; (guint64) late > bucket_bounds[i]; i++)
+    ;
+
+  self->counts[i]++;
+
+#ifdef G_OS_UNIX
+  g_mutex_lock (&self->mutex);
+  self->heartbeat = now;
+  self->sampled = FALSE;
+  g_cond_signal (&self->cond);
+  g_mutex_unlock (&self->mutex);
+
+  if (have_sample)
+    {
+      if (slow)
+        record_slow_callback (self, late, sample_source_name,
+            sample_dup_stack ());
+
+      have_sample = 0;
+      return TRUE;
+    }
+#endif
+
+  /* We didn't manage to see what it was */
+  if (slow)
+    record_slow_callback (self, late, "", g_new0 (gchar *, 1));
+
+  return TRUE;
+}
+
+/*
+ * gabble_watchdog_start:
+ * @threshold_ms: how long, in milliseconds, the main loop must be blocked
+ *  for us to find out what by, or 0 for the default
+ *
+ * Starts checking every so often how promptly the main loop gets round to
+ * us, keeping a histogram of how late we are. If we're more than
+ * @threshold_ms late, we note what we were held up by: where we can, the
+ * name of the #GSource it was dispatching, and its stack.
+ *
+ * This runs a thread, and interrupts the main thread with SIGPROF when it's
+ * stuck, so it's only meant for debugging.
+ */
+void
+gabble_watchdog_start (guint threshold_ms)
+{
+  Watchdog *self;
+
+  g_return_if_fail (watchdog == NULL);
+
+  self = watchdog = g_slice_new0 (Watchdog);
+  self->threshold_ms = (threshold_ms > 0 ?
+      threshold_ms : DEFAULT_THRESHOLD_MS);
+  self->slow_callbacks = g_ptr_array_new_with_free_func (
+      (GDestroyNotify) slow_callback_free);
+  self->last_probe = g_get_monotonic_time ();
+  self->probe_id = g_timeout_add (PROBE_INTERVAL_MS, probe_cb, self);
+
+#ifdef G_OS_UNIX
+  install_sample_handler ();
+
+  self->main_thread = pthread_self ();
+  g_mutex_init (&self->mutex);
+  g_cond_init (&self->cond);
+  self->heartbeat = self->last_probe;
+  self->sampler = g_thread_new ("gabble-watchdog", sampler_thread, self);
+#endif
+
+  DEBUG ("noting callbacks that block the main loop for %u ms or more",
+      self->threshold_ms);
+}
+
+void
+gabble_watchdog_stop (void)
+{
+  Watchdog *self = watchdog;
+
+  if (self == NULL)
+    return;
+
+#ifdef G_OS_UNIX
+  g_mutex_lock (&self->mutex);
+  self->stopping = TRUE;
+  g_cond_signal (&self->cond);
+  g_mutex_unlock (&self->mutex);
+
+  g_thread_join (self->sampler);
+
+  /* Not SIG_DFL, in case one is still on its way */
+  signal (SAMPLE_SIGNAL, SIG_IGN);
+
+  g_mutex_clear (&self->mutex);
+  g_cond_clear (&self->cond);
+#endif
+
+  g_source_remove (self->probe_id);
+  g_ptr_array_unref (self->slow_callbacks);
+  g_slice_free (Watchdog, self);
+  watchdog = NULL;
+}
+
+/*
+ * gabble_watchdog_dup_latency_histogram:
+ *
+ * Returns: how many times the main loop has got round to the watchdog within
+ *  each bucket's bound of when it should have, as a
+ *  GABBLE_ARRAY_TYPE_LATENCY_BUCKET_LIST; empty if the watchdog isn't
+ *  running
+ */
+GPtrArray *
+gabble_watchdog_dup_latency_histogram (void)
+{
+  GPtrArray *ret = g_ptr_array_new ();
+  guint i;
+
+  if (watchdog == NULL)
+    return ret;
+
+  for (i = 0; i < G_N_ELEMENTS (bucket_bounds); i++)
+    g_ptr_array_add (ret, tp_value_array_build (2,
+        G_TYPE_UINT64, bucket_bounds[i],
+        G_TYPE_UINT, watchdog->counts[i],
+        G_TYPE_INVALID));
+
+  return ret;
+}
+
+/*
+ * gabble_watchdog_dup_slow_callbacks:
+ *
+ * Returns: the callbacks which have blocked the main loop for longest, as a
+ *  GABBLE_ARRAY_TYPE_SLOW_CALLBACK_LIST; empty if the watchdog isn't running
+ */
+GPtrArray *
+gabble_watchdog_dup_slow_callbacks (void)
+{
+  GPtrArray *ret = g_ptr_array_new ();
+  guint i;
+
+  if (watchdog == NULL)
+    return ret;
+
+  for (i = 0; i < watchdog->slow_callbacks->len; i++)
+    {
+      SlowCallback *cb = g_ptr_array_index (watchdog->slow_callbacks, i);
+
+      g_ptr_array_add (ret, tp_value_array_build (3,
+          G_TYPE_STRING, cb->source_name,
+          G_TYPE_UINT64, cb->duration,
+          G_TYPE_STRV, cb->stack,
+          G_TYPE_INVALID));
+    }
+
+  return ret;
+}
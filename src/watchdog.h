@@ -0,0 +1,35 @@
+/*
+ * watchdog.h - Header for the main loop latency watchdog
+ * Copyright (C) 2012 Collabora Ltd.
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+ */
+
+#ifndef GABBLE_WATCHDOG_H
+#define GABBLE_WATCHDOG_H
+
+#include <glib.h>
+
+G_BEGIN_DECLS
+
+void gabble_watchdog_start (guint threshold_ms);
+void gabble_watchdog_stop (void);
+
+GPtrArray *gabble_watchdog_dup_latency_histogram (void);
+GPtrArray *gabble_watchdog_dup_slow_callbacks (void);
+
+G_END_DECLS
+
+#endif /* GABBLE_WATCHDOG_H */
@@ -0,0 +1,243 @@
+
+#include "config.h"
+
+#include <glib.h>
+#include <glib-object.h>
+
+#include "src/capabilities.h"
+#include "src/debug.h"
+#include "src/namespaces.h"
+
+/* More than fit in the dense part of a GabbleCapabilitySet */
+#define N_RARE_FEATURES 500
+
+static gchar *
+rare_feature (guint i)
+{
+  return g_strdup_printf ("urn:example:rare-feature:%u", i);
+}
+
+static GabbleCapabilitySet *
+typical_client (void)
+{
+  GabbleCapabilitySet *caps = gabble_capability_set_new ();
+
+  gabble_capability_set_add (caps, NS_CHAT_STATES);
+  gabble_capability_set_add (caps, NS_NICK);
+  gabble_capability_set_add (caps, NS_SI);
+  gabble_capability_set_add (caps, NS_IBB);
+  gabble_capability_set_add (caps, NS_BYTESTREAMS);
+  gabble_capability_set_add (caps, NS_FILE_TRANSFER);
+  gabble_capability_set_add (caps, NS_JINGLE_RTP);
+  gabble_capability_set_add (caps, NS_JINGLE_RTP_AUDIO);
+  gabble_capability_set_add (caps, NS_JINGLE_TRANSPORT_ICEUDP);
+  gabble_capability_set_add (caps, NS_GEOLOC "+notify");
+  return caps;
+}
+
+static void
+test_set_operations (void)
+{
+  GabbleCapabilitySet *a = gabble_capability_set_new ();
+  GabbleCapabilitySet *b;
+  GabbleCapabilitySet *rare = gabble_capability_set_new ();
+  guint i;
+
+  g_assert_cmpint (gabble_capability_set_size (a), ==, 0);
+  g_assert (!gabble_capability_set_has (a, NS_NICK));
+
+  gabble_capability_set_add (a, NS_NICK);
+  gabble_capability_set_add (a, NS_NICK);
+  g_assert (gabble_capability_set_has (a, NS_NICK));
+  g_assert_cmpint (gabble_capability_set_size (a), ==, 1);
+
+  for (i = 0; i < N_RARE_FEATURES; i++)
+    {
+      gchar *feature = rare_feature (i);
+
+      gabble_capability_set_add (rare, feature);
+      g_free (feature);
+    }
+
+  g_assert_cmpint (gabble_capability_set_size (rare), ==, N_RARE_FEATURES);
+
+  b = gabble_capability_set_copy (rare);
+  g_assert (gabble_capability_set_equals (b, rare));
+  g_assert (!gabble_capability_set_has_one (a, b));
+
+  gabble_capability_set_update (b, a);
+  g_assert_cmpint (gabble_capability_set_size (b), ==, N_RARE_FEATURES + 1);
+  g_assert (gabble_capability_set_at_least (b, a));
+  g_assert (gabble_capability_set_at_least (b, rare));
+  g_assert (!gabble_capability_set_at_least (a, b));
+  g_assert (gabble_capability_set_has_one (b, a));
+  g_assert (gabble_capability_set_has_one (b, rare));
+
+  g_assert (gabble_capability_set_remove (b, "urn:example:rare-feature:400"));
+  g_assert (!gabble_capability_set_remove (b, "urn:example:rare-feature:400"));
+  g_assert (!gabble_capability_set_has (b, "urn:example:rare-feature:400"));
+  g_assert (!gabble_capability_set_at_least (b, rare));
+
+  gabble_capability_set_intersect (b, a);
+  g_assert (gabble_capability_set_equals (b, a));
+
+  gabble_capability_set_update (b, rare);
+  gabble_capability_set_exclude (b, rare);
+  g_assert (gabble_capability_set_equals (b, a));
+
+  /* sets whose overflow part has been emptied are still equal to those
+   * which never had one */
+  gabble_capability_set_clear (b);
+  gabble_capability_set_add (b, "urn:example:rare-feature:0");
+  gabble_capability_set_remove (b, "urn:example:rare-feature:0");
+  gabble_capability_set_add (b, NS_NICK);
+  g_assert (gabble_capability_set_equals (b, a));
+  g_assert (gabble_capability_set_equals (a, b));
+
+  gabble_capability_set_free (a);
+  gabble_capability_set_free (b);
+  gabble_capability_set_free (rare);
+}
+
+static void
+count_features (gpointer feature,
+    gpointer user_data)
+{
+  guint *count = user_data;
+
+  (*count)++;
+}
+
+static void
+test_quirks (void)
+{
+  GabbleCapabilitySet *caps = gabble_capability_set_new ();
+  guint count = 0;
+
+  gabble_capability_set_add (caps, NS_NICK);
+  gabble_capability_set_add (caps, QUIRK_OMITS_CONTENT_CREATORS);
+  gabble_capability_set_add (caps, "urn:example:rare-feature:42");
+
+  g_assert_cmpint (gabble_capability_set_size (caps), ==, 3);
+  gabble_capability_set_foreach (caps, count_features, &count);
+  g_assert_cmpuint (count, ==, 2);
+
+  gabble_capability_set_free (caps);
+}
+
+static void
+test_intern (void)
+{
+  GabbleCapabilitySet *a = typical_client ();
+  GabbleCapabilitySet *b = typical_client ();
+  GabbleCapabilitySet *ia, *ib, *copy;
+
+  ia = gabble_capability_set_intern (a);
+  ib = gabble_capability_set_intern (b);
+  g_assert (ia == ib);
+  g_assert (ia != a);
+  g_assert (gabble_capability_set_equals (ia, a));
+
+  /* changing the original doesn't affect the shared copy */
+  gabble_capability_set_add (a, NS_TUBES);
+  g_assert (!gabble_capability_set_has (ia, NS_TUBES));
+
+  /* copies of shared sets can be changed */
+  copy = gabble_capability_set_copy (ia);
+  gabble_capability_set_add (copy, NS_TUBES);
+  g_assert (gabble_capability_set_equals (copy, a));
+
+  gabble_capability_set_free (ib);
+  g_assert (gabble_capability_set_has (ia, NS_NICK));
+  gabble_capability_set_free (ia);
+
+  /* once the last user has gone, it's really gone */
+  ia = gabble_capability_set_intern (a);
+  g_assert (gabble_capability_set_has (ia, NS_TUBES));
+  gabble_capability_set_free (ia);
+
+  gabble_capability_set_free (copy);
+  gabble_capability_set_free (a);
+  gabble_capability_set_free (b);
+}
+
+/* Contacts' caps are checked like this for every contact whenever the
+ * ContactCapabilities or Presence attributes are fetched */
+static void
+test_benchmark (void)
+{
+  GabbleCapabilitySet *client = typical_client ();
+  GabbleCapabilitySet *any_audio = gabble_capability_set_new ();
+  GabbleCapabilitySet *copy;
+  guint iterations = g_test_perf () ? 1000000 : 10000;
+  guint i, hits = 0;
+  gdouble elapsed;
+
+  gabble_capability_set_add (any_audio, NS_JINGLE_RTP_AUDIO);
+  gabble_capability_set_add (any_audio, NS_GOOGLE_FEAT_VOICE);
+
+  g_test_timer_start ();
+
+  for (i = 0; i < iterations; i++)
+    {
+      hits += gabble_capability_set_has (client, NS_FILE_TRANSFER);
+      hits += gabble_capability_set_has_one (client, any_audio);
+      hits += gabble_capability_set_at_least (client,
+          gabble_capabilities_get_geoloc_notify ());
+    }
+
+  elapsed = g_test_timer_elapsed ();
+  g_assert_cmpuint (hits, >, 0);
+  g_test_minimized_result (elapsed * 1e9 / iterations,
+      "has + has_one + at_least: %.1f ns", elapsed * 1e9 / iterations);
+
+  g_test_timer_start ();
+
+  for (i = 0; i < iterations; i++)
+    {
+      copy = gabble_capability_set_copy (client);
+      g_assert (gabble_capability_set_equals (copy, client));
+      gabble_capability_set_free (copy);
+    }
+
+  elapsed = g_test_timer_elapsed ();
+  g_test_minimized_result (elapsed * 1e9 / iterations,
+      "copy + equals + free: %.1f ns", elapsed * 1e9 / iterations);
+
+  g_test_timer_start ();
+
+  for (i = 0; i < iterations; i++)
+    {
+      copy = gabble_capability_set_intern (client);
+      gabble_capability_set_free (copy);
+    }
+
+  elapsed = g_test_timer_elapsed ();
+  g_test_minimized_result (elapsed * 1e9 / iterations,
+      "intern + free: %.1f ns", elapsed * 1e9 / iterations);
+
+  gabble_capability_set_free (any_audio);
+  gabble_capability_set_free (client);
+}
+
+int main (int argc, char **argv)
+{
+  int ret;
+
+  g_type_init ();
+  gabble_capabilities_init (NULL);
+  gabble_debug_set_flags_from_env ();
+
+  g_test_init (&argc, &argv, NULL);
+  g_test_add_func ("/capabilities/set-operations", test_set_operations);
+  g_test_add_func ("/capabilities/quirks", test_quirks);
+  g_test_add_func ("/capabilities/intern", test_intern);
+  g_test_add_func ("/capabilities/benchmark", test_benchmark);
+
+  ret = g_test_run ();
+
+  gabble_capabilities_finalize (NULL);
+  gabble_debug_free ();
+
+  return ret;
+}
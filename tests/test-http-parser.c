@@ -0,0 +1,310 @@
+#include "config.h"
+
+#include <string.h>
+
+#include <glib.h>
+
+#include "src/http-parser.h"
+
+typedef struct
+{
+  GString *log;
+  GString *body;
+  const gchar *buffer;
+  gsize buffer_len;
+  guint body_calls;
+  gboolean copied;
+  gboolean pause;
+} Recorder;
+
+static gboolean
+headers_complete (GabbleHttpParser *parser,
+    const gchar *start_line,
+    gpointer user_data)
+{
+  Recorder *r = user_data;
+
+  g_string_append_printf (r->log, "[%s]", start_line);
+  g_string_truncate (r->body, 0);
+  return TRUE;
+}
+
+static gboolean
+body (GabbleHttpParser *parser,
+    const gchar *data,
+    gsize len,
+    gpointer user_data)
+{
+  Recorder *r = user_data;
+
+  g_assert_cmpuint (len, >, 0);
+  r->body_calls++;
+
+  if (data < r->buffer || data + len > r->buffer + r->buffer_len)
+    r->copied = TRUE;
+
+  g_string_append_len (r->body, data, len);
+  return TRUE;
+}
+
+static gboolean
+message_complete (GabbleHttpParser *parser,
+    gpointer user_data)
+{
+  Recorder *r = user_data;
+
+  g_string_append_printf (r->log, "(%s)", r->body->str);
+  return !r->pause;
+}
+
+static const GabbleHttpParserCallbacks callbacks = {
+    headers_complete,
+    body,
+    message_complete
+};
+
+static void
+recorder_init (Recorder *r)
+{
+  memset (r, 0, sizeof (Recorder));
+  r->log = g_string_new ("");
+  r->body = g_string_new ("");
+}
+
+static void
+recorder_clear (Recorder *r)
+{
+  g_string_free (r->log, TRUE);
+  g_string_free (r->body, TRUE);
+}
+
+static gssize
+feed (GabbleHttpParser *parser,
+    Recorder *r,
+    const gchar *data,
+    gsize len)
+{
+  r->buffer = data;
+  r->buffer_len = len;
+  return gabble_http_parser_feed (parser, data, len);
+}
+
+/* Feeds @stream to a parser split in two at every possible point, and then
+ * a byte at a time, checking it always sees the same thing */
+static void
+check_stream (const gchar *stream,
+    const gchar *expected)
+{
+  gsize len = strlen (stream);
+  gsize split;
+  Recorder r;
+  GabbleHttpParser *parser;
+
+  for (split = 0; split <= len; split++)
+    {
+      recorder_init (&r);
+      parser = gabble_http_parser_new (&callbacks, &r);
+
+      g_assert_cmpint (feed (parser, &r, stream, split), ==, split);
+      g_assert_cmpint (feed (parser, &r, stream + split, len - split), ==,
+          len - split);
+      g_assert_cmpstr (r.log->str, ==, expected);
+      g_assert (!r.copied);
+
+      gabble_http_parser_free (parser);
+      recorder_clear (&r);
+    }
+
+  recorder_init (&r);
+  parser = gabble_http_parser_new (&callbacks, &r);
+
+  for (split = 0; split < len; split++)
+    g_assert_cmpint (feed (parser, &r, stream + split, 1), ==, 1);
+
+  g_assert_cmpstr (r.log->str, ==, expected);
+  g_assert (!r.copied);
+
+  gabble_http_parser_free (parser);
+  recorder_clear (&r);
+}
+
+static void
+check_invalid (const gchar *stream)
+{
+  Recorder r;
+  GabbleHttpParser *parser;
+
+  recorder_init (&r);
+  parser = gabble_http_parser_new (&callbacks, &r);
+
+  g_assert_cmpint (feed (parser, &r, stream, strlen (stream)), ==, -1);
+
+  /* It stays broken until it's reset */
+  g_assert_cmpint (feed (parser, &r, "\r\n", 2), ==, -1);
+  gabble_http_parser_reset (parser);
+  g_assert_cmpint (feed (parser, &r, "\r\n", 2), ==, 2);
+
+  gabble_http_parser_free (parser);
+  recorder_clear (&r);
+}
+
+static void
+test_content_length (void)
+{
+  check_stream (
+      "HTTP/1.1 200\r\n"
+      "Connection: Keep-Alive\r\n"
+      "Content-Length: 11\r\n"
+      "Content-Type: application/octet-stream\r\n"
+      "\r\n"
+      "hello world",
+      "[HTTP/1.1 200](hello world)");
+
+  /* Bare newlines, odd case and spacing, and no body at all */
+  check_stream (
+      "HTTP/1.1 404\n"
+      "content-length:0\n"
+      "\n",
+      "[HTTP/1.1 404]()");
+}
+
+static void
+test_body_in_one_piece (void)
+{
+  const gchar *stream =
+      "HTTP/1.1 200\r\n"
+      "Content-Length: 5\r\n"
+      "\r\n"
+      "12345";
+  Recorder r;
+  GabbleHttpParser *parser;
+
+  recorder_init (&r);
+  parser = gabble_http_parser_new (&callbacks, &r);
+
+  g_assert_cmpint (feed (parser, &r, stream, strlen (stream)), ==,
+      strlen (stream));
+  g_assert_cmpuint (r.body_calls, ==, 1);
+  g_assert_cmpuint (gabble_http_parser_get_content_length (parser), ==, 5);
+  g_assert (!gabble_http_parser_is_chunked (parser));
+
+  gabble_http_parser_free (parser);
+  recorder_clear (&r);
+}
+
+static void
+test_chunked (void)
+{
+  check_stream (
+      "HTTP/1.1 200\r\n"
+      "Transfer-Encoding: chunked\r\n"
+      "\r\n"
+      "5\r\n"
+      "hello\r\n"
+      "1;name=value\r\n"
+      " \r\n"
+      "A  \r\n"
+      "0123456789\r\n"
+      "0\r\n"
+      "Checksum: whatever\r\n"
+      "\r\n",
+      "[HTTP/1.1 200](hello 0123456789)");
+
+  check_stream (
+      "HTTP/1.1 200\r\n"
+      "Transfer-Encoding: gzip, Chunked\r\n"
+      "\r\n"
+      "0\r\n"
+      "\r\n",
+      "[HTTP/1.1 200]()");
+}
+
+static void
+test_pipelined (void)
+{
+  check_stream (
+      "\r\n"
+      "GET /temporary/1234/a.txt HTTP/1.1\r\n"
+      "Connection: Keep-Alive\r\n"
+      "Content-Length: 0\r\n"
+      "Host: alice@example.com/Empathy:0\r\n"
+      "\r\n"
+      "GET /temporary/1234/b.txt HTTP/1.1\r\n"
+      "Content-Length: 3\r\n"
+      "\r\n"
+      "abc"
+      "GET /temporary/1234/c.txt HTTP/1.1\r\n"
+      "\r\n",
+      "[GET /temporary/1234/a.txt HTTP/1.1]()"
+      "[GET /temporary/1234/b.txt HTTP/1.1](abc)"
+      "[GET /temporary/1234/c.txt HTTP/1.1]()");
+}
+
+static void
+test_pause (void)
+{
+  const gchar *first = "GET /a HTTP/1.1\r\n\r\n";
+  const gchar *second = "GET /b HTTP/1.1\r\n\r\n";
+  gchar *stream = g_strconcat (first, second, NULL);
+  gsize len = strlen (stream);
+  Recorder r;
+  GabbleHttpParser *parser;
+  gssize consumed;
+
+  recorder_init (&r);
+  r.pause = TRUE;
+  parser = gabble_http_parser_new (&callbacks, &r);
+
+  /* The parser stops right after the first request... */
+  consumed = feed (parser, &r, stream, len);
+  g_assert_cmpint (consumed, ==, strlen (first));
+  g_assert_cmpstr (r.log->str, ==, "[GET /a HTTP/1.1]()");
+  g_assert_cmpstr (gabble_http_parser_get_start_line (parser), ==,
+      "GET /a HTTP/1.1");
+
+  /* ...and picks up where it left off */
+  r.pause = FALSE;
+  g_assert_cmpint (feed (parser, &r, stream + consumed, len - consumed), ==,
+      len - consumed);
+  g_assert_cmpstr (r.log->str, ==, "[GET /a HTTP/1.1]()[GET /b HTTP/1.1]()");
+
+  gabble_http_parser_free (parser);
+  recorder_clear (&r);
+  g_free (stream);
+}
+
+static void
+test_invalid (void)
+{
+  gchar *long_line;
+
+  check_invalid ("HTTP/1.1 200\r\nNo colon here\r\n\r\n");
+  check_invalid ("HTTP/1.1 200\r\nContent-Length: 12abc\r\n\r\n");
+  check_invalid ("HTTP/1.1 200\r\nContent-Length: -1\r\n\r\n");
+  check_invalid ("HTTP/1.1 200\r\nTransfer-Encoding: chunked\r\n\r\n"
+      "zz\r\n");
+  check_invalid ("HTTP/1.1 200\r\nTransfer-Encoding: chunked\r\n\r\n"
+      "11111111111111111\r\n");
+  check_invalid ("HTTP/1.1 200\r\nTransfer-Encoding: chunked\r\n\r\n"
+      "2\r\nabcd\r\n");
+
+  long_line = g_strnfill (10000, 'x');
+  check_invalid (long_line);
+  g_free (long_line);
+}
+
+int
+main (int argc,
+    char **argv)
+{
+  g_test_init (&argc, &argv, NULL);
+
+  g_test_add_func ("/http-parser/content-length", test_content_length);
+  g_test_add_func ("/http-parser/body-in-one-piece", test_body_in_one_piece);
+  g_test_add_func ("/http-parser/chunked", test_chunked);
+  g_test_add_func ("/http-parser/pipelined", test_pipelined);
+  g_test_add_func ("/http-parser/pause", test_pause);
+  g_test_add_func ("/http-parser/invalid", test_invalid);
+
+  return g_test_run ();
+}
@@ -3,6 +3,7 @@ import hashlib
 import sys
 import random
 import socket
+import time
 
 from twisted.internet.protocol import Factory, Protocol
 from twisted.internet import reactor
@@ -142,10 +143,13 @@ class Bytestream(object):
         assert str(proto) == self.get_ns()
 
 ##### XEP-0065: SOCKS5 Bytestreams #####
-def listen_socks5(q):
+def listen_socks5(q, factory=None):
+    if factory is None:
+        factory = S5BFactory(q.append)
+
     for port in range(5000, 5100):
         try:
-            reactor.listenTCP(port, S5BFactory(q.append), interface='localhost')
+            reactor.listenTCP(port, factory, interface='localhost')
         except CannotListenError:
             continue
         else:
@@ -204,11 +208,13 @@ class BytestreamS5B(Bytestream):
         query = iq.addElement((ns.BYTESTREAMS, 'query'))
         query['sid'] = self.stream_id
         query['mode'] = 'tcp'
-        for jid, host in self.hosts:
+        for info in self.hosts:
+            # hosts can have their own port rather than the one we listen on
+            jid, host, host_port = (tuple(info) + (port,))[:3]
             streamhost = query.addElement('streamhost')
             streamhost['jid'] = jid
             streamhost['host'] = host
-            streamhost['port'] = str(port)
+            streamhost['port'] = str(host_port)
         self.stream.send(iq)
 
     def _wait_auth_request(self):
@@ -264,8 +270,14 @@ class BytestreamS5B(Bytestream):
     def open_bytestream(self, expected_before=[], expected_after=[]):
         port = listen_socks5(self.q)
 
+        start = time.time()
         self._send_socks5_init(port)
-        return self._socks5_expect_connection(expected_before, expected_after)
+        events = self._socks5_expect_connection(expected_before,
+            expected_after)
+
+        # how long it took Gabble to pick a streamhost and acknowledge it
+        self.open_time = time.time() - start
+        return events
 
     def send_data(self, data):
         self.transport.write(data)
@@ -409,6 +421,7 @@ class BytestreamS5BCannotConnect(BytestreamS5B):
         self.hosts = [('invalid.invalid', 'invalid.invalid')]
 
     def open_bytestream(self, expected_before=[], expected_after=[]):
+        start = time.time()
         self._send_socks5_init(12345)
 
         events_before, iq_event = wait_events(self.q, expected_before,
@@ -416,6 +429,9 @@ class BytestreamS5BCannotConnect(BytestreamS5B):
 
         self.check_error_stanza(iq_event.stanza)
 
+        # how long it took Gabble to give up on every streamhost
+        self.open_time = time.time() - start
+
         return events_before, []
 
     def _socks5_connect(self, host, port):
@@ -545,6 +561,26 @@ class BytestreamS5BRelay(BytestreamS5B):
         return self.q.expect_many(*expected)
 
 
+class BytestreamS5BStalled(BytestreamS5BRelay):
+    """The initiator's own streamhost accepts connections but never answers,
+    so Gabble has to get through the relay while it waits"""
+    def __init__(self, stream, q, sid, initiator, target, initiated):
+        BytestreamS5BRelay.__init__(self, stream, q, sid, initiator, target,
+            initiated)
+
+        # what happened to the streamhost that never answers
+        self.stalled_events = []
+
+    def open_bytestream(self, expected_before=[], expected_after=[]):
+        stalled_port = listen_socks5(self.q,
+            StalledS5BFactory(self.stalled_events.append))
+
+        self.hosts = [(self.initiator, '127.0.0.1', stalled_port),
+                ('proxy.localhost', '127.0.0.1')]
+
+        return BytestreamS5BRelay.open_bytestream(self, expected_before,
+            expected_after)
+
 class BytestreamS5BRelayBugged(BytestreamS5BRelay):
     """Simulate bugged ejabberd (< 2.0.2) proxy sending wrong CONNECT reply"""
     def _send_connect_reply(self):
@@ -581,6 +617,17 @@ class S5BFactory(Factory):
     def clientConnectionFailed(self, connector, reason):
         self.event_func(Event('s5b-connection-failed', reason=reason))
 
+class StalledS5BProtocol(Protocol):
+    def connectionMade(self):
+        self.factory.event_func(Event('s5b-stalled-connected'))
+
+    def connectionLost(self, reason):
+        self.factory.event_func(Event('s5b-stalled-connection-lost'))
+
+class StalledS5BFactory(S5BFactory):
+    """Accepts connections and then says nothing at all"""
+    protocol = StalledS5BProtocol
+
 def expect_socks5_reply(q):
     event = q.expect('stream-iq', iq_type='result')
     iq = event.stanza
@@ -597,6 +644,9 @@ class BytestreamIBB(Bytestream):
 
         self.seq = 0
         self.checked = False
+        # use a ridiculously small block size by default to stress test IBB
+        # buffering
+        self.block_size = 1
 
     def get_ns(self):
         return ns.IBB
@@ -611,8 +661,7 @@ class BytestreamIBB(Bytestream):
         iq['from'] = self.initiator
         open = iq.addElement((ns.IBB, 'open'))
         open['sid'] = self.stream_id
-        # set a ridiculously small block size to stress test IBB buffering
-        open['block-size'] = '1'
+        open['block-size'] = str(self.block_size)
 
         assert self.checked
 
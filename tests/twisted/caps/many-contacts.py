@@ -0,0 +1,91 @@
+"""
+Test contact capabilities for a large number of contacts using a handful of
+different clients: Gabble should only disco each client once, and every
+contact should end up with the right capabilities.
+
+There are GABBLE_CAPS_BENCHMARK_CONTACTS contacts (200 by default; try a few
+thousand for a real benchmark).
+"""
+
+import os
+import time
+
+from gabbletest import exec_test, make_presence, sync_stream
+from servicetest import assertEquals, sync_dbus
+import constants as cs
+import ns
+from caps_helper import (
+    compute_caps_hash, send_disco_reply, get_contacts_capabilities_sync,
+    )
+
+CONTACTS = int(os.environ.get('GABBLE_CAPS_BENCHMARK_CONTACTS', '200'))
+
+# A few clients with different mixtures of features; the last one also has
+# lots of features Gabble has never heard of.
+CLIENTS = [
+    [ns.CHAT_STATES],
+    [ns.CHAT_STATES, ns.FILE_TRANSFER],
+    [ns.CHAT_STATES, ns.FILE_TRANSFER, ns.TUBES, ns.GEOLOC + '+notify'],
+    [ns.FILE_TRANSFER, ns.JINGLE_RTP, ns.JINGLE_RTP_AUDIO],
+    [ns.FILE_TRANSFER] +
+        ['urn:example:rare-feature:%d' % i for i in range(300)],
+    ]
+
+NODE = 'http://example.com/client'
+
+def identities(i):
+    return ['client/pc/en/Client %d' % i]
+
+def can_send_files(rccs):
+    for fixed, allowed in rccs:
+        if fixed.get(cs.CHANNEL_TYPE) == cs.CHANNEL_TYPE_FILE_TRANSFER:
+            return True
+
+    return False
+
+def test(q, bus, conn, stream):
+    vers = [compute_caps_hash(identities(i), features, {})
+        for i, features in enumerate(CLIENTS)]
+    jids = ['contact%d@example.com' % i for i in range(CONTACTS)]
+    handles = conn.get_contact_handles_sync(jids)
+
+    start = time.time()
+
+    for i, jid in enumerate(jids):
+        client = i % len(CLIENTS)
+        stream.send(make_presence(jid + '/Resource', status='hello',
+            caps={'node': NODE, 'ver': vers[client], 'hash': 'sha-1'}))
+
+    # Each client's caps are only looked up once.
+    for _ in CLIENTS:
+        event = q.expect('stream-iq', query_ns=ns.DISCO_INFO,
+            predicate=lambda e: e.to.startswith('contact'))
+        node, ver = event.query['node'].split('#', 1)
+        assertEquals(NODE, node)
+
+        client = vers.index(ver)
+        send_disco_reply(stream, event.stanza, identities(client),
+            CLIENTS[client])
+
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    elapsed = time.time() - start
+
+    start = time.time()
+    caps = get_contacts_capabilities_sync(conn, handles)
+    fetch = time.time() - start
+
+    for i, h in enumerate(handles):
+        client = i % len(CLIENTS)
+        assertEquals(ns.FILE_TRANSFER in CLIENTS[client],
+            can_send_files(caps[h]))
+
+    # Contacts with the same client have the same capabilities.
+    for i, h in enumerate(handles[len(CLIENTS):]):
+        assertEquals(caps[handles[i % len(CLIENTS)]], caps[h])
+
+    print "%d contacts, %d clients: discovered in %.3fs, fetched in %.3fs" % (
+        CONTACTS, len(CLIENTS), elapsed, fetch)
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -0,0 +1,57 @@
+"""
+Test that Gabble records the phases of connecting, and exposes them as
+Gabble.Debug.ConnectionPhases.
+"""
+
+from gabbletest import exec_test, make_result_iq, sync_stream
+from servicetest import EventPattern, assertEquals, assertContains
+import constants as cs
+import ns
+
+def get_phases(conn):
+    return [(str(name), time) for name, time in conn.Get(
+        cs.CONN_IFACE_GABBLE_DEBUG, 'ConnectionPhases',
+        dbus_interface=cs.PROPERTIES_IFACE)]
+
+def test(q, bus, conn, stream):
+    assertEquals([], get_phases(conn))
+
+    conn.Connect()
+    _, e = q.expect_many(
+        EventPattern('dbus-signal', signal='StatusChanged',
+            args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED]),
+        EventPattern('stream-iq', query_ns=ns.ROSTER, iq_type='get'))
+
+    phases = get_phases(conn)
+    names = [name for name, _ in phases]
+    times = [time for _, time in phases]
+    assertEquals(sorted(times), times)
+
+    # The server disco and the privacy lists happen one after the other; the
+    # disco of our own bare JID is in parallel with both.
+    for before, after in [
+            ('sasl-started', 'sasl-succeeded'),
+            ('sasl-succeeded', 'bound'),
+            ('bound', 'server-disco'),
+            ('bound', 'bare-jid-disco'),
+            ('server-disco', 'privacy-lists'),
+            ('privacy-lists', 'initial-presence'),
+            ('initial-presence', 'connected'),
+            ('bare-jid-disco', 'connected'),
+            ]:
+        assertContains(before, names)
+        assertContains(after, names)
+        assert names.index(before) < names.index(after), (before, after, names)
+
+    assertEquals('connected', names[-1])
+
+    # The roster turns up once we're connected
+    stream.send(make_result_iq(stream, e.stanza))
+    sync_stream(q, stream)
+
+    phases = get_phases(conn)
+    assertEquals(len(names) + 1, len(phases))
+    assertEquals('roster', phases[-1][0])
+
+if __name__ == '__main__':
+    exec_test(test, do_connect=False)
@@ -0,0 +1,85 @@
+"""
+Measure logging in to an account with a big roster of contacts who are all
+online: how many bytes cross the wire each way, how many the server's side
+would come to if the stream were compressed with zlib, and how much CPU time
+Gabble spends.
+"""
+
+import os
+
+import dbus
+
+from gabbletest import (
+    exec_test, make_result_iq, make_presence, sync_stream,
+    ByteCountingAuthenticator,
+    )
+from servicetest import EventPattern
+import constants as cs
+import ns
+
+CONTACTS = int(os.environ.get('GABBLE_LOGIN_BENCHMARK_CONTACTS', '500'))
+
+CAPS = { 'node': 'http://telepathy.freedesktop.org/fake-client',
+         'ver': 'ZGVhZGJlZWZkZWFkYmVlZmRlYWRiZWVm',
+         'hash': 'sha-1',
+       }
+
+def gabble_cpu_time(bus, conn):
+    """
+    Returns how many seconds of CPU time Gabble has used so far, or None if
+    we can't tell (because we're not on Linux, for instance).
+    """
+    dbus_daemon = dbus.Interface(bus.get_object('org.freedesktop.DBus',
+        '/org/freedesktop/DBus'), 'org.freedesktop.DBus')
+    pid = dbus_daemon.GetConnectionUnixProcessID(conn.object.bus_name)
+
+    try:
+        # The process name is in brackets, and might have spaces in it
+        stat = open('/proc/%d/stat' % pid).read()
+        fields = stat[stat.rindex(')') + 2:].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, ValueError, IndexError, OSError):
+        return None
+
+def login(q, bus, conn, stream):
+    auth = stream.authenticator
+    jids = ['contact%04d@example.com' % i for i in range(CONTACTS)]
+
+    cpu_before = gabble_cpu_time(bus, conn)
+    conn.Connect()
+
+    _, roster = q.expect_many(
+        EventPattern('dbus-signal', signal='StatusChanged',
+            args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED]),
+        EventPattern('stream-iq', query_ns=ns.ROSTER, iq_type='get'))
+
+    result = make_result_iq(stream, roster.stanza)
+    query = result.firstChildElement()
+    for jid in jids:
+        item = query.addElement('item')
+        item['jid'] = jid
+        item['subscription'] = 'both'
+        item.addElement('group', content='Friends')
+    stream.send(result)
+
+    # Everyone's online with the same client, and an avatar
+    for i, jid in enumerate(jids):
+        stream.send(make_presence(jid + '/Resource', show='away',
+            status='Out for lunch', caps=CAPS, photo='%040x' % i))
+
+    q.expect('dbus-signal', signal='ContactListStateChanged',
+        args=[cs.CONTACT_LIST_STATE_SUCCESS])
+    sync_stream(q, stream)
+    cpu_after = gabble_cpu_time(bus, conn)
+
+    print "%d contacts: server sent %d bytes on the wire (%d if " \
+        "compressed, taking %.3fs); Gabble sent %d" % (CONTACTS,
+            auth.wire_sent, auth.zlib_sent, auth.zlib_time, auth.wire_received)
+
+    if cpu_before is not None and cpu_after is not None:
+        print "Gabble used %.2fs of CPU logging in" % (cpu_after - cpu_before)
+
+if __name__ == '__main__':
+    exec_test(login, authenticator=ByteCountingAuthenticator(),
+        do_connect=False)
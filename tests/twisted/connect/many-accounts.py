@@ -0,0 +1,115 @@
+"""
+Measure how well one Gabble process copes with lots of accounts at once.
+
+For each number of accounts in GABBLE_MANY_ACCOUNTS_BENCHMARK_ACCOUNTS
+(1 and 10 by default; try 1,10,100,500 for a real benchmark), this connects
+them all to the fake server, where each has
+GABBLE_MANY_ACCOUNTS_BENCHMARK_ROSTER (10 by default) of the others on its
+roster. Then every account changes its presence, round after
+round, which the server passes on to its contacts' accounts. It reports how
+much memory Gabble needs per account, how long the server waits for Gabble to
+answer a ping while all that's going on, and how much CPU time it uses.
+"""
+
+import os
+import time
+
+from gabbletest import (
+    exec_test, expect_connected, elem_iq, elem, sync_stream, gabble_pid,
+    gabble_rss,
+    )
+from servicetest import call_async, sync_dbus
+import constants as cs
+import ns
+
+ACCOUNTS = [int(n) for n in os.environ.get(
+    'GABBLE_MANY_ACCOUNTS_BENCHMARK_ACCOUNTS', '1,10').split(',')]
+ROSTER_SIZE = int(os.environ.get(
+    'GABBLE_MANY_ACCOUNTS_BENCHMARK_ROSTER', '10'))
+ROUNDS = int(os.environ.get('GABBLE_MANY_ACCOUNTS_BENCHMARK_ROUNDS', '5'))
+
+# How many accounts we ping in each round
+PINGS = 10
+
+def gabble_cpu_time(bus, conn):
+    try:
+        # The process name is in brackets, and might have spaces in it
+        stat = open('/proc/%d/stat' % gabble_pid(bus, conn)).read()
+        fields = stat[stat.rindex(')') + 2:].split()
+        utime, stime = int(fields[11]), int(fields[12])
+        return (utime + stime) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, ValueError, IndexError, OSError):
+        return 0
+
+def ping(q, stream):
+    """Returns how long Gabble takes to answer a ping from the server"""
+    iq = elem_iq(stream, 'get')(elem(ns.PING, 'ping')())
+    start = time.time()
+    stream.send(iq)
+
+    # If it doesn't understand, it says so; either way, it's a round trip
+    # through its main loop.
+    q.expect('stream-iq', iq_id=iq['id'],
+        predicate=lambda e: e.iq_type in ('result', 'error'))
+    return time.time() - start
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def test(q, bus, conns, streams):
+    # With only one account, we're given it rather than a list
+    if not isinstance(conns, list):
+        conns, streams = [conns], [streams]
+
+    n = len(conns)
+    # The server gives everyone as many neighbours on each side
+    contacts = 2 * min(ROSTER_SIZE / 2, (n - 1) / 2)
+    rss_before = gabble_rss(bus, conns[0])
+
+    start = time.time()
+
+    for conn in conns:
+        conn.Connect()
+        expect_connected(q)
+
+    # Everyone has fetched their roster, so everyone's contacts know they're
+    # online.
+    for conn in conns:
+        while conn.Properties.Get(cs.CONN_IFACE_CONTACT_LIST,
+                'ContactListState') != cs.CONTACT_LIST_STATE_SUCCESS:
+            sync_dbus(bus, q, conn)
+
+    for stream in streams:
+        sync_stream(q, stream)
+
+    connected = time.time() - start
+    rss = (gabble_rss(bus, conns[0]) - rss_before) / float(n)
+
+    pinged = streams[::max(1, n / PINGS)]
+    rtts = []
+    cpu_before = gabble_cpu_time(bus, conns[0])
+
+    for i in range(ROUNDS):
+        for conn in conns:
+            call_async(q, conn.SimplePresence, 'SetPresence',
+                ['away', 'available'][i % 2], 'round %d' % i)
+
+        rtts += [ping(q, stream) for stream in pinged]
+        sync_dbus(bus, q, conns[0])
+
+    for stream in streams:
+        sync_stream(q, stream)
+
+    cpu = (gabble_cpu_time(bus, conns[0]) - cpu_before) / (n * ROUNDS)
+
+    print "%d accounts with %d contacts each: connected in %.2fs, " \
+        "%.0f KiB each; while changing presence, ping round trip median " \
+        "%.3fs, worst %.3fs, %.2fms CPU per account per change" % (n,
+            contacts, connected, rss, median(rtts), max(rtts),
+            cpu * 1000)
+
+if __name__ == '__main__':
+    for n in ACCOUNTS:
+        exec_test(test, num_instances=n, do_connect=False,
+            roster_size=ROSTER_SIZE)
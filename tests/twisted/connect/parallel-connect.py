@@ -0,0 +1,189 @@
+"""
+Test the parallel-connect parameter: Gabble should ask for the privacy lists
+alongside the server's features, and for the roster as soon as it knows what
+the server supports, rather than one after another; but nothing it finds out
+early should reach clients before the connection is connected.
+
+Also measures how much sooner we're connected, and have the roster, with the
+server a round trip of GABBLE_CONNECT_BENCHMARK_RTT seconds away: asking for
+the privacy lists alongside the server's features should save at least one
+round trip on each. Timers make that too noisy to check on every run, so it's
+only asserted if GABBLE_CONNECT_BENCHMARK_ASSERT is set.
+"""
+
+import os
+import time
+
+from gabbletest import (
+    exec_test, make_result_iq, send_error_reply, sync_stream, elem, elem_iq,
+    XmppXmlStream,
+    )
+from servicetest import EventPattern, assertEquals, assertContains
+import constants as cs
+import ns
+
+BENCHMARK_RTT = float(os.environ.get('GABBLE_CONNECT_BENCHMARK_RTT', '0.1'))
+BENCHMARK_ASSERT = 'GABBLE_CONNECT_BENCHMARK_ASSERT' in os.environ
+
+# How far short of a whole round trip the saving may fall, in seconds, to
+# allow for the timers in the two runs not firing exactly on time
+TIMER_SLOP = 0.01
+
+class SlowServer(XmppXmlStream):
+    """Leaves the test to answer disco and privacy list requests"""
+    handle_privacy_lists = False
+
+    def _cb_disco_iq(self, iq):
+        pass
+
+class FarAwayServer(XmppXmlStream):
+    rtt = BENCHMARK_RTT
+
+# (connected, got the roster, bound), in seconds after Connect(), for each
+# time connect_and_time() runs
+times = []
+
+def test(q, bus, conn, stream):
+    roster_requests = []
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.ROSTER,
+        roster_requests.append)
+
+    contacts_changed = []
+    bus.add_signal_receiver(lambda *args: contacts_changed.append(args),
+        signal_name='ContactsChangedWithID',
+        dbus_interface=cs.CONN_IFACE_CONTACT_LIST, path=conn.object_path)
+
+    conn.Connect()
+
+    # We ask for the privacy lists before we know whether we'll need them...
+    disco, privacy = q.expect_many(
+        EventPattern('stream-iq', to='localhost', query_ns=ns.DISCO_INFO),
+        EventPattern('stream-iq', query_ns=ns.PRIVACY, iq_type='get'))
+
+    # ...and for the roster as soon as we know what the server supports,
+    # which decides what we ask for.
+    sync_stream(q, stream)
+    assertEquals([], roster_requests)
+    stream.send(make_result_iq(stream, disco.stanza))
+    roster = q.expect('stream-iq', query_ns=ns.ROSTER, iq_type='get')
+
+    # The roster, and a push after it, turn up while we're still waiting for
+    # the privacy lists.
+    result = make_result_iq(stream, roster.stanza)
+    result.firstChildElement().addChild(
+        elem('item', jid='amy@foo.com', subscription='both')())
+    stream.send(result)
+
+    push = elem_iq(stream, 'set', id='push-1')(
+        elem(ns.ROSTER, 'query')(
+            elem('item', jid='bob@foo.com', subscription='to')()))
+    stream.send(push)
+    sync_stream(q, stream)
+
+    # Clients don't hear about them yet.
+    assertEquals(cs.CONN_STATUS_CONNECTING,
+        conn.Properties.Get(cs.CONN, 'Status'))
+    assertEquals([], contacts_changed)
+
+    # Once we know how to be invisible, we're connected, and they do.
+    send_error_reply(stream, privacy.stanza)
+    q.expect_many(
+        EventPattern('dbus-signal', signal='StatusChanged',
+            args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED]),
+        EventPattern('stream-iq', iq_type='result', iq_id='push-1'),
+        EventPattern('dbus-signal', signal='ContactListStateChanged',
+            args=[cs.CONTACT_LIST_STATE_SUCCESS]))
+
+    attrs = conn.ContactList.GetContactListAttributes([], False)
+    ids = [a[cs.CONN + '/contact-id'] for a in attrs.values()]
+    assertEquals(['amy@foo.com', 'bob@foo.com'], sorted(ids))
+
+    # We didn't ask for the roster again once we were connected.
+    sync_stream(q, stream)
+    assertEquals(1, len(roster_requests))
+
+def test_serial(q, bus, conn, stream):
+    privacy_requests = []
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.PRIVACY,
+        privacy_requests.append)
+    roster_requests = []
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.ROSTER,
+        roster_requests.append)
+
+    conn.Connect()
+
+    # Without parallel-connect, nothing else is asked for until the server
+    # has told us what it supports...
+    disco = q.expect('stream-iq', to='localhost', query_ns=ns.DISCO_INFO)
+    sync_stream(q, stream)
+    assertEquals([], privacy_requests)
+    assertEquals([], roster_requests)
+
+    # ...and the roster not until we're connected.
+    stream.send(make_result_iq(stream, disco.stanza))
+    privacy = q.expect('stream-iq', query_ns=ns.PRIVACY, iq_type='get')
+    sync_stream(q, stream)
+    assertEquals([], roster_requests)
+
+    send_error_reply(stream, privacy.stanza)
+    q.expect_many(
+        EventPattern('dbus-signal', signal='StatusChanged',
+            args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED]),
+        EventPattern('stream-iq', query_ns=ns.ROSTER, iq_type='get'))
+
+def connect_and_time(q, bus, conn, stream):
+    def answer_roster(iq):
+        stream.send(make_result_iq(stream, iq))
+
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.ROSTER,
+        answer_roster)
+
+    start = time.time()
+    conn.Connect()
+
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+    connected_after = time.time() - start
+
+    q.expect('dbus-signal', signal='ContactListStateChanged',
+        args=[cs.CONTACT_LIST_STATE_SUCCESS])
+    roster_after = time.time() - start
+
+    phases = conn.Get(cs.CONN_IFACE_GABBLE_DEBUG, 'ConnectionPhases',
+        dbus_interface=cs.PROPERTIES_IFACE)
+    phases = dict(phases)
+    assertContains('bound', phases)
+
+    times.append((connected_after, roster_after, phases['bound'] / 1000000.0))
+
+if __name__ == '__main__':
+    exec_test(test, params={'parallel-connect': True}, protocol=SlowServer,
+        do_connect=False)
+    exec_test(test_serial, params={'parallel-connect': False},
+        protocol=SlowServer, do_connect=False)
+
+    for parallel in [False, True]:
+        exec_test(connect_and_time, params={'parallel-connect': parallel},
+            protocol=FarAwayServer, do_connect=False)
+
+    for (connected, roster, bound), mode in zip(times,
+            ['one at a time', 'parallel']):
+        print ("%s: connected %.2f RTTs and roster %.2f RTTs after binding "
+            "(RTT %.3fs)" % (mode, (connected - bound) / BENCHMARK_RTT,
+                (roster - bound) / BENCHMARK_RTT, BENCHMARK_RTT))
+
+    if BENCHMARK_ASSERT:
+        # Measure from binding, which both runs reach after the same number
+        # of round trips, so that only what parallel-connect changes counts.
+        (serial_connected, serial_roster, serial_bound), \
+            (parallel_connected, parallel_roster, parallel_bound) = times
+
+        connected_saved = ((serial_connected - serial_bound) -
+            (parallel_connected - parallel_bound))
+        roster_saved = ((serial_roster - serial_bound) -
+            (parallel_roster - parallel_bound))
+
+        assert connected_saved >= BENCHMARK_RTT - TIMER_SLOP, \
+            (connected_saved, BENCHMARK_RTT)
+        assert roster_saved >= BENCHMARK_RTT - TIMER_SLOP, \
+            (roster_saved, BENCHMARK_RTT)
@@ -0,0 +1,90 @@
+"""
+Test XEP-0198 stream management: if the server supports it, Gabble should
+enable it, answer the server's requests for acknowledgement, and ask the
+server every few stanzas which of its own have arrived.
+"""
+
+from gabbletest import (
+    exec_test, sync_stream, elem, make_presence,
+    StreamManagementAuthenticator,
+    )
+from servicetest import assertEquals
+import constants as cs
+import ns
+
+# How many stanzas Gabble sends before asking for an acknowledgement
+ACK_REQUEST_INTERVAL = 5
+
+def set_presences(conn, n):
+    for i in range(n):
+        conn.SimplePresence.SetPresence(['away', 'available'][i % 2],
+            'stanza %d' % i)
+
+def test_enabled(q, bus, conn, stream):
+    auth = stream.authenticator
+    assert auth.enabled
+
+    # The server asks how much Gabble has had from it, and hears the truth.
+    sync_stream(q, stream)
+    h = auth.request_ack()
+    e = q.expect('sm-ack')
+    assertEquals(h, e.h)
+
+    # And again, having sent some more.
+    sync_stream(q, stream)
+    sync_stream(q, stream)
+    h = auth.request_ack()
+    e = q.expect('sm-ack')
+    assertEquals(h, e.h)
+
+    # Stanzas from contacts count too, not just those from the server.
+    before = e.h
+    stream.send(elem('message', attrs={'from': 'bob@foo.com/Bob',
+        'type': 'chat'})(elem('body')(u'hello')))
+    stream.send(make_presence('bob@foo.com/Bob', status='here'))
+    sync_stream(q, stream)
+    h = auth.request_ack()
+    e = q.expect('sm-ack')
+    assertEquals(h, e.h)
+    # the message, the presence, and sync_stream()'s ping
+    assertEquals(before + 3, e.h)
+
+    # Gabble asks the server how much it has had once it has sent a few
+    # stanzas.
+    set_presences(conn, ACK_REQUEST_INTERVAL)
+    q.expect('sm-request')
+
+def test_refused(q, bus, conn, stream):
+    auth = stream.authenticator
+    assert not auth.enabled
+
+    nonzas = []
+    stream.addObserver("/r[@xmlns='%s']" % ns.SM, nonzas.append)
+    stream.addObserver("/a[@xmlns='%s']" % ns.SM, nonzas.append)
+
+    # The server doesn't do stream management after all, so Gabble neither
+    # answers <r/> nor asks for acknowledgement itself.
+    stream.send(elem(ns.SM, 'r')())
+    set_presences(conn, ACK_REQUEST_INTERVAL * 2)
+    sync_stream(q, stream)
+
+    assertEquals([], nonzas)
+
+def test_unsupported(q, bus, conn, stream):
+    enables = []
+    stream.addObserver("/enable[@xmlns='%s']" % ns.SM, enables.append)
+
+    conn.Connect()
+    q.expect('dbus-signal', signal='StatusChanged',
+        args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED])
+    sync_stream(q, stream)
+
+    # The server didn't say it supports stream management, so Gabble doesn't
+    # try to enable it.
+    assertEquals([], enables)
+
+if __name__ == '__main__':
+    exec_test(test_enabled, authenticator=StreamManagementAuthenticator())
+    exec_test(test_refused,
+        authenticator=StreamManagementAuthenticator(refuse=True))
+    exec_test(test_unsupported, do_connect=False)
@@ -2,23 +2,150 @@
 This test does nothing besides connect, and then disconnect as soon as the
 session is established, two thousand times. It was used to smoke out a bug
 where connections were leaked (which ultimately meant that new connections
-could not be established, since the file descriptors were leaked too); it may
-also be useful for profiling the connection process (and test framework).
+could not be established, since the file descriptors were leaked too).
+
+It also profiles the connection process: each time round, it notes when each
+step of setting up the stream reaches the server, and asks Gabble when it
+finished each phase of connecting (ConnectionPhases). At the end it prints
+percentiles for each, and writes every sample as JSON to $TORTURE_JSON if
+that's set.
 """
-from gabbletest import exec_test
+from gabbletest import exec_test, XmppAuthenticator, make_result_iq, sync_stream
+from servicetest import EventPattern
+import constants as cs
+import ns
+
+import json
 import os
+import time
 
 if os.environ.get('REALLY_TORTURE', '') != 'yes':
     raise SystemExit(77)
 
+ITERATIONS = int(os.environ.get('TORTURE_ITERATIONS', '2000'))
+PERCENTILES = [50, 90, 99]
+
+# phase => [milliseconds after Connect(), one per iteration]
+server_phases = {}
+gabble_phases = {}
+
+class TimingAuthenticator(XmppAuthenticator):
+    """Notes when each step of setting up the stream reaches the server"""
+
+    def __init__(self):
+        XmppAuthenticator.__init__(self, 'test', 'pass')
+        self.times = {}
+
+    def mark(self, phase):
+        if phase not in self.times:
+            self.times[phase] = time.time()
+
+    def streamStarted(self, root=None):
+        if self.authenticated:
+            self.mark('stream-restarted')
+        else:
+            self.mark('stream-started')
+
+        XmppAuthenticator.streamStarted(self, root)
+
+    def auth(self, auth):
+        self.mark('sasl-auth')
+        XmppAuthenticator.auth(self, auth)
+
+    def bindIq(self, iq):
+        self.mark('bind')
+        XmppAuthenticator.bindIq(self, iq)
+
+    def sessionIq(self, iq):
+        self.mark('session')
+        XmppAuthenticator.sessionIq(self, iq)
+
+def record(phases, phase, ms):
+    phases.setdefault(phase, []).append(ms)
+
 def test(q, bus, conn, stream):
-    pass
+    auth = stream.authenticator
+
+    for phase, path in [
+            ('disco-request', "/iq[@to='localhost']/query[@xmlns='%s']"
+                % ns.DISCO_INFO),
+            ('privacy-lists-request', "/iq/query[@xmlns='%s']" % ns.PRIVACY),
+            ('roster-request', "/iq[@type='get']/query[@xmlns='%s']"
+                % ns.ROSTER),
+            ]:
+        stream.addObserver(path, lambda _, phase=phase: auth.mark(phase))
+
+    start = time.time()
+    conn.Connect()
+
+    _, e = q.expect_many(
+        EventPattern('dbus-signal', signal='StatusChanged',
+            args=[cs.CONN_STATUS_CONNECTED, cs.CSR_REQUESTED]),
+        EventPattern('stream-iq', query_ns=ns.ROSTER, iq_type='get'))
+    stream.send(make_result_iq(stream, e.stanza))
+    sync_stream(q, stream)
+
+    for phase, t in auth.times.items():
+        record(server_phases, phase, (t - start) * 1000)
+
+    phases = conn.Get(cs.CONN_IFACE_GABBLE_DEBUG, 'ConnectionPhases',
+        dbus_interface=cs.PROPERTIES_IFACE)
+    for phase, usec in phases:
+        record(gabble_phases, str(phase), usec / 1000.0)
+
+def percentile(samples, p):
+    """Linearly interpolated, as numpy does it by default"""
+    k = (len(samples) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (k - lower)
+
+def summarize(phases):
+    summary = {}
+
+    for phase, samples in phases.items():
+        samples = sorted(samples)
+        summary[phase] = dict(('p%d' % p, percentile(samples, p))
+            for p in PERCENTILES)
+        summary[phase]['max'] = samples[-1]
+        summary[phase]['n'] = len(samples)
+
+    return summary
+
+def print_table(title, summary):
+    columns = ['p%d' % p for p in PERCENTILES] + ['max']
+
+    print
+    print "%-24s" % title + ''.join(['%9s' % c for c in columns]) + '%7s' % 'n'
+
+    for phase in sorted(summary, key=lambda phase: summary[phase]['p50']):
+        row = summary[phase]
+        print "%-24s" % phase + \
+            ''.join(['%9.1f' % row[c] for c in columns]) + '%7d' % row['n']
 
 def main():
-    for i in xrange(0, 2000):
-        print i
-        exec_test(test)
+    for i in xrange(0, ITERATIONS):
+        if i % 100 == 0:
+            print i
+        exec_test(test, authenticator=TimingAuthenticator(), do_connect=False)
     print "we partied like it's %i" % i
 
+    server = summarize(server_phases)
+    gabble = summarize(gabble_phases)
+
+    print_table('server saw (ms)', server)
+    print_table('Gabble finished (ms)', gabble)
+
+    path = os.environ.get('TORTURE_JSON')
+    if path:
+        f = open(path, 'w')
+        json.dump({ 'iterations': ITERATIONS,
+                    'server': { 'summary': server, 'samples': server_phases },
+                    'gabble': { 'summary': gabble, 'samples': gabble_phases },
+                  }, f, indent=2, sort_keys=True)
+        f.close()
+        print
+        print "wrote samples to %s" % path
+
 if __name__ == '__main__':
     main()
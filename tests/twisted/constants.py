@@ -209,7 +209,9 @@ CONN_IFACE_SIDECARS1 = CONN + '.Interface.Sidecars1'
 CONN_IFACE_SIMPLE_PRESENCE = CONN + '.Interface.SimplePresence'
 CONN_IFACE_REQUESTS = CONN + '.Interface.Requests'
 CONN_IFACE_LOCATION = CONN + '.Interface.Location'
+CONN_IFACE_GABBLE_DEBUG = CONN + '.Interface.Gabble.Debug'
 CONN_IFACE_GABBLE_DECLOAK = CONN + '.Interface.Gabble.Decloak'
+CONN_IFACE_GABBLE_FT_PROGRESS = CONN + '.Interface.Gabble.FileTransferProgress'
 CONN_IFACE_MAIL_NOTIFICATION = CONN + '.Interface.MailNotification'
 CONN_IFACE_CONTACT_LIST = CONN + '.Interface.ContactList'
 CONN_IFACE_CONTACT_GROUPS = CONN + '.Interface.ContactGroups'
@@ -0,0 +1,86 @@
+"""
+Test and time GetContactAttributes for a big roster with every interface
+requested at once.
+
+The roster has GABBLE_CONTACT_ATTRIBUTES_BENCHMARK_CONTACTS contacts (500 by
+default; try 10000 for a real benchmark), a quarter of them online, and the
+call is made GABBLE_CONTACT_ATTRIBUTES_BENCHMARK_ROUNDS times (2 by default).
+"""
+
+import os
+import time
+
+from gabbletest import exec_test, make_presence, sync_stream, gabble_rss
+from servicetest import assertContains, assertEquals, assertLength, sync_dbus
+import constants as cs
+import ns
+
+CONTACTS = int(os.environ.get('GABBLE_CONTACT_ATTRIBUTES_BENCHMARK_CONTACTS',
+    '500'))
+ONLINE = CONTACTS / 4
+ROUNDS = int(os.environ.get('GABBLE_CONTACT_ATTRIBUTES_BENCHMARK_ROUNDS',
+    '2'))
+
+def jid(i):
+    return 'contact%d@example.com' % i
+
+def test(q, bus, conn, stream):
+    event = q.expect('stream-iq', query_ns=ns.ROSTER)
+    event.stanza['type'] = 'result'
+
+    for i in range(CONTACTS):
+        item = event.query.addElement('item')
+        item['jid'] = jid(i)
+        item['name'] = 'Contact %d' % i
+        item['subscription'] = 'both'
+
+    stream.send(event.stanza)
+    q.expect('dbus-signal', signal='ContactListStateChanged',
+        args=[cs.CONTACT_LIST_STATE_SUCCESS])
+
+    for i in range(ONLINE):
+        stream.send(make_presence(jid(i) + '/Resource', show='away',
+            status='contact %d' % i, photo='%040x' % i))
+
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+
+    handles = conn.ContactList.GetContactListAttributes([], False).keys()
+    assertLength(CONTACTS, handles)
+
+    interfaces = conn.Properties.Get(cs.CONN_IFACE_CONTACTS,
+        'ContactAttributeInterfaces')
+    timings = []
+    rss_before = gabble_rss(bus, conn)
+
+    for _ in range(ROUNDS):
+        start = time.time()
+        attrs = conn.Contacts.GetContactAttributes(handles, interfaces, False)
+        timings.append(time.time() - start)
+
+    rss_after = gabble_rss(bus, conn)
+
+    assertLength(CONTACTS, attrs)
+
+    for h, a in attrs.iteritems():
+        i = int(a[cs.CONN + '/contact-id'][len('contact'):].split('@')[0])
+
+        if i < ONLINE:
+            assertEquals((cs.PRESENCE_AWAY, 'away', 'contact %d' % i),
+                a[cs.ATTR_PRESENCE])
+            assertEquals('%040x' % i, a[cs.CONN_IFACE_AVATARS + '/token'])
+        else:
+            assertEquals(cs.PRESENCE_OFFLINE, a[cs.ATTR_PRESENCE][0])
+
+        assertContains('xmpp:' + jid(i),
+            a[cs.CONN_IFACE_ADDRESSING + '/uris'])
+        assert cs.ATTR_CONTACT_CAPABILITIES in a, a
+
+    timings.sort()
+    print "%d contacts, %d interfaces: best %.3fs, median %.3fs, " \
+        "Gabble grew by %d KiB over %d calls" % (CONTACTS, len(interfaces),
+            timings[0], timings[len(timings) / 2], rss_after - rss_before,
+            ROUNDS)
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -5,7 +5,10 @@ import time
 import datetime
 import os
 
-from servicetest import EventPattern, assertEquals, assertSameSets, call_async
+from servicetest import (
+    EventPattern, assertEquals, assertSameSets, call_async,
+    EventProtocolClientFactory,
+    )
 from gabbletest import exec_test, sync_stream, make_result_iq
 import ns
 from bytestream import create_from_si_offer, announce_socks5_proxy
@@ -14,6 +17,7 @@ import bytestream
 from caps_helper import extract_data_forms, add_data_forms
 
 from twisted.words.xish import domish, xpath
+from twisted.internet import reactor
 
 import constants as cs
 
@@ -42,9 +46,45 @@ class File(object):
         self.uri = 'file:///tmp/%s' % self.name
 
     def compute_hash(self, hash_type):
-        assert hash_type == cs.FILE_HASH_TYPE_MD5
+        assert hash_type in [cs.FILE_HASH_TYPE_MD5, cs.FILE_HASH_TYPE_NONE]
         self.hash_type = hash_type
-        self.hash = hashlib.md5(self.data).hexdigest()
+
+        if hash_type == cs.FILE_HASH_TYPE_NONE:
+            self.hash = ''
+            return
+
+        md5 = hashlib.md5()
+        for chunk in self.chunks():
+            md5.update(chunk)
+        self.hash = md5.hexdigest()
+
+    def chunks(self, offset=0):
+        """Yields the file's contents from @offset onwards, in pieces."""
+        yield self.data[offset:]
+
+class LargeFile(File):
+    """
+    A file too big to keep in memory: @megabytes MB of the same pseudo-random
+    looking MB over and over. self.data is just that first MB.
+    """
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, megabytes, name='large.bin', hash_type=cs.FILE_HASH_TYPE_MD5):
+        self.megabytes = megabytes
+        block = ''.join([chr((i * 7 + i / 251) % 256)
+            for i in range(self.BLOCK_SIZE)])
+
+        File.__init__(self, data=block, name=name,
+            content_type='application/octet-stream',
+            description='%d MB of not much' % megabytes, hash_type=hash_type)
+        self.size = megabytes * self.BLOCK_SIZE
+
+    def chunks(self, offset=0):
+        first, skip = divmod(offset, self.BLOCK_SIZE)
+
+        for i in range(first, self.megabytes):
+            yield self.data[skip:]
+            skip = 0
 
 class FileTransferTest(object):
     CONTACT_NAME = 'test-ft@localhost'
@@ -159,6 +199,8 @@ class FileTransferTest(object):
             assert False
 
 class ReceiveFileTest(FileTransferTest):
+    stream_id = 'alpha'
+
     def __init__(self, bytestream_cls, file, address_type, access_control, access_control_param):
         FileTransferTest.__init__(self, bytestream_cls, file, address_type, access_control, access_control_param)
 
@@ -168,8 +210,9 @@ class ReceiveFileTest(FileTransferTest):
             self.receive_file, self.close_channel, self.done]
 
     def send_ft_offer_iq(self):
-        self.bytestream = self.bytestream_cls(self.stream, self.q, 'alpha',
-            self.contact_full_jid, 'test@localhost/Resource', True)
+        self.bytestream = self.bytestream_cls(self.stream, self.q,
+            self.stream_id, self.contact_full_jid, 'test@localhost/Resource',
+            True)
 
         iq, si = self.bytestream.create_si_offer(ns.FILE_TRANSFER)
 
@@ -177,7 +220,8 @@ class ReceiveFileTest(FileTransferTest):
         file_node['name'] = self.file.name
         file_node['size'] = str(self.file.size)
         file_node['mime-type'] = self.file.content_type
-        file_node['hash'] = self.file.hash
+        if self.file.hash:
+            file_node['hash'] = self.file.hash
         date = datetime.datetime.utcfromtimestamp(self.file.date).strftime('%FT%H:%M:%SZ')
         file_node['date'] = date
 
@@ -234,7 +278,7 @@ class ReceiveFileTest(FileTransferTest):
         assert props[cs.FT_FILENAME] == self.file.name
         assert props[cs.FT_SIZE] == self.file.size
         # FT's protocol doesn't allow us the send the hash info
-        assert props[cs.FT_CONTENT_HASH_TYPE] == cs.FILE_HASH_TYPE_MD5
+        assert props[cs.FT_CONTENT_HASH_TYPE] == self.file.hash_type
         assert props[cs.FT_CONTENT_HASH] == self.file.hash
         assert props[cs.FT_DESCRIPTION] == self.file.description
         assert props[cs.FT_DATE] == self.file.date
@@ -355,6 +399,59 @@ class ReceiveFileTest(FileTransferTest):
         assert state == cs.FT_STATE_COMPLETED
         assert reason == cs.FT_STATE_CHANGE_REASON_NONE
 
+class ReceiveLargeFileTest(ReceiveFileTest):
+    """
+    Receives a LargeFile, keeping at most @window MB in flight between the
+    sender and our end of Gabble's socket, and checks it all arrives intact.
+    Afterwards self.elapsed is how long that took.
+    """
+    window = 4
+
+    def receive_file(self):
+        factory = EventProtocolClientFactory(self.q)
+
+        if self.address_type == cs.SOCKET_ADDRESS_TYPE_UNIX:
+            reactor.connectUNIX(str(self.address), factory)
+        else:
+            ip, port = self.address
+            reactor.connectTCP(str(ip), port, factory)
+
+        e = self.q.expect('socket-connected')
+        protocol = e.protocol
+
+        # accept_file already sent the first two bytes
+        sent = self.file.offset + 2
+        chunks = self.file.chunks(sent)
+        to_receive = self.file.size - self.file.offset
+        received = 0
+        expected = hashlib.md5(self.file.data[self.file.offset:sent])
+        got = hashlib.md5()
+        window = self.window * LargeFile.BLOCK_SIZE
+
+        start = time.time()
+
+        while received < to_receive:
+            while sent < self.file.size and \
+                    sent - self.file.offset - received < window:
+                chunk = chunks.next()
+                expected.update(chunk)
+                self.bytestream.send_data(chunk)
+                sent += len(chunk)
+
+            e = self.q.expect('socket-data', protocol=protocol)
+            got.update(e.data)
+            received += len(e.data)
+
+        self.elapsed = time.time() - start
+
+        assertEquals(to_receive, received)
+        assertEquals(expected.hexdigest(), got.hexdigest())
+
+        # The state change may well have gone past while we were waiting
+        # for data.
+        state = self.ft_props.Get(cs.CHANNEL_TYPE_FILE_TRANSFER, 'State')
+        assertEquals(cs.FT_STATE_COMPLETED, state)
+
 class SendFileTest(FileTransferTest):
     def __init__(self, bytestream_cls, file, address_type, access_control, acces_control_param):
         FileTransferTest.__init__(self, bytestream_cls, file, address_type, access_control, acces_control_param)
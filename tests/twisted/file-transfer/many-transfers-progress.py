@@ -0,0 +1,139 @@
+"""
+Test progress reporting with lots of file transfers going on at once: in
+adaptive mode, Gabble should emit far fewer TransferredBytesChanged signals
+than one per transfer per second, and the connection should add up the
+transfers' progress for us.
+"""
+
+import constants as cs
+from bytestream import BytestreamS5B
+from gabbletest import exec_test
+from servicetest import (
+    assertEquals, Event, EventProtocolClientFactory,
+    )
+from file_transfer_helper import File, ReceiveFileTest
+
+from twisted.internet import reactor
+
+from config import FILE_TRANSFER_ENABLED
+
+if not FILE_TRANSFER_ENABLED:
+    print "NOTE: built with --disable-file-transfer"
+    raise SystemExit(77)
+
+TRANSFERS = 20
+ROUNDS = 80
+CHUNK_SIZE = 16 * 1024
+TICK = 0.05
+
+# ReceiveFileTest.accept_file sends the first two bytes
+SIZE = 2 + ROUNDS * CHUNK_SIZE
+
+SOCKET = (cs.SOCKET_ADDRESS_TYPE_UNIX, cs.SOCKET_ACCESS_CONTROL_LOCALHOST, "")
+
+signals = {}
+
+def wait(q):
+    reactor.callLater(TICK, q.append, Event('tick'))
+    q.expect('tick')
+
+def get_progress(conn):
+    props = conn.GetAll(cs.CONN_IFACE_GABBLE_FT_PROGRESS,
+        dbus_interface=cs.PROPERTIES_IFACE)
+    return (props['ActiveTransfers'], props['TransferredBytes'],
+        props['TotalBytes'])
+
+def start_transfers(q, bus, conn, stream):
+    transfers = []
+
+    for i in range(TRANSFERS):
+        file = File(data='x' * SIZE, name='file%d.txt' % i)
+        transfer = ReceiveFileTest(BytestreamS5B, file, *SOCKET)
+        transfer.stream_id = 'transfer%d' % i
+        transfer.q = q
+        transfer.bus = bus
+        transfer.conn = conn
+        transfer.stream = stream
+
+        if transfers:
+            first = transfers[0]
+            transfer.contact_name = first.contact_name
+            transfer.contact_full_jid = first.contact_full_jid
+            transfer.handle = first.handle
+        else:
+            transfer.connect()
+            transfer.announce_contact()
+
+        transfer.send_ft_offer_iq()
+        transfer.check_new_channel()
+        transfer.create_ft_channel()
+        transfer.accept_file()
+        transfers.append(transfer)
+
+    for transfer in transfers:
+        reactor.connectUNIX(str(transfer.address),
+            EventProtocolClientFactory(q))
+        q.expect('socket-connected')
+
+    return transfers
+
+def test(q, bus, conn, stream, adaptive):
+    conn.Set(cs.CONN_IFACE_GABBLE_FT_PROGRESS, 'AdaptiveProgress', adaptive,
+        dbus_interface=cs.PROPERTIES_IFACE)
+
+    count = [0]
+
+    def transferred_bytes_changed(*args):
+        count[0] += 1
+
+    bus.add_signal_receiver(transferred_bytes_changed,
+        signal_name='TransferredBytesChanged',
+        dbus_interface=cs.CHANNEL_TYPE_FILE_TRANSFER)
+
+    transfers = start_transfers(q, bus, conn, stream)
+
+    # Everyone trickles their file through at the same time
+    for i in range(ROUNDS):
+        for transfer in transfers:
+            start = 2 + i * CHUNK_SIZE
+            transfer.bytestream.send_data(
+                transfer.file.data[start:start + CHUNK_SIZE])
+
+        wait(q)
+
+        if i == ROUNDS / 2:
+            active, transferred, total = get_progress(conn)
+            assertEquals(TRANSFERS, active)
+            assertEquals(TRANSFERS * SIZE, total)
+            assert 0 < transferred < total, (transferred, total)
+
+    # Gabble checks every file against its MD5 before saying it's complete
+    for transfer in transfers:
+        while transfer.ft_props.Get(cs.CHANNEL_TYPE_FILE_TRANSFER,
+                'State') != cs.FT_STATE_COMPLETED:
+            wait(q)
+
+    assertEquals((0, 0, 0), get_progress(conn))
+
+    bus.remove_signal_receiver(transferred_bytes_changed,
+        signal_name='TransferredBytesChanged',
+        dbus_interface=cs.CHANNEL_TYPE_FILE_TRANSFER)
+    signals[adaptive] = count[0]
+
+if __name__ == '__main__':
+    duration = ROUNDS * TICK
+
+    for adaptive in [False, True]:
+        exec_test(lambda q, bus, conn, stream:
+            test(q, bus, conn, stream, adaptive))
+
+    # Once a second each, and once more when they finish
+    assert signals[False] >= TRANSFERS * 2, signals
+
+    # Each transfer reports progress once at the start and once at the end,
+    # and the connection as a whole aims for a few more a second in between.
+    assert signals[True] < signals[False], signals
+    assert signals[True] <= TRANSFERS * 2 + 4 * duration * 2, signals
+
+    print "%d transfers over %.1fs: %d progress signals at once a second, " \
+        "%d adaptive" % (TRANSFERS, duration, signals[False], signals[True])
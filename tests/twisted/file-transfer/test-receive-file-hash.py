@@ -0,0 +1,115 @@
+"""
+Test that Gabble checks the files it receives against the hash the sender
+gave, including the part we already had when resuming a transfer, and measure
+what doing so costs on large transfers.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import constants as cs
+from bytestream import BytestreamS5B, BytestreamIBBMsg
+from gabbletest import exec_test
+from file_transfer_helper import (
+    File, LargeFile, ReceiveFileTest, ReceiveLargeFileTest,
+    )
+
+from config import FILE_TRANSFER_ENABLED
+
+if not FILE_TRANSFER_ENABLED:
+    print "NOTE: built with --disable-file-transfer"
+    raise SystemExit(77)
+
+# The default just checks the large-file path works; set this to something in
+# the thousands to benchmark multi-GB transfers
+BENCHMARK_MB = int(os.environ.get('GABBLE_FT_BENCHMARK_MB', '4'))
+
+SOCKET = (cs.SOCKET_ADDRESS_TYPE_UNIX, cs.SOCKET_ACCESS_CONTROL_LOCALHOST, "")
+
+class ReceiveCorruptedFile(ReceiveFileTest):
+    def _read_file_from_socket(self, s):
+        self.q.expect('dbus-signal', signal='FileTransferStateChanged',
+            args=[cs.FT_STATE_CANCELLED, cs.FT_STATE_CHANGE_REASON_REMOTE_ERROR])
+
+        # Gabble hangs up on us rather than pretending it all went well
+        while s.recv(1024):
+            pass
+
+def write_prefix(file, prefix):
+    fd, path = tempfile.mkstemp(suffix='.part')
+    os.write(fd, prefix)
+    os.close(fd)
+
+    file.uri = 'file://' + path
+    file.offset = len(prefix)
+    return path
+
+def run(test_cls, file, bytestream_cls=BytestreamS5B):
+    test = test_cls(bytestream_cls, file, *SOCKET)
+    exec_test(test.test)
+    return test
+
+def test_hashes():
+    for bytestream_cls in [BytestreamS5B, BytestreamIBBMsg]:
+        # The right data arrives
+        run(ReceiveFileTest, File(), bytestream_cls)
+
+        # Nobody told us what the hash should be
+        run(ReceiveFileTest, File(hash_type=cs.FILE_HASH_TYPE_NONE),
+            bytestream_cls)
+
+        # Something else arrives
+        file = File()
+        file.hash = hashlib.md5('something else').hexdigest()
+        run(ReceiveCorruptedFile, file, bytestream_cls)
+
+def test_resume():
+    # We already have the first part of the file, so it's hashed along with
+    # the rest.
+    file = File()
+    path = write_prefix(file, file.data[:5])
+
+    try:
+        run(ReceiveFileTest, file)
+    finally:
+        os.remove(path)
+
+    # The part we already have isn't what the sender has.
+    file = File()
+    path = write_prefix(file, 'XXXXX')
+
+    try:
+        run(ReceiveCorruptedFile, file)
+    finally:
+        os.remove(path)
+
+    # The part we already have is much bigger than what's hashed at a time.
+    file = LargeFile(1)
+    prefix = file.data[:file.size / 2]
+    path = write_prefix(file, prefix)
+
+    try:
+        run(ReceiveLargeFileTest, file)
+    finally:
+        os.remove(path)
+
+def test_benchmark():
+    elapsed = {}
+
+    for hash_type in [cs.FILE_HASH_TYPE_NONE, cs.FILE_HASH_TYPE_MD5]:
+        test = run(ReceiveLargeFileTest,
+            LargeFile(BENCHMARK_MB, hash_type=hash_type))
+        elapsed[hash_type] = test.elapsed
+
+    plain = elapsed[cs.FILE_HASH_TYPE_NONE]
+    hashed = elapsed[cs.FILE_HASH_TYPE_MD5]
+
+    print "%d MB over SOCKS5: %.1f MB/s unverified, %.1f MB/s with MD5 " \
+        "(%+.1f%%)" % (BENCHMARK_MB, BENCHMARK_MB / plain,
+            BENCHMARK_MB / hashed, (hashed - plain) * 100 / plain)
+
+if __name__ == '__main__':
+    test_hashes()
+    test_resume()
+    test_benchmark()
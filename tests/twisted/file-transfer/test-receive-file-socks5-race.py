@@ -0,0 +1,49 @@
+"""
+Test that Gabble races the SOCKS5 streamhosts it is offered against each
+other rather than waiting for each one to fail before trying the next, and
+measure how long it takes to open the bytestream.
+"""
+
+import constants as cs
+from bytestream import (
+    BytestreamS5B, BytestreamS5BRelay, BytestreamS5BStalled,
+    BytestreamSIFallbackS5CannotConnect,
+    )
+from gabbletest import exec_test
+from file_transfer_helper import File, ReceiveFileTest
+
+from config import FILE_TRANSFER_ENABLED
+
+if not FILE_TRANSFER_ENABLED:
+    print "NOTE: built with --disable-file-transfer"
+    raise SystemExit(77)
+
+# This must match bytestream-socks5.c
+CONNECT_TIMEOUT = 10
+
+SOCKET = (cs.SOCKET_ADDRESS_TYPE_UNIX, cs.SOCKET_ACCESS_CONTROL_LOCALHOST, "")
+
+def run(bytestream_cls):
+    test = ReceiveFileTest(bytestream_cls, File(), *SOCKET)
+    exec_test(test.test)
+    return test.bytestream
+
+if __name__ == '__main__':
+    direct = run(BytestreamS5B)
+    relay = run(BytestreamS5BRelay)
+    stalled = run(BytestreamS5BStalled)
+    cannot_connect = run(BytestreamSIFallbackS5CannotConnect).socks5
+
+    # Gabble used the relay while still waiting for the initiator's own
+    # streamhost to say something, rather than waiting for it to time out...
+    assert stalled.open_time < CONNECT_TIMEOUT / 2, stalled.open_time
+
+    # ...and hung up on the initiator once it had.
+    types = [e.type for e in stalled.stalled_events]
+    assert types == ['s5b-stalled-connected', 's5b-stalled-connection-lost'], \
+        types
+
+    print "SOCKS5 time to open: direct %.3fs, relay %.3fs, " \
+        "relay with stalled streamhost %.3fs, giving up %.3fs" % (
+            direct.open_time, relay.open_time, stalled.open_time,
+            cannot_connect.open_time)
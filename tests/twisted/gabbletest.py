@@ -10,6 +10,8 @@ import sys
 import random
 import re
 import traceback
+import time
+import zlib
 
 import ns
 import constants as cs
@@ -86,6 +88,27 @@ def sync_stream(q, stream):
         predicate=(lambda event:
             event.stanza['id'] == id and event.iq_type == 'result'))
 
+def gabble_pid(bus, conn):
+    """Returns the process ID of the Gabble which owns conn"""
+    dbus_daemon = dbus.Interface(bus.get_object('org.freedesktop.DBus',
+        '/org/freedesktop/DBus'), 'org.freedesktop.DBus')
+    return dbus_daemon.GetConnectionUnixProcessID(conn.object.bus_name)
+
+def gabble_rss(bus, conn):
+    """
+    Returns how much memory the Gabble which owns conn is using, in KiB, or 0
+    if we can't tell (because we're not on Linux, for instance).
+    """
+    try:
+        for line in open('/proc/%d/status' % gabble_pid(bus, conn)):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+
+    # not Linux, or Gabble is running under something else
+    return 0
+
 class GabbleAuthenticator(xmlstream.Authenticator):
     def __init__(self, username, password, resource=None):
         self.username = username
@@ -180,6 +203,10 @@ class JabberAuthenticator(GabbleAuthenticator):
         self.xmlstream.dispatch(self.xmlstream, xmlstream.STREAM_AUTHD_EVENT)
 
 class XmppAuthenticator(GabbleAuthenticator):
+    # (namespace, name) pairs of extra elements to put in the post-auth
+    # <stream:features/>
+    extra_stream_features = []
+
     def __init__(self, username, password, resource=None):
         GabbleAuthenticator.__init__(self, username, password, resource)
         self.authenticated = False
@@ -201,6 +228,10 @@ class XmppAuthenticator(GabbleAuthenticator):
             elem(ns.NS_XMPP_BIND, 'bind'),
             elem(ns.NS_XMPP_SESSION, 'session'),
         )
+
+        for namespace, name in self.extra_stream_features:
+            features.addChild(elem(namespace, name)())
+
         self.xmlstream.send(features)
 
         self.xmlstream.addOnetimeObserver(
@@ -255,6 +286,218 @@ class XmppAuthenticator(GabbleAuthenticator):
     def sessionIq(self, iq):
         self.xmlstream.send(make_result_iq(self.xmlstream, iq))
 
+class RosterVersioningAuthenticator(XmppAuthenticator):
+    """Advertises XEP-0237 roster versioning as a stream feature."""
+    extra_stream_features = [(ns.ROSTER_VER, 'ver')]
+
+class StreamManagementAuthenticator(XmppAuthenticator):
+    """
+    Advertises XEP-0198 stream management, and once the client enables it,
+    counts the stanzas each side sends and answers the client's requests for
+    acknowledgement (unless auto_ack is False). Emits 'sm-enable', 'sm-ack'
+    (with h) and 'sm-request' events as the client does those things.
+    """
+    extra_stream_features = [(ns.SM, 'sm')]
+
+    def __init__(self, username='test', password='pass', resource=None,
+            refuse=False, auto_ack=True):
+        XmppAuthenticator.__init__(self, username, password, resource)
+        self.refuse = refuse
+        self.auto_ack = auto_ack
+        self.enabled = False
+        # Stanzas each side has sent since stream management was enabled
+        self.received = 0
+        self.sent = 0
+
+    def bindIq(self, iq):
+        XmppAuthenticator.bindIq(self, iq)
+        self.xmlstream.addOnetimeObserver("/enable[@xmlns='%s']" % ns.SM,
+            self.enable)
+
+    def enable(self, enable):
+        self._event_func(Event('sm-enable', stanza=enable))
+
+        if self.refuse:
+            self.xmlstream.send(elem(ns.SM, 'failed')(
+                elem(ns.STANZA, 'feature-not-implemented')()))
+            return
+
+        # The client started counting when it sent <enable/>, and we start
+        # when we send <enabled/>.
+        self.xmlstream.send(elem(ns.SM, 'enabled')())
+        self.enabled = True
+
+        for name in ['iq', 'message', 'presence']:
+            self.xmlstream.addObserver('/' + name, self._count_received)
+
+        self.xmlstream.addObserver("/r[@xmlns='%s']" % ns.SM, self._got_request)
+        self.xmlstream.addObserver("/a[@xmlns='%s']" % ns.SM, self._got_ack)
+
+        send = self.xmlstream.send
+
+        def counting_send(obj):
+            if isinstance(obj, basestring):
+                name = re.match(r'\s*<([a-z]*)', obj).group(1)
+            else:
+                name = obj.name
+
+            if name in ['iq', 'message', 'presence']:
+                self.sent += 1
+
+            send(obj)
+
+        self.xmlstream.send = counting_send
+
+    def _count_received(self, stanza):
+        self.received += 1
+
+    def _got_request(self, r):
+        self._event_func(Event('sm-request'))
+
+        if self.auto_ack:
+            self.ack()
+
+    def _got_ack(self, a):
+        self._event_func(Event('sm-ack', h=int(a['h'])))
+
+    def ack(self):
+        self.xmlstream.send(elem(ns.SM, 'a', h=str(self.received))())
+
+    def request_ack(self):
+        """Asks the client how many stanzas it has had from us, and returns
+        the right answer"""
+        self.xmlstream.send(elem(ns.SM, 'r')())
+        return self.sent
+
+class ByteCountingAuthenticator(XmppAuthenticator):
+    """
+    Counts the bytes crossing the wire each way (wire_sent and
+    wire_received), and how many bytes the server's side would have come to
+    had the stream been compressed with zlib, flushing after every write as
+    XEP-0138 would have to (zlib_sent), and how long working that out took
+    (zlib_time).
+    """
+
+    def __init__(self, username='test', password='pass', resource=None):
+        XmppAuthenticator.__init__(self, username, password, resource)
+        self.wire_sent = 0
+        self.wire_received = 0
+        self.zlib_sent = 0
+        self.zlib_time = 0.0
+
+        self._estimator = zlib.compressobj()
+
+    def connectionMade(self):
+        XmppAuthenticator.connectionMade(self)
+
+        transport = self.xmlstream.transport
+        write = transport.write
+        data_received = self.xmlstream.dataReceived
+
+        def counting_write(data):
+            start = time.time()
+            estimate = self._estimator.compress(data) + \
+                self._estimator.flush(zlib.Z_SYNC_FLUSH)
+            self.zlib_time += time.time() - start
+            self.zlib_sent += len(estimate)
+
+            self.wire_sent += len(data)
+            write(data)
+
+        def counting_data_received(data):
+            self.wire_received += len(data)
+            data_received(data)
+
+        transport.write = counting_write
+        self.xmlstream.dataReceived = counting_data_received
+
+class VersionedRoster(object):
+    """
+    A server-side roster which answers roster queries as a XEP-0237 server
+    would: if the client already has the current version it gets an empty
+    result, if it has a version we remember it gets an empty result followed
+    by one push per change, and otherwise it gets the whole roster.
+    """
+
+    def __init__(self):
+        self.version = 0
+        # jid -> (subscription, name, groups)
+        self.items = {}
+        # (version, jid) for each change, oldest first
+        self.history = []
+
+    def _changed(self, jid):
+        self.version += 1
+        self.history.append((self.version, jid))
+
+    def set_item(self, jid, subscription='both', name=None, groups=()):
+        self.items[jid] = (subscription, name, tuple(groups))
+        self._changed(jid)
+
+    def remove_item(self, jid):
+        del self.items[jid]
+        self._changed(jid)
+
+    def _add_item(self, query, jid):
+        item = query.addElement('item')
+        item['jid'] = jid
+
+        if jid not in self.items:
+            item['subscription'] = 'remove'
+            return
+
+        subscription, name, groups = self.items[jid]
+        item['subscription'] = subscription
+
+        if name is not None:
+            item['name'] = name
+
+        for group in groups:
+            item.addElement('group', content=group)
+
+    def _make_push(self, stream, jid, version):
+        iq = IQ(stream, 'set')
+        query = iq.addElement((ns.ROSTER, 'query'))
+        query['ver'] = str(version)
+        self._add_item(query, jid)
+        return iq
+
+    def handle_query(self, stream, iq):
+        """
+        Replies to @iq, a roster get. Returns the number of <item/>s sent,
+        including those in pushes.
+        """
+        query = iq.firstChildElement()
+        ver = query.getAttribute('ver')
+
+        known = [str(v) for v, _ in self.history]
+
+        if ver is not None and (ver == str(self.version) or ver in known):
+            stream.send(make_result_iq(stream, iq, add_query_node=False))
+
+            # Only the latest change to each contact matters.
+            changed = {}
+            for v, jid in self.history:
+                if v > int(ver):
+                    changed[jid] = v
+
+            for jid, v in sorted(changed.items(), key=lambda (j, v): v):
+                stream.send(self._make_push(stream, jid, v))
+
+            return len(changed)
+
+        result = make_result_iq(stream, iq)
+        query = result.firstChildElement()
+
+        if ver is not None:
+            query['ver'] = str(self.version)
+
+        for jid in self.items:
+            self._add_item(query, jid)
+
+        stream.send(result)
+        return len(self.items)
+
 class StreamEvent(servicetest.Event):
     def __init__(self, type_, stanza, stream):
         servicetest.Event.__init__(self, type_, stanza=stanza)
@@ -295,12 +538,29 @@ class MessageEvent(StreamEvent):
         self.message_type = stanza.getAttribute('type')
 
 class StreamFactory(twisted.internet.protocol.Factory):
-    def __init__(self, streams, jids):
+    def __init__(self, streams, jids, roster_size=None):
+        """
+        Each account has all the others on its roster; or, if roster_size is
+        not None, that many of them at most, its neighbours in jids.
+        """
         self.streams = streams
         self.jids = jids
         self.presences = {}
         self.mappings = dict(map (lambda jid, stream: (jid, stream),
                                   jids, streams))
+        self.rosters = {}
+
+        for i, jid in enumerate(jids):
+            if roster_size is None:
+                offsets = range(1, len(jids))
+            else:
+                # As many after it as before, so that everyone's roster
+                # contains everyone who has them on theirs
+                half = min(roster_size / 2, (len(jids) - 1) / 2)
+                offsets = range(1, half + 1) + range(-half, 0)
+
+            self.rosters[jid] = [jids[(i + offset) % len(jids)]
+                for offset in offsets]
 
         # Make a copy of the streams
         self.factory_streams = list(streams)
@@ -309,7 +569,7 @@ class StreamFactory(twisted.internet.protocol.Factory):
         # Do not add observers for single instances because it's unnecessary and
         # some unit tests need to respond to the roster request, and we shouldn't
         # answer it for them otherwise we break compatibility
-        if len(streams) > 1:
+        if len(streams) > 1 or roster_size is not None:
             # We need to have a function here because lambda keeps a reference on
             # the stream and jid and in the for loop, there is no context
             def addObservers(stream, jid):
@@ -329,7 +589,10 @@ class StreamFactory(twisted.internet.protocol.Factory):
         stanza.attributes['from'] = jid
         self.presences[jid] = stanza
 
-        for dest_jid  in self.presences.keys():
+        for dest_jid in [jid] + self.rosters[jid]:
+            if dest_jid not in self.presences:
+                continue
+
             # Dispatch the new presence to other clients
             stanza.attributes['to'] = dest_jid
             self.mappings[dest_jid].send(stanza)
@@ -344,7 +607,10 @@ class StreamFactory(twisted.internet.protocol.Factory):
     def lost_presence(self, stream, jid):
         if self.presences.has_key(jid):
             del self.presences[jid]
-            for dest_jid  in self.presences.keys():
+            for dest_jid in self.rosters[jid]:
+                if dest_jid not in self.presences:
+                    continue
+
                 presence = domish.Element(('jabber:client', 'presence'))
                 presence['from'] = jid
                 presence['to'] = dest_jid
@@ -360,11 +626,10 @@ class StreamFactory(twisted.internet.protocol.Factory):
         if query and query.uri == ns.ROSTER:
             roster = make_result_iq(stream, stanza)
             query = roster.firstChildElement()
-            for roster_jid in self.mappings.keys():
-                if jid != roster_jid:
-                    item = query.addElement('item')
-                    item['jid'] = roster_jid
-                    item['subscription'] = 'both'
+            for roster_jid in self.rosters[jid]:
+                item = query.addElement('item')
+                item['jid'] = roster_jid
+                item['subscription'] = 'both'
             stream.send(roster)
             return
 
@@ -383,9 +648,15 @@ class BaseXmlStream(xmlstream.XmlStream):
     disco_features = []
     handle_privacy_lists = True
 
+    # Everything the server sends reaches Gabble this many seconds late, so
+    # that each request Gabble makes takes at least this long to be answered:
+    # set it in a subclass to make the server seem further away.
+    rtt = 0
+
     def __init__(self, event_func, authenticator):
         xmlstream.XmlStream.__init__(self, authenticator)
         self.event_func = event_func
+        self._delayed = []
         self.addObserver('//iq', lambda x: event_func(
             IQEvent(self, x)))
         self.addObserver('//message', lambda x: event_func(
@@ -403,6 +674,23 @@ class BaseXmlStream(xmlstream.XmlStream):
         if 'GABBLE_NODELAY' in os.environ:
             self.transport.setTcpNoDelay(True)
 
+    def send(self, obj):
+        if not self.rtt:
+            xmlstream.XmlStream.send(self, obj)
+            return
+
+        # Serialize it now, in case the caller changes it in the meantime
+        if domish.IElement.providedBy(obj):
+            obj = obj.toXml()
+
+        # Timers due at the same time can fire in any order, but each one
+        # sends whatever has been waiting longest, so order is preserved.
+        self._delayed.append(obj)
+        reactor.callLater(self.rtt, self._send_delayed)
+
+    def _send_delayed(self):
+        xmlstream.XmlStream.send(self, self._delayed.pop(0))
+
     def _cb_priv_list(self, iq):
         send_error_reply(self, iq)
 
@@ -571,7 +859,8 @@ def exec_test_deferred(fun, params, protocol=None, timeout=None,
                         authenticator=None, num_instances=1,
                         do_connect=True,
                         make_connection_func=make_connection,
-                        expect_connected_func=expect_connected):
+                        expect_connected_func=expect_connected,
+                        roster_size=None):
     # hack to ease debugging
     domish.Element.__repr__ = element_repr
     colourer = None
@@ -619,7 +908,7 @@ def exec_test_deferred(fun, params, protocol=None, timeout=None,
                                    authenticator=authenticator,
                                    resource=resource, suffix=suffix))
 
-    factory = StreamFactory(streams, jids)
+    factory = StreamFactory(streams, jids, roster_size)
     port = reactor.listenTCP(4242, factory, interface='localhost')
 
     def signal_receiver(*args, **kw):
@@ -709,10 +998,11 @@ def exec_test_deferred(fun, params, protocol=None, timeout=None,
 
 
 def exec_test(fun, params=None, protocol=None, timeout=None,
-              authenticator=None, num_instances=1, do_connect=True):
+              authenticator=None, num_instances=1, do_connect=True,
+              roster_size=None):
     reactor.callWhenRunning(
         exec_test_deferred, fun, params, protocol, timeout, authenticator, num_instances,
-        do_connect)
+        do_connect, roster_size=roster_size)
     reactor.run()
 
 # Useful routines for server-side vCard handling
@@ -0,0 +1,99 @@
+"""
+Measure how fast a large file goes from one Gabble to another over Google
+Share, and check that it arrives intact: the whole of it goes through
+Gabble's HTTP parser on the receiving side.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+import constants as cs
+from file_transfer_helper import SendFileTest, ReceiveFileTest, \
+    exec_file_transfer_test, File
+
+from config import JINGLE_FILE_TRANSFER_ENABLED
+
+if not JINGLE_FILE_TRANSFER_ENABLED:
+    print "NOTE: built with --disable-file-transfer or --disable-voip"
+    raise SystemExit(77)
+
+# Set this to something in the hundreds for a more meaningful figure
+BENCHMARK_MB = int(os.environ.get('GABBLE_SHARE_BENCHMARK_MB', '8'))
+
+times = {}
+
+def wait_for_state(test, state):
+    if test.ft_props.Get(cs.CHANNEL_TYPE_FILE_TRANSFER, 'State') != state:
+        test.q.expect('dbus-signal', signal='FileTransferStateChanged',
+            path=test.channel.object_path,
+            predicate=lambda e: e.args[0] == state)
+
+class SendLargeFileTest(SendFileTest):
+    def __init__(self, file, address_type,
+                 access_control, access_control_param):
+        SendFileTest.__init__(self, file, address_type,
+                              access_control, access_control_param)
+
+        # The receiver has to start reading before we can finish sending
+        self._actions = [self.connect, self.set_ft_caps,
+                         self.check_ft_available, None,
+
+                         self.wait_for_ft_caps, None,
+
+                         self.request_ft_channel, self.provide_file, None,
+
+                         self.send_file, None,
+
+                         self.wait_for_completion, None,
+
+                         self.close_channel, self.done]
+
+    def send_file(self):
+        self.q.expect('dbus-signal', signal='FileTransferStateChanged',
+            path=self.channel.object_path,
+            args=[cs.FT_STATE_OPEN, self.open_reason])
+
+        self.socket = self.create_socket()
+        self.socket.connect(self.address)
+
+        # Gabble won't read it all until the receiver does, so we can't
+        # block the main loop writing it.
+        times['start'] = time.time()
+        self.writer = threading.Thread(target=self.socket.sendall,
+            args=(self.file.data,))
+        self.writer.start()
+
+    def wait_for_completion(self):
+        self.writer.join()
+        wait_for_state(self, cs.FT_STATE_COMPLETED)
+        self.socket.close()
+
+class ReceiveLargeFileTest(ReceiveFileTest):
+    def _read_file_from_socket(self, s):
+        md5 = hashlib.md5()
+        received = 0
+
+        while True:
+            data = s.recv(65536)
+            if len(data) == 0:
+                break
+            md5.update(data)
+            received += len(data)
+
+        times['end'] = time.time()
+
+        assert received == self.file.size, (received, self.file.size)
+        assert md5.hexdigest() == self.file.hash
+
+        wait_for_state(self, cs.FT_STATE_COMPLETED)
+
+if __name__ == '__main__':
+    file = File(data=os.urandom(64 * 1024) * (BENCHMARK_MB * 16),
+        name='benchmark.bin', content_type='application/octet-stream')
+    exec_file_transfer_test(SendLargeFileTest, ReceiveLargeFileTest, file)
+
+    elapsed = times['end'] - times['start']
+    print "%d MB over Google Share: %.1f MB/s" % (BENCHMARK_MB,
+        BENCHMARK_MB / elapsed)
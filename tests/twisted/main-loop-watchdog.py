@@ -0,0 +1,74 @@
+"""
+Test that Gabble's main loop watchdog notices a callback hogging the main
+loop, and exposes it as Gabble.Debug.SlowCallbacks and MainLoopLatency.
+
+run-test.sh runs this test, and only this one, with GABBLE_WATCHDOG=500,
+which Gabble inherits from the session bus that activates it. The test
+plugin's .Slow sidecar blocks the main loop for a second before failing.
+"""
+
+import os
+import time
+
+from servicetest import call_async, assertEquals, sync_dbus
+from gabbletest import exec_test
+import constants as cs
+from config import PLUGINS_ENABLED
+
+TEST_PLUGIN_IFACE = cs.PREFIX + ".Gabble.Plugin.Test"
+
+if not PLUGINS_ENABLED:
+    print "NOTE: built without --enable-plugins, not testing the watchdog"
+    raise SystemExit(77) # which makes the test show up as skipped
+
+if 'GABBLE_WATCHDOG' not in os.environ:
+    print "NOTE: GABBLE_WATCHDOG isn't set, so Gabble isn't watching itself"
+    raise SystemExit(77)
+
+# What the test plugin calls the idle source that blocks the main loop
+SLOW_SOURCE = 'test-plugin-slow-sidecar'
+
+# GABBLE_WATCHDOG, in microseconds
+THRESHOLD = int(os.environ['GABBLE_WATCHDOG']) * 1000
+
+def get_debug(conn, name):
+    return conn.Get(cs.CONN_IFACE_GABBLE_DEBUG, name,
+        dbus_interface=cs.PROPERTIES_IFACE)
+
+def late_probes(conn):
+    """Returns how many times the main loop has been more than THRESHOLD
+    late"""
+    return sum([count for bound, count in get_debug(conn, 'MainLoopLatency')
+        if bound > THRESHOLD])
+
+def test(q, bus, conn, stream):
+    before = late_probes(conn)
+
+    call_async(q, conn.Sidecars1, 'EnsureSidecar', TEST_PLUGIN_IFACE + ".Slow")
+    q.expect('dbus-error', method='EnsureSidecar', name=cs.NOT_IMPLEMENTED)
+
+    # The watchdog notices once the main loop gets going again, so it may
+    # take a moment to turn up.
+    deadline = time.time() + 10
+    while True:
+        slow = get_debug(conn, 'SlowCallbacks')
+        ours = [(name, duration, stack) for name, duration, stack in slow
+            if name == SLOW_SOURCE]
+
+        if ours or time.time() > deadline:
+            break
+
+        sync_dbus(bus, q, conn)
+
+    assert ours, slow
+    name, duration, stack = ours[0]
+    assert duration >= THRESHOLD, duration
+
+    # The slowest come first
+    durations = [d for _, d, _ in slow]
+    assertEquals(sorted(durations, reverse=True), durations)
+
+    assert late_probes(conn) > before
+
+if __name__ == '__main__':
+    exec_test(test)
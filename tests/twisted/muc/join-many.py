@@ -0,0 +1,196 @@
+"""
+Test joining lots of rooms at once: Gabble should ask about each room along
+with its join presence rather than once it has joined, only once per room,
+and announce rooms it finishes joining together in one NewChannels signal.
+
+Also measures how long it takes to join GABBLE_MUC_JOIN_BENCHMARK_ROOMS rooms
+(50 by default) with the server GABBLE_MUC_JOIN_BENCHMARK_RTT seconds away.
+"""
+
+import os
+import time
+
+import dbus
+
+from gabbletest import (
+    exec_test, make_muc_presence, make_result_iq, sync_stream, elem,
+    XmppXmlStream, send_error_reply,
+    )
+from servicetest import (
+    call_async, EventPattern, assertEquals, assertLength, sync_dbus,
+    )
+import constants as cs
+import ns
+
+BENCHMARK_ROOMS = int(os.environ.get('GABBLE_MUC_JOIN_BENCHMARK_ROOMS', '50'))
+BENCHMARK_RTT = float(os.environ.get('GABBLE_MUC_JOIN_BENCHMARK_RTT', '0.1'))
+
+class FarAwayServer(XmppXmlStream):
+    rtt = BENCHMARK_RTT
+
+def room_request(room):
+    return dbus.Dictionary({
+        cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_TEXT,
+        cs.TARGET_HANDLE_TYPE: cs.HT_ROOM,
+        cs.TARGET_ID: room,
+        }, signature='sv')
+
+def room_info(stream, iq):
+    result = make_result_iq(stream, iq)
+    query = result.firstChildElement()
+    query.addChild(elem('identity', category='conference', type='text',
+        name='Room %s' % iq['to'])())
+    query.addChild(elem('feature', var=ns.MUC)())
+    return result
+
+def watch_new_channels(bus, conn):
+    """Returns a list to which the channels from each NewChannels are
+    appended"""
+    new_channels = []
+    bus.add_signal_receiver(lambda channels: new_channels.append(channels),
+        signal_name='NewChannels', dbus_interface=cs.CONN_IFACE_REQUESTS,
+        path=conn.object_path)
+    return new_channels
+
+def test_pipelined(q, bus, conn, stream):
+    room = 'chat@conf.localhost'
+    discos = []
+    stream.addObserver("/iq[@to='%s']/query[@xmlns='%s']"
+        % (room, ns.DISCO_INFO), discos.append)
+
+    call_async(q, conn.Requests, 'EnsureChannel', room_request(room))
+
+    # Gabble asks about the room straight after asking to join it, without
+    # waiting until it has.
+    _, disco = q.expect_many(
+        EventPattern('stream-presence', to='%s/test' % room),
+        EventPattern('stream-iq', to=room, iq_type='get',
+            query_ns=ns.DISCO_INFO))
+
+    stream.send(make_muc_presence('none', 'participant', room, 'test'))
+    q.expect('dbus-return', method='EnsureChannel')
+
+    stream.send(room_info(stream, disco.stanza))
+    q.expect('dbus-signal', signal='PropertiesChanged',
+        args=[cs.CHANNEL_IFACE_ROOM_CONFIG,
+              {'ConfigurationRetrieved': True},
+              []
+             ])
+
+    # Having joined doesn't make it ask again.
+    sync_stream(q, stream)
+    assertLength(1, discos)
+
+def test_disco_error_after_join(q, bus, conn, stream):
+    room = 'chat@conf.localhost'
+
+    call_async(q, conn.Requests, 'EnsureChannel', room_request(room))
+    _, disco = q.expect_many(
+        EventPattern('stream-presence', to='%s/test' % room),
+        EventPattern('stream-iq', to=room, iq_type='get',
+            query_ns=ns.DISCO_INFO))
+
+    # We're in before the server gets round to the disco, which fails...
+    stream.send(make_muc_presence('none', 'participant', room, 'test'))
+    q.expect('dbus-return', method='EnsureChannel')
+    sync_stream(q, stream)
+
+    send_error_reply(stream, disco.stanza)
+
+    # ...so Gabble asks again, now that the room certainly exists.
+    disco = q.expect('stream-iq', to=room, iq_type='get',
+        query_ns=ns.DISCO_INFO)
+    stream.send(room_info(stream, disco.stanza))
+    q.expect('dbus-signal', signal='PropertiesChanged',
+        args=[cs.CHANNEL_IFACE_ROOM_CONFIG,
+              {'ConfigurationRetrieved': True},
+              []
+             ])
+
+def test_batched(q, bus, conn, stream):
+    rooms = ['room%d@conf.localhost' % i for i in range(3)]
+    new_channels = watch_new_channels(bus, conn)
+
+    for room in rooms:
+        call_async(q, conn.Requests, 'EnsureChannel', room_request(room))
+
+    q.expect_many(*[EventPattern('stream-presence', to='%s/test' % room)
+        for room in rooms])
+
+    # The server lets us in to all of them at once...
+    stream.send(''.join([
+        make_muc_presence('none', 'participant', room, 'test').toXml()
+        for room in rooms]))
+
+    returns = q.expect_many(*[EventPattern('dbus-return',
+        method='EnsureChannel') for room in rooms])
+    sync_dbus(bus, q, conn)
+
+    # ...so they're announced together.
+    assertLength(1, new_channels)
+    assertEquals(set([e.value[1] for e in returns]),
+        set([path for path, _ in new_channels[0]]))
+
+    # Asking for one of them again gives us the same channel.
+    yours, path, _ = conn.Requests.EnsureChannel(room_request(rooms[0]))
+    assert not yours
+    assertEquals(returns[0].value[1], path)
+
+def test_benchmark(q, bus, conn, stream):
+    rooms = ['room%03d@conf.localhost' % i for i in range(BENCHMARK_ROOMS)]
+    new_channels = watch_new_channels(bus, conn)
+
+    # room => how many times Gabble asked about it
+    discos = dict((room, 0) for room in rooms)
+
+    def join_cb(presence):
+        room = presence['to'].split('/')[0]
+        if room in discos:
+            stream.send(make_muc_presence('none', 'participant', room, 'test'))
+
+    def disco_cb(iq):
+        room = iq.getAttribute('to')
+        if room in discos:
+            discos[room] += 1
+            stream.send(room_info(stream, iq))
+
+    stream.addObserver("/presence/x[@xmlns='%s']" % ns.MUC, join_cb)
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.DISCO_INFO,
+        disco_cb)
+
+    retrieved = set()
+
+    def properties_changed_cb(interface, changed, invalidated, path=None):
+        if interface == cs.CHANNEL_IFACE_ROOM_CONFIG and \
+                changed.get('ConfigurationRetrieved'):
+            retrieved.add(path)
+
+    bus.add_signal_receiver(properties_changed_cb,
+        signal_name='PropertiesChanged', dbus_interface=cs.PROPERTIES_IFACE,
+        path_keyword='path')
+
+    start = time.time()
+
+    for room in rooms:
+        call_async(q, conn.Requests, 'EnsureChannel', room_request(room))
+
+    q.expect_many(*[EventPattern('dbus-return', method='EnsureChannel')
+        for room in rooms])
+    joined = time.time() - start
+
+    while len(retrieved) < len(rooms) and time.time() - start < 60:
+        sync_dbus(bus, q, conn)
+    configured = time.time() - start
+
+    assertEquals(len(rooms), len(retrieved))
+    assertEquals([1] * len(rooms), discos.values())
+
+    print "%d rooms (RTT %.3fs): all joined after %.2fs, all configuration " \
+        "retrieved after %.2fs, in %d NewChannels signals" % (len(rooms),
+            BENCHMARK_RTT, joined, configured, len(new_channels))
+
+if __name__ == '__main__':
+    exec_test(test_pipelined)
+    exec_test(test_disco_error_after_join)
+    exec_test(test_batched)
+    exec_test(test_benchmark, protocol=FarAwayServer)
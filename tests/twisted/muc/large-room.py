@@ -0,0 +1,184 @@
+"""
+Test joining a room with lots of people in it: Gabble should tell us about
+all of them together rather than one at a time, and ignore presences from
+them that it has already seen.
+
+Also measures how long it takes to join a room of
+GABBLE_MUC_LARGE_ROOM_OCCUPANTS other people (200 by default; try thousands
+for a real benchmark), and to deal with all of them sending their presence
+again.
+"""
+
+import os
+import time
+
+from gabbletest import exec_test, make_muc_presence, sync_stream
+from servicetest import (
+    EventPattern, assertEquals, assertLength, sync_dbus,
+    )
+from mucutil import try_to_join_muc, join_muc
+import constants as cs
+
+OCCUPANTS = int(os.environ.get('GABBLE_MUC_LARGE_ROOM_OCCUPANTS', '200'))
+
+MUC = 'chat@conf.localhost'
+
+def occupant_presence(i, show=None):
+    presence = make_muc_presence('none', 'participant', MUC, 'user%04d' % i,
+        jid='user%04d@localhost/Resource' % i)
+
+    if show is not None:
+        presence.addElement('show', content=show)
+
+    return presence
+
+class SignalCounter(object):
+    """Keeps lists of the contacts in each PresencesChanged signal, and of
+    those added by each MembersChangedDetailed signal"""
+
+    def __init__(self, bus, conn):
+        self.presences = []
+        self.added = []
+
+        bus.add_signal_receiver(
+            lambda presences: self.presences.append(presences.keys()),
+            signal_name='PresencesChanged',
+            dbus_interface=cs.CONN_IFACE_SIMPLE_PRESENCE,
+            path=conn.object_path)
+        bus.add_signal_receiver(
+            lambda added, *args: self.added.append(added),
+            signal_name='MembersChangedDetailed',
+            dbus_interface=cs.CHANNEL_IFACE_GROUP)
+
+    def reset(self):
+        self.presences = []
+        self.added = []
+
+def join(q, bus, conn, stream, n):
+    """Joins a room of n other people, who are all already there"""
+    try_to_join_muc(q, bus, conn, stream, MUC)
+
+    for i in range(n):
+        stream.send(occupant_presence(i))
+
+    stream.send(make_muc_presence('none', 'participant', MUC, 'test'))
+    return q.expect('dbus-return', method='CreateChannel')
+
+def test_join(q, bus, conn, stream):
+    counter = SignalCounter(bus, conn)
+
+    join(q, bus, conn, stream, 3)
+    sync_dbus(bus, q, conn)
+
+    handles = conn.get_contact_handles_sync(
+        ['%s/user%04d' % (MUC, i) for i in range(3)])
+
+    # We hear about everyone's presence at once...
+    about_them = [contacts for contacts in counter.presences
+        if set(contacts) & set(handles)]
+    assertLength(1, about_them)
+    assertEquals(set(handles), set(handles) & set(about_them[0]))
+
+    # ...and about them joining at once.
+    joining = [added for added in counter.added if set(added) & set(handles)]
+    assertLength(1, joining)
+    assertEquals(set(handles), set(handles) & set(joining[0]))
+
+def test_unchanged(q, bus, conn, stream):
+    join_muc(q, bus, conn, stream, MUC)
+    bob = make_muc_presence('owner', 'moderator', MUC, 'bob')
+    bob_handle = conn.get_contact_handle_sync('%s/bob' % MUC)
+
+    # Bob says the same thing again, so there's nothing to tell anyone.
+    patterns = [
+        EventPattern('dbus-signal', signal='PresencesChanged'),
+        EventPattern('dbus-signal', signal='MembersChangedDetailed'),
+        EventPattern('dbus-signal', signal='HandleOwnersChanged'),
+        ]
+    q.forbid_events(patterns)
+    stream.send(bob)
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    q.unforbid_events(patterns)
+
+    # But when he goes away, there is.
+    bob.addElement('show', content='away')
+    stream.send(bob)
+    e = q.expect('dbus-signal', signal='PresencesChanged',
+        predicate=lambda e: bob_handle in e.args[0])
+    assertEquals((cs.PRESENCE_AWAY, 'away', ''), e.args[0][bob_handle])
+
+    # Once he's left and come back, his presence is news again.
+    bob = make_muc_presence('owner', 'moderator', MUC, 'bob')
+    bob['type'] = 'unavailable'
+    stream.send(bob)
+    q.expect('dbus-signal', signal='MembersChangedDetailed',
+        predicate=lambda e: e.args[1] == [bob_handle])
+
+    stream.send(make_muc_presence('owner', 'moderator', MUC, 'bob'))
+    q.expect('dbus-signal', signal='MembersChangedDetailed',
+        predicate=lambda e: e.args[0] == [bob_handle])
+
+    # Bob changes his nick to Robert...
+    robert_handle = conn.get_contact_handle_sync('%s/robert' % MUC)
+    bob = make_muc_presence('owner', 'moderator', MUC, 'bob')
+    bob['type'] = 'unavailable'
+    x = bob.firstChildElement()
+    x.firstChildElement()['nick'] = 'robert'
+    x.addElement('status')['code'] = '303'
+    stream.send(bob)
+    stream.send(make_muc_presence('owner', 'moderator', MUC, 'robert'))
+    q.expect('dbus-signal', signal='MembersChangedDetailed',
+        predicate=lambda e: e.args[0] == [robert_handle])
+
+    # ...so saying the same thing again as Robert is no news...
+    q.forbid_events(patterns)
+    stream.send(make_muc_presence('owner', 'moderator', MUC, 'robert'))
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    q.unforbid_events(patterns)
+
+    # ...but someone turning up as Bob again is.
+    stream.send(make_muc_presence('owner', 'moderator', MUC, 'bob'))
+    q.expect('dbus-signal', signal='MembersChangedDetailed',
+        predicate=lambda e: e.args[0] == [bob_handle])
+
+def test_benchmark(q, bus, conn, stream):
+    counter = SignalCounter(bus, conn)
+
+    start = time.time()
+    join(q, bus, conn, stream, OCCUPANTS)
+    sync_dbus(bus, q, conn)
+    joined = time.time() - start
+    signals = (len(counter.presences), len(counter.added))
+
+    # Everyone sends the same presence again...
+    counter.reset()
+    start = time.time()
+    for i in range(OCCUPANTS):
+        stream.send(occupant_presence(i))
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    repeated = time.time() - start
+
+    # ...which is no news to anyone.
+    assertEquals([], counter.presences)
+    assertEquals([], counter.added)
+
+    # Then everyone goes away.
+    start = time.time()
+    for i in range(OCCUPANTS):
+        stream.send(occupant_presence(i, show='away'))
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    changed = time.time() - start
+
+    print "%d occupants: joined in %.2fs with %d PresencesChanged and %d " \
+        "MembersChangedDetailed; repeated presences took %.2fs, changed " \
+        "ones %.2fs" % (OCCUPANTS, joined, signals[0], signals[1],
+            repeated, changed)
+
+if __name__ == '__main__':
+    exec_test(test_join)
+    exec_test(test_unchanged)
+    exec_test(test_benchmark)
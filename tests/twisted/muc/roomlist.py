@@ -1,13 +1,33 @@
 
 """
-Test MUC support.
+Test MUC support, and listing rooms a page at a time with XEP-0059 Result Set
+Management, including on a server with very many of them.
 """
 
+import os
+import time
+
 import dbus
 
-from gabbletest import make_result_iq, exec_test, sync_stream, disconnect_conn
+from gabbletest import (
+    make_result_iq, exec_test, sync_stream, disconnect_conn, elem, elem_iq,
+    )
 from servicetest import call_async, EventPattern, assertEquals
 import constants as cs
+import ns
+
+from twisted.words.xish import xpath
+
+SERVER = 'conference.example.net'
+
+# Gabble asks for this many rooms at a time, and asks for INFO on this many at
+# once; it ought to fetch the next page only once it's nearly through the last.
+PAGE_SIZE = 100
+INFO_PIPELINE = 10
+
+# A few pages by default; set this to tens of thousands for a benchmark
+BENCHMARK_ROOMS = int(os.environ.get('GABBLE_ROOMLIST_BENCHMARK_ROOMS',
+    '500'))
 
 def test(q, bus, conn, stream):
     event = q.expect('stream-iq', to='localhost',
@@ -92,6 +112,172 @@ def test(q, bus, conn, stream):
     EventPattern('dbus-signal', signal='Closed', path=path2),
     EventPattern('dbus-signal', signal='ChannelClosed', args=[path2])])
 
+class RoomServer(object):
+    """Plays the part of a conference server with lots of rooms"""
+
+    def __init__(self, stream, n_rooms, rsm=True, page_cap=None):
+        self.stream = stream
+        self.rooms = ['room%05d@%s' % (i, SERVER) for i in range(n_rooms)]
+        self.index = dict((jid, i) for i, jid in enumerate(self.rooms))
+        self.rsm = rsm
+        self.page_cap = page_cap
+
+        self.pages = []
+        self.info_requests = 0
+
+        stream.addObserver(
+            "/iq[@type='get']/query[@xmlns='%s']" % ns.DISCO_ITEMS,
+            self.items_cb)
+        stream.addObserver(
+            "/iq[@type='get']/query[@xmlns='%s']" % ns.DISCO_INFO,
+            self.info_cb)
+
+    def items_cb(self, iq):
+        if iq.getAttribute('to') != SERVER:
+            return
+
+        set_ = xpath.queryForNodes('/iq/query/set', iq)
+        start = 0
+        end = len(self.rooms)
+
+        if set_ is not None and self.rsm:
+            max_ = int(xpath.queryForString('/iq/query/set/max', iq))
+            after = xpath.queryForNodes('/iq/query/set/after', iq)
+
+            if after is not None:
+                start = self.index[str(after[0])] + 1
+
+            if self.page_cap is not None:
+                max_ = min(max_, self.page_cap)
+
+            end = min(end, start + max_)
+
+        # Remember how many rooms Gabble had asked about when it asked for
+        # this page
+        self.pages.append((start, self.info_requests))
+
+        query = elem(ns.DISCO_ITEMS, 'query')
+        for jid in self.rooms[start:end]:
+            query.addChild(elem('item', jid=jid)())
+
+        if set_ is not None and self.rsm and start < end:
+            query.addChild(elem(ns.RSM, 'set')(
+                elem('first', index=str(start))(unicode(self.rooms[start])),
+                elem('last')(unicode(self.rooms[end - 1])),
+                elem('count')(unicode(len(self.rooms)))))
+
+        reply = elem_iq(self.stream, 'result', id=iq['id'], from_=SERVER)(
+            query)
+        self.stream.send(reply)
+
+    def info_cb(self, iq):
+        jid = iq.getAttribute('to')
+        if jid not in self.index:
+            return
+
+        self.info_requests += 1
+
+        # There are a lot of these, so we don't bother building them up
+        self.stream.send(
+            '<iq type="result" id="%s" from="%s"><query xmlns="%s">'
+            '<identity category="conference" type="text" name="Room %d"/>'
+            '<feature var="http://jabber.org/protocol/muc"/>'
+            '</query></iq>' % (iq['id'], jid, ns.DISCO_INFO, self.index[jid]))
+
+def create_roomlist(q, bus, conn):
+    path, props = conn.Requests.CreateChannel(
+            { cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_ROOM_LIST,
+              cs.TARGET_HANDLE_TYPE: cs.HT_NONE,
+              cs.CHANNEL_TYPE_ROOM_LIST + '.Server': SERVER,
+              })
+    chan = bus.get_object(conn.bus_name, path)
+    return path, dbus.Interface(chan, cs.CHANNEL_TYPE_ROOM_LIST)
+
+def count_rooms(bus, path):
+    rooms = {}
+
+    def got_rooms(new_rooms):
+        for handle, channel_type, info in new_rooms:
+            rooms[info['handle-name']] = info['name']
+
+    bus.add_signal_receiver(got_rooms, signal_name='GotRooms',
+        dbus_interface=cs.CHANNEL_TYPE_ROOM_LIST, path=path)
+    return rooms
+
+def list_rooms(q, bus, conn, stream, n_rooms, **kwargs):
+    server = RoomServer(stream, n_rooms, **kwargs)
+    path, roomlist = create_roomlist(q, bus, conn)
+    rooms = count_rooms(bus, path)
+
+    start = time.time()
+    call_async(q, roomlist, 'ListRooms')
+    q.expect('dbus-signal', signal='ListingRooms', args=[True])
+    q.expect('dbus-signal', signal='ListingRooms', args=[False])
+    elapsed = time.time() - start
+
+    # Let the last GotRooms through
+    sync_stream(q, stream)
+
+    assertEquals(n_rooms, len(rooms))
+    assertEquals('Room 0', rooms[server.rooms[0]])
+    assertEquals('Room %d' % (n_rooms - 1), rooms[server.rooms[-1]])
+
+    return server, elapsed
+
+def test_paging(q, bus, conn, stream):
+    # The server sends fewer rooms at a time than Gabble asks for, which it's
+    # allowed to do.
+    server, _ = list_rooms(q, bus, conn, stream, 5, page_cap=2)
+    assertEquals([0, 2, 4], [start for start, _ in server.pages])
+
+def test_no_rsm(q, bus, conn, stream):
+    # The server ignores the <set/> and sends all its rooms at once
+    server, _ = list_rooms(q, bus, conn, stream, 250, rsm=False)
+    assertEquals(1, len(server.pages))
+
+def test_stop_listing(q, bus, conn, stream):
+    server = RoomServer(stream, 1000)
+    path, roomlist = create_roomlist(q, bus, conn)
+
+    call_async(q, roomlist, 'ListRooms')
+    q.expect('dbus-signal', signal='GotRooms')
+
+    call_async(q, roomlist, 'StopListing')
+    q.expect_many(
+        EventPattern('dbus-return', method='StopListing'),
+        EventPattern('dbus-signal', signal='ListingRooms', args=[False]))
+
+    # Once whatever Gabble sent before it stopped has arrived, it doesn't
+    # ask for any more pages, or about any more rooms.
+    sync_stream(q, stream)
+    pages = len(server.pages)
+    info_requests = server.info_requests
+
+    sync_stream(q, stream)
+    assertEquals(pages, len(server.pages))
+    assertEquals(info_requests, server.info_requests)
+    assert pages < len(server.rooms) / PAGE_SIZE, pages
+
+    assertEquals(False, roomlist.GetListingRooms())
+
+def test_benchmark(q, bus, conn, stream):
+    server, elapsed = list_rooms(q, bus, conn, stream, BENCHMARK_ROOMS)
+
+    # Gabble only asked for each page once it had got through most of the
+    # one before, so it never had more than about a page of rooms to hold on
+    # to.
+    assertEquals((BENCHMARK_ROOMS + PAGE_SIZE - 1) / PAGE_SIZE,
+        len(server.pages))
+    for start, asked in server.pages:
+        assert asked >= start - PAGE_SIZE + INFO_PIPELINE, (start, asked)
+
+    print "listed %d rooms in %.1fs: %.0f rooms/s" % (
+        BENCHMARK_ROOMS, elapsed, BENCHMARK_ROOMS / elapsed)
+
 if __name__ == '__main__':
     exec_test(test)
+    exec_test(test_paging)
+    exec_test(test_no_rsm)
+    exec_test(test_stop_listing)
+    exec_test(test_benchmark)
 
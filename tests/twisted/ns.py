@@ -1,6 +1,7 @@
 AMP = "http://jabber.org/protocol/amp"
 BYTESTREAMS = 'http://jabber.org/protocol/bytestreams'
 CHAT_STATES = 'http://jabber.org/protocol/chatstates'
+CSI = 'urn:xmpp:csi:0'
 CAPS = "http://jabber.org/protocol/caps"
 CLIENT = "jabber:client"
 DISCO_INFO = "http://jabber.org/protocol/disco#info"
@@ -55,14 +56,18 @@ OLPC_BUDDY_PROPS = "http://laptop.org/xmpp/buddy-properties"
 OLPC_BUDDY_PROPS_NOTIFY = "%s+notify" % OLPC_BUDDY_PROPS
 OLPC_CURRENT_ACTIVITY = "http://laptop.org/xmpp/current-activity"
 OLPC_CURRENT_ACTIVITY_NOTIFY = "%s+notify" % OLPC_CURRENT_ACTIVITY
+PING = "urn:xmpp:ping"
 PUBSUB = "http://jabber.org/protocol/pubsub"
 PUBSUB_EVENT = "%s#event" % PUBSUB
 RECEIPTS = "urn:xmpp:receipts"
 REGISTER = "jabber:iq:register"
 ROSTER = "jabber:iq:roster"
+ROSTER_VER = "urn:xmpp:features:rosterver"
+RSM = "http://jabber.org/protocol/rsm"
 SEARCH = 'jabber:iq:search'
 SI = 'http://jabber.org/protocol/si'
 SI_MULTIPLE = 'http://telepathy.freedesktop.org/xmpp/si-multiple'
+SM = 'urn:xmpp:sm:3'
 STANZA = "urn:ietf:params:xml:ns:xmpp-stanzas"
 STREAMS = "urn:ietf:params:xml:ns:xmpp-streams"
 TEMPPRES = "urn:xmpp:temppres:0"
@@ -1,9 +1,15 @@
 """
 Test Gabble's implementation of channel managers from plugins.
+
+Also measures how long it takes to set up GABBLE_PLUGIN_BENCHMARK_CONNECTIONS
+(20 by default) more connections, each with its plugins' channel managers.
 """
 
+import os
+import time
+
 from servicetest import assertContains
-from gabbletest import exec_test
+from gabbletest import exec_test, make_connection
 import constants as cs
 from config import PLUGINS_ENABLED
 
@@ -13,6 +19,9 @@ if not PLUGINS_ENABLED:
     print "NOTE: built without --enable-plugins, not testing plugins"
     raise SystemExit(77) # which makes the test show up as skipped
 
+BENCHMARK_CONNECTIONS = int(os.environ.get(
+    'GABBLE_PLUGIN_BENCHMARK_CONNECTIONS', '20'))
+
 def test(q, bus, conn, stream):
     rccs = conn.Properties.Get(cs.CONN_IFACE_REQUESTS,
         'RequestableChannelClasses')
@@ -25,5 +34,19 @@ def test(q, bus, conn, stream):
     allowed = ["com.jonnylamb.omg", "com.jonnylamb.brokethebuild"]
     assertContains((fixed, allowed), rccs)
 
+def test_benchmark(q, bus, conn, stream):
+    start = time.time()
+    conns = [make_connection(bus, q.append, suffix=str(i))[0]
+        for i in range(BENCHMARK_CONNECTIONS)]
+    elapsed = time.time() - start
+
+    # They never connected, so this gets rid of them straight away.
+    for c in conns:
+        c.Disconnect()
+
+    print "%d connections set up in %.2fs, %.1fms each" % (
+        BENCHMARK_CONNECTIONS, elapsed, elapsed * 1000 / BENCHMARK_CONNECTIONS)
+
 if __name__ == '__main__':
     exec_test(test)
+    exec_test(test_benchmark)
@@ -1,12 +1,17 @@
 """
 Test entering and leaving power saving mode.
+
+Also counts how many times clients are woken up by PresencesChanged while a
+few contacts change their presence a lot, with and without power saving.
 """
 
+import os
+
 import constants as cs
 
 from gabbletest import exec_test, GoogleXmlStream, make_result_iq, \
     send_error_reply, disconnect_conn, make_presence, sync_stream, elem, \
-    acknowledge_iq
+    acknowledge_iq, XmppAuthenticator
 from servicetest import call_async, assertEquals, EventPattern, \
     assertContains, sync_dbus
 import ns
@@ -96,9 +101,9 @@ def test_local_queueing(q, bus, conn, stream):
     stream.send(message.toXml())
 
     sync_dbus(bus, q, conn)
-    q.unforbid_events(presence_update)
 
-    # Incoming important stanza will flush the queue
+    # Incoming important stanza will flush the queue: the result of the PEP
+    # notification comes first...
     m = domish.Element((None, 'message'))
     m['from'] = 'foo@bar.com/Pidgin'
     m['id'] = '123'
@@ -106,34 +111,32 @@ def test_local_queueing(q, bus, conn, stream):
     m.addElement('body', content='important message')
     stream.send(m)
 
-    # Presence updates should come in the original order ...
-    p1 = q.expect('dbus-signal', signal='PresencesChanged')
-    p2 = q.expect('dbus-signal', signal='PresencesChanged')
-
-    assertEquals('away', p1.args[0].values()[0][1])
-    assertEquals('xa', p2.args[0].values()[0][1])
-
-    # .. followed by the result of PEP notification ..
     event = q.expect('dbus-signal', signal='AliasesChanged')
 
-    # .. and finally the message that flushed the stanza queue
+    # .. followed by the message that flushed the stanza queue, but the
+    # presence updates are still held back
     q.expect('dbus-signal', signal='NewChannels')
 
     sync_stream(q, stream)
 
-    q.forbid_events(presence_update)
-
     stream.send(make_presence('carl@foo.com', show='away',
                               status='Home'))
 
-    # Carl's presence update is queued
+    # Carl's presence update is queued too
     sync_dbus(bus, q, conn)
     q.unforbid_events(presence_update)
 
-    # Disable powersaving, flushing the queue
+    # Disable powersaving, flushing the queue; everyone's presence is
+    # signalled at once.
     conn.PowerSaving.SetPowerSaving(False)
 
-    q.expect('dbus-signal', signal='PresencesChanged')
+    e = q.expect('dbus-signal', signal='PresencesChanged')
+    amy, bob, carl = conn.get_contact_handles_sync(
+        ['amy@foo.com', 'bob@foo.com', 'carl@foo.com'])
+    assertEquals(set([amy, bob, carl]), set(e.args[0].keys()))
+    assertEquals('away', e.args[0][amy][1])
+    assertEquals('xa', e.args[0][bob][1])
+    assertEquals('away', e.args[0][carl][1])
 
 
 def test(q, bus, conn, stream):
@@ -208,8 +211,108 @@ def test_disconnect(q, bus, conn, stream):
 
     disconnect_conn(q, conn, stream)
 
+class CsiAuthenticator(XmppAuthenticator):
+    extra_stream_features = [(ns.CSI, 'csi')]
+
+def test_csi(q, bus, conn, stream):
+    states = []
+
+    for state in ['active', 'inactive']:
+        stream.addObserver("/%s[@xmlns='%s']" % (state, ns.CSI),
+            lambda x: states.append(x.name))
+
+    pattern = [EventPattern('stream-iq', query_ns=ns.GOOGLE_QUEUE)]
+    q.forbid_events(pattern)
+
+    # The server supports XEP-0352, so Gabble tells it when we go inactive,
+    # rather than queueing anything itself.
+    call_async(q, conn.PowerSaving, 'SetPowerSaving', True)
+    q.expect_many(EventPattern('dbus-return', method='SetPowerSaving'),
+                  EventPattern('dbus-signal', signal='PowerSavingChanged',
+                               args=[True]))
+    sync_stream(q, stream)
+    assertEquals(['inactive'], states)
+
+    # So presence changes are signalled as usual
+    stream.send(make_presence('amy@foo.com', show='away'))
+    q.expect('dbus-signal', signal='PresencesChanged')
+
+    call_async(q, conn.PowerSaving, 'SetPowerSaving', False)
+    q.expect_many(EventPattern('dbus-return', method='SetPowerSaving'),
+                  EventPattern('dbus-signal', signal='PowerSavingChanged',
+                               args=[False]))
+    sync_stream(q, stream)
+    assertEquals(['inactive', 'active'], states)
+
+    q.unforbid_events(pattern)
+
+STORM_CONTACTS = 20
+STORM_UPDATES = int(os.environ.get('GABBLE_POWER_SAVE_STORM_UPDATES', '25'))
+
+# PresencesChanged signals, without and with power saving
+wakeups = []
+
+def presence_storm(q, bus, conn, stream, power_saving):
+    jids = ['storm%02d@foo.com' % i for i in range(STORM_CONTACTS)]
+    shows = ['away', 'xa', 'dnd', 'chat']
+    signals = []
+
+    bus.add_signal_receiver(lambda *args: signals.append(args),
+        signal_name='PresencesChanged',
+        dbus_interface=cs.CONN_IFACE_SIMPLE_PRESENCE, path=conn.object_path)
+
+    if power_saving:
+        conn.PowerSaving.SetPowerSaving(True)
+
+    for n in range(STORM_UPDATES):
+        for jid in jids:
+            stream.send(make_presence(jid, show=shows[n % len(shows)],
+                                      status='update %d' % n))
+
+        # Something important turns up now and then, flushing Wocky's queue
+        if n % 10 == 9:
+            stream.send(elem('message', from_='foo@bar.com/Pidgin',
+                type='chat')(elem('body')(u'wake up')))
+
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+
+    if power_saving:
+        conn.PowerSaving.SetPowerSaving(False)
+        sync_dbus(bus, q, conn)
+
+    # Everyone ends up with the presence they last sent, whether or not we
+    # heard about every change along the way.
+    last = {}
+    for (presences,) in signals:
+        last.update(presences)
+
+    handles = conn.get_contact_handles_sync(jids)
+    assertEquals(set(handles), set(last.keys()))
+
+    for h in handles:
+        assertEquals(shows[(STORM_UPDATES - 1) % len(shows)], last[h][1])
+        assertEquals('update %d' % (STORM_UPDATES - 1), last[h][2])
+
+    wakeups.append(len(signals))
+
+def test_storm(q, bus, conn, stream):
+    presence_storm(q, bus, conn, stream, False)
+
+def test_storm_power_saving(q, bus, conn, stream):
+    presence_storm(q, bus, conn, stream, True)
+
+    # However often they changed, clients heard about it once, at the end.
+    assertEquals(1, wakeups[-1])
+
 if __name__ == '__main__':
     exec_test(test, protocol=GoogleXmlStream)
     exec_test(test_local_queueing)
     exec_test(test_error, protocol=GoogleXmlStream)
     exec_test(test_disconnect, protocol=GoogleXmlStream)
+    exec_test(test_csi, authenticator=CsiAuthenticator('test', 'pass'))
+    exec_test(test_storm)
+    exec_test(test_storm_power_saving)
+
+    print "%d presence updates: %d PresencesChanged without power saving, " \
+        "%d with" % (STORM_CONTACTS * STORM_UPDATES, wakeups[0], wakeups[1])
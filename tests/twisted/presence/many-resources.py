@@ -0,0 +1,136 @@
+"""
+Test presence and capability aggregation for contacts with a large number of
+resources: the aggregated presence should follow the most preferable resource
+and the aggregated caps should be the union of every resource's caps, however
+resources come and go.
+"""
+
+import time
+
+from gabbletest import exec_test, make_presence, sync_stream
+from servicetest import EventPattern, assertEquals
+import constants as cs
+import ns
+from caps_helper import compute_caps_hash, send_disco_reply
+
+CONTACTS = 4
+RESOURCES = 50
+
+def get_presence(conn, handle):
+    attrs = conn.Contacts.GetContactAttributes([handle],
+        [cs.CONN_IFACE_SIMPLE_PRESENCE], False)
+    return attrs[handle][cs.ATTR_PRESENCE]
+
+def can_send_files(conn, handle):
+    attrs = conn.Contacts.GetContactAttributes([handle],
+        [cs.CONN_IFACE_CONTACT_CAPS], False)
+
+    for fixed, allowed in attrs[handle][cs.ATTR_CONTACT_CAPABILITIES]:
+        if fixed.get(cs.CHANNEL_TYPE) == cs.CHANNEL_TYPE_FILE_TRANSFER:
+            return True
+
+    return False
+
+def resource_jid(bare_jid, i):
+    return '%s/r%d' % (bare_jid, i)
+
+def test_contact(q, bus, conn, stream, n):
+    bare_jid = 'bob%d@example.com' % n
+    handle = conn.get_contact_handle_sync(bare_jid)
+    presences_changed = [EventPattern('dbus-signal', signal='PresencesChanged')]
+
+    # Every resource is equally away, so the first one stays the most
+    # preferable and the aggregated presence doesn't change after it.
+    start = time.time()
+
+    stream.send(make_presence(resource_jid(bare_jid, 0), show='away',
+        status='r0'))
+    q.expect('dbus-signal', signal='PresencesChanged',
+        args=[{handle: (cs.PRESENCE_AWAY, 'away', 'r0')}])
+
+    q.forbid_events(presences_changed)
+
+    for i in range(1, RESOURCES):
+        stream.send(make_presence(resource_jid(bare_jid, i), show='away',
+            status='r%d' % i))
+
+    sync_stream(q, stream)
+    up = time.time() - start
+
+    assertEquals((cs.PRESENCE_AWAY, 'away', 'r0'), get_presence(conn, handle))
+
+    q.unforbid_events(presences_changed)
+
+    # One resource in the middle becomes available, and so wins.
+    stream.send(make_presence(resource_jid(bare_jid, 30), status='here'))
+    q.expect('dbus-signal', signal='PresencesChanged',
+        args=[{handle: (cs.PRESENCE_AVAILABLE, 'available', 'here')}])
+
+    # The last few resources all have the same caps, including file transfer.
+    features = [ns.FILE_TRANSFER]
+    identities = ['client/web/en/Client %d' % n]
+    caps = {
+        'node': 'http://example.com/client',
+        'ver': compute_caps_hash(identities, features, {}),
+        'hash': 'sha-1',
+        }
+
+    for i in range(40, RESOURCES):
+        stream.send(make_presence(resource_jid(bare_jid, i), show='away',
+            status='r%d' % i, caps=caps))
+
+    event = q.expect('stream-iq', query_ns=ns.DISCO_INFO,
+        predicate=lambda e: e.to.startswith(bare_jid + '/'))
+    send_disco_reply(stream, event.stanza, identities, features)
+
+    q.expect('dbus-signal', signal='ContactCapabilitiesChanged',
+        predicate=lambda e: handle in e.args[0])
+    assert can_send_files(conn, handle)
+
+    # Resources other than the most preferable one going away shouldn't
+    # change the aggregated presence.
+    q.forbid_events(presences_changed)
+    start = time.time()
+
+    for i in range(10, 20):
+        stream.send(make_presence(resource_jid(bare_jid, i),
+            type='unavailable'))
+
+    sync_stream(q, stream)
+    churn = time.time() - start
+
+    assertEquals((cs.PRESENCE_AVAILABLE, 'available', 'here'),
+        get_presence(conn, handle))
+
+    # Neither should all but one of the resources with file transfer caps
+    # going away change the aggregated caps.
+    for i in range(40, RESOURCES - 1):
+        stream.send(make_presence(resource_jid(bare_jid, i),
+            type='unavailable'))
+
+    sync_stream(q, stream)
+    assert can_send_files(conn, handle)
+
+    q.unforbid_events(presences_changed)
+
+    # Once the last one goes, nobody can receive files any more.
+    stream.send(make_presence(resource_jid(bare_jid, RESOURCES - 1),
+        type='unavailable'))
+    q.expect('dbus-signal', signal='ContactCapabilitiesChanged',
+        predicate=lambda e: handle in e.args[0])
+    assert not can_send_files(conn, handle)
+
+    # When the winning resource goes away, the best of the rest takes over.
+    stream.send(make_presence(resource_jid(bare_jid, 30), type='unavailable'))
+    q.expect('dbus-signal', signal='PresencesChanged',
+        args=[{handle: (cs.PRESENCE_AWAY, 'away', 'r0')}])
+
+    print "contact %d: %d resources up in %.3fs, 10 left in %.3fs" % (
+        n, RESOURCES, up, churn)
+
+def test(q, bus, conn, stream):
+    for n in range(CONTACTS):
+        test_contact(q, bus, conn, stream, n)
+
+if __name__ == '__main__':
+    exec_test(test)
@@ -0,0 +1,94 @@
+"""
+Test XEP-0237 roster versioning: Gabble should keep the roster it downloaded,
+and on the next connection only receive the changes since then.
+"""
+
+import time
+
+from gabbletest import (
+    exec_test, RosterVersioningAuthenticator, VersionedRoster,
+    )
+from rostertest import check_contact_roster
+from servicetest import assertEquals
+import constants as cs
+import ns
+
+ROSTER_SIZE = 500
+
+roster = VersionedRoster()
+
+for i in range(ROSTER_SIZE):
+    roster.set_item('contact%d@example.com' % i, name='Contact %d' % i,
+        groups=['Group %d' % (i % 10)])
+
+def wait_for_roster(q, stream, expected_ver):
+    event = q.expect('stream-iq', query_ns=ns.ROSTER, iq_type='get')
+    assertEquals(expected_ver, event.query.getAttribute('ver'))
+
+    start = time.time()
+    sent = roster.handle_query(stream, event.stanza)
+    q.expect('dbus-signal', signal='ContactListStateChanged',
+        args=[cs.CONTACT_LIST_STATE_SUCCESS])
+    return start, sent
+
+def check_contacts(conn, expected_ids):
+    attrs = conn.ContactList.GetContactListAttributes([], False)
+    ids = [a[cs.CONN + '/contact-id'] for a in attrs.values()]
+    assertEquals(sorted(expected_ids), sorted(ids))
+
+def test_first_download(q, bus, conn, stream):
+    # We don't have anything stored, but we tell the server we'd like
+    # versioning with an empty ver.
+    start, sent = wait_for_roster(q, stream, '')
+    assertEquals(ROSTER_SIZE, sent)
+
+    check_contacts(conn, roster.items.keys())
+    print "full download: %d items on the wire, %.3fs" % (
+        sent, time.time() - start)
+
+def test_unchanged(q, bus, conn, stream):
+    # We offer the version we stored last time; the server has nothing newer,
+    # so the roster comes entirely from our local store.
+    start, sent = wait_for_roster(q, stream, str(roster.version))
+    assertEquals(0, sent)
+
+    check_contacts(conn, roster.items.keys())
+    check_contact_roster(conn, 'contact42@example.com', ['Group 2'],
+        cs.SUBSCRIPTION_STATE_YES, cs.SUBSCRIPTION_STATE_YES)
+    print "unchanged roster: %d items on the wire, %.3fs" % (
+        sent, time.time() - start)
+
+def test_slightly_changed(q, bus, conn, stream):
+    stored_ver = str(roster.version)
+
+    roster.set_item('newcomer@example.com', subscription='to')
+    roster.remove_item('contact1@example.com')
+    roster.set_item('contact2@example.com', name='Renamed',
+        groups=['Somewhere else'])
+
+    start, sent = wait_for_roster(q, stream, stored_ver)
+    assertEquals(3, sent)
+
+    q.expect('dbus-signal', signal='ContactsChangedWithID',
+        predicate=lambda e: 'newcomer@example.com' in e.args[1].values())
+    q.expect('dbus-signal', signal='ContactsChangedWithID',
+        predicate=lambda e: 'contact1@example.com' in e.args[2].values())
+
+    check_contacts(conn, roster.items.keys())
+    check_contact_roster(conn, 'contact2@example.com', ['Somewhere else'])
+    print "slightly changed roster: %d items on the wire, %.3fs" % (
+        sent, time.time() - start)
+
+def test_pushes_are_stored(q, bus, conn, stream):
+    # The changes we were pushed last time should have made it into the
+    # store along with their version.
+    start, sent = wait_for_roster(q, stream, str(roster.version))
+    assertEquals(0, sent)
+
+    check_contacts(conn, roster.items.keys())
+
+if __name__ == '__main__':
+    for test in [test_first_download, test_unchanged, test_slightly_changed,
+            test_pushes_are_stored]:
+        exec_test(test,
+            authenticator=RosterVersioningAuthenticator('test', 'pass'))
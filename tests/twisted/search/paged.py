@@ -0,0 +1,258 @@
+"""
+Tests Contact Search channels to a simulated XEP-0055 service which pages its
+results with XEP-0059 Result Set Management, including one with very many of
+them: Gabble should pass each page on as soon as it has it.
+"""
+
+import os
+import time
+
+import dbus
+
+from gabbletest import exec_test, sync_stream
+from servicetest import (
+    call_async, make_channel_proxy, EventPattern, assertEquals, sync_dbus,
+    )
+from search_helper import call_create, answer_field_query
+
+import constants as cs
+import ns
+
+from twisted.words.xish import xpath
+
+SERVER = 'jud.localhost'
+
+# Gabble asks for this many results at a time, and passes on no more than
+# this many in each SearchResultReceived, unless the search-page-size
+# parameter says otherwise
+PAGE_SIZE = 100
+
+# Set this to something smaller for a quicker run
+BENCHMARK_RESULTS = int(os.environ.get('GABBLE_SEARCH_BENCHMARK_RESULTS',
+    '20000'))
+
+TERMS = { 'x-n-family': 'Threepwood' }
+
+class DirectoryServer(object):
+    """Plays the part of a user directory with lots of Threepwoods in it"""
+
+    def __init__(self, stream, n_results, rsm=True, page_cap=None, auto=True):
+        self.stream = stream
+        self.jids = ['user%05d@example.com' % i for i in range(n_results)]
+        self.index = dict((jid, i) for i, jid in enumerate(self.jids))
+        self.rsm = rsm
+        self.page_cap = page_cap
+        self.auto = auto
+
+        # (after, max) for each search Gabble sent
+        self.pages = []
+
+        self.xpath = "/iq[@type='set']/query[@xmlns='%s']" % ns.SEARCH
+        stream.addObserver(self.xpath, self.search_cb)
+
+    def close(self):
+        self.stream.removeObserver(self.xpath, self.search_cb)
+
+    def search_cb(self, iq):
+        if iq.getAttribute('to') != SERVER:
+            return
+
+        max_ = xpath.queryForString('/iq/query/set/max', iq)
+        after = xpath.queryForNodes('/iq/query/set/after', iq)
+        after = after and str(after[0]) or None
+        self.pages.append((after, max_ and int(max_) or None))
+
+        if self.auto:
+            self.answer(iq)
+
+    def answer(self, iq):
+        start = 0
+        end = len(self.jids)
+        paged = self.rsm and self.pages[-1][1] is not None
+
+        if paged:
+            after, max_ = self.pages[-1]
+
+            if after is not None:
+                start = self.index[after] + 1
+
+            if self.page_cap is not None:
+                max_ = min(max_, self.page_cap)
+
+            end = min(end, start + max_)
+
+        # There are a lot of these, so we don't bother building them up
+        items = ''.join([
+            '<item jid="%s"><first>User %d</first><last>Threepwood</last>'
+            '<nick>u%d</nick><email>%s</email></item>' % (jid, i, i, jid)
+            for i, jid in enumerate(self.jids[start:end], start)])
+
+        if paged and start < end:
+            items += ('<set xmlns="%s"><first index="%d">%s</first>'
+                '<last>%s</last><count>%d</count></set>' % (ns.RSM, start,
+                    self.jids[start], self.jids[end - 1], len(self.jids)))
+
+        self.stream.send('<iq type="result" id="%s" from="%s">'
+            '<query xmlns="%s">%s</query></iq>' % (
+                iq['id'], SERVER, ns.SEARCH, items))
+
+def create_channel(q, bus, conn, stream):
+    call_create(q, conn, SERVER)
+    ret, _ = answer_field_query(q, stream, SERVER)
+    path, props = ret.value
+
+    c = make_channel_proxy(conn, path, 'Channel')
+    c_props = dbus.Interface(c, cs.PROPERTIES_IFACE)
+    c_search = dbus.Interface(c, cs.CHANNEL_TYPE_CONTACT_SEARCH)
+
+    # (when, how many) for each SearchResultReceived, and everyone we've heard
+    # about
+    batches = []
+    found = set()
+
+    def got_results(results):
+        batches.append((time.time(), len(results)))
+        found.update(results.keys())
+
+    bus.add_signal_receiver(got_results, signal_name='SearchResultReceived',
+        dbus_interface=cs.CHANNEL_TYPE_CONTACT_SEARCH, path=path)
+
+    return c, c_props, c_search, batches, found
+
+def search(q, bus, conn, stream, n_results, **kwargs):
+    server = DirectoryServer(stream, n_results, **kwargs)
+    c, c_props, c_search, batches, found = create_channel(q, bus, conn, stream)
+
+    start = time.time()
+    call_async(q, c_search, 'Search', TERMS)
+    q.expect('dbus-signal', signal='SearchStateChanged',
+        predicate=lambda e: e.args[0] == cs.SEARCH_COMPLETED)
+    elapsed = time.time() - start
+
+    assertEquals(n_results, len(found))
+    assertEquals(n_results, sum([n for _, n in batches]))
+
+    c.Close()
+    q.expect('dbus-signal', signal='Closed')
+    server.close()
+
+    return server, [n for _, n in batches], batches[0][0] - start, elapsed
+
+def test_paging(q, bus, conn, stream):
+    server, sizes, _, _ = search(q, bus, conn, stream, 250)
+
+    assertEquals([(None, PAGE_SIZE), ('user00099@example.com', PAGE_SIZE),
+        ('user00199@example.com', PAGE_SIZE)], server.pages)
+    assertEquals([100, 100, 50], sizes)
+
+    # The server sends fewer results at a time than Gabble asks for, which it's
+    # allowed to do.
+    server, sizes, _, _ = search(q, bus, conn, stream, 250, page_cap=30)
+    assertEquals(9, len(server.pages))
+    assertEquals([30] * 8 + [10], sizes)
+
+def test_page_size_param(q, bus, conn, stream):
+    # This connection was made with search-page-size=40
+    server, sizes, _, _ = search(q, bus, conn, stream, 100)
+    assertEquals([(None, 40), ('user00039@example.com', 40),
+        ('user00079@example.com', 40)], server.pages)
+    assertEquals([40, 40, 20], sizes)
+
+def test_unpaged_param(q, bus, conn, stream):
+    # With search-page-size=0, Gabble asks for everything at once, and passes
+    # it on all together.
+    server, sizes, _, _ = search(q, bus, conn, stream, 250)
+    assertEquals([(None, None)], server.pages)
+    assertEquals([250], sizes)
+
+def test_no_rsm(q, bus, conn, stream):
+    # The server ignores the <set/> and sends everything at once; Gabble still
+    # passes it on a bit at a time.
+    server, sizes, _, _ = search(q, bus, conn, stream, 250, rsm=False)
+    assertEquals(1, len(server.pages))
+    assertEquals([100, 100, 50], sizes)
+
+def test_stop(q, bus, conn, stream):
+    server = DirectoryServer(stream, 1000, auto=False)
+    c, c_props, c_search, batches, found = create_channel(q, bus, conn, stream)
+
+    call_async(q, c_search, 'Search', TERMS)
+    e = q.expect('stream-iq', to=SERVER, query_ns=ns.SEARCH, iq_type='set')
+    server.answer(e.stanza)
+
+    # We get the first page while Gabble asks for the second
+    _, e = q.expect_many(
+        EventPattern('dbus-signal', signal='SearchResultReceived'),
+        EventPattern('stream-iq', to=SERVER, query_ns=ns.SEARCH,
+            iq_type='set'))
+
+    call_async(q, c_search, 'Stop')
+    _, ssc = q.expect_many(
+        EventPattern('dbus-return', method='Stop'),
+        EventPattern('dbus-signal', signal='SearchStateChanged'))
+    assertEquals(cs.SEARCH_FAILED, ssc.args[0])
+    assertEquals(cs.CANCELLED, ssc.args[1])
+
+    # The second page turns up anyway, but Gabble doesn't pass it on or ask
+    # for any more.
+    server.answer(e.stanza)
+    sync_stream(q, stream)
+    sync_stream(q, stream)
+
+    assertEquals(1, len(batches))
+    assertEquals(PAGE_SIZE, len(found))
+    assertEquals(2, len(server.pages))
+
+    state = c_props.Get(cs.CHANNEL_TYPE_CONTACT_SEARCH, 'SearchState')
+    assertEquals(cs.SEARCH_FAILED, state)
+
+    c.Close()
+    q.expect('dbus-signal', signal='Closed')
+
+def test_close_while_paging(q, bus, conn, stream):
+    server = DirectoryServer(stream, 1000, auto=False)
+    c, c_props, c_search, batches, found = create_channel(q, bus, conn, stream)
+
+    call_async(q, c_search, 'Search', TERMS)
+    e = q.expect('stream-iq', to=SERVER, query_ns=ns.SEARCH, iq_type='set')
+
+    # Closing the channel gives up on the page we were waiting for; the
+    # reply turning up afterwards doesn't upset Gabble, and neither does the
+    # search having been cancelled: there's no channel left to fail it on.
+    state_changed = [EventPattern('dbus-signal', signal='SearchStateChanged')]
+    q.forbid_events(state_changed)
+
+    c.Close()
+    q.expect('dbus-signal', signal='Closed')
+
+    server.answer(e.stanza)
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+    q.unforbid_events(state_changed)
+
+    assertEquals([], batches)
+    assertEquals(1, len(server.pages))
+
+def test_benchmark(q, bus, conn, stream):
+    server, sizes, first, elapsed = search(q, bus, conn, stream,
+        BENCHMARK_RESULTS)
+    assertEquals((BENCHMARK_RESULTS + PAGE_SIZE - 1) / PAGE_SIZE,
+        len(server.pages))
+    assertEquals(PAGE_SIZE, sizes[0])
+
+    _, _, unpaged_first, unpaged_elapsed = search(q, bus, conn, stream,
+        BENCHMARK_RESULTS, rsm=False)
+
+    print "%d results: first after %.3fs, all after %.1fs " \
+        "(%.3fs and %.1fs without paging)" % (BENCHMARK_RESULTS,
+            first, elapsed, unpaged_first, unpaged_elapsed)
+
+if __name__ == '__main__':
+    exec_test(test_paging)
+    exec_test(test_page_size_param,
+        params={ 'search-page-size': dbus.UInt32(40) })
+    exec_test(test_unpaged_param, params={ 'search-page-size': dbus.UInt32(0) })
+    exec_test(test_no_rsm)
+    exec_test(test_stop)
+    exec_test(test_close_while_paging)
+    exec_test(test_benchmark)
@@ -66,6 +66,11 @@ def complete_search(q, bus, conn, stream, server):
     query = iq.firstChildElement()
     i = 0
     for field in query.elements():
+        # Gabble asks for the first page of results
+        if field.uri == ns.RSM:
+            assert field.name == 'set', field.toXml()
+            continue
+
         assert field.name == 'last', field.toXml()
         assert field.children[0] == u'Threepwood', field.children[0]
         i += 1
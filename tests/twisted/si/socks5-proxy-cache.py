@@ -0,0 +1,223 @@
+"""
+Test that Gabble remembers the SOCKS5 proxies it has used, and how well they
+worked, from one connection to the next: on a warm start it shouldn't have to
+discover or query them again, and it should offer the ones which got through
+quickest first.
+"""
+
+import socket
+import time
+
+from gabbletest import (
+    exec_test, elem, elem_iq, make_presence, make_result_iq, sync_stream)
+from servicetest import EventPattern, call_async, assertEquals
+from caps_helper import send_disco_reply
+from bytestream import (
+    create_from_si_offer, announce_socks5_proxy, listen_socks5, BytestreamS5B,
+    S5BFactory)
+
+import ns
+import constants as cs
+
+from twisted.words.xish import xpath
+
+from config import FILE_TRANSFER_ENABLED
+
+if not FILE_TRANSFER_ENABLED:
+    print "NOTE: built with --disable-file-transfer"
+    raise SystemExit(77)
+
+SELF_JID = 'test@localhost/Resource'
+ALICE_JID = 'alice@localhost/Test'
+
+# proxy.localhost is announced by our server, and takes its time to answer;
+# these two come from proxies.telepathy.im.
+SLOW_PROXY = 'proxy.localhost'
+FAST_PROXY = 'fast-proxy.localhost'
+BROKEN_PROXY = 'broken-proxy.localhost'
+
+SLOW_DELAY = 0.5
+
+# Our proxies outlive the connections, so they pass their events on to
+# whichever one is running at the time.
+current_q = [None]
+proxy_ports = {}
+offer_times = {}
+
+class BytestreamS5BProxy(BytestreamS5B):
+    """We are the target, and we pick which proxy Gabble is to use"""
+
+    def open_through(self, proxy=None, delay=0):
+        """Tells Gabble that we connected to @proxy (or the first one it
+        offered, if that's None) and plays the part of the proxy. Returns
+        the proxies Gabble offered, in order."""
+        id, mode, sid, hosts = self._expect_socks5_init()
+        assertEquals(self.stream_id, sid)
+        self.offered_at = time.time()
+
+        proxies = [jid for jid, host, port in hosts if jid != self.initiator]
+
+        if proxy is None:
+            proxy = proxies[0]
+
+        self._send_socks5_reply(id, proxy)
+
+        if proxy == BROKEN_PROXY:
+            self.q.expect('dbus-signal', signal='FileTransferStateChanged',
+                predicate=lambda e: e.args[0] == cs.FT_STATE_CANCELLED)
+            return proxies
+
+        self.q.expect('s5b-connected')
+        self._wait_auth_request()
+        time.sleep(delay)
+        self._send_auth_reply()
+        self._wait_connect_cmd()
+        self._send_connect_reply()
+
+        e = self.q.expect('stream-iq', iq_type='set', to=proxy,
+            query_ns=ns.BYTESTREAMS)
+        activate = xpath.queryForNodes('/iq/query/activate', e.stanza)[0]
+        assertEquals(self.target, str(activate))
+        make_result_iq(self.stream, e.stanza).send()
+
+        return proxies
+
+def forward(event):
+    current_q[0].append(event)
+
+def closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def announce_alice(q, stream):
+    caps =  { 'ext': '', 'ver': '0.0.0',
+        'node': 'http://example.com/fake-client0' }
+    stream.send(make_presence(ALICE_JID, caps=caps))
+
+    disco_event = q.expect('stream-iq', to=ALICE_JID, query_ns=ns.DISCO_INFO)
+    send_disco_reply(
+        stream, disco_event.stanza, [], [ns.TUBES, ns.FILE_TRANSFER])
+    sync_stream(q, stream)
+
+def send_file_to_alice(q, conn):
+    call_async(q, conn.Requests, 'CreateChannel', {
+        cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_FILE_TRANSFER,
+        cs.TARGET_HANDLE_TYPE: cs.HT_CONTACT,
+        cs.TARGET_ID: 'alice@localhost',
+        cs.FT_FILENAME: 'test.txt',
+        cs.FT_CONTENT_TYPE: 'text/plain',
+        cs.FT_SIZE: 10})
+
+def expect_file_offer(q):
+    return q.expect_many(
+        EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('stream-iq', to=ALICE_JID,
+            predicate=lambda e: xpath.matches('/iq/si', e.stanza)))[1]
+
+def accept_file(q, stream, e):
+    bytestream, profile = create_from_si_offer(stream, q, BytestreamS5BProxy,
+        e.stanza, SELF_JID)
+    result, si = bytestream.create_si_reply(e.stanza)
+    stream.send(result)
+
+    return bytestream
+
+def answer_proxy_query(stream, iq):
+    jid = iq['to']
+
+    if jid not in proxy_ports:
+        return
+
+    reply = elem_iq(stream, 'result', id=iq['id'], from_=jid)(
+        elem(ns.BYTESTREAMS, 'query')(
+            elem('streamhost', jid=jid, host='127.0.0.1',
+                port=str(proxy_ports[jid]))()))
+    stream.send(reply)
+
+def cold_start(q, bus, conn, stream):
+    current_q[0] = q
+
+    disco_event = q.expect('stream-iq', to='localhost', query_ns=ns.DISCO_ITEMS)
+    announce_socks5_proxy(q, stream, disco_event.stanza)
+    announce_alice(q, stream)
+
+    proxy_ports[FAST_PROXY] = listen_socks5(q, S5BFactory(forward))
+    proxy_ports[BROKEN_PROXY] = closed_port()
+
+    # Gabble asks for our proxies' addresses again every so often; they
+    # haven't moved.
+    stream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % ns.BYTESTREAMS,
+        lambda iq: answer_proxy_query(stream, iq))
+
+    start = time.time()
+    send_file_to_alice(q, conn)
+
+    # We don't know anything yet, so Gabble has to ask for a list of proxies
+    _, si_event, e = q.expect_many(
+        EventPattern('dbus-return', method='CreateChannel'),
+        EventPattern('stream-iq', to=ALICE_JID,
+            predicate=lambda e: xpath.matches('/iq/si', e.stanza)),
+        EventPattern('stream-iq', to='proxies.telepathy.im', iq_type='get',
+            query_ns=ns.DISCO_ITEMS))
+
+    reply = make_result_iq(stream, e.stanza)
+    query = xpath.queryForNodes('/iq/query', reply)[0]
+    for jid in [FAST_PROXY, BROKEN_PROXY]:
+        item = query.addElement((None, 'item'))
+        item['jid'] = jid
+    stream.send(reply)
+
+    # and then ask each of them where they are
+    q.expect_many(
+        EventPattern('stream-iq', to=FAST_PROXY, iq_type='get',
+            query_ns=ns.BYTESTREAMS),
+        EventPattern('stream-iq', to=BROKEN_PROXY, iq_type='get',
+            query_ns=ns.BYTESTREAMS))
+
+    # Use each proxy once
+    bytestream = accept_file(q, stream, si_event)
+    bytestream.open_through(FAST_PROXY)
+    offer_times['cold'] = bytestream.offered_at - start
+
+    send_file_to_alice(q, conn)
+    bytestream = accept_file(q, stream, expect_file_offer(q))
+    bytestream.open_through(SLOW_PROXY, delay=SLOW_DELAY)
+
+    send_file_to_alice(q, conn)
+    bytestream = accept_file(q, stream, expect_file_offer(q))
+    bytestream.open_through(BROKEN_PROXY)
+
+def warm_start(q, bus, conn, stream):
+    current_q[0] = q
+
+    # Gabble doesn't need to discover any proxies
+    q.forbid_events([
+        EventPattern('stream-iq', to='proxies.telepathy.im'),
+        EventPattern('stream-iq', iq_type='get', query_ns=ns.BYTESTREAMS),
+        ])
+
+    # and our server doesn't even announce its own this time
+    disco_event = q.expect('stream-iq', to='localhost', query_ns=ns.DISCO_ITEMS)
+    stream.send(make_result_iq(stream, disco_event.stanza))
+    announce_alice(q, stream)
+
+    start = time.time()
+    send_file_to_alice(q, conn)
+    bytestream = accept_file(q, stream, expect_file_offer(q))
+
+    # The proxy which got through quickest comes first, then the one which
+    # got through slowly, then the one which didn't get through at all; and
+    # the first one works without having been asked where it is.
+    proxies = bytestream.open_through()
+    offer_times['warm'] = bytestream.offered_at - start
+    assertEquals([FAST_PROXY, SLOW_PROXY, BROKEN_PROXY], proxies)
+
+if __name__ == '__main__':
+    exec_test(cold_start)
+    exec_test(warm_start)
+
+    print "proxies offered after %.3fs cold, %.3fs warm" % (
+        offer_times['cold'], offer_times['warm'])
@@ -1,15 +1,25 @@
 """
 Test Gabble's implementation of sidecars, using the test plugin.
+
+Also measures how long it takes to get the gateways plugin's sidecar, which
+means loading the plugin the first time round, and not thereafter.
 """
 
+import time
+
 from servicetest import (
     sync_dbus, call_async, EventPattern, assertEquals, assertContains,
+    assertLength, ProxyWrapper,
     )
 from gabbletest import exec_test, send_error_reply, acknowledge_iq, sync_stream
 import constants as cs
 from config import PLUGINS_ENABLED
 
 TEST_PLUGIN_IFACE = cs.PREFIX + ".Gabble.Plugin.Test"
+GATEWAYS_IFACE = cs.PREFIX + ".Gabble.Plugin.Gateways"
+
+# What the plugin loader says when it loads the gateways plugin
+GATEWAYS_LOADED = "loaded 'Gateway registration plugin'"
 
 if not PLUGINS_ENABLED:
     print "NOTE: built without --enable-plugins, not testing plugins"
@@ -83,6 +93,38 @@ def test(q, bus, conn, stream):
         conn.Sidecars1.EnsureSidecar(TEST_PLUGIN_IFACE + ".IQ")
         sync_stream(q, stream)
 
+        # The gateways plugin's manifest says it has this sidecar, so it isn't
+        # loaded until we ask for it. Gabble only loads each plugin once, so
+        # if it says it's loading it now, it hadn't before.
+        loaded = []
+
+        def new_message(timestamp, domain, level, string):
+            if GATEWAYS_LOADED in string:
+                loaded.append(string)
+
+        debug = ProxyWrapper(bus.get_object(conn.bus_name, cs.DEBUG_PATH),
+            cs.DEBUG_IFACE)
+        debug.connect_to_signal('NewDebugMessage', new_message)
+        debug.Properties.Set(cs.DEBUG_IFACE, 'Enabled', True)
+
+        start = time.time()
+        path, _ = conn.Sidecars1.EnsureSidecar(GATEWAYS_IFACE)
+        first = time.time() - start
+        sync_dbus(bus, q, conn)
+        assertLength(1, loaded)
+
+        start = time.time()
+        path2, _ = conn.Sidecars1.EnsureSidecar(GATEWAYS_IFACE)
+        again = time.time() - start
+        assertEquals(path, path2)
+        sync_dbus(bus, q, conn)
+        assertLength(1, loaded)
+
+        debug.Properties.Set(cs.DEBUG_IFACE, 'Enabled', False)
+
+        print "EnsureSidecar(%s): %.1fms the first time, %.1fms again" % (
+            GATEWAYS_IFACE, first * 1000, again * 1000)
+
         # TODO: test ensuring a sidecar that waits for something from the
         # network, disconnecting while it's waiting, and ensuring that nothing
         # breaks regardless of whether the network replies before
@@ -0,0 +1,359 @@
+"""
+Test flow control with lots of IBB bytestreams carrying the same stream tube:
+however much data they are all given, Gabble should only keep a bounded number
+of IBB stanzas in flight and a bounded amount of data in memory for the whole
+connection, and share the bandwidth fairly between the bytestreams. Also
+test that bytestreams which can't deliver what they're sent hold back their
+acknowledgements, and once the connection's buffers are full ask the peer to
+send the rest again later, rather than going over budget or giving up.
+"""
+
+import base64
+import re
+
+from servicetest import (
+    call_async, EventPattern, sync_dbus, assertEquals, ProxyWrapper,
+    )
+from gabbletest import (
+    exec_test, acknowledge_iq, sync_stream, make_result_iq, elem, elem_iq,
+    )
+import constants as cs
+import ns
+import tubetestutil as t
+from bytestream import BytestreamIBBIQ
+
+from twisted.words.xish import domish, xpath
+
+TUBES = 50
+BLOCK_SIZE = 4096
+BLOCKS_PER_TUBE = 32
+
+# How many bytestreams to fill up; enough that between them they can fill the
+# connection's budget without any one of them reaching its own limit
+BLOCKED_TUBES = 24
+
+# These must match bytestream-budget.h and bytestream-ibb.c
+MAX_IN_FLIGHT = 32
+MAX_BUFFERED = 4 * 1024 * 1024
+WINDOW_SIZE = 10
+READ_BUFFER_MAX_SIZE = 512 * 1024
+
+bob_full_jid = 'bob@localhost/Bob'
+self_full_jid = 'test@localhost/Resource'
+
+def announce_bob(q, bus, stream):
+    event = q.expect('stream-iq', query_ns=ns.ROSTER)
+    event.stanza['type'] = 'result'
+    item = event.query.addElement('item')
+    item['jid'] = 'bob@localhost'
+    item['subscription'] = 'both'
+    stream.send(event.stanza)
+
+    presence = domish.Element(('jabber:client', 'presence'))
+    presence['from'] = bob_full_jid
+    presence['to'] = self_full_jid
+    c = presence.addElement('c')
+    c['xmlns'] = 'http://jabber.org/protocol/caps'
+    c['node'] = 'http://example.com/ICantBelieveItsNotTelepathy'
+    c['ver'] = '1.2.3'
+    stream.send(presence)
+
+    event = q.expect('stream-iq', iq_type='get', query_ns=ns.DISCO_INFO,
+        to=bob_full_jid)
+    result = make_result_iq(stream, event.stanza)
+    feature = result.firstChildElement().addElement('feature')
+    feature['var'] = ns.TUBES
+    stream.send(result)
+
+    sync_stream(q, stream)
+
+def offer_tube(q, bus, conn, address):
+    bob_handle = conn.get_contact_handle_sync('bob@localhost')
+
+    path, _ = conn.Requests.CreateChannel({
+        cs.CHANNEL_TYPE: cs.CHANNEL_TYPE_STREAM_TUBE,
+        cs.TARGET_HANDLE_TYPE: cs.HT_CONTACT,
+        cs.TARGET_HANDLE: bob_handle,
+        cs.STREAM_TUBE_SERVICE: 'echo',
+        })
+    tube_chan = bus.get_object(conn.bus_name, path)
+
+    call_async(q, tube_chan, 'Offer', cs.SOCKET_ADDRESS_TYPE_UNIX, address,
+        cs.SOCKET_ACCESS_CONTROL_LOCALHOST, {},
+        dbus_interface=cs.CHANNEL_TYPE_STREAM_TUBE)
+
+    e = q.expect('stream-message', to=bob_full_jid)
+    tube = xpath.queryForNodes('/message/tube[@xmlns="%s"]' % ns.TUBES,
+        e.stanza)[0]
+    return tube['id']
+
+def get_usage(conn):
+    """Returns {stream name: (bytes buffered, stanzas in flight)}"""
+    usage = conn.Get(cs.CONN_IFACE_GABBLE_DEBUG, 'BytestreamUsage',
+        dbus_interface=cs.PROPERTIES_IFACE)
+    return dict((name, (buffered, in_flight))
+        for name, buffered, in_flight in usage)
+
+class RecordingIBB(BytestreamIBBIQ):
+    """Remembers the ids of the data IQs it sends, in ids"""
+    def __init__(self, *args):
+        BytestreamIBBIQ.__init__(self, *args)
+        self.ids = set()
+
+    def _send(self, from_, to, data):
+        iq = elem_iq(self.stream, 'set', from_=from_, to=to)(
+            elem('data', xmlns=ns.IBB, sid=self.stream_id, seq=str(self.seq))(
+                unicode(base64.b64encode(data))))
+        self.ids.add(iq['id'])
+        self.stream.send(iq)
+
+def connect_bytestream(q, stream, tube_id, i, cls=BytestreamIBBIQ):
+    bytestream = cls(stream, q, 'ibb%d' % i, bob_full_jid, self_full_jid,
+        True)
+    bytestream.block_size = BLOCK_SIZE
+
+    iq, si = bytestream.create_si_offer(ns.TUBES)
+    stream_node = si.addElement((ns.TUBES, 'stream'))
+    stream_node['tube'] = tube_id
+    stream.send(iq)
+
+    si_reply_event, _, socket_event = q.expect_many(
+        EventPattern('stream-iq', iq_type='result', to=bob_full_jid,
+            predicate=lambda e: e.stanza['id'] == iq['id']),
+        EventPattern('dbus-signal', signal='NewRemoteConnection'),
+        EventPattern('socket-connected'))
+    bytestream.check_si_reply(si_reply_event.stanza)
+    bytestream.open_bytestream()
+
+    return bytestream, socket_event.protocol
+
+def test(q, bus, conn, stream):
+    buffered = []
+    pattern = re.compile(r'(\d+) bytes buffered by the connection')
+
+    def new_message(timestamp, domain, level, string):
+        m = pattern.search(string)
+        if m is not None:
+            buffered.append(int(m.group(1)))
+
+    debug = ProxyWrapper(bus.get_object(conn.bus_name, cs.DEBUG_PATH),
+            cs.DEBUG_IFACE)
+    debug.connect_to_signal('NewDebugMessage', new_message)
+    debug.Properties.Set(cs.DEBUG_IFACE, 'Enabled', True)
+
+    address = t.set_up_echo(q, cs.SOCKET_ADDRESS_TYPE_UNIX)
+    announce_bob(q, bus, stream)
+    tube_id = offer_tube(q, bus, conn, address)
+
+    bytestreams = [connect_bytestream(q, stream, tube_id, i)[0]
+        for i in range(TUBES)]
+    sync_stream(q, stream)
+
+    # Everyone sends their data at once. Gabble hands it all to the echo
+    # server, which sends it straight back for Gabble to send to us; but we
+    # don't acknowledge any of it yet.
+    block = 'X' * BLOCK_SIZE
+
+    for _ in range(BLOCKS_PER_TUBE):
+        for bytestream in bytestreams:
+            bytestream.send_data(block)
+
+    unacked = []
+    received = dict((b.stream_id, '') for b in bytestreams)
+
+    # Gabble might send the next stanza at any point after we acknowledge one,
+    # so collect them as they come rather than expecting them one by one.
+    def got_iq(iq):
+        data = xpath.queryForNodes('/iq/data[@xmlns="%s"]' % ns.IBB, iq)
+        if iq['type'] != 'set' or data is None:
+            return
+
+        received[data[0]['sid']] += base64.b64decode(str(data[0]))
+        unacked.append(iq)
+
+    def check_in_flight():
+        assert len(unacked) <= MAX_IN_FLIGHT, len(unacked)
+
+        per_stream = {}
+        for iq in unacked:
+            sid = xpath.queryForNodes('/iq/data', iq)[0]['sid']
+            per_stream[sid] = per_stream.get(sid, 0) + 1
+
+        if per_stream:
+            assert max(per_stream.values()) <= WINDOW_SIZE, per_stream
+
+    def got():
+        return sum(len(data) for data in received.values())
+
+    stream.addObserver('/iq/data', got_iq)
+
+    # The connection's whole allowance of stanzas goes out, and then nothing
+    # more until we acknowledge some.
+    while len(unacked) < MAX_IN_FLIGHT:
+        sync_stream(q, stream)
+
+    sync_dbus(bus, q, conn)
+    sync_stream(q, stream)
+    check_in_flight()
+    assertEquals(MAX_IN_FLIGHT, len(unacked))
+
+    # The debug interface agrees, stream by stream
+    usage = get_usage(conn)
+    assertEquals(sorted('IBB %s' % b.stream_id for b in bytestreams),
+        sorted(usage.keys()))
+    assertEquals(MAX_IN_FLIGHT,
+        sum(in_flight for _, in_flight in usage.values()))
+    assert sum(buffered for buffered, _ in usage.values()) <= MAX_BUFFERED, \
+        usage
+
+    # Now acknowledge them one at a time: every acknowledgement lets one more
+    # stanza out, from whichever bytestream has been waiting longest.
+    total = TUBES * BLOCKS_PER_TUBE * BLOCK_SIZE
+    checked_fairness = False
+
+    while got() < total or unacked:
+        if unacked:
+            acknowledge_iq(stream, unacked.pop(0))
+
+        sync_stream(q, stream)
+        check_in_flight()
+
+        if not checked_fairness and got() >= total / 2:
+            # nobody has been left far behind
+            least = min(len(data) for data in received.values())
+            assert least >= total / TUBES / 4, (least, total)
+            checked_fairness = True
+
+    stream.removeObserver('/iq/data', got_iq)
+
+    for data in received.values():
+        assertEquals(block.lower() * BLOCKS_PER_TUBE, data)
+
+    sync_dbus(bus, q, conn)
+
+    assert buffered, "no buffering was reported"
+    assert max(buffered) <= MAX_BUFFERED, max(buffered)
+
+    print "%d IBB tubes: at most %d bytes buffered by the connection" % (
+        TUBES, max(buffered))
+
+    # Everything has been delivered and acknowledged
+    for buffered, in_flight in get_usage(conn).values():
+        assertEquals((0, 0), (buffered, in_flight))
+
+    t.cleanup()
+
+def test_blocked(q, bus, conn, stream):
+    # Nobody reads what Gabble writes to these sockets, so once the kernel's
+    # buffers are full Gabble has to keep what it's sent.
+    address = t.create_server(q, cs.SOCKET_ADDRESS_TYPE_UNIX,
+        block_reading=True)
+    announce_bob(q, bus, stream)
+    tube_id = offer_tube(q, bus, conn, address)
+
+    connected = [connect_bytestream(q, stream, tube_id, i, RecordingIBB)
+        for i in range(BLOCKED_TUBES)]
+    bytestreams = [bytestream for bytestream, _ in connected]
+    protocols = [protocol for _, protocol in connected]
+    sync_stream(q, stream)
+
+    # id → the reply to each of our data IQs
+    replies = {}
+    closes = []
+
+    def got_reply(iq):
+        if (iq['type'] in ('result', 'error') and
+                iq.getAttribute('to') == bob_full_jid):
+            replies[iq['id']] = iq
+
+    stream.addObserver('/iq', got_reply)
+    stream.addObserver('/iq/close', closes.append)
+
+    def refused():
+        """Returns the ids of data IQs Gabble asked us to send again, with
+        the bytestreams they were sent on"""
+        ret = []
+
+        for bytestream in bytestreams:
+            for id in bytestream.ids:
+                if id in replies and replies[id]['type'] == 'error':
+                    ret.append((id, bytestream))
+
+        return ret
+
+    def total_buffered():
+        return sum(buffered for buffered, _ in get_usage(conn).values())
+
+    block = 'X' * BLOCK_SIZE
+    blocks = 0
+
+    # Keep sending until Gabble starts refusing data, and then some more;
+    # the connection never holds more than its budget.
+    for _ in range(READ_BUFFER_MAX_SIZE / BLOCK_SIZE - 1):
+        for bytestream in bytestreams:
+            bytestream.send_data(block)
+            blocks += 1
+
+        sync_stream(q, stream)
+        assert total_buffered() <= MAX_BUFFERED, get_usage(conn)
+
+        if len(refused()) >= BLOCKED_TUBES:
+            break
+    else:
+        assert False, get_usage(conn)
+
+    # Gabble asked for the data it couldn't keep to be sent again later,
+    # without closing any of the bytestreams; and it hasn't acknowledged
+    # what it kept, so the peer knows not to send any more yet.
+    sync_dbus(bus, q, conn)
+    sync_stream(q, stream)
+    assertEquals([], closes)
+
+    for id, _ in refused():
+        error = xpath.queryForNodes('/iq/error', replies[id])[0]
+        assertEquals('wait', error['type'])
+        assert xpath.queryForNodes('/error/resource-constraint[@xmlns="%s"]'
+            % ns.STANZA, error), error.toXml()
+
+    assert len(replies) < sum(len(b.ids) for b in bytestreams), replies
+
+    # Once the other ends start reading, what Gabble kept gets through and
+    # is acknowledged, and so does whatever we send again.
+    for protocol in protocols:
+        protocol.transport.startReading()
+
+    delivered = 0
+    retried = set()
+
+    while True:
+        sync_stream(q, stream)
+
+        for id, bytestream in refused():
+            if id not in retried:
+                retried.add(id)
+                bytestream.send_data(block)
+
+        unanswered = [id for b in bytestreams for id in b.ids
+            if id not in replies]
+
+        if not unanswered and len(retried) == len(refused()):
+            break
+
+    while delivered < blocks * BLOCK_SIZE:
+        e = q.expect('socket-data')
+        delivered += len(e.data)
+
+    assertEquals(blocks * BLOCK_SIZE, delivered)
+    assertEquals([], closes)
+
+    stream.removeObserver('/iq', got_reply)
+    stream.removeObserver('/iq/close', closes.append)
+
+    for buffered, in_flight in get_usage(conn).values():
+        assertEquals((0, 0), (buffered, in_flight))
+
+    t.cleanup()
+
+if __name__ == '__main__':
+    exec_test(test)
+    exec_test(test_blocked)
@@ -1,5 +1,7 @@
 """Test 1-1 tubes support."""
 
+import os
+
 import dbus
 
 from servicetest import call_async, EventPattern, sync_dbus, assertEquals
@@ -7,6 +9,7 @@ from gabbletest import acknowledge_iq, sync_stream, make_result_iq
 import constants as cs
 import ns
 import tubetestutil as t
+from bytestream import BytestreamS5B
 
 from twisted.words.xish import domish, xpath
 
@@ -24,6 +27,13 @@ new_sample_parameters = dbus.Dictionary({
     'i': dbus.Int32(-123),
     }, signature='sv')
 
+# How much data to push through a tube to gauge its throughput; set
+# GABBLE_TUBE_BENCHMARK_MB=1024 for a meaningful figure. The relayed variants
+# only need to show they're still forwarded correctly, so never get more than
+# 16 MB.
+THROUGHPUT_MB = int(os.environ.get('GABBLE_TUBE_BENCHMARK_MB', '4'))
+RELAYED_THROUGHPUT_MB = min(THROUGHPUT_MB, 16)
+
 def contact_offer_dbus_tube(bytestream, tube_id):
     iq, si = bytestream.create_si_offer(ns.TUBES)
 
@@ -268,6 +278,25 @@ def test(q, bus, conn, stream, bytestream_cls,
     binary = bytestream1.get_data(len(data))
     assert binary == data, binary
 
+    # Bulk data only goes straight from socket to socket with SOCKS5 (where
+    # Gabble splices the two together); other bytestreams are far too slow
+    # for this to be worth measuring.
+    if isinstance(bytestream1, BytestreamS5B):
+        if bytestream_cls is BytestreamS5B:
+            megabytes = THROUGHPUT_MB
+        else:
+            megabytes = RELAYED_THROUGHPUT_MB
+
+        elapsed, syscalls = t.measure_echo_throughput(q, bus, conn,
+            bytestream1, megabytes)
+
+        if syscalls is None:
+            syscalls = float('nan')
+
+        print "%s over %s: %d MB echoed in %.2fs (%.1f MB/s), " \
+            "%.1f syscalls/MB" % (bytestream_cls.__name__, address_type,
+            megabytes, elapsed, megabytes / elapsed, syscalls)
+
     # have the fake client open the stream
     bytestream2.open_bytestream()
 
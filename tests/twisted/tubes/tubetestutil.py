@@ -7,6 +7,7 @@ import os
 import socket
 import sys
 import tempfile
+import time
 
 import dbus
 
@@ -234,6 +235,61 @@ def set_up_echo(q, address_type, block_reading=False, streamfile='stream'):
     factory = EchoFactory(q, block_reading)
     return create_server(q, address_type, factory, streamfile=streamfile)
 
+def gabble_io_syscalls(bus, conn):
+    """
+    Returns how many read and write system calls Gabble has made so far, or
+    None if we can't tell (because we're not on Linux, for instance).
+    """
+    dbus_daemon = dbus.Interface(bus.get_object('org.freedesktop.DBus',
+        '/org/freedesktop/DBus'), 'org.freedesktop.DBus')
+    pid = dbus_daemon.GetConnectionUnixProcessID(conn.object.bus_name)
+
+    try:
+        counts = {}
+        for line in open('/proc/%d/io' % pid):
+            key, value = line.split(':')
+            counts[key] = int(value)
+
+        return counts['syscr'] + counts['syscw']
+    except (IOError, KeyError, ValueError):
+        return None
+
+MEGABYTE = 1024 * 1024
+
+def measure_echo_throughput(q, bus, conn, bytestream, megabytes, window=4):
+    """
+    Pushes @megabytes MB through @bytestream, which must be open and carrying
+    a tube to an Echo server, and checks that it all comes back, with at most
+    @window MB in flight at once. Returns the time it took and how many read
+    and write system calls Gabble made per MB, or None if we can't tell.
+    """
+    chunk = 'X' * MEGABYTE
+    total = megabytes * MEGABYTE
+    sent = 0
+    received = 0
+
+    syscalls_before = gabble_io_syscalls(bus, conn)
+    start = time.time()
+
+    while received < total:
+        while sent < total and sent - received < window * MEGABYTE:
+            bytestream.send_data(chunk)
+            sent += len(chunk)
+
+        e = q.expect('s5b-data-received', transport=bytestream.transport)
+        assert e.data.count('x') == len(e.data)
+        received += len(e.data)
+
+    elapsed = time.time() - start
+    syscalls_after = gabble_io_syscalls(bus, conn)
+
+    assertEquals(total, received)
+
+    if syscalls_before is None or syscalls_after is None:
+        return elapsed, None
+
+    return elapsed, float(syscalls_after - syscalls_before) / megabytes
+
 # Twisted doesn't set the REUSEADDR option on client sockets.
 # As we need this option to be able to bind successively on the same port
 # during the tests, we define our own client and connector to be able to set
@@ -0,0 +1,143 @@
+"""
+Test RequestAvatars for lots of contacts at once: contacts advertising the
+same avatar should only cost one vCard fetch between them, avatars we've
+already seen shouldn't be fetched again, and Gabble shouldn't fill the
+request pipeline with vCard requests.
+"""
+
+import base64
+import hashlib
+import time
+
+from servicetest import EventPattern, sync_dbus, assertEquals
+from gabbletest import (exec_test, acknowledge_iq, make_result_iq,
+    sync_stream, make_presence)
+import ns
+
+CONTACTS = 60
+AVATARS = 3
+
+# Gabble's limit on vCard fetches in flight for RequestAvatars
+MAX_FETCHES = 4
+
+vcard_request = EventPattern('stream-iq', query_ns=ns.VCARD_TEMP,
+    query_name='vCard')
+
+def avatar_data(i):
+    return 'avatar %d' % i
+
+def avatar_token(i):
+    return hashlib.sha1(avatar_data(i)).hexdigest()
+
+def send_vcard(stream, iq, data):
+    result = make_result_iq(stream, iq)
+    vcard = result.firstChildElement()
+    photo = vcard.addElement('PHOTO')
+    photo.addElement('TYPE', content='image/png')
+    photo.addElement('BINVAL', content=base64.b64encode(data))
+    stream.send(result)
+
+def expect_avatars(q, n):
+    retrieved = {}
+
+    for _ in range(n):
+        e = q.expect('dbus-signal', signal='AvatarRetrieved')
+        handle, token, data, mime_type = e.args
+        assert handle not in retrieved, handle
+        assertEquals(hashlib.sha1(''.join(data)).hexdigest(), token)
+        assertEquals('image/png', mime_type)
+        retrieved[handle] = token
+
+    return retrieved
+
+def test(q, bus, conn, stream):
+    event = q.expect('stream-iq', to=None, query_ns=ns.VCARD_TEMP,
+        query_name='vCard')
+    acknowledge_iq(stream, event.stanza)
+
+    jids = ['contact%d@example.com' % i for i in range(CONTACTS)]
+    handles = conn.get_contact_handles_sync(jids)
+
+    for i, jid in enumerate(jids):
+        stream.send(make_presence(jid + '/Resource', show='away',
+            photo=avatar_token(i % AVATARS)))
+
+    sync_stream(q, stream)
+    sync_dbus(bus, q, conn)
+
+    # Only the first contact with each avatar has its vCard fetched; everyone
+    # else with the same avatar gets it too.
+    start = time.time()
+    conn.Avatars.RequestAvatars(handles)
+
+    for _ in range(AVATARS):
+        event = q.expect('stream-iq', query_ns=ns.VCARD_TEMP,
+            query_name='vCard')
+        i = jids.index(event.to)
+        assert i < AVATARS, event.to
+        send_vcard(stream, event.stanza, avatar_data(i))
+
+    q.forbid_events([vcard_request])
+    retrieved = expect_avatars(q, CONTACTS)
+    elapsed = time.time() - start
+
+    for i, h in enumerate(handles):
+        assertEquals(avatar_token(i % AVATARS), retrieved[h])
+
+    # Asking again, or about someone else with an avatar we've seen, doesn't
+    # need any more vCards.
+    late_jid = 'late@example.com'
+    late = conn.get_contact_handle_sync(late_jid)
+    stream.send(make_presence(late_jid + '/Resource',
+        photo=avatar_token(0)))
+    sync_stream(q, stream)
+
+    conn.Avatars.RequestAvatars([late] + handles[:10])
+    retrieved = expect_avatars(q, 11)
+    assertEquals(avatar_token(0), retrieved[late])
+
+    sync_stream(q, stream)
+    q.unforbid_events([vcard_request])
+
+    # Contacts we know nothing about are fetched individually, but only a
+    # few at a time.
+    unknown_jids = ['unknown%d@example.com' % i for i in range(10)]
+    unknown = conn.get_contact_handles_sync(unknown_jids)
+    conn.Avatars.RequestAvatars(unknown)
+
+    iqs = []
+
+    for _ in range(MAX_FETCHES):
+        iqs.append(q.expect('stream-iq', query_ns=ns.VCARD_TEMP,
+            query_name='vCard'))
+
+    q.forbid_events([vcard_request])
+    sync_stream(q, stream)
+    q.unforbid_events([vcard_request])
+
+    # Each answer lets another request in.
+    retrieved = {}
+
+    while iqs:
+        event = iqs.pop(0)
+        i = unknown_jids.index(event.to)
+        send_vcard(stream, event.stanza, avatar_data(100 + i))
+
+        patterns = [EventPattern('dbus-signal', signal='AvatarRetrieved',
+            predicate=lambda e, h=unknown[i]: e.args[0] == h)]
+
+        if len(retrieved) + len(iqs) + 1 < len(unknown):
+            patterns.append(vcard_request)
+
+        events = q.expect_many(*patterns)
+        retrieved[unknown[i]] = events[0].args[1]
+        iqs.extend(events[1:])
+
+    for i, h in enumerate(unknown):
+        assertEquals(avatar_token(100 + i), retrieved[h])
+
+    print "%d contacts, %d avatars: retrieved in %.3fs" % (
+        CONTACTS, AVATARS, elapsed)
+
+if __name__ == '__main__':
+    exec_test(test)